@@ -0,0 +1,88 @@
+# -*- coding: UTF-8 -*-
+"""
+Measures the peak memory used while exporting 1,000 to 50,000 ESRS instances
+from a fake vCenter that returns them one page at a time, like the
+PropertyCollector does.
+
+Usage::
+
+    python benchmarks/bench_export_memory.py [--users 500]
+"""
+import os
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+from unittest.mock import patch, MagicMock
+
+import ujson
+
+from vlab_esrs_api.lib import exports
+from vlab_esrs_api.lib.worker import export
+
+ANNOTATION = ujson.dumps({'component': 'ESRS', 'version': '3.28', 'created': 1560000000,
+                          'configured': False, 'generation': 1})
+
+
+class FakeObject(object):
+    """Stands in for a managed object"""
+    def __init__(self, moid):
+        self._moId = moid
+
+
+def fake_inventory(vm_count, users):
+    """Make a fake inventory.retrieve that builds VMs lazily"""
+    top = FakeObject('group-top')
+    folders = [FakeObject('group-{}'.format(x)) for x in range(users)]
+    host = FakeObject('host-1')
+    datastore = FakeObject('datastore-1')
+
+    def retrieve(vcenter, vimtype, properties, container=None):
+        if vimtype is export.vim.Folder:
+            return ((x, {'name': 'user{}'.format(idx), 'parent': top}) for idx, x in enumerate(folders))
+        elif vimtype is export.vim.HostSystem:
+            return iter([(host, {'name': 'esxi01'})])
+        elif vimtype is export.vim.Datastore:
+            return iter([(datastore, {'name': 'VM-Storage'})])
+        elif vimtype is export.vim.Network:
+            return iter([])
+        return ((FakeObject('vm-{}'.format(x)), {'name': 'esrs{}'.format(x),
+                                                 'parent': folders[x % users],
+                                                 'config.annotation': ANNOTATION,
+                                                 'runtime.powerState': 'poweredOn',
+                                                 'runtime.host': host,
+                                                 'datastore': [datastore]})
+                for x in range(vm_count))
+    vcenter = MagicMock()
+    vcenter.get_by_name.return_value = top
+    return vcenter, retrieve
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--users', type=int, default=500)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    try:
+        print('{:>8}{:>16}{:>14}'.format('VMs', 'peak KB', 'export KB'))
+        for vm_count in (1000, 10000, 50000):
+            vcenter, retrieve = fake_inventory(vm_count, args.users)
+            with patch.object(export.inventory, 'retrieve', retrieve), \
+                 patch.object(exports, 'const', MagicMock(VLAB_ESRS_EXPORT_DIR=workdir)):
+                tracemalloc.start()
+                with exports.ExportWriter('bench-{}'.format(vm_count)) as writer:
+                    for count, record in enumerate(export.records(vcenter, 'vc1'), 1):
+                        writer.write(record)
+                        if not count % export.FLUSH_EVERY:
+                            writer.flush()
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                size = os.path.getsize(exports.path_for('bench-{}'.format(vm_count)))
+            print('{:>8}{:>16.1f}{:>14.1f}'.format(vm_count, peak / 1024, size / 1024))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
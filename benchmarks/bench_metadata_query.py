@@ -0,0 +1,79 @@
+# -*- coding: UTF-8 -*-
+"""
+Measures filtered lookups against the local metadata index, with a fake fleet
+of 50,000 ESRS instances owned by 1,000 users.
+
+Usage::
+
+    python benchmarks/bench_metadata_query.py [--vms 50000] [--users 1000] [--queries 200]
+"""
+import os
+import time
+import random
+import argparse
+import tempfile
+
+from vlab_esrs_api.lib import metadata
+
+VERSIONS = ['3.24', '3.26', '3.28', '3.30', '3.32']
+
+
+def fleet(vms, users):
+    """Make up the metadata of a fleet of ESRS instances"""
+    now = time.time()
+    for x in range(vms):
+        yield {'owner': 'user{}'.format(x % users),
+               'name': 'esrs{}'.format(x),
+               'vcenter': 'vc{}'.format(x % 3),
+               'version': random.choice(VERSIONS),
+               'created': now - random.uniform(0, 365 * 86400),
+               'state': random.choice(['poweredOn', 'poweredOff']),
+               'networks': ['frontend']}
+
+
+def timed(queries, func):
+    """Run some queries
+
+    :Returns: Tuple - (milliseconds per query, the average number of results)
+    """
+    found = 0
+    start = time.perf_counter()
+    for args in queries:
+        found += len(func(**args))
+    elapsed = time.perf_counter() - start
+    return elapsed * 1000 / len(queries), found / len(queries)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--vms', type=int, default=50000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--queries', type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        index = metadata.MetadataIndex(os.path.join(workdir, 'metadata.db'))
+        start = time.perf_counter()
+        index.reconcile('vc0', fleet(args.vms, args.users))
+        load_seconds = time.perf_counter() - start
+        reader = metadata.MetadataIndex(index.path, read_only=True)
+
+        year_ago = time.time() - 365 * 86400
+        cases = [
+            ('owner', [{'owner': 'user{}'.format(random.randrange(args.users))} for _ in range(args.queries)]),
+            ('version, limit 100', [{'version': random.choice(VERSIONS), 'limit': 100} for _ in range(args.queries)]),
+            ('created before, limit 100', [{'created_before': year_ago + random.uniform(0, 30 * 86400), 'limit': 100}
+                                           for _ in range(args.queries)]),
+            ('owner + version', [{'owner': 'user{}'.format(random.randrange(args.users)),
+                                  'version': random.choice(VERSIONS)} for _ in range(args.queries)]),
+        ]
+
+        print('{} ESRS instances, {} users; reconciled in {:.2f}s'.format(args.vms, args.users, load_seconds))
+        print('{:<32}{:>12}{:>12}'.format('', 'ms/query', 'results'))
+        for label, queries in cases:
+            millis, found = timed(queries, reader.query)
+            print('{:<32}{:>12.3f}{:>12.1f}'.format(label, millis, found))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+# -*- coding: UTF-8 -*-
+"""
+Compares resolving a network by enumerating every port group (what
+``vcenter.networks[name]`` does) to looking it up in the NetworkIndex, with a
+fake inventory of 10,000 networks.
+
+Each simulated round trip to vCenter costs ``--rtt`` milliseconds, and each
+network object read costs ``--per-object`` milliseconds.
+
+Usage::
+
+    python benchmarks/bench_network_index.py [--networks 10000] [--lookups 100]
+"""
+import time
+import random
+import argparse
+from unittest.mock import MagicMock
+
+from vlab_esrs_api.lib.worker import network_index
+
+
+class FakeNetwork(object):
+    """Stands in for a vim.Network"""
+    def __init__(self, moId, stub=None):
+        self._moId = moId
+        self._stub = stub
+
+
+class FakeInventory(object):
+    """A vCenter with lots of networks, and a configurable cost per call"""
+    def __init__(self, count, rtt, per_object):
+        self.networks = {'user{}_frontend'.format(x): FakeNetwork('network-{}'.format(x)) for x in range(count)}
+        self.rtt = rtt
+        self.per_object = per_object
+        self.calls = 0
+
+    def _cost(self, objects):
+        self.calls += 1
+        time.sleep(self.rtt + self.per_object * objects)
+
+    def enumerate(self, vcenter=None):
+        """Like vcenter.networks; every network, every time"""
+        self._cost(len(self.networks))
+        return dict(self.networks)
+
+    def find(self, vcenter, name):
+        """Like SearchIndex.FindChild; a single round trip"""
+        self._cost(1)
+        return self.networks.get(name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--networks', type=int, default=10000)
+    parser.add_argument('--lookups', type=int, default=100)
+    parser.add_argument('--rtt', type=float, default=2.0, help='milliseconds per call to vCenter')
+    parser.add_argument('--per-object', type=float, default=0.01, help='milliseconds per object returned')
+    args = parser.parse_args()
+
+    inventory = FakeInventory(args.networks, args.rtt / 1000, args.per_object / 1000)
+    names = random.sample(list(inventory.networks), args.lookups)
+    vcenter = MagicMock()
+
+    start = time.perf_counter()
+    for name in names:
+        inventory.enumerate()[name]
+    enumerate_seconds = time.perf_counter() - start
+    enumerate_calls, inventory.calls = inventory.calls, 0
+
+    index = network_index.NetworkIndex(ttl=300, fetch_all=inventory.enumerate, fetch_one=inventory.find)
+    start = time.perf_counter()
+    index.lookup(vcenter, names[0])
+    cold_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    for name in names:
+        index.lookup(vcenter, name)
+    warm_seconds = time.perf_counter() - start
+    index_calls, inventory.calls = inventory.calls, 0
+
+    new_name = 'user{}_frontend'.format(args.networks)
+    inventory.networks[new_name] = FakeNetwork('network-new')
+    start = time.perf_counter()
+    index.lookup(vcenter, new_name)
+    miss_seconds = time.perf_counter() - start
+
+    print('{} networks, {} lookups'.format(args.networks, args.lookups))
+    print('{:<32}{:>12}{:>14}'.format('', 'ms/lookup', 'vCenter calls'))
+    print('{:<32}{:>12.3f}{:>14}'.format('enumerate every lookup', enumerate_seconds * 1000 / args.lookups, enumerate_calls))
+    print('{:<32}{:>12.3f}{:>14}'.format('index, first lookup', cold_seconds * 1000, 1))
+    print('{:<32}{:>12.3f}{:>14}'.format('index, warm', warm_seconds * 1000 / args.lookups, index_calls - 1))
+    print('{:<32}{:>12.3f}{:>14}'.format('index, miss on new network', miss_seconds * 1000, inventory.calls))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+# -*- coding: UTF-8 -*-
+"""
+Compares the JSON task results Celery sends by default to the msgpack
+encoding in ``vlab_esrs_api.lib.encoding``, for esrs.show results of 10, 100
+and 1,000 VMs.
+
+The VMs have realistic fields, including the long console URL that
+``get_info`` returns for every VM.
+
+Usage::
+
+    python benchmarks/bench_result_encoding.py [--rounds 200] [--threshold 4096]
+"""
+import json
+import time
+import argparse
+
+from vlab_esrs_api.lib import encoding
+
+CONSOLE = ('https://vcenter.vlab.local/ui/webconsole.html?vmId=vm-{0}&vmName=esrs{0}&'
+           'serverGuid=2a9c5d4e-6f7b-4c8d-9e0f-1a2b3c4d5e6f&locale=en_US&host=vcenter.vlab.local&'
+           'sessionTicket=cst-VCT-52a1b2c3-d4e5-f6a7-b8c9-d0e1f2a3b4c5--tp-12-34-56-78-90-AB-CD-EF-'
+           '12-34-56-78-90-AB-CD-EF-12-34-56-78&thumbprint=12:34:56:78:90:AB:CD:EF:12:34:56:78:90:AB:CD:EF:{0:04X}')
+
+
+def make_result(vm_count):
+    """An esrs.show result for a user with lots of VMs"""
+    content = {}
+    for idx in range(vm_count):
+        content['esrs{}'.format(idx)] = {'state': 'poweredOn' if idx % 3 else 'poweredOff',
+                                         'console': CONSOLE.format(idx),
+                                         'ips': ['10.{}.{}.{}'.format(idx // 65536, idx // 256 % 256, idx % 256),
+                                                 '2001:db8::{:x}'.format(idx)],
+                                         'networks': ['frontend'],
+                                         'moid': 'vm-{}'.format(1000 + idx),
+                                         'meta': {'component': 'ESRS',
+                                                  'created': 1560000000 + idx,
+                                                  'version': '3.28',
+                                                  'configured': False,
+                                                  'generation': 1}}
+    return {'content': content, 'error': None, 'params': {}}
+
+
+def measure(encode, decode, data, rounds):
+    """Time encoding and decoding a payload
+
+    :Returns: Tuple - (bytes, encode ms, decode ms)
+    """
+    start = time.perf_counter()
+    for _ in range(rounds):
+        payload = encode(data)
+    encode_ms = (time.perf_counter() - start) * 1000 / rounds
+    start = time.perf_counter()
+    for _ in range(rounds):
+        decode(payload)
+    decode_ms = (time.perf_counter() - start) * 1000 / rounds
+    return len(payload), encode_ms, decode_ms
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--rounds', type=int, default=200)
+    parser.add_argument('--threshold', type=int, default=4096, help='compress payloads over this many bytes')
+    args = parser.parse_args()
+
+    codecs = [('json', lambda x: json.dumps(x).encode(), json.loads),
+              ('msgpack', lambda x: encoding.encode(x, threshold=float('inf')), encoding.decode),
+              ('msgpack+zlib', lambda x: encoding.encode(x, 'zlib', args.threshold), encoding.decode)]
+    if encoding.zstandard is not None:
+        codecs.append(('msgpack+zstd', lambda x: encoding.encode(x, 'zstd', args.threshold), encoding.decode))
+    else:
+        print('zstandard is not installed; skipping zstd')
+
+    print('{:<8}{:<16}{:>12}{:>12}{:>12}'.format('VMs', 'encoding', 'bytes', 'encode ms', 'decode ms'))
+    for vm_count in (10, 100, 1000):
+        data = make_result(vm_count)
+        rounds = max(1, args.rounds // (vm_count // 10))
+        for name, encode, decode in codecs:
+            size, encode_ms, decode_ms = measure(encode, decode, data, rounds)
+            print('{:<8}{:<16}{:>12}{:>12.3f}{:>12.3f}'.format(vm_count, name, size, encode_ms, decode_ms))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+# -*- coding: UTF-8 -*-
+"""
+Measures task status lookups per second against the bundled SQLite result
+store, the way ``/task/<id>`` polls it, by 1, 2 and 4 API replicas (separate
+processes) at once, while a worker keeps storing new results.
+
+Usage::
+
+    python benchmarks/bench_result_lookups.py [--results 10000] [--seconds 3] [--replicas 1 2 4]
+"""
+import os
+import time
+import random
+import argparse
+import tempfile
+import multiprocessing
+
+from celery import Celery
+
+from vlab_esrs_api.lib import results
+
+RESULT = {'content': {'esrs1': {'state': 'poweredOn', 'ips': ['10.1.2.3'], 'networks': ['frontend']}},
+          'error': None, 'params': {}}
+
+
+def make_app(url):
+    """Make a Celery app that stores results at ``url``"""
+    app = Celery('bench', broker='memory://')
+    results.configure(app)
+    app.conf.result_backend = url
+    return app
+
+
+def replica(url, task_ids, seconds, counts):
+    """Poll random task ids like an API replica, until time's up"""
+    app = make_app(url)
+    lookups = 0
+    stop = time.perf_counter() + seconds
+    while time.perf_counter() < stop:
+        for task_id in random.sample(task_ids, 100):
+            app.AsyncResult(task_id).status
+        lookups += 100
+    counts.put(lookups)
+
+
+def worker(url, seconds):
+    """Store new results like a busy worker, until time's up"""
+    backend = make_app(url).backend
+    stop = time.perf_counter() + seconds
+    stored = 0
+    while time.perf_counter() < stop:
+        backend.store_result('new-task-{}'.format(stored), RESULT, 'SUCCESS')
+        stored += 1
+    return stored
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--results', type=int, default=10000)
+    parser.add_argument('--seconds', type=float, default=3)
+    parser.add_argument('--replicas', type=int, nargs='+', default=[1, 2, 4])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        url = 'sqlite://{}'.format(os.path.join(workdir, 'results.db'))
+        backend = make_app(url).backend
+        task_ids = ['task-{}'.format(x) for x in range(args.results)]
+        start = time.perf_counter()
+        for task_id in task_ids:
+            backend.store_result(task_id, RESULT, 'SUCCESS')
+        print('Stored {} results in {:.2f}s'.format(args.results, time.perf_counter() - start))
+
+        print('{:<12}{:>16}{:>20}{:>16}'.format('replicas', 'lookups/sec', 'per replica/sec', 'stores/sec'))
+        for count in args.replicas:
+            counts = multiprocessing.Queue()
+            procs = [multiprocessing.Process(target=replica, args=(url, task_ids, args.seconds, counts))
+                     for _ in range(count)]
+            for proc in procs:
+                proc.start()
+            stored = worker(url, args.seconds)
+            lookups = sum(counts.get() for _ in procs)
+            for proc in procs:
+                proc.join()
+            rate = lookups / args.seconds
+            print('{:<12}{:>16,.0f}{:>20,.0f}{:>16,.0f}'.format(count, rate, rate / count, stored / args.seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+# -*- coding: UTF-8 -*-
+"""
+Runs 200 concurrent ``esrs.show`` tasks on one worker process, using the
+``threads`` pool, against a fake vCenter that takes ``--rtt`` milliseconds
+for every call.
+
+A prefork worker needs one process per concurrent task; this reports how much
+the memory of a single ``threads`` worker grows instead. Resident memory also
+grows a bit as malloc gives the pool's threads their own arenas, so the Python
+heap (from tracemalloc) is reported too.
+
+Usage::
+
+    python benchmarks/bench_thread_pool.py [--tasks 200] [--vms 5] [--rtt 20]
+"""
+import os
+import gc
+import time
+import logging
+import argparse
+import tempfile
+import tracemalloc
+
+WORKDIR = tempfile.mkdtemp()
+os.environ['VLAB_ESRS_BREAKER_STATE'] = os.path.join(WORKDIR, 'breaker.json')
+os.environ['VLAB_ESRS_METADATA_DB'] = os.path.join(WORKDIR, 'metadata.db')
+# don't let the per-process session cap be the bottleneck
+os.environ['VLAB_ESRS_VCENTER_CONCURRENCY'] = '1000'
+os.environ['VLAB_ESRS_LOG_LEVEL'] = 'ERROR'
+
+from celery.contrib.testing.worker import start_worker
+
+from vlab_esrs_api.lib.worker import tasks, vmware
+
+
+class FakeVM(object):
+    """Stands in for a vim.VirtualMachine"""
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeFolder(object):
+    """Stands in for a user's vim.Folder"""
+    def __init__(self, vms):
+        self.childEntity = [FakeVM('esrs{}'.format(x)) for x in range(vms)]
+
+
+class FakeVCenter(object):
+    """A vCenter where every call (including logging in) takes ``rtt`` seconds"""
+    rtt = 0.02
+    vms = 5
+
+    def __init__(self, host, user, password):
+        time.sleep(self.rtt)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, the_traceback):
+        time.sleep(self.rtt)
+
+    def get_by_name(self, name, vimtype):
+        time.sleep(self.rtt)
+        return FakeFolder(self.vms)
+
+
+def fake_get_info(vcenter, vm, username):
+    """Like virtual_machine.get_info, with the round trip to vCenter"""
+    time.sleep(FakeVCenter.rtt)
+    return {'state': 'poweredOn', 'console': 'https://localhost', 'ips': ['10.1.1.1'],
+            'networks': ['frontend'], 'moid': 'vm-1',
+            'meta': {'component': 'ESRS', 'created': 1234, 'version': '3.28',
+                     'configured': False, 'generation': 1}}
+
+
+def rss_kb():
+    """The resident memory of this process, in KB"""
+    with open('/proc/self/status') as the_file:
+        for line in the_file:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+
+
+def run_wave(count):
+    """Send ``count`` show tasks at once, and wait for all of them
+
+    :Returns: Float - seconds until the last task finished
+    """
+    start = time.perf_counter()
+    results = [tasks.show.delay('user{}'.format(x), 'bench') for x in range(count)]
+    for result in results:
+        output = result.get(timeout=120, interval=0.01)
+        assert output['error'] is None and len(output['content']) == FakeVCenter.vms, output
+        # the in-memory result backend would otherwise keep every result
+        result.forget()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--tasks', type=int, default=200)
+    parser.add_argument('--vms', type=int, default=5, help='ESRS instances per user')
+    parser.add_argument('--rtt', type=float, default=20.0, help='milliseconds per call to vCenter')
+    args = parser.parse_args()
+
+    FakeVCenter.rtt = args.rtt / 1000
+    FakeVCenter.vms = args.vms
+    vmware.vCenter = FakeVCenter
+    vmware.virtual_machine.get_info = fake_get_info
+    tasks.app.conf.broker_url = 'memory://'
+    tasks.app.conf.result_backend = 'cache+memory://'
+    tasks.app.conf.task_ignore_result = False
+
+    one_task = 2 * args.rtt + 2 * args.rtt + args.vms * args.rtt
+    with start_worker(tasks.app, pool='threads', concurrency=args.tasks, perform_ping_check=False,
+                      loglevel='ERROR'):
+        # the first wave starts the pool's threads
+        run_wave(args.tasks)
+        before = rss_kb()
+        loggers = len(logging.Logger.manager.loggerDict)
+        waves = [run_wave(args.tasks) for _ in range(5)]
+        after = rss_kb()
+        loggers = len(logging.Logger.manager.loggerDict) - loggers
+        small = run_wave(args.tasks // 10)
+        # tracemalloc slows everything down, so it only watches these waves
+        gc.collect()
+        tracemalloc.start()
+        for _ in range(2):
+            run_wave(args.tasks)
+        gc.collect()
+        heap_growth, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    print('{} concurrent esrs.show tasks, {} ESRS each, {}ms per vCenter call'.format(args.tasks, args.vms, args.rtt))
+    print('one task alone would take about {:.0f}ms'.format(one_task))
+    print('{:<40}{:>10.0f}ms'.format('{} tasks at once, best of 5'.format(args.tasks), min(waves) * 1000))
+    print('{:<40}{:>10.0f}ms'.format('{} tasks at once'.format(args.tasks // 10), small * 1000))
+    print('{:<40}{:>10.1f}MB'.format('worker resident memory', after / 1024))
+    print('{:<40}{:>10.1f}KB'.format('resident growth over 5 more waves', after - before))
+    print('{:<40}{:>10.2f}KB'.format('Python heap growth per task', heap_growth / 1024 / (2 * args.tasks)))
+    print('{:<40}{:>10}'.format('task loggers left behind', loggers))
+    print('{:<40}{:>10.1f}MB'.format('prefork, {} processes (estimate)'.format(args.tasks), args.tasks * after / 1024))
+
+
+if __name__ == '__main__':
+    main()
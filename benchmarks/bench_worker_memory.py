@@ -0,0 +1,122 @@
+# -*- coding: UTF-8 -*-
+"""
+Measures the unique and shared memory of forked worker children, with and
+without ``preload.warm`` in the parent, for 4, 16 and 64 children.
+
+Like a prefork worker, each run imports the tasks module in a fresh parent
+process, optionally warms it, then forks the children. Each child does what
+a task does to pyVmomi (build an import spec and a property filter, read a
+task's info) and runs a full garbage collection, then its memory is read from
+``/proc/<pid>/smaps_rollup``:
+
+- unique: Private_Clean + Private_Dirty; what killing the child would free
+- shared: Shared_Clean + Shared_Dirty; pages still shared with the parent or siblings
+- pss: proportional set size; the child's fair share of the node's memory
+
+Linux only. Usage::
+
+    python benchmarks/bench_worker_memory.py [--children 4 16 64]
+"""
+import os
+import gc
+import sys
+import json
+import signal
+import argparse
+import subprocess
+
+MODES = ('none', 'preload', 'preload+freeze')
+FIELDS = ('Private_Clean', 'Private_Dirty', 'Shared_Clean', 'Shared_Dirty', 'Pss')
+
+
+def task_like_work():
+    """Use pyVmomi the way the tasks do"""
+    from vlab_inf_common.vmware import vim
+    backing = vim.vm.device.VirtualEthernetCard.NetworkBackingInfo(deviceName='frontend')
+    nic = vim.vm.device.VirtualVmxnet3(key=4000, backing=backing)
+    disk = vim.vm.device.VirtualDisk(key=2000, capacityInKB=1024)
+    config = vim.vm.ConfigSpec(name='esrs1',
+                               deviceChange=[vim.vm.device.VirtualDeviceSpec(operation='add', device=disk),
+                                             vim.vm.device.VirtualDeviceSpec(operation='add', device=nic)])
+    vim.VirtualMachineImportSpec(configSpec=config)
+    vim.OvfManager.CreateImportSpecParams(entityName='esrs1')
+    prop_set = vim.PropertyCollector.PropertySpec(type=vim.VirtualMachine, pathSet=['name', 'runtime.powerState'])
+    vim.PropertyCollector.FilterSpec(propSet=[prop_set])
+    vim.TaskInfo(state=vim.TaskInfo.State.success)
+    gc.collect()
+
+
+def memory(pid):
+    """Read the memory of a process, in KB
+
+    :Returns: Dictionary
+    """
+    found = {}
+    with open('/proc/{}/smaps_rollup'.format(pid)) as the_file:
+        for line in the_file:
+            name, _, value = line.partition(':')
+            if name in FIELDS:
+                found[name] = int(value.split()[0])
+    return {'unique': found['Private_Clean'] + found['Private_Dirty'],
+            'shared': found['Shared_Clean'] + found['Shared_Dirty'],
+            'pss': found['Pss']}
+
+
+def run(mode, children):
+    """Be the parent; fork the children and measure them
+
+    :Returns: Dictionary - the average memory of a child, in KB
+    """
+    from vlab_esrs_api.lib.worker import tasks, preload
+    if mode == 'preload':
+        preload.vsphere_types()
+        preload.image_catalog()
+        preload.configuration()
+    elif mode == 'preload+freeze':
+        preload.warm()
+    pids = []
+    ready_r, ready_w = os.pipe()
+    for _ in range(children):
+        pid = os.fork()
+        if pid == 0:
+            os.close(ready_r)
+            task_like_work()
+            os.write(ready_w, b'.')
+            signal.pause()
+            os._exit(0)
+        pids.append(pid)
+    os.close(ready_w)
+    for _ in pids:
+        os.read(ready_r, 1)
+    try:
+        measured = [memory(pid) for pid in pids]
+    finally:
+        for pid in pids:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+    return {x: sum(y[x] for y in measured) / len(measured) for x in ('unique', 'shared', 'pss')}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--children', type=int, nargs='+', default=[4, 16, 64])
+    parser.add_argument('--run', nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run:
+        print(json.dumps(run(args.run[0], int(args.run[1]))))
+        return
+
+    print('Average per child, in MB')
+    print('{:<18}{:>10}{:>10}{:>10}{:>10}{:>14}'.format('mode', 'children', 'unique', 'shared', 'pss', 'total pss'))
+    for children in args.children:
+        for mode in MODES:
+            # a fresh parent each time, so nothing is warm from the last run
+            output = subprocess.check_output([sys.executable, __file__, '--run', mode, str(children)])
+            found = json.loads(output.decode().strip().splitlines()[-1])
+            print('{:<18}{:>10}{:>10.1f}{:>10.1f}{:>10.1f}{:>14.1f}'.format(mode, children, found['unique'] / 1024,
+                                                                           found['shared'] / 1024, found['pss'] / 1024,
+                                                                           found['pss'] * children / 1024))
+
+
+if __name__ == '__main__':
+    main()
@@ -15,5 +15,6 @@ setup(name="vlab-esrs-api",
       package_files={'vlab_esrs_api' : ['app.ini']},
       description="RESTful API for deploying ESRS instances",
       install_requires=['flask', 'ldap3', 'pyjwt', 'uwsgi', 'vlab-api-common',
-                        'ujson', 'cryptography', 'vlab-inf-common', 'celery']
+                        'ujson', 'cryptography', 'vlab-inf-common', 'celery', 'msgpack'],
+      extras_require={'zstd': ['zstandard']}
       )
@@ -0,0 +1,40 @@
+# -*- coding: UTF-8 -*-
+"""
+Fakes and fixture builders shared by the test suites
+"""
+import io
+import tarfile
+
+DESCRIPTOR = b'<Envelope><NetworkSection><Network ovf:name="vLabNetwork"/></NetworkSection></Envelope>'
+
+
+class FakeClock(object):
+    """A clock that only moves when told to
+
+    Call it, or its ``time`` method, in place of ``time.time``; ``sleep`` moves
+    it forward in place of ``time.sleep``.
+    """
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def make_ova(path, members=(('ESRS.ovf', DESCRIPTOR), ('disk.vmdk', b'disk bytes'))):
+    """Write an OVA to ``path``
+
+    :param members: The (name, bytes) of each file in the OVA, in order
+    :type members: List
+    """
+    with tarfile.open(path, 'w') as ova:
+        for name, data in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            ova.addfile(info, io.BytesIO(data))
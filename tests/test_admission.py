@@ -0,0 +1,216 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in admission.py
+"""
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch, MagicMock
+
+from vlab_esrs_api.lib.worker import admission
+
+from helpers import FakeClock
+
+MB = 1024 * 1024
+
+
+def datastore_bandwidth(concurrency):
+    """Aggregate MB/s of a datastore; a single stream tops out at 40 MB/s,
+    the datastore at 100 MB/s, and it thrashes beyond 4 concurrent uploads"""
+    if concurrency <= 4:
+        return min(concurrency * 40, 100)
+    return 100 / (1 + 0.5 * (concurrency - 4))
+
+
+def simulate(controller, clock, imports, size_mb, step=10):
+    """Run concurrent imports to one datastore against the simulated bandwidth
+
+    :Returns: Dictionary - import number -> seconds until it finished
+    """
+    tickets = {x: controller.enqueue(['datastore:VM-Storage'], ticket_id=str(x)) for x in range(imports)}
+    remaining = {x: size_mb for x in range(imports)}
+    started = {}
+    finished = {}
+    start = clock()
+    while remaining:
+        active = [x for x in remaining if controller.position(tickets[x]) == 0]
+        for x in active:
+            started.setdefault(x, clock())
+        rate = datastore_bandwidth(len(active)) / max(len(active), 1)
+        clock.sleep(step)
+        for x in remaining:
+            controller.heartbeat(tickets[x])
+        for x in active:
+            remaining[x] -= rate * step
+            if remaining[x] <= 0:
+                del remaining[x]
+                controller.record_throughput('datastore:VM-Storage', size_mb * MB, clock() - started[x])
+                controller.release(tickets[x])
+                finished[x] = clock() - start
+    return finished
+
+
+class TestAdmissionController(unittest.TestCase):
+    """A set of test cases for the AdmissionController object"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.directory = tempfile.mkdtemp()
+        self.clock = FakeClock()
+        self.controller = admission.AdmissionController(self.directory,
+                                                        caps={'datastore': 4, 'host': 2},
+                                                        clock=self.clock,
+                                                        sleep=self.clock.sleep)
+
+    def tearDown(self):
+        """Runs after every test case"""
+        shutil.rmtree(self.directory)
+
+    def test_position(self):
+        """``AdmissionController`` admits up to the cap, and queues the rest in order"""
+        tickets = []
+        for x in range(6):
+            tickets.append(self.controller.enqueue(['datastore:VM-Storage']))
+            self.clock.sleep(1)
+
+        output = [self.controller.position(x) for x in tickets]
+        expected = [0, 0, 0, 0, 1, 2]
+
+        self.assertEqual(output, expected)
+
+    def test_position_release(self):
+        """``AdmissionController`` admits the next import in line when one is released"""
+        tickets = []
+        for x in range(5):
+            tickets.append(self.controller.enqueue(['datastore:VM-Storage']))
+            self.clock.sleep(1)
+        self.controller.release(tickets[0])
+
+        self.assertEqual(self.controller.position(tickets[4]), 0)
+
+    def test_position_host_cap(self):
+        """``AdmissionController`` holds an import until every resource it needs has room"""
+        tickets = []
+        for x in range(3):
+            tickets.append(self.controller.enqueue(['datastore:VM-Storage', 'host:esxi01']))
+            self.clock.sleep(1)
+
+        output = self.controller.position(tickets[2])
+        expected = 1
+
+        self.assertEqual(output, expected)
+
+    def test_stale_ticket(self):
+        """``AdmissionController`` drops tickets of imports that stopped refreshing them"""
+        dead = [self.controller.enqueue(['host:esxi01']) for _ in range(2)]
+        self.clock.sleep(self.controller.stale_after + 1)
+        alive = self.controller.enqueue(['host:esxi01'])
+
+        self.assertEqual(self.controller.position(alive), 0)
+
+    def test_admit_reports_position(self):
+        """``AdmissionController.admit`` reports the place in line while waiting"""
+        blockers = [self.controller.enqueue(['host:esxi01']) for _ in range(2)]
+        self.clock.sleep(1)
+        positions = []
+
+        def sleep(seconds):
+            self.clock.sleep(seconds)
+            self.controller.release(blockers.pop())
+
+        self.controller.sleep = sleep
+        with self.controller.admit(['host:esxi01'], on_queued=positions.append):
+            pass
+
+        self.assertEqual(positions, [1, 0])
+
+    def test_admit_not_queued(self):
+        """``AdmissionController.admit`` doesn't report a place in line for an import that never waited"""
+        positions = []
+        with self.controller.admit(['host:esxi01'], on_queued=positions.append):
+            pass
+
+        self.assertEqual(positions, [])
+
+    def test_admit_max_wait(self):
+        """``AdmissionController.admit`` gives up after waiting ``max_wait`` seconds"""
+        blockers = [self.controller.enqueue(['host:esxi01']) for _ in range(2)]
+        self.clock.sleep(1)
+        self.controller.max_wait = 10
+
+        with self.assertRaises(ValueError):
+            with self.controller.admit(['host:esxi01']):
+                pass
+
+        self.assertEqual(len(self.controller._live_tickets('host:esxi01')), 2)
+
+    def test_admit_releases(self):
+        """``AdmissionController.admit`` gives up the slot even if the import fails"""
+        try:
+            with self.controller.admit(['host:esxi01']) as ticket:
+                raise RuntimeError('testing')
+        except RuntimeError:
+            pass
+
+        self.assertEqual(self.controller.holders('host:esxi01'), 0)
+
+    def test_admit_cancelled(self):
+        """``AdmissionController.admit`` gives up its place in line when the import is cancelled"""
+        blockers = [self.controller.enqueue(['host:esxi01']) for _ in range(2)]
+        self.clock.sleep(1)
+
+        with self.assertRaises(admission.cancel.Cancelled):
+            with self.controller.admit(['host:esxi01'], cancelled=lambda: True):
+                pass
+
+        self.assertEqual(len(self.controller._live_tickets('host:esxi01')), 2)
+
+    def test_capped_imports_meet_time_limit(self):
+        """``AdmissionController`` keeps a burst of imports under the task time limit"""
+        finished = simulate(self.controller, self.clock, imports=16, size_mb=4096)
+
+        self.assertTrue(max(finished.values()) < 1800)
+
+    def test_uncapped_imports_collapse(self):
+        """Without admission control, the same burst of imports blows the time limit"""
+        controller = admission.AdmissionController(self.directory,
+                                                   caps={'datastore': 100},
+                                                   clock=self.clock,
+                                                   sleep=self.clock.sleep)
+
+        finished = simulate(controller, self.clock, imports=16, size_mb=4096)
+
+        self.assertTrue(min(finished.values()) > 1800)
+
+    def test_tune(self):
+        """``AdmissionController.tune`` sets the cap from measured throughput"""
+        samples = []
+        for concurrency in range(1, 9):
+            rate = datastore_bandwidth(concurrency) / concurrency * MB
+            samples.append({'concurrency': concurrency, 'rate': rate})
+        with patch.object(admission, 'load_json') as fake_load_json:
+            fake_load_json.side_effect = lambda path, default: {'datastore:VM-Storage': samples} if path.endswith('throughput.json') else {}
+            caps = self.controller.tune()
+
+        self.assertEqual(caps, {'datastore:VM-Storage': 3})
+        self.assertEqual(self.controller.cap('datastore:VM-Storage'), 3)
+
+
+class TestRecommendCap(unittest.TestCase):
+    """A set of test cases for the ``recommend_cap`` function"""
+    def test_recommend_cap(self):
+        """``recommend_cap`` returns the least concurrency with near-best aggregate throughput"""
+        samples = [{'concurrency': 1, 'rate': 40}, {'concurrency': 2, 'rate': 40},
+                   {'concurrency': 4, 'rate': 20}, {'concurrency': 8, 'rate': 5}]
+
+        output = admission.recommend_cap(samples)
+        expected = 2
+
+        self.assertEqual(output, expected)
+
+    def test_recommend_cap_no_samples(self):
+        """``recommend_cap`` returns None without any samples"""
+        self.assertTrue(admission.recommend_cap([]) is None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -51,6 +51,16 @@ class TestESRSViewSchema(unittest.TestCase):
 
         self.assertTrue(schema_valid)
 
+    def test_images_args_schema(self):
+        """The schema defined for the query parameters of GET on /images is valid"""
+        try:
+            Draft4Validator.check_schema(esrs.ESRSView.IMAGES_ARGS_SCHEMA)
+            schema_valid = True
+        except RuntimeError:
+            schema_valid = False
+
+        self.assertTrue(schema_valid)
+
     def test_delete(self):
         """The DELETE schema happy path test"""
         body = {'name': "myESRS"}
@@ -117,6 +127,91 @@ class TestESRSViewSchema(unittest.TestCase):
 
         self.assertTrue(ok)
 
+    def test_network_schema(self):
+        """The schema defined for PUT/PATCH is valid"""
+        try:
+            Draft4Validator.check_schema(esrs.ESRSView.NETWORK_SCHEMA)
+            schema_valid = True
+        except RuntimeError:
+            schema_valid = False
+
+        self.assertTrue(schema_valid)
+
+    def test_network(self):
+        """The PUT/PATCH schema happy path test"""
+        body = {'name': "myESRS", 'new_network': "someNetwork"}
+        try:
+            validate(body, esrs.ESRSView.NETWORK_SCHEMA)
+            ok = True
+        except ValidationError:
+            ok = False
+
+        self.assertTrue(ok)
+
+    def test_network_list(self):
+        """The PUT/PATCH schema accepts a list of names"""
+        body = {'name': ["myESRS", "myOtherESRS"], 'new_network': "someNetwork"}
+        try:
+            validate(body, esrs.ESRSView.NETWORK_SCHEMA)
+            ok = True
+        except ValidationError:
+            ok = False
+
+        self.assertTrue(ok)
+
+    def test_network_required(self):
+        """The PUT/PATCH schema requires the 'new_network' parameter"""
+        body = {'name': "myESRS"}
+        try:
+            validate(body, esrs.ESRSView.NETWORK_SCHEMA)
+            ok = False
+        except ValidationError:
+            ok = True
+
+        self.assertTrue(ok)
+
+    def test_reaper_schema(self):
+        """The schema defined for PUT on /reaper is valid"""
+        try:
+            Draft4Validator.check_schema(esrs.ESRSView.REAPER_SCHEMA)
+            schema_valid = True
+        except RuntimeError:
+            schema_valid = False
+
+        self.assertTrue(schema_valid)
+
+    def test_power_schema(self):
+        """The schema defined for POST on /power is valid"""
+        try:
+            Draft4Validator.check_schema(esrs.ESRSView.POWER_SCHEMA)
+            schema_valid = True
+        except RuntimeError:
+            schema_valid = False
+
+        self.assertTrue(schema_valid)
+
+    def test_power_all(self):
+        """The /power schema powers all of the user's ESRS when no name is given"""
+        body = {'power': "off"}
+        try:
+            validate(body, esrs.ESRSView.POWER_SCHEMA)
+            ok = True
+        except ValidationError:
+            ok = False
+
+        self.assertTrue(ok)
+
+    def test_power_unknown(self):
+        """The /power schema rejects unknown actions"""
+        body = {'name': ["myESRS"], 'power': "hibernate"}
+        try:
+            validate(body, esrs.ESRSView.POWER_SCHEMA)
+            ok = False
+        except ValidationError:
+            ok = True
+
+        self.assertTrue(ok)
+
 
 if __name__ == '__main__':
     unittest.main()
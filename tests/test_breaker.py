@@ -0,0 +1,244 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in breaker.py
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch, MagicMock
+
+from vlab_esrs_api.lib.worker import breaker, vmware
+
+from helpers import FakeClock
+
+
+class FakeVCenter(object):
+    """Stands in for vlab_inf_common.vmware.vCenter, with injected faults
+
+    Each login takes the next fault off the list: None to log in fine, a number
+    to log in after that many seconds, or an Exception to fail.
+    """
+    def __init__(self, clock):
+        self.clock = clock
+        self.faults = []
+        self.logins = 0
+
+    def __call__(self, host, user, password):
+        self.logins += 1
+        fault = self.faults.pop(0) if self.faults else None
+        if isinstance(fault, Exception):
+            raise fault
+        if fault:
+            self.clock.now += fault
+        return MagicMock()
+
+
+class TestBreaker(unittest.TestCase):
+    """A set of test cases for breaker.py"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.workdir = tempfile.mkdtemp()
+        self.clock = FakeClock()
+        self.vcenter = FakeVCenter(self.clock)
+        self.patchers = [patch.object(breaker, 'const'),
+                         patch.object(breaker, 'time', self.clock),
+                         patch.object(vmware, 'time', self.clock),
+                         patch.object(vmware, 'vCenter', self.vcenter)]
+        fake_const = self.patchers[0].start()
+        for patcher in self.patchers[1:]:
+            patcher.start()
+        fake_const.VLAB_ESRS_BREAKER_STATE = os.path.join(self.workdir, 'breaker.json')
+        fake_const.VLAB_ESRS_BREAKER_WINDOW = 60
+        fake_const.VLAB_ESRS_BREAKER_MIN_CALLS = 4
+        fake_const.VLAB_ESRS_BREAKER_ERROR_PCT = 50
+        fake_const.VLAB_ESRS_BREAKER_SLOW_SECONDS = 10
+        fake_const.VLAB_ESRS_BREAKER_COOLDOWN = 30
+        breaker._PENDING.clear()
+
+    def tearDown(self):
+        """Runs after every test case"""
+        for patcher in self.patchers:
+            patcher.stop()
+        shutil.rmtree(self.workdir)
+
+    def login(self, fault=None):
+        """Log into the fake vCenter
+
+        :Returns: Boolean - True if the login, and the work done with the session, worked
+
+        :param fault: Raised while using the session, like a vCenter call that failed
+        :type fault: Exception
+        """
+        try:
+            with vmware.connect('vc1'):
+                if fault is not None:
+                    raise fault
+        except breaker.BreakerOpen:
+            raise
+        except Exception:
+            return False
+        return True
+
+    def test_closed(self):
+        """The breaker lets calls through while vCenter is healthy"""
+        for _ in range(10):
+            self.assertTrue(self.login())
+
+        self.assertFalse(breaker.allow('vc1'))
+
+    @patch.object(breaker, 'save_json')
+    @patch.object(breaker, 'locked')
+    def test_closed_no_writes(self, fake_locked, fake_save_json):
+        """The breaker doesn't lock or rewrite the shared state for good sessions with a healthy vCenter"""
+        for _ in range(10):
+            self.assertTrue(self.login())
+
+        self.assertFalse(fake_locked.called)
+        self.assertFalse(fake_save_json.called)
+
+    def test_counts_unwritten_calls(self):
+        """The good sessions a process didn't write still count once vCenter starts failing"""
+        for _ in range(6):
+            self.login()
+        self.vcenter.faults = [OSError('down')] * 2
+        self.login()
+        self.login()
+
+        self.assertEqual(breaker.status()['vc1']['calls'], 8)
+        self.assertEqual(breaker.status()['vc1']['state'], breaker.CLOSED)
+
+    def test_min_calls(self):
+        """The breaker doesn't open before it's seen enough calls"""
+        self.vcenter.faults = [OSError('down')] * 3
+        for _ in range(3):
+            self.login()
+
+        self.assertEqual(breaker.status()['vc1']['state'], breaker.CLOSED)
+
+    def test_opens_on_errors(self):
+        """The breaker opens once too many logins fail, and then fails fast"""
+        self.vcenter.faults = [None, None, OSError('down'), OSError('down')]
+        for _ in range(4):
+            self.login()
+
+        with self.assertRaises(breaker.BreakerOpen):
+            self.login()
+        self.assertEqual(self.vcenter.logins, 4)
+
+    def test_opens_on_session_errors(self):
+        """The breaker opens once too many vCenter calls fail, even though the logins work"""
+        for fault in (None, None, vmware.vmodl.fault.HostCommunication(), ConnectionResetError()):
+            self.login(fault)
+
+        with self.assertRaises(breaker.BreakerOpen):
+            self.login()
+        self.assertEqual(self.vcenter.logins, 4)
+
+    def test_ignores_user_errors(self):
+        """The breaker doesn't count errors that aren't vCenter's fault"""
+        for _ in range(4):
+            self.login(ValueError('You already have a machine named esrs1'))
+
+        self.assertFalse(breaker.allow('vc1'))
+
+    def test_half_open_session_fails(self):
+        """The probe fails if vCenter fails while it's being used, not just at login"""
+        self.vcenter.faults = [OSError('down')] * 4
+        for _ in range(4):
+            self.login()
+        self.clock.now += 31
+        self.login(vmware.vmodl.fault.HostCommunication())
+
+        self.assertEqual(breaker.status()['vc1']['state'], breaker.OPEN)
+
+    def test_opens_on_latency(self):
+        """The breaker treats slow logins like failed ones"""
+        self.vcenter.faults = [None, None, 20, 20]
+        for _ in range(4):
+            self.assertTrue(self.login())
+
+        self.assertEqual(breaker.status()['vc1']['state'], breaker.OPEN)
+
+    def test_window(self):
+        """The breaker forgets failures older than the window"""
+        self.vcenter.faults = [OSError('down')] * 2
+        self.login()
+        self.login()
+        self.clock.now += 61
+        self.login()
+        self.login()
+
+        self.assertEqual(breaker.status()['vc1']['state'], breaker.CLOSED)
+
+    def test_open_error(self):
+        """BreakerOpen is a retryable ValueError that says when to try again"""
+        self.vcenter.faults = [OSError('down')] * 4
+        for _ in range(4):
+            self.login()
+        self.clock.now += 10
+
+        with self.assertRaises(ValueError) as context:
+            self.login()
+        self.assertEqual(context.exception.retry_in, 20)
+        self.assertEqual(breaker.status()['vc1']['retry_in'], 20)
+
+    def test_half_open_recovers(self):
+        """After the cooldown, a good probe closes the breaker"""
+        self.vcenter.faults = [OSError('down')] * 4
+        for _ in range(4):
+            self.login()
+        self.clock.now += 30
+
+        self.assertTrue(self.login())
+        self.assertEqual(breaker.status()['vc1']['state'], breaker.CLOSED)
+        self.assertTrue(self.login())
+
+    def test_half_open_fails(self):
+        """After the cooldown, a bad probe opens the breaker again"""
+        self.vcenter.faults = [OSError('down')] * 5
+        for _ in range(4):
+            self.login()
+        self.clock.now += 30
+
+        self.assertFalse(self.login())
+        with self.assertRaises(breaker.BreakerOpen):
+            self.login()
+
+    def test_half_open_one_probe(self):
+        """While the breaker is half open, only the probe goes to vCenter"""
+        self.vcenter.faults = [OSError('down')] * 4
+        for _ in range(4):
+            self.login()
+        self.clock.now += 30
+
+        self.assertTrue(breaker.allow('vc1'))
+        with self.assertRaises(breaker.BreakerOpen):
+            breaker.allow('vc1')
+
+    def test_half_open_stuck_probe(self):
+        """A probe that never finishes doesn't keep the breaker open forever"""
+        self.vcenter.faults = [OSError('down')] * 4
+        for _ in range(4):
+            self.login()
+        self.clock.now += 30
+        breaker.allow('vc1')
+        self.clock.now += 30
+
+        self.assertTrue(breaker.allow('vc1'))
+
+    def test_servers(self):
+        """Each vCenter server has its own breaker"""
+        self.vcenter.faults = [OSError('down')] * 4
+        for _ in range(4):
+            self.login()
+
+        self.assertFalse(breaker.allow('vc2'))
+
+    def test_status_empty(self):
+        """``status`` is empty before vCenter has been called"""
+        self.assertEqual(breaker.status(), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
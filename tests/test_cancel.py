@@ -0,0 +1,98 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in cancel.py
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from vlab_esrs_api.lib import cancel
+
+
+class TestCancel(unittest.TestCase):
+    """A set of test cases for cancel.py"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.workdir = tempfile.mkdtemp()
+        self.patcher = patch.object(cancel, 'const')
+        fake_const = self.patcher.start()
+        fake_const.VLAB_ESRS_CANCEL_DIR = self.workdir
+        fake_const.VLAB_ESRS_CANCEL_TTL = 86400
+
+    def tearDown(self):
+        """Runs after every test case"""
+        self.patcher.stop()
+        shutil.rmtree(self.workdir)
+
+    def test_path_for(self):
+        """``path_for`` rejects ids that could escape the cancel directory"""
+        with self.assertRaises(ValueError):
+            cancel.path_for('../../etc/passwd')
+
+    def test_requested(self):
+        """``requested`` is True once the owner of the task cancels it"""
+        self.assertFalse(cancel.requested('abc-123', 'alice'))
+
+        cancel.request('abc-123', 'alice')
+
+        self.assertTrue(cancel.requested('abc-123', 'alice'))
+
+    def test_requested_other_user(self):
+        """``requested`` ignores users cancelling tasks they don't own"""
+        cancel.request('abc-123', 'bob')
+
+        self.assertFalse(cancel.requested('abc-123', 'alice'))
+
+    def test_request_not_overwritten(self):
+        """``request`` doesn't let another user replace the owner's request"""
+        cancel.request('abc-123', 'alice')
+        cancel.request('abc-123', 'bob')
+
+        self.assertTrue(cancel.requested('abc-123', 'alice'))
+
+    def test_request_after_other_user(self):
+        """``request`` still works for the owner after someone else asked first"""
+        cancel.request('abc-123', 'bob')
+        cancel.request('abc-123', 'alice')
+
+        self.assertTrue(cancel.requested('abc-123', 'alice'))
+
+    def test_request_once(self):
+        """``request`` only records the same request once"""
+        cancel.request('abc-123', 'alice')
+        cancel.request('abc-123', 'alice')
+
+        with open(cancel.path_for('abc-123')) as the_file:
+            self.assertEqual(len(the_file.read().splitlines()), 1)
+
+    def test_requested_admin(self):
+        """``requested`` lets admins cancel anyone's task"""
+        cancel.request('abc-123', 'bob', admin=True)
+
+        self.assertTrue(cancel.requested('abc-123', 'alice'))
+
+    def test_requested_no_task_id(self):
+        """``requested`` is False when the task has no id, like when it's called directly"""
+        self.assertFalse(cancel.requested(None, 'alice'))
+
+    def test_clear(self):
+        """``clear`` forgets the cancel marker"""
+        cancel.request('abc-123', 'alice')
+
+        cancel.clear('abc-123')
+
+        self.assertEqual(os.listdir(self.workdir), [])
+
+    def test_clean(self):
+        """``clean`` deletes old markers"""
+        cancel.request('abc-123', 'alice')
+
+        cancel.clean(max_age=60, clock=lambda: os.path.getmtime(cancel.path_for('abc-123')) + 61)
+
+        self.assertEqual(os.listdir(self.workdir), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in encoding.py
+"""
+import unittest
+from unittest.mock import patch, MagicMock
+
+from kombu.serialization import dumps, loads
+
+from vlab_esrs_api.lib import encoding
+
+
+def make_result(vm_count):
+    """A task result like esrs.show returns"""
+    content = {}
+    for idx in range(vm_count):
+        content['esrs{}'.format(idx)] = {'state': 'poweredOn',
+                                         'ips': ['10.1.1.{}'.format(idx % 250)],
+                                         'networks': ['frontend'],
+                                         'moid': 'vm-{}'.format(idx),
+                                         'meta': {'component': 'ESRS', 'created': 1234,
+                                                  'version': '3.28', 'configured': False,
+                                                  'generation': 1}}
+    return {'content': content, 'error': None, 'params': {}}
+
+
+class TestEncoding(unittest.TestCase):
+    """A set of test cases for encoding.py"""
+    def test_round_trip_small(self):
+        """``decode`` reverses ``encode`` for payloads under the threshold"""
+        data = make_result(1)
+
+        payload = encoding.encode(data, compression='zlib', threshold=4096)
+
+        self.assertEqual(payload[:1], encoding.RAW)
+        self.assertEqual(encoding.decode(payload), data)
+
+    def test_round_trip_zlib(self):
+        """``encode`` compresses payloads over the threshold"""
+        data = make_result(100)
+
+        payload = encoding.encode(data, compression='zlib', threshold=4096)
+
+        self.assertEqual(payload[:1], encoding.ZLIB)
+        self.assertEqual(encoding.decode(payload), data)
+
+    @unittest.skipIf(encoding.zstandard is None, 'zstandard is not installed')
+    def test_round_trip_zstd(self):
+        """``encode`` supports zstd"""
+        data = make_result(100)
+
+        payload = encoding.encode(data, compression='zstd', threshold=4096)
+
+        self.assertEqual(payload[:1], encoding.ZSTD)
+        self.assertEqual(encoding.decode(payload), data)
+
+    @patch.object(encoding, 'zstandard', None)
+    def test_zstd_fallback(self):
+        """``encode`` falls back to zlib when zstandard isn't installed"""
+        payload = encoding.encode(make_result(100), compression='zstd', threshold=4096)
+
+        self.assertEqual(payload[:1], encoding.ZLIB)
+
+    def test_smaller(self):
+        """``encode`` produces less than JSON for a large show result"""
+        import json
+        data = make_result(1000)
+
+        self.assertTrue(len(encoding.encode(data, threshold=4096)) < len(json.dumps(data)) / 4)
+
+    def test_decode_unknown(self):
+        """``decode`` raises ValueError for payloads it didn't make"""
+        with self.assertRaises(ValueError):
+            encoding.decode(b'x1234')
+
+    @patch.object(encoding, 'const')
+    def test_configure(self, fake_const):
+        """``configure`` sets the result serializer when msgpack is enabled"""
+        fake_const.VLAB_ESRS_RESULT_ENCODING = 'msgpack'
+        fake_app = MagicMock()
+
+        encoding.configure(fake_app)
+
+        self.assertEqual(fake_app.conf.result_serializer, encoding.SERIALIZER)
+        self.assertTrue('json' in fake_app.conf.result_accept_content)
+
+    @patch.object(encoding, 'const')
+    def test_configure_default(self, fake_const):
+        """``configure`` leaves results as JSON by default, but still accepts msgpack"""
+        fake_const.VLAB_ESRS_RESULT_ENCODING = 'json'
+        fake_app = MagicMock()
+        fake_app.conf.result_serializer = 'json'
+
+        encoding.configure(fake_app)
+
+        self.assertEqual(fake_app.conf.result_serializer, 'json')
+        self.assertTrue(encoding.SERIALIZER in fake_app.conf.result_accept_content)
+
+    def test_kombu(self):
+        """The registered serializer round trips through kombu"""
+        encoding.configure(MagicMock())
+        data = make_result(100)
+
+        content_type, content_encoding, payload = dumps(data, serializer=encoding.SERIALIZER)
+        output = loads(payload, content_type, content_encoding, accept=[encoding.CONTENT_TYPE])
+
+        self.assertEqual(output, data)
+
+
+if __name__ == '__main__':
+    unittest.main()
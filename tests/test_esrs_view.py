@@ -7,10 +7,13 @@ from unittest.mock import patch, MagicMock
 
 import ujson
 from flask import Flask
+from celery import Celery
+from celery.signals import after_task_publish
 from vlab_api_common import flask_common
 from vlab_api_common.http_auth import generate_v2_test_token
 
 
+from vlab_esrs_api.lib import profiling
 from vlab_esrs_api.lib.views import esrs
 
 
@@ -33,6 +36,14 @@ class TestESRSView(unittest.TestCase):
         cls.fake_task = MagicMock()
         cls.fake_task.id = 'asdf-asdf-asdf'
         app.celery_app.send_task.return_value = cls.fake_task
+        cls.celery_app = app.celery_app
+        # Keep creates from reading a real metadata index
+        cls.validation_patcher = patch.object(esrs.validation, 'check_create')
+        cls.fake_check_create = cls.validation_patcher.start()
+
+    def tearDown(self):
+        """Runs after every test case"""
+        self.validation_patcher.stop()
 
     def test_v1_deprecated(self):
         """ESRSView - GET on /api/1/inf/esrs returns an HTTP 404"""
@@ -64,6 +75,108 @@ class TestESRSView(unittest.TestCase):
 
         self.assertEqual(task_id, expected)
 
+    def test_get_fields(self):
+        """ESRSView - GET on /api/2/inf/esrs passes fields, limit and cursor to the worker"""
+        self.app.get('/api/2/inf/esrs?fields=name,state&limit=10&cursor=Zm9v',
+                     headers={'X-Auth': self.token})
+
+        the_args, _ = self.celery_app.send_task.call_args
+        expected = {'fields': 'name,state', 'limit': 10, 'cursor': 'Zm9v'}
+
+        self.assertEqual(the_args[2], expected)
+
+    def test_get_bad_field(self):
+        """ESRSView - GET on /api/2/inf/esrs returns 400 for unknown fields"""
+        resp = self.app.get('/api/2/inf/esrs?fields=name,doh',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 400)
+        self.assertFalse(self.celery_app.send_task.called)
+
+    def test_get_bad_limit(self):
+        """ESRSView - GET on /api/2/inf/esrs returns 400 for a limit that isn't a positive number"""
+        for limit in ('0', 'ten'):
+            resp = self.app.get('/api/2/inf/esrs?limit={}'.format(limit),
+                                headers={'X-Auth': self.token})
+
+            self.assertEqual(resp.status_code, 400)
+
+    def test_get_wait(self):
+        """ESRSView - GET on /api/2/inf/esrs with ?wait returns the result of a task that finishes in time"""
+        self.fake_task.status = 'SUCCESS'
+        self.fake_task.result = {'content': {'myESRS': {}}, 'error': None, 'params': {}}
+        resp = self.app.get('/api/2/inf/esrs?wait=2',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json['content'], {'myESRS': {}})
+        self.assertEqual(self.fake_task.get.call_args[1]['timeout'], 2)
+
+    def test_get_wait_timeout(self):
+        """ESRSView - GET on /api/2/inf/esrs with ?wait returns a task-id if the task takes too long"""
+        self.fake_task.get.side_effect = esrs.CeleryTimeoutError()
+        resp = self.app.get('/api/2/inf/esrs?wait=1',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 202)
+        self.assertEqual(resp.json['content']['task-id'], 'asdf-asdf-asdf')
+
+    def test_get_wait_error(self):
+        """ESRSView - GET on /api/2/inf/esrs with ?wait returns 400 if the task had an error"""
+        self.fake_task.status = 'SUCCESS'
+        self.fake_task.result = {'content': {}, 'error': 'doh', 'params': {}}
+        resp = self.app.get('/api/2/inf/esrs?wait=1',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(resp.json['error'], 'doh')
+
+    def test_get_wait_failure(self):
+        """ESRSView - GET on /api/2/inf/esrs with ?wait returns 500 if the task failed"""
+        self.fake_task.status = 'FAILURE'
+        resp = self.app.get('/api/2/inf/esrs?wait=1',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 500)
+
+    @patch.object(esrs, 'const')
+    def test_get_wait_max(self, fake_const):
+        """ESRSView - GET on /api/2/inf/esrs waits no longer than VLAB_ESRS_MAX_WAIT"""
+        fake_const.VLAB_ESRS_MAX_WAIT = 3
+        fake_const.VLAB_URL = 'https://localhost'
+        self.fake_task.get.side_effect = esrs.CeleryTimeoutError()
+        self.app.get('/api/2/inf/esrs?wait=600',
+                     headers={'X-Auth': self.token})
+
+        self.assertEqual(self.fake_task.get.call_args[1]['timeout'], 3)
+
+    @patch.object(esrs, 'const')
+    def test_get_wait_ceiling(self, fake_const):
+        """ESRSView - GET on /api/2/inf/esrs never pins a uwsgi worker longer than WAIT_CEILING, whatever VLAB_ESRS_MAX_WAIT says"""
+        fake_const.VLAB_ESRS_MAX_WAIT = 600
+        fake_const.VLAB_URL = 'https://localhost'
+        self.fake_task.get.side_effect = esrs.CeleryTimeoutError()
+        self.app.get('/api/2/inf/esrs?wait=600',
+                     headers={'X-Auth': self.token})
+
+        self.assertEqual(self.fake_task.get.call_args[1]['timeout'], esrs.WAIT_CEILING)
+
+    def test_get_bad_wait(self):
+        """ESRSView - GET on /api/2/inf/esrs returns 400 for a wait that isn't a positive number"""
+        for wait in ('-1', 'soon', 'nan'):
+            resp = self.app.get('/api/2/inf/esrs?wait={}'.format(wait),
+                                headers={'X-Auth': self.token})
+
+            self.assertEqual(resp.status_code, 400)
+        self.assertFalse(self.celery_app.send_task.called)
+
+    def test_get_no_wait(self):
+        """ESRSView - GET on /api/2/inf/esrs doesn't wait on the task by default"""
+        self.app.get('/api/2/inf/esrs',
+                     headers={'X-Auth': self.token})
+
+        self.assertFalse(self.fake_task.get.called)
+
     def test_post_task(self):
         """ESRSView - POST on /api/2/inf/esrs returns a task-id"""
         resp = self.app.post('/api/2/inf/esrs',
@@ -86,6 +199,53 @@ class TestESRSView(unittest.TestCase):
 
         self.assertEqual(task_id, expected)
 
+    def test_image_wait(self):
+        """ESRSView - GET on /api/2/inf/esrs/image with ?wait returns the images inline"""
+        self.fake_task.status = 'SUCCESS'
+        self.fake_task.result = {'content': {'image': ['3.28']}, 'error': None, 'params': {}}
+        resp = self.app.get('/api/2/inf/esrs/image?wait=1',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json['content'], {'image': ['3.28']})
+
+    def test_image_bad_wait(self):
+        """ESRSView - GET on /api/2/inf/esrs/image returns 400 for a bad wait"""
+        resp = self.app.get('/api/2/inf/esrs/image?wait=later',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 400)
+        self.assertFalse(self.celery_app.send_task.called)
+
+    def test_post_checked(self):
+        """ESRSView - POST on /api/2/inf/esrs checks the create before sending it to a worker"""
+        self.app.post('/api/2/inf/esrs',
+                      headers={'X-Auth': self.token},
+                      json={'name': "myESRS", 'image': "3.28", 'network': "someNetwork"})
+
+        self.fake_check_create.assert_called_with('bob', 'myESRS', '3.28', 'bob_someNetwork')
+
+    def test_post_invalid(self):
+        """ESRSView - POST on /api/2/inf/esrs returns 400 for a create that can't work"""
+        self.fake_check_create.side_effect = ValueError('No such network named bob_someNetwork')
+        resp = self.app.post('/api/2/inf/esrs',
+                             headers={'X-Auth': self.token},
+                             json={'name': "myESRS", 'image': "3.28", 'network': "someNetwork"})
+
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(resp.json['error'], 'No such network named bob_someNetwork')
+        self.assertFalse(self.celery_app.send_task.called)
+
+    def test_post_conflict(self):
+        """ESRSView - POST on /api/2/inf/esrs returns 409 when the name is taken"""
+        self.fake_check_create.side_effect = esrs.validation.Conflict('You already have an ESRS named myESRS')
+        resp = self.app.post('/api/2/inf/esrs',
+                             headers={'X-Auth': self.token},
+                             json={'name': "myESRS", 'image': "3.28", 'network': "someNetwork"})
+
+        self.assertEqual(resp.status_code, 409)
+        self.assertFalse(self.celery_app.send_task.called)
+
     def test_delete_task(self):
         """ESRSView - DELETE on /api/2/inf/esrs returns a task-id"""
         resp = self.app.delete('/api/2/inf/esrs',
@@ -128,6 +288,281 @@ class TestESRSView(unittest.TestCase):
 
         self.assertEqual(task_id, expected)
 
+    def test_put_task(self):
+        """ESRSView - PUT on /api/2/inf/esrs returns a task-id"""
+        resp = self.app.put('/api/2/inf/esrs',
+                            headers={'X-Auth': self.token},
+                            json={'name': "myESRS", 'new_network': "someNetwork"})
+
+        task_id = resp.json['content']['task-id']
+        expected = 'asdf-asdf-asdf'
+
+        self.assertEqual(task_id, expected)
+
+    def test_put_task_link(self):
+        """ESRSView - PUT on /api/2/inf/esrs sets the Link header"""
+        resp = self.app.put('/api/2/inf/esrs',
+                            headers={'X-Auth': self.token},
+                            json={'name': "myESRS", 'new_network': "someNetwork"})
+
+        task_id = resp.headers['Link']
+        expected = '<https://localhost/api/2/inf/esrs/task/asdf-asdf-asdf>; rel=status'
+
+        self.assertEqual(task_id, expected)
+
+    def test_put_network_name(self):
+        """ESRSView - PUT on /api/2/inf/esrs prefixes the network with the username"""
+        self.app.put('/api/2/inf/esrs',
+                     headers={'X-Auth': self.token},
+                     json={'name': "myESRS", 'new_network': "someNetwork"})
+
+        args, _ = self.celery_app.send_task.call_args
+        expected = ('esrs.modify_network', ['bob', 'myESRS', 'bob_someNetwork', 'noId'])
+
+        self.assertEqual(args, expected)
+
+    def test_power(self):
+        """ESRSView - POST on /api/2/inf/esrs/power sends the names and action to the worker"""
+        resp = self.app.post('/api/2/inf/esrs/power',
+                             headers={'X-Auth': self.token},
+                             json={'name': ["esrs1", "esrs2"], 'power': "shutdown"})
+
+        args, _ = self.celery_app.send_task.call_args
+        expected = ('esrs.power', ['bob', ['esrs1', 'esrs2'], 'shutdown', 'noId'])
+
+        self.assertEqual(resp.status_code, 202)
+        self.assertEqual(args, expected)
+
+    def test_power_all(self):
+        """ESRSView - POST on /api/2/inf/esrs/power without a name powers all of the user's ESRS"""
+        self.app.post('/api/2/inf/esrs/power',
+                      headers={'X-Auth': self.token},
+                      json={'power': "on"})
+
+        args, _ = self.celery_app.send_task.call_args
+        expected = ('esrs.power', ['bob', None, 'on', 'noId'])
+
+        self.assertEqual(args, expected)
+
+    def test_patch_bulk(self):
+        """ESRSView - PATCH on /api/2/inf/esrs accepts a list of names"""
+        resp = self.app.patch('/api/2/inf/esrs',
+                              headers={'X-Auth': self.token},
+                              json={'name': ["esrs1", "esrs2"], 'new_network': "someNetwork"})
+
+        args, _ = self.celery_app.send_task.call_args
+        expected = ('esrs.modify_network', ['bob', ['esrs1', 'esrs2'], 'bob_someNetwork', 'noId'])
+
+        self.assertEqual(resp.status_code, 202)
+        self.assertEqual(args, expected)
+
+    def test_reaper_opt_out(self):
+        """ESRSView - PUT on /api/2/inf/esrs/reaper sends the opt-out to the worker"""
+        resp = self.app.put('/api/2/inf/esrs/reaper',
+                            headers={'X-Auth': self.token},
+                            json={'opt_out': True})
+
+        the_args, _ = self.celery_app.send_task.call_args
+
+        self.assertEqual(resp.status_code, 202)
+        self.assertEqual(the_args, ('esrs.reaper_opt_out', ['bob', True, 'noId']))
+
+    @patch.object(esrs, 'const')
+    def test_export(self, fake_const):
+        """ESRSView - POST on /api/2/inf/esrs/export starts an export"""
+        fake_const.VLAB_ESRS_ADMINS = 'bob'
+        fake_const.VLAB_URL = 'https://localhost'
+        resp = self.app.post('/api/2/inf/esrs/export',
+                             headers={'X-Auth': self.token})
+
+        expected = '<https://localhost/api/2/inf/esrs/export/asdf-asdf-asdf>; rel=export'
+
+        self.assertEqual(resp.status_code, 202)
+        self.assertEqual(resp.headers['Link'], expected)
+
+    def test_export_not_admin(self):
+        """ESRSView - POST on /api/2/inf/esrs/export is only for admins"""
+        resp = self.app.post('/api/2/inf/esrs/export',
+                             headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 403)
+        self.assertFalse(self.celery_app.send_task.called)
+
+    @patch.object(esrs.exports, 'follow')
+    @patch.object(esrs, 'const')
+    def test_export_records(self, fake_const, fake_follow):
+        """ESRSView - GET on /api/2/inf/esrs/export/<id> streams the export"""
+        fake_const.VLAB_ESRS_ADMINS = 'bob'
+        fake_follow.return_value = iter(['{"name": "esrs1"}\n', '{"name": "esrs2"}\n'])
+        resp = self.app.get('/api/2/inf/esrs/export/asdf-asdf-asdf',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+        self.assertEqual(resp.data, b'{"name": "esrs1"}\n{"name": "esrs2"}\n')
+
+    def test_export_records_not_admin(self):
+        """ESRSView - GET on /api/2/inf/esrs/export/<id> is only for admins"""
+        resp = self.app.get('/api/2/inf/esrs/export/asdf-asdf-asdf',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 403)
+
+    def test_task_queued(self):
+        """ESRSView - GET on /api/2/inf/esrs/task/<id> includes the place in line of a queued create"""
+        self.celery_app.AsyncResult.return_value.status = 'QUEUED'
+        self.celery_app.AsyncResult.return_value.info = {'position': 3}
+        resp = self.app.get('/api/2/inf/esrs/task/asdf-asdf-asdf',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 202)
+        self.assertEqual(resp.json['content'], {'status': 'QUEUED', 'position': 3})
+
+    def test_task_success(self):
+        """ESRSView - GET on /api/2/inf/esrs/task/<id> returns the result of a finished task"""
+        self.celery_app.AsyncResult.return_value.status = 'SUCCESS'
+        self.celery_app.AsyncResult.return_value.result = {'content': {'myESRS': {}}, 'error': None, 'params': {}}
+        resp = self.app.get('/api/2/inf/esrs/task/asdf-asdf-asdf',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json['content'], {'myESRS': {}})
+
+    @patch.object(esrs.cancel, 'request')
+    def test_cancel_task(self, fake_request):
+        """ESRSView - DELETE on /api/2/inf/esrs/task/<id> asks the task to stop"""
+        resp = self.app.delete('/api/2/inf/esrs/task/asdf-asdf-asdf',
+                               headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 202)
+        fake_request.assert_called_with('asdf-asdf-asdf', 'bob', admin=False)
+
+    def test_cancel_task_bad_id(self):
+        """ESRSView - DELETE on /api/2/inf/esrs/task/<id> returns 400 for malformed task ids"""
+        resp = self.app.delete('/api/2/inf/esrs/task/not.a.task',
+                               headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 400)
+
+    def get_published(self, url, headers):
+        """Send a GET, with a real Celery app that publishes to memory
+
+        :Returns: Tuple - the response, and the headers of the Celery message the request sent
+        """
+        self.app.application.celery_app = Celery('test', broker='memory://', backend='cache+memory://')
+        sent = []
+        def record(headers=None, **kwargs):
+            sent.append(headers)
+        after_task_publish.connect(record)
+        try:
+            resp = self.app.get(url, headers=headers)
+        finally:
+            after_task_publish.disconnect(record)
+        return resp, sent[0]
+
+    @patch.object(esrs, 'const')
+    def test_profile_header(self, fake_const):
+        """ESRSView - The X-PROFILE header asks the worker to profile the task, and links to the profile"""
+        fake_const.VLAB_ESRS_ADMINS = 'bob'
+        fake_const.VLAB_URL = 'https://localhost'
+        resp, headers = self.get_published('/api/2/inf/esrs', {'X-Auth': self.token, 'X-PROFILE': '1'})
+
+        task_id = resp.json['content']['task-id']
+        expected = '<https://localhost/api/2/inf/esrs/profile/{}>; rel=profile'.format(task_id)
+
+        self.assertTrue(headers[profiling.HEADER])
+        self.assertIn(expected, resp.headers.getlist('Link'))
+
+    def test_profile_header_not_admin(self):
+        """ESRSView - The X-PROFILE header is ignored for users that aren't admins"""
+        resp, headers = self.get_published('/api/2/inf/esrs', {'X-Auth': self.token, 'X-PROFILE': '1'})
+
+        self.assertNotIn(profiling.HEADER, headers)
+        self.assertFalse([x for x in resp.headers.getlist('Link') if 'rel=profile' in x])
+
+    @patch.object(esrs, 'profiling')
+    @patch.object(esrs, 'const')
+    def test_profile(self, fake_const, fake_profiling):
+        """ESRSView - GET on /api/2/inf/esrs/profile/<id> returns the profile as text"""
+        fake_const.VLAB_ESRS_ADMINS = 'bob'
+        fake_profiling.report.return_value = 'some stats'
+        resp = self.app.get('/api/2/inf/esrs/profile/asdf-asdf-asdf?format=text',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data, b'some stats')
+
+    @patch.object(esrs, 'const')
+    def test_profile_missing(self, fake_const):
+        """ESRSView - GET on /api/2/inf/esrs/profile/<id> returns 404 until the task saves its profile"""
+        fake_const.VLAB_ESRS_ADMINS = 'bob'
+        with patch.object(profiling, 'const') as fake_profiling_const:
+            fake_profiling_const.VLAB_ESRS_PROFILE_DIR = '/nowhere'
+            resp = self.app.get('/api/2/inf/esrs/profile/asdf-asdf-asdf',
+                                headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 404)
+
+    def test_profile_not_admin(self):
+        """ESRSView - GET on /api/2/inf/esrs/profile/<id> is only for admins"""
+        resp = self.app.get('/api/2/inf/esrs/profile/asdf-asdf-asdf',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 403)
+
+    @patch.object(esrs, 'metadata')
+    def test_query(self, fake_metadata):
+        """ESRSView - GET on /api/2/inf/esrs/query only finds the user's own ESRS instances"""
+        fake_query = fake_metadata.get_index.return_value.query
+        fake_query.return_value = [{'owner': 'bob', 'name': 'esrs1'}]
+        resp = self.app.get('/api/2/inf/esrs/query?version=3.28&limit=10',
+                            headers={'X-Auth': self.token})
+
+        _, the_kwargs = fake_query.call_args
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json['content'], [{'owner': 'bob', 'name': 'esrs1'}])
+        self.assertEqual(the_kwargs['owner'], 'bob')
+        self.assertEqual(the_kwargs['limit'], 10)
+
+    def test_query_other_owner(self):
+        """ESRSView - GET on /api/2/inf/esrs/query of another user's ESRS is only for admins"""
+        resp = self.app.get('/api/2/inf/esrs/query?owner=alice',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 403)
+
+    @patch.object(esrs, 'metadata')
+    @patch.object(esrs, 'const')
+    def test_query_admin(self, fake_const, fake_metadata):
+        """ESRSView - GET on /api/2/inf/esrs/query lets admins find every user's ESRS instances"""
+        fake_const.VLAB_ESRS_ADMINS = 'bob'
+        fake_query = fake_metadata.get_index.return_value.query
+        fake_query.return_value = []
+        resp = self.app.get('/api/2/inf/esrs/query?created_before=12345',
+                            headers={'X-Auth': self.token})
+
+        _, the_kwargs = fake_query.call_args
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(the_kwargs['owner'], None)
+        self.assertEqual(the_kwargs['created_before'], 12345.0)
+
+    def test_query_bad_number(self):
+        """ESRSView - GET on /api/2/inf/esrs/query returns 400 for parameters that aren't numbers"""
+        resp = self.app.get('/api/2/inf/esrs/query?limit=lots',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 400)
+
+    @patch.object(esrs, 'metadata')
+    def test_query_unavailable(self, fake_metadata):
+        """ESRSView - GET on /api/2/inf/esrs/query returns 503 when the index doesn't exist yet"""
+        fake_metadata.get_index.side_effect = ValueError('not yet')
+        resp = self.app.get('/api/2/inf/esrs/query',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 503)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,77 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in export.py
+"""
+import types
+import unittest
+from unittest.mock import patch, MagicMock
+
+import ujson
+
+from vlab_esrs_api.lib.worker import export
+
+
+def make_obj(moid):
+    """A fake managed object"""
+    obj = MagicMock()
+    obj._moId = moid
+    return obj
+
+
+class TestExport(unittest.TestCase):
+    """A set of test cases for export.py"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.top = make_obj('group-top')
+        alice = make_obj('group-alice')
+        nested = make_obj('group-nested')
+        self.host = make_obj('host-1')
+        self.datastore = make_obj('datastore-1')
+        self.network = make_obj('network-1')
+        self.folders = [(alice, {'name': 'alice', 'parent': self.top}),
+                        (nested, {'name': 'stuff', 'parent': alice})]
+        esrs = {'name': 'esrs1', 'parent': nested, 'runtime.powerState': 'poweredOn',
+                'runtime.host': self.host, 'datastore': [self.datastore], 'network': [self.network],
+                'config.annotation': ujson.dumps({'component': 'ESRS', 'version': '3.28', 'created': 1234})}
+        onefs = dict(esrs, name='onefs1', **{'config.annotation': ujson.dumps({'component': 'OneFS'})})
+        self.vms = [(make_obj('vm-1'), esrs), (make_obj('vm-2'), onefs)]
+        self.patcher = patch.object(export.inventory, 'retrieve')
+        fake_retrieve = self.patcher.start()
+        fake_retrieve.side_effect = self._retrieve
+        self.vcenter = MagicMock()
+        self.vcenter.get_by_name.return_value = self.top
+
+    def tearDown(self):
+        """Runs after every test case"""
+        self.patcher.stop()
+
+    def _retrieve(self, vcenter, vimtype, properties, container=None):
+        """Stands in for inventory.retrieve"""
+        if vimtype is export.vim.Folder:
+            return iter(self.folders)
+        elif vimtype is export.vim.HostSystem:
+            return iter([(self.host, {'name': 'esxi01'})])
+        elif vimtype is export.vim.Datastore:
+            return iter([(self.datastore, {'name': 'VM-Storage'})])
+        elif vimtype is export.vim.Network:
+            return iter([(self.network, {'name': 'alice_frontend'})])
+        return iter(self.vms)
+
+    def test_records(self):
+        """``records`` describes every ESRS instance"""
+        output = list(export.records(self.vcenter, 'vc1'))
+        expected = [{'owner': 'alice', 'name': 'esrs1', 'version': '3.28', 'created': 1234,
+                     'state': 'poweredOn', 'host': 'esxi01', 'datastore': ['VM-Storage'], 'networks': ['frontend'],
+                     'vcenter': 'vc1'}]
+
+        self.assertEqual(output, expected)
+
+    def test_records_generator(self):
+        """``records`` yields records as the VMs are read, instead of building a list"""
+        output = export.records(self.vcenter, 'vc1')
+
+        self.assertTrue(isinstance(output, types.GeneratorType))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in exports.py
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import ujson
+
+from vlab_esrs_api.lib import exports
+
+
+class TestExports(unittest.TestCase):
+    """A set of test cases for exports.py"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.workdir = tempfile.mkdtemp()
+        self.patcher = patch.object(exports, 'const')
+        fake_const = self.patcher.start()
+        fake_const.VLAB_ESRS_EXPORT_DIR = self.workdir
+
+    def tearDown(self):
+        """Runs after every test case"""
+        self.patcher.stop()
+        shutil.rmtree(self.workdir)
+
+    def test_path_for(self):
+        """``path_for`` rejects ids that could escape the export directory"""
+        with self.assertRaises(ValueError):
+            exports.path_for('../../etc/passwd')
+
+    def test_writer(self):
+        """``ExportWriter`` renames the export once it's complete"""
+        with exports.ExportWriter('abc-123') as writer:
+            writer.write({'name': 'esrs1'})
+            self.assertTrue(os.path.exists(exports.path_for('abc-123', partial=True)))
+
+        with open(exports.path_for('abc-123')) as the_file:
+            output = [ujson.loads(x) for x in the_file]
+
+        self.assertEqual(output, [{'name': 'esrs1'}])
+        self.assertEqual(writer.count, 1)
+
+    def test_writer_error(self):
+        """``ExportWriter`` removes a failed export"""
+        try:
+            with exports.ExportWriter('abc-123') as writer:
+                writer.write({'name': 'esrs1'})
+                raise RuntimeError('testing')
+        except RuntimeError:
+            pass
+
+        self.assertEqual(os.listdir(self.workdir), [])
+
+    def test_follow(self):
+        """``follow`` reads the records written while it waits"""
+        writer = exports.ExportWriter('abc-123').__enter__()
+        writer.write({'name': 'esrs1'})
+        writer.flush()
+        pending = [{'name': 'esrs2'}, {'name': 'esrs3'}]
+
+        def fake_sleep(seconds):
+            """Write more records each time the reader waits"""
+            if pending:
+                writer.write(pending.pop(0))
+                writer.flush()
+            else:
+                writer.__exit__(None, None, None)
+
+        output = ''.join(exports.follow('abc-123', sleep=fake_sleep))
+        names = [ujson.loads(x)['name'] for x in output.splitlines()]
+
+        self.assertEqual(names, ['esrs1', 'esrs2', 'esrs3'])
+
+    def test_follow_whole_lines(self):
+        """``follow`` never yields part of a record"""
+        writer = exports.ExportWriter('abc-123').__enter__()
+        writer._file.write('{"name": "es')
+        writer.flush()
+        chunks = []
+
+        def fake_sleep(seconds):
+            """Finish the record"""
+            writer._file.write('rs1"}\n')
+            writer.__exit__(None, None, None)
+
+        for chunk in exports.follow('abc-123', sleep=fake_sleep):
+            chunks.append(chunk)
+
+        self.assertEqual(chunks, ['{"name": "esrs1"}\n'])
+
+    def test_follow_timeout(self):
+        """``follow`` gives up if the export never shows up"""
+        output = list(exports.follow('abc-123', wait=1, poll_interval=0.5, sleep=lambda x: None))
+
+        self.assertEqual(output, [])
+
+    def test_clean(self):
+        """``clean`` deletes old exports"""
+        with exports.ExportWriter('old') as writer:
+            writer.write({})
+        os.utime(exports.path_for('old'), (0, 0))
+        with exports.ExportWriter('new') as writer:
+            writer.write({})
+
+        exports.clean(3600)
+
+        self.assertEqual(os.listdir(self.workdir), ['new.ndjson'])
+
+
+if __name__ == '__main__':
+    unittest.main()
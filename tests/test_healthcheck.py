@@ -31,6 +31,14 @@ class TestHealthView(unittest.TestCase):
 
         self.assertEqual(resp.status_code, expected)
 
+    @patch.object(healthcheck.breaker, 'status')
+    def test_get_breaker(self, fake_status):
+        """HealthView reports the state of the vCenter circuit breakers"""
+        fake_status.return_value = {'vc1': {'state': 'open'}}
+        resp = self.app.get('/api/1/inf/esrs/healthcheck')
+
+        self.assertEqual(resp.json['vcenter'], {'vc1': {'state': 'open'}})
+
 
 if __name__ == '__main__':
     unittest.main()
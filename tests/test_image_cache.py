@@ -0,0 +1,194 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in image_cache.py
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch, MagicMock
+
+from vlab_esrs_api.lib.worker import image_cache, integrity
+
+
+class TestImageCache(unittest.TestCase):
+    """A set of test cases for the ImageCache object"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.source_dir = tempfile.mkdtemp()
+        self.cache_dir = tempfile.mkdtemp()
+        for version, size in (('3.28', 100), ('3.30', 200), ('3.32', 300)):
+            with open(os.path.join(self.source_dir, 'ESRS_{}.ova'.format(version)), 'wb') as the_file:
+                the_file.write(os.urandom(size))
+        self.cache = image_cache.ImageCache(self.source_dir, self.cache_dir, max_bytes=500)
+
+    def tearDown(self):
+        """Runs after every test case"""
+        shutil.rmtree(self.source_dir)
+        shutil.rmtree(self.cache_dir)
+
+    def test_checkout(self):
+        """``ImageCache.checkout`` returns a local copy of the image"""
+        with self.cache.checkout('ESRS_3.28.ova') as path:
+            with open(path, 'rb') as the_file:
+                cached = the_file.read()
+        with open(os.path.join(self.source_dir, 'ESRS_3.28.ova'), 'rb') as the_file:
+            source = the_file.read()
+
+        self.assertTrue(path.startswith(self.cache_dir))
+        self.assertEqual(cached, source)
+
+    def test_checkout_content_addressed(self):
+        """``ImageCache.checkout`` names the cached copy after its sha256"""
+        with self.cache.checkout('ESRS_3.28.ova') as path:
+            pass
+        expected = image_cache._sha256(os.path.join(self.source_dir, 'ESRS_3.28.ova'))
+
+        self.assertEqual(os.path.basename(path), '{}.ova'.format(expected))
+
+    @patch.object(image_cache.ImageCache, '_copy')
+    def test_checkout_copies_once(self, fake_copy):
+        """``ImageCache.checkout`` only copies an image into the cache once"""
+        def copy(source, expected):
+            digest = image_cache._sha256(source)
+            shutil.copy(source, self.cache._object_path(digest))
+            return digest
+        fake_copy.side_effect = copy
+
+        for _ in range(3):
+            with self.cache.checkout('ESRS_3.28.ova'):
+                pass
+
+        self.assertEqual(fake_copy.call_count, 1)
+
+    def test_checkout_refills_changed(self):
+        """``ImageCache.checkout`` refreshes the cached copy when the source changes"""
+        with self.cache.checkout('ESRS_3.28.ova') as first:
+            pass
+        source = os.path.join(self.source_dir, 'ESRS_3.28.ova')
+        with open(source, 'wb') as the_file:
+            the_file.write(os.urandom(100))
+        os.utime(source, (1, 1))
+        with self.cache.checkout('ESRS_3.28.ova') as second:
+            pass
+
+        self.assertNotEqual(first, second)
+
+    def test_checkout_missing(self):
+        """``ImageCache.checkout`` raises FileNotFoundError for unknown images"""
+        with self.assertRaises(FileNotFoundError):
+            with self.cache.checkout('ESRS_1.0.ova'):
+                pass
+
+    def test_checkout_too_big(self):
+        """``ImageCache.checkout`` reads from the source if the image can never fit"""
+        cache = image_cache.ImageCache(self.source_dir, self.cache_dir, max_bytes=50)
+        with cache.checkout('ESRS_3.28.ova') as path:
+            pass
+
+        self.assertEqual(path, os.path.join(self.source_dir, 'ESRS_3.28.ova'))
+
+    def test_evict_lru(self):
+        """``ImageCache`` evicts the least recently used image to stay under the size limit"""
+        with self.cache.checkout('ESRS_3.28.ova'):
+            pass
+        with self.cache.checkout('ESRS_3.30.ova') as oldest:
+            pass
+        with self.cache.checkout('ESRS_3.28.ova') as newest:
+            pass
+        with self.cache.checkout('ESRS_3.32.ova'):
+            pass
+
+        self.assertFalse(os.path.exists(oldest))
+        self.assertTrue(os.path.exists(newest))
+        self.assertEqual(len(os.listdir(self.cache._objects)), 2)
+
+    def test_checkout_keeps_key(self):
+        """``ImageCache.checkout`` doesn't change the file a deploy keys its caches on"""
+        with self.cache.checkout('ESRS_3.28.ova') as path:
+            first = integrity.image_key(path)
+        with self.cache.checkout('ESRS_3.28.ova') as path:
+            second = integrity.image_key(path)
+
+        self.assertEqual(first, second)
+
+    def test_evict_skips_in_use(self):
+        """``ImageCache`` does not evict an image that's checked out"""
+        with self.cache.checkout('ESRS_3.28.ova') as in_use:
+            with self.cache.checkout('ESRS_3.30.ova'):
+                pass
+            with self.cache.checkout('ESRS_3.32.ova'):
+                pass
+
+            self.assertTrue(os.path.exists(in_use))
+
+    def test_evict_race(self):
+        """``ImageCache`` skips images another worker evicted while it was looking"""
+        with self.cache.checkout('ESRS_3.28.ova'):
+            pass
+        listdir = os.listdir
+        with patch.object(image_cache.os, 'listdir') as fake_listdir:
+            fake_listdir.side_effect = lambda path: listdir(path) + ['gone.ova']
+            self.cache._evict(300)
+
+        self.assertEqual(len(os.listdir(self.cache._objects)), 1)
+
+    def test_refill_checks_digest(self):
+        """``ImageCache.checkout`` rejects a refill that differs from the first copy of an unchanged source"""
+        with self.cache.checkout('ESRS_3.28.ova') as path:
+            pass
+        os.unlink(path)
+        source = os.path.join(self.source_dir, 'ESRS_3.28.ova')
+        info = os.stat(source)
+        with open(source, 'wb') as the_file:
+            the_file.write(os.urandom(100))
+        os.utime(source, ns=(info.st_atime_ns, info.st_mtime_ns))
+
+        with self.assertRaises(image_cache.IntegrityError):
+            with self.cache.checkout('ESRS_3.28.ova'):
+                pass
+
+        self.assertEqual(os.listdir(self.cache._objects), [])
+
+    def test_prefetch(self):
+        """``ImageCache.prefetch`` fills the cache with the most used images"""
+        for _ in range(2):
+            with self.cache.checkout('ESRS_3.30.ova'):
+                pass
+        with self.cache.checkout('ESRS_3.28.ova'):
+            pass
+        shutil.rmtree(self.cache._objects)
+        os.makedirs(self.cache._objects)
+
+        output = self.cache.prefetch(1)
+        expected = ['ESRS_3.30.ova']
+
+        self.assertEqual(output, expected)
+        self.assertEqual(len(os.listdir(self.cache._objects)), 1)
+
+
+class TestCheckout(unittest.TestCase):
+    """A set of test cases for the module level ``checkout`` function"""
+    @patch.object(image_cache, 'const')
+    def test_checkout_disabled(self, fake_const):
+        """``checkout`` returns the path to the source image when caching is disabled"""
+        fake_const.VLAB_ESRS_IMAGE_CACHE_DIR = ''
+        fake_const.VLAB_ESRS_IMAGES_DIR = '/images'
+
+        with image_cache.checkout('ESRS_3.28.ova') as path:
+            pass
+
+        self.assertEqual(path, '/images/ESRS_3.28.ova')
+
+    @patch.object(image_cache, 'get_cache')
+    def test_prefetch_disabled(self, fake_get_cache):
+        """``prefetch`` does nothing when caching is disabled"""
+        fake_get_cache.return_value = None
+
+        output = image_cache.prefetch()
+
+        self.assertEqual(output, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
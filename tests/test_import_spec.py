@@ -0,0 +1,207 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in import_spec.py
+"""
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+from unittest.mock import patch, MagicMock
+
+from vlab_esrs_api.lib.worker import import_spec, image_cache
+from vlab_esrs_api.lib.worker.import_spec import vim
+
+from helpers import DESCRIPTOR, make_ova
+
+
+def make_stub(properties):
+    """Stands in for a session to vCenter, where managed objects read their properties
+
+    :param properties: Property name -> value
+    :type properties: Dictionary
+    """
+    stub = MagicMock()
+    stub.InvokeAccessor.side_effect = lambda mo, info: properties[info.name]
+    return stub
+
+
+def make_spec(name, network):
+    """Make a result of ``OvfManager.CreateImportSpec`` for a VM with one NIC"""
+    backing = vim.vm.device.VirtualEthernetCard.NetworkBackingInfo(deviceName=network.name, network=network)
+    nic = vim.vm.device.VirtualVmxnet3(key=4000, backing=backing)
+    disk = vim.vm.device.VirtualDisk(key=2000, capacityInKB=1024)
+    config = vim.vm.ConfigSpec(name=name,
+                               deviceChange=[vim.vm.device.VirtualDeviceSpec(operation='add', device=disk),
+                                             vim.vm.device.VirtualDeviceSpec(operation='add', device=nic)])
+    spec = vim.OvfManager.CreateImportSpecResult()
+    spec.importSpec = vim.VirtualMachineImportSpec(configSpec=config)
+    spec.fileItem = [vim.OvfManager.FileItem(deviceId='disk1', path='disk.vmdk', size=10, create=True)]
+    return spec
+
+
+class TestSpecCache(unittest.TestCase):
+    """A set of test cases for the SpecCache object"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.workdir = tempfile.mkdtemp()
+        self.ova_path = os.path.join(self.workdir, 'ESRS_3.28.ova')
+        make_ova(self.ova_path)
+        self.cache = import_spec.SpecCache(max_entries=2)
+        self.vcenter = MagicMock()
+        self.resource_pool = vim.ResourcePool('resgroup-1')
+        self.datastore = vim.Datastore('datastore-1')
+        self.network1 = vim.Network('network-1', make_stub({'name': 'alice_frontend'}))
+        self.network2 = vim.Network('network-2', make_stub({'name': 'bob_frontend'}))
+        self.vcenter.ovf_manager.CreateImportSpec.return_value = make_spec('esrs1', self.network1)
+
+    def tearDown(self):
+        """Runs after every test case"""
+        shutil.rmtree(self.workdir)
+
+    def import_spec(self, machine_name, network):
+        """Make the import spec for an instance on ``network``"""
+        network_map = [vim.OvfManager.NetworkMapping(name='vLabNetwork', network=network)]
+        return self.cache.import_spec(self.vcenter, self.ova_path, self.resource_pool, self.datastore,
+                                      machine_name, network_map)
+
+    def test_descriptor(self):
+        """``descriptor`` reads the OVF descriptor and its networks from the OVA"""
+        found = self.cache.descriptor(self.ova_path)
+
+        self.assertEqual(found.name, 'ESRS.ovf')
+        self.assertEqual(found.text, DESCRIPTOR.decode())
+        self.assertEqual(found.networks, ['vLabNetwork'])
+
+    def test_descriptor_cached(self):
+        """``descriptor`` only reads the OVA once"""
+        self.cache.descriptor(self.ova_path)
+        with patch.object(import_spec.tarfile, 'open') as fake_open:
+            self.cache.descriptor(self.ova_path)
+
+        self.assertFalse(fake_open.called)
+
+    def test_descriptor_changed(self):
+        """``descriptor`` reads the OVA again after it's replaced"""
+        self.cache.descriptor(self.ova_path)
+        new_path = os.path.join(self.workdir, 'new.ova')
+        make_ova(new_path)
+        os.rename(new_path, self.ova_path)
+        with patch.object(import_spec.tarfile, 'open', wraps=tarfile.open) as fake_open:
+            self.cache.descriptor(self.ova_path)
+
+        self.assertTrue(fake_open.called)
+
+    def test_import_spec(self):
+        """``import_spec`` asks vCenter for the first spec of an image"""
+        spec, file_items, cached = self.import_spec('esrs1', self.network1)
+
+        self.assertFalse(cached)
+        self.assertEqual(spec.configSpec.name, 'esrs1')
+        self.assertEqual(file_items[0].path, 'disk.vmdk')
+
+    def test_import_spec_thin(self):
+        """``import_spec`` asks vCenter for thin provisioned disks"""
+        self.import_spec('esrs1', self.network1)
+        _, kwargs = self.vcenter.ovf_manager.CreateImportSpec.call_args
+
+        self.assertEqual(kwargs['cisp'].diskProvisioning, 'thin')
+
+    def test_import_spec_bad_name(self):
+        """``import_spec`` raises ValueError for a machine name that isn't a valid hostname"""
+        with self.assertRaises(ValueError):
+            self.import_spec('my_esrs!', self.network1)
+
+        self.assertFalse(self.vcenter.ovf_manager.CreateImportSpec.called)
+
+    def test_import_spec_cached(self):
+        """``import_spec`` patches the name and network into a copy of the cached spec"""
+        first, _, _ = self.import_spec('esrs1', self.network1)
+        spec, file_items, cached = self.import_spec('esrs2', self.network2)
+        nic = spec.configSpec.deviceChange[1].device
+
+        self.assertTrue(cached)
+        self.assertEqual(self.vcenter.ovf_manager.CreateImportSpec.call_count, 1)
+        self.assertEqual(spec.configSpec.name, 'esrs2')
+        self.assertEqual(nic.backing.network._moId, 'network-2')
+        self.assertEqual(nic.backing.deviceName, 'bob_frontend')
+        self.assertEqual(spec.configSpec.deviceChange[0].device.capacityInKB, 1024)
+        self.assertEqual(file_items[0].path, 'disk.vmdk')
+
+    def test_import_spec_image_cache(self):
+        """``import_spec`` reuses the template for every checkout of an image from the image cache"""
+        cache = image_cache.ImageCache(self.workdir, os.path.join(self.workdir, 'cache'), max_bytes=1024 ** 2)
+        outputs = []
+        for machine_name in ('esrs1', 'esrs2', 'esrs3'):
+            with cache.checkout('ESRS_3.28.ova') as path:
+                self.ova_path = path
+                outputs.append(self.import_spec(machine_name, self.network1))
+
+        self.assertEqual([x[2] for x in outputs], [False, True, True])
+        self.assertEqual(self.vcenter.ovf_manager.CreateImportSpec.call_count, 1)
+
+    def test_descriptor_image_cache(self):
+        """``descriptor`` only reads an image from the image cache once"""
+        cache = image_cache.ImageCache(self.workdir, os.path.join(self.workdir, 'cache'), max_bytes=1024 ** 2)
+        with cache.checkout('ESRS_3.28.ova') as path:
+            self.cache.descriptor(path)
+        with cache.checkout('ESRS_3.28.ova') as path:
+            with patch.object(import_spec.tarfile, 'open') as fake_open:
+                self.cache.descriptor(path)
+
+        self.assertFalse(fake_open.called)
+
+    def test_import_spec_copies(self):
+        """``import_spec`` never hands out the cached template itself"""
+        self.import_spec('esrs1', self.network1)
+        spec, _, _ = self.import_spec('esrs2', self.network2)
+        spec.configSpec.name = 'changed'
+        again, _, _ = self.import_spec('esrs3', self.network1)
+
+        self.assertEqual(again.configSpec.name, 'esrs3')
+        self.assertEqual(again.configSpec.deviceChange[1].device.backing.network._moId, 'network-1')
+
+    def test_import_spec_distributed(self):
+        """``import_spec`` connects NICs to distributed port groups"""
+        switch = vim.DistributedVirtualSwitch('dvs-1', make_stub({'uuid': 'some-uuid'}))
+        config = vim.dvs.DistributedVirtualPortgroup.ConfigInfo(key='dvportgroup-9', distributedVirtualSwitch=switch)
+        portgroup = vim.dvs.DistributedVirtualPortgroup('dvportgroup-9', make_stub({'config': config}))
+        self.import_spec('esrs1', self.network1)
+
+        spec, _, _ = self.import_spec('esrs2', portgroup)
+        backing = spec.configSpec.deviceChange[1].device.backing
+
+        self.assertEqual(backing.port.portgroupKey, 'dvportgroup-9')
+        self.assertEqual(backing.port.switchUuid, 'some-uuid')
+
+    def test_import_spec_warnings(self):
+        """``import_spec`` doesn't cache specs that vCenter warned about"""
+        self.vcenter.ovf_manager.CreateImportSpec.return_value.warning = [vim.fault.OvfUnsupportedPackage()]
+        self.import_spec('esrs1', self.network1)
+        _, _, cached = self.import_spec('esrs2', self.network2)
+
+        self.assertFalse(cached)
+        self.assertEqual(self.vcenter.ovf_manager.CreateImportSpec.call_count, 2)
+
+    def test_import_spec_error(self):
+        """``import_spec`` raises ValueError if vCenter rejects the OVA"""
+        self.vcenter.ovf_manager.CreateImportSpec.return_value.error = [vim.fault.OvfUnsupportedPackage(msg='testing')]
+
+        with self.assertRaises(ValueError):
+            self.import_spec('esrs1', self.network1)
+
+    def test_lru(self):
+        """``SpecCache`` forgets the least recently used templates"""
+        self.import_spec('esrs1', self.network1)
+        self.resource_pool = vim.ResourcePool('resgroup-2')
+        self.import_spec('esrs2', self.network1)
+        self.resource_pool = vim.ResourcePool('resgroup-3')
+        self.import_spec('esrs3', self.network1)
+        self.resource_pool = vim.ResourcePool('resgroup-1')
+        _, _, cached = self.import_spec('esrs4', self.network1)
+
+        self.assertFalse(cached)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,155 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in integrity.py
+"""
+import os
+import shutil
+import hashlib
+import tempfile
+import unittest
+from unittest.mock import patch, MagicMock
+
+from vlab_esrs_api.lib.worker import integrity, image_cache
+
+
+class TestParseManifest(unittest.TestCase):
+    """A set of test cases for the ``parse_manifest`` function"""
+    def test_parse_manifest(self):
+        """``parse_manifest`` returns the algorithm and digest of every file"""
+        text = 'SHA256(ESRS.ovf)= ABCD\nSHA1(ESRS-disk1.vmdk)= 1234\n'
+
+        output = integrity.parse_manifest(text)
+        expected = {'ESRS.ovf': ('sha256', 'abcd'), 'ESRS-disk1.vmdk': ('sha1', '1234')}
+
+        self.assertEqual(output, expected)
+
+    def test_parse_manifest_malformed(self):
+        """``parse_manifest`` raises IntegrityError for lines it cannot parse"""
+        with self.assertRaises(integrity.IntegrityError):
+            integrity.parse_manifest('MD5 ESRS.ovf abcd')
+
+
+class TestVerifier(unittest.TestCase):
+    """A set of test cases for the Verifier object"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.workdir = tempfile.mkdtemp()
+        self.ova_path = os.path.join(self.workdir, 'ESRS_3.28.ova')
+        with open(self.ova_path, 'wb') as the_file:
+            the_file.write(b'not really a tar')
+        self.disk = b'some disk bytes'
+        self.manifest = 'SHA256(disk.vmdk)= {}\n'.format(hashlib.sha256(self.disk).hexdigest())
+        self.patcher = patch.object(integrity, 'const')
+        fake_const = self.patcher.start()
+        fake_const.VLAB_ESRS_VERIFY_DB = os.path.join(self.workdir, 'verified.json')
+        fake_const.VLAB_ESRS_VERIFY_IMAGES = 1
+        fake_const.VLAB_ESRS_FORCE_VERIFY = 0
+
+    def tearDown(self):
+        """Runs after every test case"""
+        self.patcher.stop()
+        shutil.rmtree(self.workdir)
+
+    def test_check(self):
+        """``Verifier.check`` records the image as verified when the hashes match"""
+        verifier = integrity.Verifier(self.ova_path, self.manifest)
+        verifier.update('disk.vmdk', self.disk[:4])
+        verifier.update('disk.vmdk', self.disk[4:])
+        verifier.check()
+
+        self.assertFalse(integrity.needs_verification(self.ova_path))
+
+    def test_check_mismatch(self):
+        """``Verifier.check`` raises IntegrityError when a hash doesn't match"""
+        verifier = integrity.Verifier(self.ova_path, self.manifest)
+        verifier.update('disk.vmdk', b'corrupted')
+
+        with self.assertRaises(integrity.IntegrityError):
+            verifier.check()
+
+    def test_check_mismatch_not_recorded(self):
+        """``Verifier.check`` does not record images that fail verification"""
+        verifier = integrity.Verifier(self.ova_path, self.manifest)
+        verifier.update('disk.vmdk', b'corrupted')
+        try:
+            verifier.check()
+        except integrity.IntegrityError:
+            pass
+
+        self.assertTrue(integrity.needs_verification(self.ova_path))
+
+    def test_update_unknown_file(self):
+        """``Verifier.update`` raises IntegrityError for files not in the manifest"""
+        verifier = integrity.Verifier(self.ova_path, self.manifest)
+
+        with self.assertRaises(integrity.IntegrityError):
+            verifier.update('evil.vmdk', b'data')
+
+    def test_integrity_error_is_value_error(self):
+        """IntegrityError is a ValueError, so tasks report it to the user"""
+        self.assertTrue(issubclass(integrity.IntegrityError, ValueError))
+
+    def test_needs_verification_changed(self):
+        """``needs_verification`` is True once the image changes on disk"""
+        verifier = integrity.Verifier(self.ova_path, self.manifest)
+        verifier.update('disk.vmdk', self.disk)
+        verifier.check()
+        with open(self.ova_path, 'ab') as the_file:
+            the_file.write(b'more')
+
+        self.assertTrue(integrity.needs_verification(self.ova_path))
+
+    def test_needs_verification_touched(self):
+        """``needs_verification`` is False for a verified image that was only touched"""
+        verifier = integrity.Verifier(self.ova_path, self.manifest)
+        verifier.update('disk.vmdk', self.disk)
+        verifier.check()
+        os.utime(self.ova_path, (1, 1))
+
+        self.assertFalse(integrity.needs_verification(self.ova_path))
+
+    def test_needs_verification_replaced(self):
+        """``needs_verification`` is True once the image is replaced by a new file of the same size"""
+        verifier = integrity.Verifier(self.ova_path, self.manifest)
+        verifier.update('disk.vmdk', self.disk)
+        verifier.check()
+        new_path = os.path.join(self.workdir, 'new.ova')
+        with open(new_path, 'wb') as the_file:
+            the_file.write(b'not really a taR')
+        os.rename(new_path, self.ova_path)
+
+        self.assertTrue(integrity.needs_verification(self.ova_path))
+
+    def test_needs_verification_cached(self):
+        """``needs_verification`` is False for every later checkout of a verified image from the image cache"""
+        source_dir = os.path.join(self.workdir, 'images')
+        os.makedirs(source_dir)
+        shutil.copy(self.ova_path, source_dir)
+        cache = image_cache.ImageCache(source_dir, os.path.join(self.workdir, 'cache'), max_bytes=1024)
+        with cache.checkout('ESRS_3.28.ova') as path:
+            self.assertTrue(integrity.needs_verification(path))
+            verifier = integrity.Verifier(path, self.manifest)
+            verifier.update('disk.vmdk', self.disk)
+            verifier.check()
+
+        for _ in range(2):
+            with cache.checkout('ESRS_3.28.ova') as path:
+                self.assertFalse(integrity.needs_verification(path))
+
+    def test_needs_verification_force(self):
+        """``needs_verification`` is True when forced, even for verified images"""
+        verifier = integrity.Verifier(self.ova_path, self.manifest)
+        verifier.update('disk.vmdk', self.disk)
+        verifier.check()
+
+        self.assertTrue(integrity.needs_verification(self.ova_path, force=True))
+
+    def test_needs_verification_disabled(self):
+        """``needs_verification`` is False when verification is turned off"""
+        integrity.const.VLAB_ESRS_VERIFY_IMAGES = 0
+
+        self.assertFalse(integrity.needs_verification(self.ova_path))
+
+
+if __name__ == '__main__':
+    unittest.main()
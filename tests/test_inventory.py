@@ -0,0 +1,106 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in inventory.py
+"""
+import unittest
+from unittest.mock import MagicMock
+
+from vlab_esrs_api.lib.worker import inventory
+from vlab_esrs_api.lib.worker.inventory import vim
+
+from helpers import FakeClock
+
+
+def make_update(version, changes):
+    """Make a result of ``WaitForUpdatesEx``
+
+    :param changes: List of (managed object, property path, new value)
+    :type changes: List
+    """
+    objects = []
+    for obj, path, value in changes:
+        change = MagicMock()
+        change.name = path
+        change.val = value
+        objects.append(MagicMock(obj=obj, changeSet=[change]))
+    return MagicMock(version=version, filterSet=[MagicMock(objectSet=objects)])
+
+
+class TestWaitFor(unittest.TestCase):
+    """A set of test cases for the ``wait_for`` function"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.clock = FakeClock()
+        self.vcenter = MagicMock()
+        self.collector = self.vcenter.content.propertyCollector.CreatePropertyCollector.return_value
+        self.vm1 = vim.VirtualMachine('vm-1')
+        self.vm2 = vim.VirtualMachine('vm-2')
+
+    def wait(self, updates, timeout=60):
+        """Wait for both VMs to power off, as vCenter sends ``updates``"""
+        def wait_for_updates(version, options):
+            self.clock.now += 1
+            return updates.pop(0) if updates else None
+        self.collector.WaitForUpdatesEx.side_effect = wait_for_updates
+        return inventory.wait_for(self.vcenter, [self.vm1, self.vm2], 'runtime.powerState',
+                                  lambda state: state == 'poweredOff', timeout=timeout, clock=self.clock.time)
+
+    def test_wait_for(self):
+        """``wait_for`` watches every object with one PropertyCollector, until they're all done"""
+        updates = [make_update('1', [(self.vm1, 'runtime.powerState', 'poweredOn'),
+                                     (self.vm2, 'runtime.powerState', 'poweredOff')]),
+                   make_update('2', [(self.vm1, 'runtime.powerState', 'poweredOff')])]
+
+        values = self.wait(updates)
+
+        self.assertEqual(values, {'vm-1': 'poweredOff', 'vm-2': 'poweredOff'})
+        self.assertEqual(self.collector.WaitForUpdatesEx.call_count, 2)
+        self.assertEqual(self.collector.CreateFilter.call_count, 1)
+        self.assertTrue(self.collector.DestroyPropertyCollector.called)
+
+    def test_wait_for_timeout(self):
+        """``wait_for`` gives up after the timeout, with the last values it saw"""
+        updates = [make_update('1', [(self.vm1, 'runtime.powerState', 'poweredOn'),
+                                     (self.vm2, 'runtime.powerState', 'poweredOff')])]
+
+        values = self.wait(updates, timeout=5)
+
+        self.assertEqual(values, {'vm-1': 'poweredOn', 'vm-2': 'poweredOff'})
+        self.assertEqual(self.collector.WaitForUpdatesEx.call_count, 5)
+
+    def test_wait_for_whole_value(self):
+        """``wait_for`` asks vCenter for the whole value of the property on every change"""
+        self.wait([make_update('1', [(self.vm1, 'runtime.powerState', 'poweredOff'),
+                                     (self.vm2, 'runtime.powerState', 'poweredOff')])])
+        _, kwargs = self.collector.CreateFilter.call_args
+
+        self.assertFalse(kwargs['partialUpdates'])
+
+    def test_wait_for_nested(self):
+        """``wait_for`` applies changes to a nested property, like info.state of a running task"""
+        task = vim.Task('task-1')
+        updates = [make_update('1', [(task, 'info', vim.TaskInfo(key='task-1', state=vim.TaskInfo.State.running))]),
+                   make_update('2', [(task, 'info.progress', 50)]),
+                   make_update('3', [(task, 'info.state', vim.TaskInfo.State.success)])]
+        def wait_for_updates(version, options):
+            self.clock.now += 1
+            return updates.pop(0) if updates else None
+        self.collector.WaitForUpdatesEx.side_effect = wait_for_updates
+
+        values = inventory.wait_for(self.vcenter, [task], 'info', lambda info: info.state == 'success',
+                                    timeout=60, clock=self.clock.time)
+
+        self.assertEqual(values['task-1'].state, vim.TaskInfo.State.success)
+        self.assertEqual(values['task-1'].progress, 50)
+        self.assertEqual(self.collector.WaitForUpdatesEx.call_count, 3)
+
+    def test_wait_for_nothing(self):
+        """``wait_for`` doesn't call vCenter when there's nothing to wait on"""
+        values = inventory.wait_for(self.vcenter, [], 'info', lambda info: True, timeout=60)
+
+        self.assertEqual(values, {})
+        self.assertFalse(self.vcenter.content.propertyCollector.CreatePropertyCollector.called)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in listing.py
+"""
+import unittest
+from unittest.mock import patch, MagicMock
+
+import ujson
+
+from vlab_esrs_api.lib.worker import listing
+
+
+def make_vm(name, component='ESRS', state='poweredOn', ips=None, networks=None):
+    """Make a fake VM and the properties the PropertyCollector would return for it"""
+    vm = MagicMock()
+    vm._moId = 'vm-{}'.format(name)
+    nic = MagicMock()
+    nic.ipAddress = ips or []
+    props = {'name': name,
+             'config.annotation': ujson.dumps({'component': component, 'version': '3.28', 'created': 1234}),
+             'runtime.powerState': state,
+             'guest.net': [nic],
+             'network': networks or []}
+    return vm, props
+
+
+class TestListing(unittest.TestCase):
+    """A set of test cases for listing.py"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.vms = [make_vm('esrs{}'.format(x)) for x in (3, 1, 2)]
+        self.vms.append(make_vm('notESRS', component='OneFS'))
+        self.patcher = patch.object(listing.inventory, 'retrieve')
+        self.fake_retrieve = self.patcher.start()
+        self.fake_retrieve.side_effect = lambda *args, **kwargs: iter(self.vms)
+        self.vcenter = MagicMock()
+        self.folder = MagicMock()
+
+    def tearDown(self):
+        """Runs after every test case"""
+        self.patcher.stop()
+
+    def test_parse_fields(self):
+        """``parse_fields`` supports sub-fields of meta"""
+        output = listing.parse_fields('name, state,meta.version')
+        expected = {'name': None, 'state': None, 'meta': ['version']}
+
+        self.assertEqual(output, expected)
+
+    def test_parse_fields_whole_meta(self):
+        """``parse_fields`` - asking for all of meta wins over a sub-field"""
+        output = listing.parse_fields('meta.version,meta')
+
+        self.assertEqual(output, {'meta': None})
+
+    def test_parse_fields_unknown(self):
+        """``parse_fields`` raises ValueError for unknown fields"""
+        for fields in ('name,doh', 'state.foo', ','):
+            with self.assertRaises(ValueError):
+                listing.parse_fields(fields)
+
+    def test_cursor(self):
+        """``decode_cursor`` reverses ``encode_cursor``"""
+        output = listing.decode_cursor(listing.encode_cursor('myESRS'))
+
+        self.assertEqual(output, 'myESRS')
+
+    def test_cursor_invalid(self):
+        """``decode_cursor`` raises ValueError for malformed cursors"""
+        with self.assertRaises(ValueError):
+            listing.decode_cursor('not!base64')
+
+    def test_list_esrs_projection(self):
+        """``list_esrs`` only returns the requested fields"""
+        fields = listing.parse_fields('name,state,meta.version')
+
+        output, _ = listing.list_esrs(self.vcenter, self.folder, 'alice', fields=fields)
+        expected = {'esrs1': {'state': 'poweredOn', 'meta': {'version': '3.28'}},
+                    'esrs2': {'state': 'poweredOn', 'meta': {'version': '3.28'}},
+                    'esrs3': {'state': 'poweredOn', 'meta': {'version': '3.28'}}}
+
+        self.assertEqual(output, expected)
+
+    def test_list_esrs_properties(self):
+        """``list_esrs`` only fetches the properties the fields need"""
+        fields = listing.parse_fields('name,state')
+
+        listing.list_esrs(self.vcenter, self.folder, 'alice', fields=fields)
+        properties = self.fake_retrieve.call_args[0][2]
+
+        self.assertEqual(properties, ['config.annotation', 'name', 'runtime.powerState'])
+
+    def test_list_esrs_pages(self):
+        """``list_esrs`` pages through the VMs in name order"""
+        fields = listing.parse_fields('name')
+        seen = []
+        cursor = None
+        while True:
+            page, cursor = listing.list_esrs(self.vcenter, self.folder, 'alice',
+                                             fields=fields, limit=2, cursor=cursor)
+            seen += sorted(page)
+            if cursor is None:
+                break
+
+        self.assertEqual(seen, ['esrs1', 'esrs2', 'esrs3'])
+
+    def test_list_esrs_last_page(self):
+        """``list_esrs`` returns no cursor when there are no more VMs"""
+        _, cursor = listing.list_esrs(self.vcenter, self.folder, 'alice', fields={'name': None}, limit=3)
+
+        self.assertTrue(cursor is None)
+
+    @patch.object(listing.virtual_machine, 'get_info')
+    def test_list_esrs_all_fields(self, fake_get_info):
+        """``list_esrs`` uses ``get_info`` when no fields are requested, but only for the page"""
+        fake_get_info.return_value = {'worked': True}
+
+        output, _ = listing.list_esrs(self.vcenter, self.folder, 'alice', limit=1)
+
+        self.assertEqual(output, {'esrs1': {'worked': True}})
+        self.assertEqual(fake_get_info.call_count, 1)
+
+    def test_list_esrs_ips(self):
+        """``list_esrs`` drops IPv6 link-local addresses"""
+        self.vms = [make_vm('esrs1', ips=['10.1.1.1', 'fe80::1'])]
+
+        output, _ = listing.list_esrs(self.vcenter, self.folder, 'alice', fields={'ips': None})
+
+        self.assertEqual(output['esrs1']['ips'], ['10.1.1.1'])
+
+    def test_list_esrs_networks(self):
+        """``list_esrs`` returns the user's networks without the username prefix"""
+        frontend, backend = MagicMock(), MagicMock()
+        names = {id(frontend): 'alice_frontend', id(backend): 'bob_backend'}
+        self.vms = [make_vm('esrs1', networks=[frontend, backend])]
+
+        output, _ = listing.list_esrs(self.vcenter, self.folder, 'alice', fields={'networks': None},
+                                      network_name=lambda x: names[id(x)])
+
+        self.assertEqual(output['esrs1']['networks'], ['frontend'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,190 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in metadata.py
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from vlab_esrs_api.lib import metadata
+
+
+class TestMetadataIndex(unittest.TestCase):
+    """A set of test cases for the MetadataIndex object"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.workdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.workdir, 'metadata.db')
+        self.index = metadata.MetadataIndex(self.path)
+        self.index.upsert({'owner': 'alice', 'name': 'esrs1', 'vcenter': 'vc1', 'version': '3.28',
+                           'created': 100, 'state': 'poweredOn', 'networks': ['frontend']})
+        self.index.upsert({'owner': 'alice', 'name': 'esrs2', 'vcenter': 'vc1', 'version': '3.30',
+                           'created': 200, 'state': 'poweredOff', 'networks': []})
+        self.index.upsert({'owner': 'bob', 'name': 'esrs1', 'vcenter': 'vc2', 'version': '3.28',
+                           'created': 300, 'state': 'poweredOn', 'networks': []})
+
+    def tearDown(self):
+        """Runs after every test case"""
+        shutil.rmtree(self.workdir)
+
+    def test_query(self):
+        """``query`` returns every ESRS instance by default"""
+        output = [(x['owner'], x['name']) for x in self.index.query()]
+        expected = [('alice', 'esrs1'), ('alice', 'esrs2'), ('bob', 'esrs1')]
+
+        self.assertEqual(output, expected)
+
+    def test_query_record(self):
+        """``query`` returns the indexed metadata"""
+        output = self.index.query(owner='alice', limit=1)
+        expected = [{'owner': 'alice', 'name': 'esrs1', 'vcenter': 'vc1', 'version': '3.28',
+                     'created': 100, 'state': 'poweredOn', 'networks': ['frontend']}]
+
+        self.assertEqual(output, expected)
+
+    def test_query_filters(self):
+        """``query`` combines the supplied filters"""
+        output = self.index.query(version='3.28', created_after=150)
+
+        self.assertEqual([(x['owner'], x['name']) for x in output], [('bob', 'esrs1')])
+
+    def test_query_created_before(self):
+        """``query`` supports finding old ESRS instances"""
+        output = self.index.query(created_before=150)
+
+        self.assertEqual([(x['owner'], x['name']) for x in output], [('alice', 'esrs1')])
+
+    def test_remove(self):
+        """``remove`` forgets an ESRS instance"""
+        self.index.remove('alice', 'esrs1')
+        output = self.index.query(owner='alice')
+
+        self.assertEqual([x['name'] for x in output], ['esrs2'])
+
+    def test_set_networks(self):
+        """``set_networks`` records a network change"""
+        self.index.set_networks('alice', ['esrs1', 'esrs2'], ['backend'])
+        output = self.index.query(owner='alice')
+
+        self.assertEqual([x['networks'] for x in output], [['backend'], ['backend']])
+
+    def test_reconcile(self):
+        """``reconcile`` adds, updates and removes ESRS instances to match vCenter"""
+        records = [{'owner': 'alice', 'name': 'esrs2', 'vcenter': 'vc1', 'version': '3.30',
+                    'created': 200, 'state': 'poweredOn', 'networks': []},
+                   {'owner': 'alice', 'name': 'esrs3', 'vcenter': 'vc1', 'version': '3.30',
+                    'created': 400, 'state': 'poweredOn', 'networks': []}]
+
+        output = self.index.reconcile('vc1', iter(records))
+        found = [(x['owner'], x['name'], x['state']) for x in self.index.query()]
+        expected = [('alice', 'esrs2', 'poweredOn'), ('alice', 'esrs3', 'poweredOn'), ('bob', 'esrs1', 'poweredOn')]
+
+        self.assertEqual(output, {'added': 1, 'updated': 1, 'removed': 1})
+        self.assertEqual(found, expected)
+
+    @patch.object(metadata, 'RECONCILE_BATCH', 1)
+    def test_reconcile_batches(self):
+        """``reconcile`` works when the records span several batches"""
+        records = [{'owner': 'alice', 'name': 'esrs{}'.format(x), 'vcenter': 'vc1'} for x in range(5)]
+
+        output = self.index.reconcile('vc1', iter(records))
+
+        self.assertEqual(output, {'added': 3, 'updated': 2, 'removed': 0})
+
+    def test_reconcile_fresh(self):
+        """``reconcile`` records when the ESRS instances of a vCenter were last current"""
+        self.assertTrue(self.index.freshness(metadata.ESRS) is None)
+
+        self.index.reconcile('vc1', iter([]))
+
+        self.assertTrue(self.index.freshness(metadata.ESRS) is not None)
+
+    def test_exists(self):
+        """``exists`` checks for a user's ESRS instance by name"""
+        self.assertTrue(self.index.exists('alice', 'esrs2'))
+        self.assertFalse(self.index.exists('bob', 'esrs2'))
+
+    def test_count(self):
+        """``count`` counts a user's ESRS instances"""
+        self.assertEqual(self.index.count('alice'), 2)
+        self.assertEqual(self.index.count('carol'), 0)
+
+    def test_replace_catalog(self):
+        """``replace_catalog`` replaces every name of a kind from one scope"""
+        self.index.replace_catalog(metadata.NETWORK, 'vc1', ['alice_frontend', 'bob_frontend'])
+        self.index.replace_catalog(metadata.NETWORK, 'vc2', ['carol_frontend'])
+        self.index.replace_catalog(metadata.NETWORK, 'vc1', ['alice_frontend'])
+
+        self.assertTrue(self.index.in_catalog(metadata.NETWORK, 'alice_frontend'))
+        self.assertTrue(self.index.in_catalog(metadata.NETWORK, 'carol_frontend'))
+        self.assertFalse(self.index.in_catalog(metadata.NETWORK, 'bob_frontend'))
+        self.assertFalse(self.index.in_catalog(metadata.IMAGE, 'alice_frontend'))
+
+    def test_update_catalog(self):
+        """``update_catalog`` adds and removes names, and says the catalog is current"""
+        self.index.replace_catalog(metadata.NETWORK, 'vc1', ['alice_frontend'])
+        before = self.index.freshness(metadata.NETWORK)
+        self.index.update_catalog(metadata.NETWORK, 'vc1', added=['alice_backend'], removed=['alice_frontend'])
+
+        self.assertTrue(self.index.in_catalog(metadata.NETWORK, 'alice_backend'))
+        self.assertFalse(self.index.in_catalog(metadata.NETWORK, 'alice_frontend'))
+        self.assertTrue(self.index.freshness(metadata.NETWORK) >= before)
+
+    def test_freshness_oldest(self):
+        """``freshness`` is the time of the least current scope"""
+        with patch.object(metadata.time, 'time', return_value=100):
+            self.index.replace_catalog(metadata.NETWORK, 'vc1', [])
+        with patch.object(metadata.time, 'time', return_value=200):
+            self.index.replace_catalog(metadata.NETWORK, 'vc2', [])
+
+        self.assertEqual(self.index.freshness(metadata.NETWORK), 100)
+
+    def test_read_only(self):
+        """A read only MetadataIndex can't change the database"""
+        reader = metadata.MetadataIndex(self.path, read_only=True)
+
+        self.assertEqual(len(reader.query()), 3)
+        with self.assertRaises(metadata.sqlite3.OperationalError):
+            reader.remove('alice', 'esrs1')
+
+
+class TestGetIndex(unittest.TestCase):
+    """A set of test cases for the get_index function"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.workdir = tempfile.mkdtemp()
+        self.patcher = patch.object(metadata, 'const')
+        fake_const = self.patcher.start()
+        fake_const.VLAB_ESRS_METADATA_DB = os.path.join(self.workdir, 'metadata.db')
+        metadata._INDEXES.clear()
+
+    def tearDown(self):
+        """Runs after every test case"""
+        self.patcher.stop()
+        metadata._INDEXES.clear()
+        shutil.rmtree(self.workdir)
+
+    def test_get_index(self):
+        """``get_index`` reuses the same MetadataIndex"""
+        self.assertTrue(metadata.get_index() is metadata.get_index())
+
+    def test_get_index_missing(self):
+        """``get_index`` raises ValueError when a read only index doesn't exist yet"""
+        with self.assertRaises(ValueError):
+            metadata.get_index(read_only=True)
+
+    def test_get_index_read_only(self):
+        """``get_index`` gives a reader and a writer in the same process their own MetadataIndex"""
+        writer = metadata.get_index()
+        reader = metadata.get_index(read_only=True)
+
+        self.assertFalse(writer is reader)
+        self.assertTrue(reader.read_only)
+        self.assertFalse(writer.read_only)
+        self.assertTrue(metadata.get_index(read_only=True) is reader)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,220 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in network_index.py
+"""
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch, MagicMock
+
+from vlab_esrs_api.lib.worker import network_index
+
+from helpers import FakeClock
+
+
+class FakeNetwork(object):
+    """Stands in for a vim.Network"""
+    def __init__(self, moId, stub=None):
+        self._moId = moId
+        self._stub = stub
+
+
+class TestNetworkIndex(unittest.TestCase):
+    """A set of test cases for the NetworkIndex object"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.clock = FakeClock()
+        self.networks = {'alice_frontend': FakeNetwork('network-1'), 'bob_frontend': FakeNetwork('network-2')}
+        self.fetch_all = MagicMock()
+        self.fetch_all.side_effect = lambda vcenter: dict(self.networks)
+        self.fetch_one = MagicMock()
+        self.fetch_one.return_value = None
+        self.index = network_index.NetworkIndex(ttl=300,
+                                                fetch_all=self.fetch_all,
+                                                fetch_one=self.fetch_one,
+                                                clock=self.clock)
+        self.vcenter = MagicMock()
+
+    def test_lookup(self):
+        """``NetworkIndex.lookup`` returns the network bound to the caller's session"""
+        output = self.index.lookup(self.vcenter, 'alice_frontend')
+
+        self.assertEqual(output._moId, 'network-1')
+        self.assertTrue(output._stub is self.vcenter.content.rootFolder._stub)
+
+    def test_lookup_cached(self):
+        """``NetworkIndex.lookup`` only enumerates the networks once"""
+        for _ in range(10):
+            self.index.lookup(self.vcenter, 'alice_frontend')
+            self.index.lookup(self.vcenter, 'bob_frontend')
+
+        self.assertEqual(self.fetch_all.call_count, 1)
+
+    def test_lookup_ttl(self):
+        """``NetworkIndex.lookup`` reloads the networks once the TTL expires"""
+        self.index.lookup(self.vcenter, 'alice_frontend')
+        self.clock.now += 301
+        self.index.lookup(self.vcenter, 'alice_frontend')
+
+        self.assertEqual(self.fetch_all.call_count, 2)
+
+    def test_lookup_watching(self):
+        """``NetworkIndex.lookup`` trusts the index past the TTL while the watcher runs"""
+        self.index.lookup(self.vcenter, 'alice_frontend')
+        self.index._watching = True
+        self.clock.now += 301
+        self.index.lookup(self.vcenter, 'alice_frontend')
+
+        self.assertEqual(self.fetch_all.call_count, 1)
+
+    def test_lookup_miss_targeted(self):
+        """``NetworkIndex.lookup`` re-checks vCenter for just the missing network"""
+        self.index.lookup(self.vcenter, 'alice_frontend')
+        self.fetch_one.return_value = FakeNetwork('network-3')
+
+        output = self.index.lookup(self.vcenter, 'carl_frontend')
+
+        self.assertEqual(output._moId, 'network-3')
+        self.assertEqual(self.fetch_all.call_count, 1)
+
+    def test_lookup_miss_remembered(self):
+        """``NetworkIndex.lookup`` adds networks found on a miss to the index"""
+        self.index.lookup(self.vcenter, 'alice_frontend')
+        self.fetch_one.return_value = FakeNetwork('network-3')
+        self.index.lookup(self.vcenter, 'carl_frontend')
+        self.fetch_one.return_value = None
+
+        output = self.index.lookup(self.vcenter, 'carl_frontend')
+
+        self.assertEqual(output._moId, 'network-3')
+
+    def test_lookup_miss_full_reload(self):
+        """``NetworkIndex.lookup`` falls back to reloading everything if the targeted check misses"""
+        self.index.lookup(self.vcenter, 'alice_frontend')
+        self.networks['carl_frontend'] = FakeNetwork('network-3')
+        self.clock.now += 10
+
+        output = self.index.lookup(self.vcenter, 'carl_frontend')
+
+        self.assertEqual(output._moId, 'network-3')
+
+    def test_lookup_miss_rate_limited(self):
+        """``NetworkIndex.lookup`` doesn't reload everything on every miss"""
+        self.index.lookup(self.vcenter, 'alice_frontend')
+        for _ in range(5):
+            try:
+                self.index.lookup(self.vcenter, 'nope')
+            except KeyError:
+                pass
+
+        self.assertEqual(self.fetch_all.call_count, 1)
+
+    def test_lookup_missing(self):
+        """``NetworkIndex.lookup`` raises KeyError for networks that don't exist"""
+        with self.assertRaises(KeyError):
+            self.index.lookup(self.vcenter, 'nope')
+
+    def test_name_of(self):
+        """``NetworkIndex.name_of`` returns the name of a network"""
+        output = self.index.name_of(self.vcenter, FakeNetwork('network-2'))
+
+        self.assertEqual(output, 'bob_frontend')
+
+    def test_name_of_unknown(self):
+        """``NetworkIndex.name_of`` returns None for networks not in the index"""
+        output = self.index.name_of(self.vcenter, FakeNetwork('network-99'))
+
+        self.assertTrue(output is None)
+
+    def test_apply_rename(self):
+        """``NetworkIndex.apply`` moves a renamed network to its new name"""
+        self.index.lookup(self.vcenter, 'alice_frontend')
+        self.index.apply([('modify', FakeNetwork('network-1'), 'alice_backend')])
+
+        output = self.index.lookup(self.vcenter, 'alice_backend')
+
+        self.assertEqual(output._moId, 'network-1')
+        self.assertFalse('alice_frontend' in self.index._by_name)
+
+    def test_apply_leave(self):
+        """``NetworkIndex.apply`` drops deleted networks"""
+        self.index.lookup(self.vcenter, 'alice_frontend')
+        self.index.apply([('leave', FakeNetwork('network-1'), None)])
+
+        self.assertFalse('alice_frontend' in self.index._by_name)
+
+    @patch.object(network_index, 'logger')
+    @patch.object(network_index.time, 'sleep')
+    def test_watch_forever_logs(self, fake_sleep, fake_logger):
+        """``NetworkIndex._watch_forever`` logs a lost connection and reconnects"""
+        fake_sleep.side_effect = [None, Stop()]
+        connect = MagicMock(side_effect=RuntimeError('vCenter is down'))
+
+        with self.assertRaises(Stop):
+            self.index._watch_forever(connect, 60)
+
+        self.assertEqual(connect.call_count, 2)
+        self.assertEqual(fake_logger.warning.call_count, 2)
+        self.assertFalse(self.index._watching)
+
+
+class Stop(Exception):
+    """Breaks out of a loop that runs forever"""
+
+
+class TestListener(unittest.TestCase):
+    """A set of test cases for the listener of a NetworkIndex"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.listener = MagicMock()
+        networks = {'alice_frontend': FakeNetwork('network-1')}
+        self.index = network_index.NetworkIndex(ttl=300,
+                                                fetch_all=lambda vcenter: dict(networks),
+                                                fetch_one=MagicMock(return_value=None),
+                                                clock=FakeClock(),
+                                                listener=self.listener)
+
+    def test_refresh(self):
+        """A full reload tells the listener every network"""
+        self.index.refresh(MagicMock())
+
+        self.listener.assert_called_with(['alice_frontend'], (), ())
+
+    def test_apply(self):
+        """Changes tell the listener what came and went"""
+        self.index.refresh(MagicMock())
+        self.index.apply([('modify', FakeNetwork('network-1'), 'alice_backend'),
+                          ('enter', FakeNetwork('network-2'), 'bob_frontend')])
+
+        self.listener.assert_called_with(None, ['alice_backend', 'bob_frontend'], ['alice_frontend'])
+
+    @patch.object(network_index, 'metadata')
+    def test_share(self, fake_metadata):
+        """``_share`` records the networks of a vCenter in the metadata index"""
+        network_index._share('vc1', ['alice_frontend'])
+        network_index._share('vc1', None, ['bob_frontend'], [])
+        index = fake_metadata.get_index.return_value
+
+        index.replace_catalog.assert_called_with(fake_metadata.NETWORK, 'vc1', ['alice_frontend'])
+        index.update_catalog.assert_called_with(fake_metadata.NETWORK, 'vc1', ['bob_frontend'], [])
+
+    @patch.object(network_index, 'metadata')
+    def test_share_error(self, fake_metadata):
+        """``_share`` never fails a lookup"""
+        fake_metadata.get_index.side_effect = network_index.sqlite3.OperationalError('locked')
+
+        network_index._share('vc1', ['alice_frontend'])
+
+
+class TestGetIndex(unittest.TestCase):
+    """A set of test cases for the get_index function"""
+    @patch.object(network_index, '_INDEXES', {})
+    def test_get_index_threads(self):
+        """``get_index`` gives every thread the same NetworkIndex"""
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            found = list(executor.map(lambda _: network_index.get_index('vc1'), range(64)))
+
+        self.assertEqual(len(set(id(x) for x in found)), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,237 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in ovf.py
+"""
+import os
+import shutil
+import hashlib
+import tempfile
+import unittest
+from unittest.mock import patch, MagicMock
+
+from vlab_esrs_api.lib import cancel
+from vlab_esrs_api.lib.worker import ovf, admission
+
+import helpers
+
+
+def make_ova(path, disk, manifest_disk=None):
+    """Write a minimal OVA, with a manifest, to ``path``"""
+    descriptor = b'<Envelope/>'
+    manifest_disk = disk if manifest_disk is None else manifest_disk
+    manifest = 'SHA256(ESRS.ovf)= {}\nSHA256(disk.vmdk)= {}\n'.format(hashlib.sha256(descriptor).hexdigest(),
+                                                                     hashlib.sha256(manifest_disk).hexdigest())
+    helpers.make_ova(path, [('ESRS.ovf', descriptor), ('ESRS.mf', manifest.encode()), ('disk.vmdk', disk)])
+
+
+class TestDeployFromOva(unittest.TestCase):
+    """A set of test cases for the ``deploy_from_ova`` function"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.workdir = tempfile.mkdtemp()
+        self.ova_path = os.path.join(self.workdir, 'ESRS_3.28.ova')
+        self.vcenter = MagicMock()
+        self.vcenter.host_systems = {'host1': MagicMock()}
+        self.vcenter.datastores = {'VM-Storage': MagicMock()}
+        spec = MagicMock()
+        spec.error = []
+        file_item = MagicMock()
+        file_item.deviceId = 'disk1'
+        file_item.path = 'disk.vmdk'
+        spec.fileItem = [file_item]
+        self.vcenter.ovf_manager.CreateImportSpec.return_value = spec
+        self.lease = MagicMock()
+        self.lease.state = ovf.vim.HttpNfcLease.State.ready
+        device_url = MagicMock()
+        device_url.importKey = 'disk1'
+        device_url.url = 'https://esxi01/nfc/disk-0.vmdk'
+        self.lease.info.deviceUrl = [device_url]
+        self.vcenter.resource_pools.__getitem__.return_value.ImportVApp.return_value = self.lease
+        self.conn = MagicMock()
+        upload_response = MagicMock()
+        upload_response.status = 200
+        self.lease.info.entity.runtime.powerState = 'poweredOff'
+        self.patchers = [patch.object(ovf, '_open_upload'), patch.object(ovf, 'placement'),
+                         patch.object(ovf, 'admission'), patch.object(ovf.virtual_machine, 'consume_task')]
+        fake_open_upload, fake_placement, self.fake_admission, self.fake_consume_task = [x.start() for x in self.patchers]
+        fake_open_upload.return_value = (self.conn, lambda: upload_response)
+        fake_placement.get_engine.return_value.choose.return_value = ('VM-Storage', 'host1')
+
+    def tearDown(self):
+        """Runs after every test case"""
+        for patcher in self.patchers:
+            patcher.stop()
+        shutil.rmtree(self.workdir)
+
+    @patch.object(ovf.integrity, 'needs_verification')
+    def test_deploy(self, fake_needs_verification):
+        """``deploy_from_ova`` uploads the disk and completes the lease"""
+        fake_needs_verification.return_value = False
+        make_ova(self.ova_path, b'disk bytes')
+
+        output = ovf.deploy_from_ova(self.vcenter, self.ova_path, [], 'alice', 'myESRS', MagicMock())
+
+        self.assertTrue(output is self.lease.info.entity)
+        self.assertTrue(self.lease.HttpNfcLeaseComplete.called)
+        self.conn.send.assert_called_with(b'disk bytes')
+        self.assertTrue(self.conn.close.called)
+
+    @patch.object(ovf.integrity, 'needs_verification')
+    def test_deploy_powers_on(self, fake_needs_verification):
+        """``deploy_from_ova`` powers on the new VM once the lease is complete"""
+        fake_needs_verification.return_value = False
+        make_ova(self.ova_path, b'disk bytes')
+
+        ovf.deploy_from_ova(self.vcenter, self.ova_path, [], 'alice', 'myESRS', MagicMock())
+        the_vm = self.lease.info.entity
+
+        self.assertTrue(the_vm.PowerOn.called)
+        self.fake_consume_task.assert_called_with(the_vm.PowerOn.return_value, timeout=600)
+
+    @patch.object(ovf.integrity, 'needs_verification')
+    def test_deploy_entity_before_complete(self, fake_needs_verification):
+        """``deploy_from_ova`` finds the new VM before completing the lease, when the lease's info is still valid"""
+        fake_needs_verification.return_value = False
+        make_ova(self.ova_path, b'disk bytes')
+        the_vm = self.lease.info.entity
+        self.lease.HttpNfcLeaseComplete.side_effect = lambda: setattr(self.lease, 'info', None)
+
+        output = ovf.deploy_from_ova(self.vcenter, self.ova_path, [], 'alice', 'myESRS', MagicMock())
+
+        self.assertTrue(output is the_vm)
+        self.assertTrue(the_vm.PowerOn.called)
+
+    @patch.object(ovf, 'LEASE_TIMEOUT', 0)
+    @patch.object(ovf.integrity, 'needs_verification')
+    def test_deploy_lease_timeout(self, fake_needs_verification):
+        """``deploy_from_ova`` gives up on a lease that never leaves initializing, and releases its admission slots"""
+        fake_needs_verification.return_value = False
+        make_ova(self.ova_path, b'disk bytes')
+        self.lease.state = ovf.vim.HttpNfcLease.State.initializing
+
+        with self.assertRaises(ValueError):
+            ovf.deploy_from_ova(self.vcenter, self.ova_path, [], 'alice', 'myESRS', MagicMock())
+
+        self.assertTrue(self.lease.HttpNfcLeaseAbort.called)
+        self.assertFalse(self.conn.send.called)
+        self.assertTrue(self.fake_admission.admit.return_value.__exit__.called)
+
+    @patch.object(ovf.integrity, 'needs_verification')
+    def test_deploy_power_off(self, fake_needs_verification):
+        """``deploy_from_ova`` leaves the new VM off when ``power_on`` is False"""
+        fake_needs_verification.return_value = False
+        make_ova(self.ova_path, b'disk bytes')
+
+        ovf.deploy_from_ova(self.vcenter, self.ova_path, [], 'alice', 'myESRS', MagicMock(), power_on=False)
+
+        self.assertFalse(self.lease.info.entity.PowerOn.called)
+
+    @patch.object(ovf.integrity, 'needs_verification')
+    def test_deploy_upload_failed(self, fake_needs_verification):
+        """``deploy_from_ova`` closes the upload connection when the ESXi host rejects the disk"""
+        fake_needs_verification.return_value = False
+        make_ova(self.ova_path, b'disk bytes')
+        rejected = MagicMock()
+        rejected.status = 500
+        ovf._open_upload.return_value = (self.conn, lambda: rejected)
+
+        with self.assertRaises(ValueError):
+            ovf.deploy_from_ova(self.vcenter, self.ova_path, [], 'alice', 'myESRS', MagicMock())
+
+        self.assertTrue(self.conn.close.called)
+        self.assertTrue(self.lease.HttpNfcLeaseAbort.called)
+        self.assertFalse(self.lease.info.entity.PowerOn.called)
+
+    @patch.object(ovf.integrity, '_record')
+    @patch.object(ovf.integrity, 'needs_verification')
+    def test_deploy_verifies(self, fake_needs_verification, fake_record):
+        """``deploy_from_ova`` records the image as verified when it matches its manifest"""
+        fake_needs_verification.return_value = True
+        make_ova(self.ova_path, b'disk bytes')
+
+        ovf.deploy_from_ova(self.vcenter, self.ova_path, [], 'alice', 'myESRS', MagicMock())
+
+        self.assertTrue(fake_record.called)
+
+    @patch.object(ovf.integrity, '_record')
+    @patch.object(ovf.integrity, 'needs_verification')
+    def test_deploy_corrupt(self, fake_needs_verification, fake_record):
+        """``deploy_from_ova`` aborts the lease when the image doesn't match its manifest"""
+        fake_needs_verification.return_value = True
+        make_ova(self.ova_path, b'disk bytes', manifest_disk=b'other bytes')
+
+        with self.assertRaises(ovf.integrity.IntegrityError):
+            ovf.deploy_from_ova(self.vcenter, self.ova_path, [], 'alice', 'myESRS', MagicMock())
+
+        self.assertTrue(self.lease.HttpNfcLeaseAbort.called)
+        self.assertFalse(self.lease.HttpNfcLeaseComplete.called)
+        self.assertFalse(fake_record.called)
+
+    @patch.object(ovf.integrity, 'needs_verification')
+    def test_deploy_spec_error(self, fake_needs_verification):
+        """``deploy_from_ova`` raises ValueError if vCenter rejects the import spec"""
+        fake_needs_verification.return_value = False
+        make_ova(self.ova_path, b'disk bytes')
+        error = MagicMock()
+        error.msg = 'testing'
+        self.vcenter.ovf_manager.CreateImportSpec.return_value.error = [error]
+
+        with self.assertRaises(ValueError):
+            ovf.deploy_from_ova(self.vcenter, self.ova_path, [], 'alice', 'myESRS', MagicMock())
+
+    @patch.object(ovf, 'consume_task')
+    @patch.object(ovf, 'CHUNK_SIZE', 4)
+    @patch.object(ovf.integrity, 'needs_verification')
+    def test_deploy_cancelled(self, fake_needs_verification, fake_consume_task):
+        """``deploy_from_ova`` stops at the next chunk once cancelled, and cleans up the partial VM"""
+        fake_needs_verification.return_value = False
+        make_ova(self.ova_path, b'disk bytes, sent four at a time')
+        controller = admission.AdmissionController(os.path.join(self.workdir, 'admission'),
+                                                   caps={'datastore': 1, 'host': 1})
+        self.fake_admission.admit.side_effect = lambda resources, **kwargs: controller.admit(resources, **kwargs)
+        self.vcenter.datastores['VM-Storage'].name = 'VM-Storage'
+        self.vcenter.host_systems['host1'].name = 'host1'
+        # the user cancels while the second chunk is being sent
+        cancels = []
+        self.conn.send.side_effect = lambda chunk: cancels.append(True) if self.conn.send.call_count == 2 else None
+        partial_vm = self.lease.info.entity
+
+        with self.assertRaises(cancel.Cancelled):
+            ovf.deploy_from_ova(self.vcenter, self.ova_path, [], 'alice', 'myESRS', MagicMock(),
+                                cancelled=lambda: bool(cancels))
+
+        self.assertEqual(self.conn.send.call_count, 2)
+        self.assertTrue(self.lease.HttpNfcLeaseAbort.called)
+        self.assertFalse(self.lease.HttpNfcLeaseComplete.called)
+        self.assertTrue(partial_vm.Destroy_Task.called)
+        self.assertEqual(controller.holders('datastore:VM-Storage'), 0)
+        self.assertEqual(controller.holders('host:host1'), 0)
+
+    @patch.object(ovf, 'consume_task')
+    @patch.object(ovf.integrity, 'needs_verification')
+    def test_deploy_cancelled_already_gone(self, fake_needs_verification, fake_consume_task):
+        """``deploy_from_ova`` is fine with vCenter having removed the partial VM itself"""
+        fake_needs_verification.return_value = False
+        make_ova(self.ova_path, b'disk bytes')
+        fake_consume_task.side_effect = ovf.vmodl.fault.ManagedObjectNotFound()
+
+        with self.assertRaises(cancel.Cancelled):
+            ovf.deploy_from_ova(self.vcenter, self.ova_path, [], 'alice', 'myESRS', MagicMock(),
+                                cancelled=lambda: True)
+
+    @patch.object(ovf.integrity, 'needs_verification')
+    def test_deploy_placement(self, fake_needs_verification):
+        """``deploy_from_ova`` imports to the datastore and host the placement engine picks"""
+        fake_needs_verification.return_value = False
+        make_ova(self.ova_path, b'disk bytes')
+
+        ovf.deploy_from_ova(self.vcenter, self.ova_path, [], 'alice', 'myESRS', MagicMock())
+        _, kwargs = self.vcenter.ovf_manager.CreateImportSpec.call_args
+        args, _ = self.vcenter.resource_pools.__getitem__.return_value.ImportVApp.call_args
+
+        self.assertTrue(kwargs['datastore'] is self.vcenter.datastores['VM-Storage'])
+        self.assertTrue(args[2] is self.vcenter.host_systems['host1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
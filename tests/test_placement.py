@@ -0,0 +1,185 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in placement.py
+"""
+import os
+import tempfile
+import unittest
+from functools import partial
+from unittest.mock import patch, MagicMock
+
+from vlab_esrs_api.lib.worker import placement
+
+from helpers import FakeClock
+
+GB = 1024 ** 3
+
+
+def make_stats():
+    """Capacity stats for two datastores and three hosts"""
+    return {'datastores': {'ds1': {'free': 100 * GB, 'capacity': 1000 * GB, 'accessible': True},
+                           'ds2': {'free': 800 * GB, 'capacity': 1000 * GB, 'accessible': True}},
+            'hosts': {'esxi01': {'vms': 30, 'usable': True, 'datastores': ['ds1', 'ds2']},
+                      'esxi02': {'vms': 5, 'usable': True, 'datastores': ['ds1', 'ds2']},
+                      'esxi03': {'vms': 0, 'usable': False, 'datastores': ['ds1', 'ds2']}}}
+
+
+class TestPlacementEngine(unittest.TestCase):
+    """A set of test cases for the PlacementEngine object"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.clock = FakeClock()
+        self.fetch = MagicMock()
+        self.fetch.side_effect = lambda vcenter: make_stats()
+        self.engine = placement.PlacementEngine(datastores=['ds1', 'ds2'],
+                                                ttl=60,
+                                                policy='deterministic',
+                                                fetch=self.fetch,
+                                                clock=self.clock)
+
+    def test_choose(self):
+        """``PlacementEngine.choose`` picks the emptiest datastore and least busy usable host"""
+        output = self.engine.choose(MagicMock(), 10 * GB)
+        expected = ('ds2', 'esxi02')
+
+        self.assertEqual(output, expected)
+
+    def test_choose_deterministic(self):
+        """``PlacementEngine.choose`` is repeatable with the deterministic policy"""
+        first = [self.engine.choose(MagicMock(), GB) for _ in range(5)]
+        self.engine._stats = None
+        second = [self.engine.choose(MagicMock(), GB) for _ in range(5)]
+
+        self.assertEqual(first, second)
+
+    def test_choose_cached(self):
+        """``PlacementEngine.choose`` doesn't query vCenter while the stats are fresh"""
+        for _ in range(5):
+            self.engine.choose(MagicMock(), GB)
+
+        self.assertEqual(self.fetch.call_count, 1)
+
+    def test_choose_stale(self):
+        """``PlacementEngine.choose`` refreshes the stats if the background refresh fell behind"""
+        self.engine.choose(MagicMock(), GB)
+        self.clock.now += 1000
+        self.engine.choose(MagicMock(), GB)
+
+        self.assertEqual(self.fetch.call_count, 2)
+
+    def test_choose_charges_placement(self):
+        """``PlacementEngine.choose`` counts earlier placements against the cached stats"""
+        self.engine.choose(MagicMock(), 10 * GB)
+
+        self.assertEqual(self.engine._stats['datastores']['ds2']['free'], 790 * GB)
+        self.assertEqual(self.engine._stats['hosts']['esxi02']['vms'], 6)
+
+    def test_choose_import_load(self):
+        """``PlacementEngine.choose`` avoids datastores busy with imports"""
+        self.engine.load = lambda resource: 10 if resource == 'datastore:ds2' else 0
+
+        output = self.engine.choose(MagicMock(), GB)[0]
+        expected = 'ds1'
+
+        self.assertEqual(output, expected)
+
+    def test_choose_only_allowed(self):
+        """``PlacementEngine.choose`` only uses the configured datastores"""
+        self.engine.datastores = ['ds1']
+
+        output = self.engine.choose(MagicMock(), GB)[0]
+        expected = 'ds1'
+
+        self.assertEqual(output, expected)
+
+    def test_choose_no_room(self):
+        """``PlacementEngine.choose`` raises ValueError if no datastore has room"""
+        with self.assertRaises(ValueError):
+            self.engine.choose(MagicMock(), 900 * GB)
+
+    def test_choose_no_host(self):
+        """``PlacementEngine.choose`` raises ValueError if no usable host mounts the datastore"""
+        def fetch(vcenter):
+            stats = make_stats()
+            for host in stats['hosts'].values():
+                host['usable'] = False
+            return stats
+        self.engine.fetch = fetch
+
+        with self.assertRaises(ValueError):
+            self.engine.choose(MagicMock(), GB)
+
+    def test_choose_weighted(self):
+        """``PlacementEngine.choose`` spreads deploys over the candidates with the weighted policy"""
+        self.engine.policy = 'weighted'
+        self.fetch.side_effect = lambda vcenter: {'datastores': {'ds1': {'free': 500 * GB, 'capacity': 1000 * GB, 'accessible': True},
+                                                                 'ds2': {'free': 500 * GB, 'capacity': 1000 * GB, 'accessible': True}},
+                                                  'hosts': make_stats()['hosts']}
+
+        picked = set()
+        for _ in range(50):
+            self.engine._stats = None
+            picked.add(self.engine.choose(MagicMock(), GB)[0])
+
+        self.assertEqual(picked, {'ds1', 'ds2'})
+
+    @patch.object(placement, 'logger')
+    @patch.object(placement.time, 'sleep')
+    def test_refresh_forever_logs(self, fake_sleep, fake_logger):
+        """``PlacementEngine._refresh_forever`` logs a failed refresh and keeps going"""
+        fake_sleep.side_effect = [None, Stop()]
+        connect = MagicMock(side_effect=RuntimeError('vCenter is down'))
+
+        with self.assertRaises(Stop):
+            self.engine._refresh_forever(connect)
+
+        self.assertEqual(connect.call_count, 2)
+        self.assertEqual(fake_logger.warning.call_count, 2)
+
+    @patch.object(placement.time, 'sleep')
+    def test_refresh_forever_elected(self, fake_sleep):
+        """``PlacementEngine._refresh_forever`` leaves vCenter alone while another process holds the lock"""
+        fake_sleep.side_effect = Stop()
+        connect = MagicMock()
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            lock_file = os.path.join(temp_dir, 'vc1-placement.lock')
+            with placement.elected(lock_file, 60, sleep=fake_sleep):
+                with patch.object(placement, 'elected', partial(placement.elected, sleep=fake_sleep)):
+                    with self.assertRaises(Stop):
+                        self.engine._refresh_forever(connect, lock_file=lock_file)
+
+        self.assertFalse(connect.called)
+
+
+class Stop(Exception):
+    """Breaks out of a loop that runs forever"""
+
+
+class TestFetchStats(unittest.TestCase):
+    """A set of test cases for the ``fetch_stats`` function"""
+    def test_fetch_stats(self):
+        """``fetch_stats`` summarizes the datastores and hosts"""
+        datastore = MagicMock()
+        datastore.name = 'ds1'
+        datastore.summary.freeSpace = 10
+        datastore.summary.capacity = 20
+        datastore.summary.accessible = True
+        host = MagicMock()
+        host.vm = [MagicMock(), MagicMock()]
+        host.runtime.connectionState = 'connected'
+        host.runtime.inMaintenanceMode = False
+        host.datastore = [datastore]
+        vcenter = MagicMock()
+        vcenter.datastores = {'ds1': datastore}
+        vcenter.host_systems = {'esxi01': host}
+
+        output = placement.fetch_stats(vcenter)
+        expected = {'datastores': {'ds1': {'free': 10, 'capacity': 20, 'accessible': True}},
+                    'hosts': {'esxi01': {'vms': 2, 'usable': True, 'datastores': ['ds1']}}}
+
+        self.assertEqual(output, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,171 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in power.py
+"""
+import unittest
+from unittest.mock import patch, MagicMock
+
+from vlab_esrs_api.lib.worker import power
+from vlab_esrs_api.lib.worker.power import vim
+
+ON = power.POWERED_ON
+OFF = power.POWERED_OFF
+
+
+class FakeTask(object):
+    """Stands in for a vim.Task"""
+    def __init__(self, moid, error=None):
+        self._moId = moid
+        self.error = error
+
+
+class FakeVM(object):
+    """Stands in for a vim.VirtualMachine; records the calls made to it
+
+    :param shuts_down: Set to False for a guest OS that ignores the shutdown
+    :param tools: Set to False for a VM without VMware Tools
+    """
+    def __init__(self, name, shuts_down=True, tools=True, fails=None):
+        self._moId = 'vm-{}'.format(name)
+        self.name = name
+        self.shuts_down = shuts_down
+        self.tools = tools
+        self.fails = fails
+        self.calls = []
+
+    def _task(self, call):
+        self.calls.append(call)
+        return FakeTask('task-{}-{}'.format(self.name, call), error=self.fails)
+
+    def PowerOnVM_Task(self):
+        return self._task('on')
+
+    def PowerOffVM_Task(self):
+        return self._task('off')
+
+    def ResetVM_Task(self):
+        return self._task('reset')
+
+    def ShutdownGuest(self):
+        self.calls.append('shutdown')
+        if not self.tools:
+            raise vim.fault.ToolsUnavailable(msg='VMware Tools is not running')
+
+
+def fake_wait_for(vcenter, objects, path, done, timeout):
+    """Finishes every task, and shuts down the VMs that will"""
+    values = {}
+    for obj in objects:
+        if path == 'info':
+            state = vim.TaskInfo.State.error if obj.error else vim.TaskInfo.State.success
+            error = vim.fault.InvalidPowerState(msg=obj.error) if obj.error else None
+            values[obj._moId] = vim.TaskInfo(state=state, error=error)
+        elif obj.shuts_down:
+            values[obj._moId] = OFF
+        else:
+            values[obj._moId] = ON
+    return values
+
+
+class TestPower(unittest.TestCase):
+    """A set of test cases for power.py"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.vcenter = MagicMock()
+        self.patcher = patch.object(power.inventory, 'wait_for', side_effect=fake_wait_for)
+        self.fake_wait_for = self.patcher.start()
+
+    def tearDown(self):
+        """Runs after every test case"""
+        self.patcher.stop()
+
+    def test_on(self):
+        """``power`` powers on the VMs that are off, and waits on the tasks together"""
+        vm1, vm2 = FakeVM('esrs1'), FakeVM('esrs2')
+
+        results = power.power(self.vcenter, {'esrs1': (vm1, OFF), 'esrs2': (vm2, ON)}, 'on', MagicMock())
+
+        self.assertEqual(results, {'esrs1': None, 'esrs2': None})
+        self.assertEqual(vm1.calls, ['on'])
+        self.assertEqual(vm2.calls, [])
+        self.assertEqual(self.fake_wait_for.call_count, 1)
+
+    def test_off(self):
+        """``power`` powers off every VM that isn't off"""
+        vms = {'esrs{}'.format(x): (FakeVM('esrs{}'.format(x)), ON) for x in range(40)}
+
+        results = power.power(self.vcenter, vms, 'off', MagicMock())
+        args, _ = self.fake_wait_for.call_args
+
+        self.assertEqual(set(results.values()), {None})
+        self.assertEqual(len(args[1]), 40)
+
+    def test_task_error(self):
+        """``power`` reports the error of a failed task"""
+        vm1 = FakeVM('esrs1', fails='bad power state')
+
+        results = power.power(self.vcenter, {'esrs1': (vm1, ON)}, 'off', MagicMock())
+
+        self.assertEqual(results, {'esrs1': 'bad power state'})
+
+    def test_timeout(self):
+        """``power`` reports tasks that didn't finish in time"""
+        self.fake_wait_for.side_effect = lambda *args, **kwargs: {}
+        vm1 = FakeVM('esrs1')
+
+        results = power.power(self.vcenter, {'esrs1': (vm1, ON)}, 'off', MagicMock())
+
+        self.assertEqual(results, {'esrs1': 'Timed out waiting on vCenter'})
+
+    def test_reboot(self):
+        """``power`` resets the VMs that are on, and can't reboot the ones that are off"""
+        vm1, vm2 = FakeVM('esrs1'), FakeVM('esrs2')
+
+        results = power.power(self.vcenter, {'esrs1': (vm1, ON), 'esrs2': (vm2, OFF)}, 'reboot', MagicMock())
+
+        self.assertEqual(results['esrs1'], None)
+        self.assertTrue(results['esrs2'])
+        self.assertEqual(vm1.calls, ['reset'])
+
+    def test_shutdown(self):
+        """``power`` shuts down the guest OS, without powering off VMs that shut down"""
+        vm1 = FakeVM('esrs1')
+
+        results = power.power(self.vcenter, {'esrs1': (vm1, ON)}, 'shutdown', MagicMock())
+
+        self.assertEqual(results, {'esrs1': None})
+        self.assertEqual(vm1.calls, ['shutdown'])
+
+    def test_shutdown_fallback(self):
+        """``power`` powers off the VMs whose guest OS can't, or doesn't, shut down"""
+        vm1, vm2, vm3 = FakeVM('esrs1'), FakeVM('esrs2', shuts_down=False), FakeVM('esrs3', tools=False)
+        vms = {'esrs1': (vm1, ON), 'esrs2': (vm2, ON), 'esrs3': (vm3, ON)}
+
+        results = power.power(self.vcenter, vms, 'shutdown', MagicMock())
+
+        self.assertEqual(set(results.values()), {None})
+        self.assertEqual(vm1.calls, ['shutdown'])
+        self.assertEqual(vm2.calls, ['shutdown', 'off'])
+        self.assertEqual(vm3.calls, ['shutdown', 'off'])
+
+    def test_unknown_action(self):
+        """``power`` raises ValueError for unknown actions"""
+        with self.assertRaises(ValueError):
+            power.power(self.vcenter, {}, 'hibernate', MagicMock())
+
+    @patch.object(power.inventory, 'retrieve')
+    def test_find_esrs(self, fake_retrieve):
+        """``find_esrs`` ignores the user's VMs that aren't ESRS"""
+        vm1, vm2 = FakeVM('esrs1'), FakeVM('other')
+        fake_retrieve.return_value = [(vm1, {'name': 'esrs1', 'config.annotation': '{"component": "ESRS"}',
+                                             'runtime.powerState': ON}),
+                                      (vm2, {'name': 'other', 'config.annotation': '{"component": "OneFS"}',
+                                             'runtime.powerState': ON})]
+
+        found = power.find_esrs(self.vcenter, MagicMock())
+
+        self.assertEqual(found, {'esrs1': (vm1, ON)})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in preload.py
+"""
+import gc
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch, MagicMock
+
+from vlab_esrs_api.lib.worker import preload
+
+from helpers import DESCRIPTOR, make_ova
+
+
+class TestPreload(unittest.TestCase):
+    """A set of test cases for preload.py"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.images = tempfile.mkdtemp()
+        make_ova(os.path.join(self.images, 'ESRS_3.28.ova'), [('ESRS.ovf', DESCRIPTOR)])
+        self.patcher = patch.object(preload, 'const')
+        self.fake_const = self.patcher.start()
+        self.fake_const.VLAB_ESRS_IMAGES_DIR = self.images
+        self.cache_patcher = patch.object(preload.image_cache, 'get_cache', return_value=None)
+        self.cache_patcher.start()
+
+    def tearDown(self):
+        """Runs after every test case"""
+        self.patcher.stop()
+        self.cache_patcher.stop()
+        shutil.rmtree(self.images)
+        if hasattr(gc, 'unfreeze'):
+            gc.unfreeze()
+
+    def test_vsphere_types(self):
+        """``vsphere_types`` loads every vSphere type"""
+        count = preload.vsphere_types()
+
+        self.assertTrue(count > 1000)
+        self.assertTrue(len(preload.VmomiSupport._wsdlTypeMap) >= count)
+
+    @patch.object(preload, 'import_spec')
+    def test_image_catalog(self, fake_import_spec):
+        """``image_catalog`` reads the descriptor of every image"""
+        count = preload.image_catalog()
+
+        self.assertEqual(count, 1)
+        fake_import_spec.descriptor.assert_called_with(os.path.join(self.images, 'ESRS_3.28.ova'))
+
+    def test_image_catalog_cache(self):
+        """``image_catalog`` also reads the descriptors of the cached images"""
+        os.makedirs(os.path.join(self.images, 'objects'))
+        cached = os.path.join(self.images, 'objects', 'cached.ova')
+        make_ova(cached, [('ESRS.ovf', DESCRIPTOR)])
+        fake_cache = MagicMock()
+        fake_cache.cached.return_value = [cached]
+        with patch.object(preload.image_cache, 'get_cache', return_value=fake_cache):
+            count = preload.image_catalog()
+
+        self.assertEqual(count, 2)
+
+    def test_image_catalog_broken(self):
+        """``image_catalog`` skips images it can't read"""
+        make_ova(os.path.join(self.images, 'ESRS_3.30.ova'), [('disk.vmdk', b'no descriptor')])
+
+        count = preload.image_catalog()
+
+        self.assertEqual(count, 1)
+
+    def test_image_catalog_no_dir(self):
+        """``image_catalog`` handles a missing images directory"""
+        self.fake_const.VLAB_ESRS_IMAGES_DIR = os.path.join(self.images, 'nope')
+
+        self.assertEqual(preload.image_catalog(), 0)
+
+    @patch.object(preload.shards, 'ring')
+    def test_configuration_no_servers(self, fake_ring):
+        """``configuration`` handles having no vCenter servers"""
+        fake_ring.side_effect = ValueError('At least one vCenter server is required')
+
+        self.assertEqual(preload.configuration(), 0)
+
+    @unittest.skipUnless(hasattr(gc, 'freeze'), 'needs gc.freeze')
+    @patch.object(preload, 'image_catalog', return_value=1)
+    @patch.object(preload, 'vsphere_types', return_value=4000)
+    def test_warm(self, fake_vsphere_types, fake_image_catalog):
+        """``warm`` freezes what it loaded, and leaves the collector on"""
+        loaded = preload.warm()
+
+        self.assertEqual(loaded['types'], 4000)
+        self.assertEqual(loaded['images'], 1)
+        self.assertTrue(loaded['frozen'] > 0)
+        self.assertTrue(gc.isenabled())
+
+    @unittest.skipUnless(hasattr(gc, 'freeze'), 'needs gc.freeze')
+    @patch.object(preload, 'vsphere_types')
+    def test_warm_no_collection(self, fake_vsphere_types):
+        """``warm`` doesn't collect garbage while loading"""
+        fake_vsphere_types.side_effect = lambda: gc.isenabled()
+
+        loaded = preload.warm()
+
+        self.assertFalse(loaded['types'])
+
+    @patch.object(preload, 'gc')
+    @patch.object(preload, 'vsphere_types')
+    def test_warm_no_freeze(self, fake_vsphere_types, fake_gc):
+        """``warm`` skips preloading on Pythons without ``gc.freeze``"""
+        del fake_gc.freeze
+
+        loaded = preload.warm()
+
+        self.assertEqual(loaded, {})
+        self.assertFalse(fake_vsphere_types.called)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in profiling.py
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from vlab_esrs_api.lib import profiling
+
+
+class TestProfiling(unittest.TestCase):
+    """A set of test cases for profiling.py"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.workdir = tempfile.mkdtemp()
+        self.patcher = patch.object(profiling, 'const')
+        fake_const = self.patcher.start()
+        fake_const.VLAB_ESRS_PROFILE_DIR = self.workdir
+        fake_const.VLAB_ESRS_PROFILE_MAX = 2
+        fake_const.VLAB_ESRS_PROFILE_TTL = 86400
+
+    def tearDown(self):
+        """Runs after every test case"""
+        self.patcher.stop()
+        shutil.rmtree(self.workdir)
+
+    def test_path_for(self):
+        """``path_for`` rejects ids that could escape the profile directory"""
+        with self.assertRaises(ValueError):
+            profiling.path_for('../../etc/passwd')
+
+    def test_profile(self):
+        """``start`` and ``stop`` save stats that ``report`` can summarize"""
+        profile = profiling.start('abc-123')
+        sorted(range(1000))
+        path = profile.stop()
+
+        self.assertEqual(path, profiling.path_for('abc-123'))
+        self.assertIn('function calls', profiling.report('abc-123'))
+
+    def test_report_missing(self):
+        """``report`` raises FileNotFoundError for tasks that weren't profiled"""
+        with self.assertRaises(FileNotFoundError):
+            profiling.report('abc-123')
+
+    def test_max(self):
+        """``start`` returns None once ``VLAB_ESRS_PROFILE_MAX`` tasks are being profiled"""
+        profiles = [profiling.start('abc-1'), profiling.start('abc-2')]
+        try:
+            self.assertEqual(profiling.start('abc-3'), None)
+        finally:
+            for profile in profiles:
+                profile.stop()
+
+    def test_max_released(self):
+        """``stop`` frees the slot for the next task"""
+        profiling.start('abc-1').stop()
+        profiling.start('abc-2').stop()
+
+        profile = profiling.start('abc-3')
+        profile.stop()
+
+        self.assertTrue(profile is not None)
+
+    def test_clean(self):
+        """``clean`` deletes old stats"""
+        profiling.start('abc-123').stop()
+
+        profiling.clean(60, clock=lambda: os.path.getmtime(profiling.path_for('abc-123')) + 61)
+
+        self.assertFalse(os.path.exists(profiling.path_for('abc-123')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,178 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in reaper.py
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch, MagicMock
+
+import ujson
+
+from vlab_esrs_api.lib.worker import reaper
+
+DAY = 86400
+NOW = 1600000000
+
+
+def make_folder(moid, name, parent):
+    """A fake user folder, and its properties"""
+    folder = MagicMock(spec=reaper.vim.Folder)
+    folder._moId = moid
+    return folder, {'name': name, 'parent': parent}
+
+
+def make_vm(moid, name, folder, created=NOW - DAY, component='ESRS', state='poweredOn', cpu=500):
+    """A fake VM, and its properties"""
+    vm = MagicMock(spec=reaper.vim.VirtualMachine)
+    vm._moId = moid
+    annotation = ujson.dumps({'component': component, 'created': created})
+    return vm, {'name': name, 'parent': folder, 'config.annotation': annotation,
+                'runtime.powerState': state, 'summary.quickStats.overallCpuUsage': cpu}
+
+
+class TestReaper(unittest.TestCase):
+    """A set of test cases for reaper.py"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.workdir = tempfile.mkdtemp()
+        self.const_patcher = patch.object(reaper, 'const')
+        fake_const = self.const_patcher.start()
+        fake_const.INF_VCENTER_TOP_LVL_DIR = 'vlab'
+        fake_const.VLAB_ESRS_REAPER_MAX_AGE_DAYS = 30
+        fake_const.VLAB_ESRS_REAPER_MAX_IDLE_DAYS = 7
+        fake_const.VLAB_ESRS_REAPER_IDLE_MHZ = 50
+        fake_const.VLAB_ESRS_REAPER_OPT_OUT = os.path.join(self.workdir, 'opt-out.json')
+        fake_const.VLAB_ESRS_REAPER_STATE = os.path.join(self.workdir, 'activity.json')
+        fake_const.VLAB_ESRS_PARALLEL_OPS = 4
+        self.top = MagicMock()
+        self.top._moId = 'group-top'
+        self.vcenter = MagicMock()
+        self.vcenter.get_by_name.return_value = self.top
+        alice, alice_props = make_folder('group-alice', 'alice', self.top)
+        bob, bob_props = make_folder('group-bob', 'bob', self.top)
+        self.inventory = [(alice, alice_props), (bob, bob_props)]
+        self.alice = alice
+        self.bob = bob
+        self.retrieve_patcher = patch.object(reaper.inventory, 'retrieve_many')
+        fake_retrieve = self.retrieve_patcher.start()
+        fake_retrieve.side_effect = lambda *args, **kwargs: iter(self.inventory)
+
+    def tearDown(self):
+        """Runs after every test case"""
+        self.const_patcher.stop()
+        self.retrieve_patcher.stop()
+        shutil.rmtree(self.workdir)
+
+    def test_sweep_age(self):
+        """``sweep`` finds ESRS instances older than the max age"""
+        self.inventory.append(make_vm('vm-1', 'old', self.alice, created=NOW - 31 * DAY))
+        self.inventory.append(make_vm('vm-2', 'new', self.alice))
+
+        output = reaper.sweep(self.vcenter, 'vc1', now=NOW)
+
+        self.assertEqual([(x.username, x.name, x.reason) for x in output], [('alice', 'old', 'age')])
+
+    def test_sweep_single_traversal(self):
+        """``sweep`` reads every user folder in one traversal"""
+        self.inventory.append(make_vm('vm-1', 'esrs1', self.alice))
+        self.inventory.append(make_vm('vm-2', 'esrs2', self.bob))
+
+        reaper.sweep(self.vcenter, 'vc1', now=NOW)
+
+        self.assertEqual(reaper.inventory.retrieve_many.call_count, 1)
+
+    def test_sweep_ignores_others(self):
+        """``sweep`` ignores VMs that aren't ESRS"""
+        self.inventory.append(make_vm('vm-1', 'old', self.alice, created=NOW - 31 * DAY, component='OneFS'))
+
+        output = reaper.sweep(self.vcenter, 'vc1', now=NOW)
+
+        self.assertEqual(output, [])
+
+    def test_sweep_idle(self):
+        """``sweep`` finds ESRS instances that haven't been busy for the max idle time"""
+        self.inventory.append(make_vm('vm-1', 'idle', self.alice, cpu=0))
+        self.inventory.append(make_vm('vm-2', 'busy', self.alice, cpu=500))
+        reaper.sweep(self.vcenter, 'vc1', now=NOW)
+
+        output = reaper.sweep(self.vcenter, 'vc1', now=NOW + 8 * DAY)
+
+        self.assertEqual([(x.name, x.reason) for x in output], [('idle', 'idle')])
+
+    def test_sweep_idle_clock(self):
+        """``sweep`` starts the idle clock the first time it sees a VM"""
+        self.inventory.append(make_vm('vm-1', 'idle', self.alice, cpu=0))
+
+        output = reaper.sweep(self.vcenter, 'vc1', now=NOW)
+
+        self.assertEqual(output, [])
+
+    def test_sweep_opt_out(self):
+        """``sweep`` skips users who opted out"""
+        self.inventory.append(make_vm('vm-1', 'old', self.alice, created=NOW - 31 * DAY))
+        reaper.set_opt_out('alice', True)
+
+        output = reaper.sweep(self.vcenter, 'vc1', now=NOW)
+
+        self.assertEqual(output, [])
+
+    def test_set_opt_out(self):
+        """``set_opt_out`` can undo an opt-out"""
+        reaper.set_opt_out('alice', True)
+        reaper.set_opt_out('bob', True)
+        reaper.set_opt_out('alice', False)
+
+        self.assertEqual(reaper.opt_outs(), ['bob'])
+
+    @patch.object(reaper, '_reclaim_one')
+    def test_reclaim_dry_run(self, fake_reclaim_one):
+        """``reclaim`` only reports what it would do on a dry run"""
+        candidates = [reaper.Candidate('alice', MagicMock(), 'esrs1', 'age', True)]
+
+        output = reaper.reclaim(candidates, 'off', dry_run=True)
+        expected = {'alice': {'esrs1': {'reason': 'age', 'action': 'off', 'error': None}}}
+
+        self.assertEqual(output, expected)
+        self.assertFalse(fake_reclaim_one.called)
+
+    @patch.object(reaper, '_reclaim_one')
+    def test_reclaim(self, fake_reclaim_one):
+        """``reclaim`` reports the VMs it failed to reclaim"""
+        candidates = [reaper.Candidate('alice', MagicMock(), 'esrs{}'.format(x), 'age', True) for x in range(3)]
+        fake_reclaim_one.side_effect = [None, RuntimeError('doh'), None]
+
+        output = reaper.reclaim(candidates, 'delete', dry_run=False)
+        errors = [x['error'] for x in output['alice'].values()]
+
+        self.assertEqual(fake_reclaim_one.call_count, 3)
+        self.assertEqual(errors.count('doh'), 1)
+
+    def test_reclaim_skip_off(self):
+        """``reclaim`` doesn't power off VMs that are already off"""
+        candidates = [reaper.Candidate('alice', MagicMock(), 'esrs1', 'age', False)]
+
+        output = reaper.reclaim(candidates, 'off', dry_run=False)
+
+        self.assertEqual(output, {})
+
+    def test_reclaim_bad_action(self):
+        """``reclaim`` raises ValueError for unknown actions"""
+        with self.assertRaises(ValueError):
+            reaper.reclaim([], 'explode')
+
+    @patch.object(reaper, 'consume_task')
+    @patch.object(reaper.virtual_machine, 'power')
+    def test_reclaim_one_delete(self, fake_power, fake_consume_task):
+        """``_reclaim_one`` powers off a VM before deleting it"""
+        the_vm = MagicMock()
+
+        reaper._reclaim_one(reaper.Candidate('alice', the_vm, 'esrs1', 'age', True), 'delete')
+
+        self.assertTrue(fake_power.called)
+        self.assertTrue(the_vm.Destroy_Task.called)
+
+
+if __name__ == '__main__':
+    unittest.main()
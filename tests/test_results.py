@@ -0,0 +1,121 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in results.py
+"""
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from celery import Celery
+from celery.exceptions import ImproperlyConfigured
+
+from vlab_esrs_api.lib import results
+
+
+def make_app(url, ttl=60):
+    """Make a Celery app that stores results at ``url``"""
+    app = Celery('test', broker='memory://')
+    with patch.object(results, 'const') as fake_const:
+        fake_const.VLAB_ESRS_RESULT_BACKEND = url
+        fake_const.VLAB_ESRS_RESULT_TTL = ttl
+        results.configure(app)
+    return app
+
+
+class TestSQLiteBackend(unittest.TestCase):
+    """A set of test cases for the SQLiteBackend object"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.workdir = tempfile.mkdtemp()
+        self.url = 'sqlite://{}'.format(os.path.join(self.workdir, 'results.db'))
+
+    def tearDown(self):
+        """Runs after every test case"""
+        shutil.rmtree(self.workdir)
+
+    def test_configure(self):
+        """``configure`` makes the sqlite:// scheme use SQLiteBackend"""
+        app = make_app(self.url)
+
+        self.assertTrue(isinstance(app.backend, results.SQLiteBackend))
+        self.assertEqual(app.backend.expires, 60)
+
+    def test_configure_other(self):
+        """``configure`` leaves other backends to Celery"""
+        app = make_app('cache+memory://')
+
+        self.assertFalse(isinstance(app.backend, results.SQLiteBackend))
+
+    def test_bad_url(self):
+        """SQLiteBackend raises ImproperlyConfigured without a path"""
+        with self.assertRaises(ImproperlyConfigured):
+            results.SQLiteBackend(url='sqlite://', app=make_app(self.url))
+
+    def test_shared(self):
+        """A result stored by the worker can be read by any API replica"""
+        worker, api1, api2 = make_app(self.url), make_app(self.url), make_app(self.url)
+        worker.backend.store_result('some-task-id', {'content': {}, 'error': None, 'params': {}}, 'SUCCESS')
+
+        for api in (api1, api2):
+            found = api.AsyncResult('some-task-id')
+            self.assertEqual(found.status, 'SUCCESS')
+            self.assertEqual(found.result, {'content': {}, 'error': None, 'params': {}})
+
+    def test_pending(self):
+        """Unknown tasks are PENDING"""
+        app = make_app(self.url)
+
+        self.assertEqual(app.AsyncResult('nope').status, 'PENDING')
+
+    def test_update(self):
+        """Storing a result again replaces it"""
+        app = make_app(self.url)
+        app.backend.store_result('some-task-id', None, 'STARTED')
+        app.backend.store_result('some-task-id', {'error': None}, 'SUCCESS')
+
+        self.assertEqual(app.AsyncResult('some-task-id').status, 'SUCCESS')
+
+    def test_forget(self):
+        """Forgetting a task deletes its result"""
+        app = make_app(self.url)
+        app.backend.store_result('some-task-id', {'error': None}, 'SUCCESS')
+        app.AsyncResult('some-task-id').forget()
+
+        self.assertEqual(make_app(self.url).AsyncResult('some-task-id').status, 'PENDING')
+
+    def test_cleanup(self):
+        """``cleanup`` deletes the results older than the TTL"""
+        app = make_app(self.url, ttl=60)
+        now = [1000]
+        backend = results.SQLiteBackend(url=self.url, app=app, clock=lambda: now[0])
+        backend.store_result('old-task', {'error': None}, 'SUCCESS')
+        now[0] = 1050
+        backend.store_result('new-task', {'error': None}, 'SUCCESS')
+        now[0] = 1070
+
+        deleted = backend.cleanup()
+
+        self.assertEqual(deleted, 1)
+        self.assertEqual(backend.get_task_meta('old-task')['status'], 'PENDING')
+        self.assertEqual(backend.get_task_meta('new-task')['status'], 'SUCCESS')
+
+    def test_cleanup_no_ttl(self):
+        """``cleanup`` keeps every result if results never expire"""
+        app = make_app(self.url, ttl=0)
+        app.backend.store_result('some-task-id', {'error': None}, 'SUCCESS')
+
+        self.assertEqual(app.backend.cleanup(), 0)
+
+    def test_pickle(self):
+        """The backend can be sent to other processes"""
+        app = make_app(self.url)
+        copied = pickle.loads(pickle.dumps(app.backend))
+
+        self.assertEqual(copied.url, self.url)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in shards.py
+"""
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from vlab_esrs_api.lib.worker import shards
+
+USERS = ['user{}'.format(x) for x in range(1000)]
+
+
+class TestHashRing(unittest.TestCase):
+    """A set of test cases for the HashRing object"""
+    def test_stable(self):
+        """``HashRing.server_for`` always puts a user on the same vCenter"""
+        ring1 = shards.HashRing(['vc1', 'vc2', 'vc3'])
+        ring2 = shards.HashRing(['vc3', 'vc1', 'vc2'])
+
+        for user in USERS:
+            self.assertEqual(ring1.server_for(user), ring2.server_for(user))
+
+    def test_spread(self):
+        """``HashRing.server_for`` spreads users over every vCenter"""
+        ring = shards.HashRing(['vc1', 'vc2', 'vc3'])
+        counts = {}
+        for user in USERS:
+            server = ring.server_for(user)
+            counts[server] = counts.get(server, 0) + 1
+
+        self.assertEqual(set(counts), {'vc1', 'vc2', 'vc3'})
+        self.assertTrue(min(counts.values()) > 200)
+
+    def test_no_servers(self):
+        """``HashRing`` raises ValueError without any servers"""
+        with self.assertRaises(ValueError):
+            shards.HashRing([])
+
+
+class TestShards(unittest.TestCase):
+    """A set of test cases for the functions in shards.py"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.tmp = tempfile.mkdtemp()
+        self.overrides = os.path.join(self.tmp, 'overrides.json')
+        self.patcher = patch.object(shards, 'const')
+        self.fake_const = self.patcher.start()
+        self.fake_const.INF_VCENTER_SERVERS = 'vc1,vc2'
+        self.fake_const.VLAB_ESRS_VCENTER_OVERRIDES = ''
+        self.fake_const.VLAB_ESRS_VCENTER_CONCURRENCY = 2
+
+    def tearDown(self):
+        """Runs after every test case"""
+        self.patcher.stop()
+        shutil.rmtree(self.tmp)
+
+    def test_servers(self):
+        """``servers`` parses the comma separated list"""
+        self.fake_const.INF_VCENTER_SERVERS = 'vc1, vc2,'
+        self.assertEqual(shards.servers(), ['vc1', 'vc2'])
+
+    def test_server_for(self):
+        """``server_for`` uses the hash ring"""
+        expected = shards.HashRing(['vc1', 'vc2']).server_for('alice')
+
+        self.assertEqual(shards.server_for('alice'), expected)
+
+    def test_ring(self):
+        """``ring`` builds the ring of the configured servers once"""
+        self.assertTrue(shards.ring() is shards.ring())
+        self.assertEqual(shards.ring().servers, ['vc1', 'vc2'])
+
+    def test_server_for_override(self):
+        """``server_for`` honors the override table"""
+        self.fake_const.VLAB_ESRS_VCENTER_OVERRIDES = self.overrides
+        with open(self.overrides, 'w') as the_file:
+            json.dump({'alice': 'vc9'}, the_file)
+
+        self.assertEqual(shards.server_for('alice'), 'vc9')
+
+    def test_plan_rebalance(self):
+        """``plan_rebalance`` only moves users onto the new vCenter"""
+        moves = shards.plan_rebalance(USERS, ['vc1', 'vc2', 'vc3'], ['vc1', 'vc2', 'vc3', 'vc4'])
+
+        self.assertTrue(all(new == 'vc4' for old, new in moves.values()))
+        # about a quarter of the users should move
+        self.assertTrue(150 < len(moves) < 350)
+
+    def test_plan_rebalance_pinned(self):
+        """``plan_rebalance`` never moves pinned users"""
+        moves = shards.plan_rebalance(USERS, ['vc1'], ['vc1', 'vc2'])
+        pinned = {x: 'vc1' for x in moves}
+
+        output = shards.plan_rebalance(USERS, ['vc1'], ['vc1', 'vc2'], pinned=pinned)
+
+        self.assertEqual(output, {})
+
+    def test_pin(self):
+        """``pin`` adds to the override table"""
+        self.fake_const.VLAB_ESRS_VCENTER_OVERRIDES = self.overrides
+        shards.pin({'alice': 'vc1'})
+        output = shards.pin({'bob': 'vc2'})
+
+        self.assertEqual(output, {'alice': 'vc1', 'bob': 'vc2'})
+
+    def test_pin_no_table(self):
+        """``pin`` raises ValueError when no override table is configured"""
+        with self.assertRaises(ValueError):
+            shards.pin({'alice': 'vc1'})
+
+    def test_session_slot(self):
+        """``session_slot`` limits the sessions per vCenter"""
+        with shards.session_slot('vc-slots'):
+            with shards.session_slot('vc-slots'):
+                self.assertFalse(shards._SLOTS['vc-slots'].acquire(blocking=False))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,6 +5,9 @@ A suite of tests for the functions in tasks.py
 import unittest
 from unittest.mock import patch, MagicMock
 
+from celery.app.task import Context
+
+from vlab_esrs_api.lib import cancel, profiling
 from vlab_esrs_api.lib.worker import tasks
 
 
@@ -20,6 +23,17 @@ class TestTasks(unittest.TestCase):
 
         self.assertEqual(output, expected)
 
+    @patch.object(tasks, 'vmware')
+    def test_show_paged(self, fake_vmware):
+        """``show`` returns the cursor for the next page"""
+        fake_vmware.page_esrs.return_value = ({'esrs1': {}}, 'ZXNyczE=')
+
+        output = tasks.show(username='bob', txn_id='myId', fields='name', limit=1)
+        expected = {'content' : {'esrs1': {}}, 'error': None, 'params': {'next_cursor': 'ZXNyczE='}}
+
+        self.assertEqual(output, expected)
+        self.assertFalse(fake_vmware.show_esrs.called)
+
     @patch.object(tasks, 'vmware')
     def test_show_value_error(self, fake_vmware):
         """``show`` sets the error in the dictionary to the ValueError message"""
@@ -36,10 +50,38 @@ class TestTasks(unittest.TestCase):
         fake_vmware.create_esrs.return_value = {'worked': True}
 
         output = tasks.create(username='bob', machine_name='myESRS', image='3.28', network='someNetwork', txn_id='myId')
-        expected = {'content' : {'worked': True}, 'error': None, 'params': {}}
+        expected = {'content' : {'worked': True}, 'error': None, 'params': {'timings': {}}}
 
         self.assertEqual(output, expected)
 
+    @patch.object(tasks, 'vmware')
+    def test_create_timings(self, fake_vmware):
+        """``create`` reports how long preparing the import spec, and the upload took"""
+        def create_esrs(*args, **kwargs):
+            kwargs['timings'].update({'spec': 0.5, 'upload': 60.0})
+            return {'worked': True}
+        fake_vmware.create_esrs.side_effect = create_esrs
+
+        output = tasks.create(username='bob', machine_name='myESRS', image='3.28', network='someNetwork', txn_id='myId')
+
+        self.assertEqual(output['params']['timings'], {'spec': 0.5, 'upload': 60.0})
+
+    @patch.object(tasks.create, 'update_state')
+    @patch.object(tasks, 'vmware')
+    def test_create_queued(self, fake_vmware, fake_update_state):
+        """``create`` goes back to STARTED once a queued upload is admitted"""
+        def create_esrs(*args, **kwargs):
+            kwargs['on_queued'](2)
+            kwargs['on_queued'](0)
+            return {'worked': True}
+        fake_vmware.create_esrs.side_effect = create_esrs
+
+        tasks.create(username='bob', machine_name='myESRS', image='3.28', network='someNetwork', txn_id='myId')
+        states = [x[1] for x in fake_update_state.call_args_list]
+        expected = [{'state': 'QUEUED', 'meta': {'position': 2}}, {'state': 'STARTED'}]
+
+        self.assertEqual(states, expected)
+
     @patch.object(tasks, 'vmware')
     def test_create_value_error(self, fake_vmware):
         """``create`` sets the error in the dictionary to the ValueError message"""
@@ -50,6 +92,19 @@ class TestTasks(unittest.TestCase):
 
         self.assertEqual(output, expected)
 
+    @patch.object(tasks, 'cancel')
+    @patch.object(tasks, 'vmware')
+    def test_create_cancelled(self, fake_vmware, fake_cancel):
+        """``create`` doesn't start if it was cancelled while queued"""
+        fake_cancel.requested.return_value = True
+        fake_cancel.Cancelled = cancel.Cancelled
+
+        output = tasks.create(username='bob', machine_name='myESRS', image='3.28', network='someNetwork', txn_id='myId')
+
+        self.assertEqual(output['error'], 'Cancelled before starting')
+        self.assertFalse(fake_vmware.create_esrs.called)
+        self.assertTrue(fake_cancel.clear.called)
+
     @patch.object(tasks, 'vmware')
     def test_delete_ok(self, fake_vmware):
         """``delete`` returns a dictionary when everything works as expected"""
@@ -105,5 +160,234 @@ class TestTasks(unittest.TestCase):
 
         self.assertEqual(output, expected)
 
+    @patch.object(tasks, 'vmware')
+    def test_modify_network_bulk(self, fake_vmware):
+        """``modify_network`` returns the outcome per VM when given a list of names"""
+        fake_vmware.update_networks.return_value = {'esrs1': None, 'esrs2': None}
+
+        output = tasks.modify_network(username='pat',
+                                      machine_name=['esrs1', 'esrs2'],
+                                      new_network='wootTown',
+                                      txn_id='someTransactionID')
+        expected = {'content': {'esrs1': None, 'esrs2': None}, 'error': None, 'params': {}}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(tasks, 'vmware')
+    def test_modify_network_bulk_partial(self, fake_vmware):
+        """``modify_network`` sets the error when some VMs in the list failed"""
+        fake_vmware.update_networks.return_value = {'esrs1': None, 'esrs2': 'doh'}
+
+        output = tasks.modify_network(username='pat',
+                                      machine_name=['esrs1', 'esrs2'],
+                                      new_network='wootTown',
+                                      txn_id='someTransactionID')
+        expected = 'Unable to change the network of esrs2'
+
+        self.assertEqual(output['error'], expected)
+
+    @patch.object(tasks, 'admission')
+    def test_tune_admission(self, fake_admission):
+        """``tune_admission`` returns the new caps"""
+        fake_admission.tune.return_value = {'datastore:VM-Storage': 3}
+
+        output = tasks.tune_admission(txn_id='myId')
+        expected = {'content': {'caps': {'datastore:VM-Storage': 3}}, 'error': None, 'params': {}}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(tasks, 'vmware')
+    def test_rebalance(self, fake_vmware):
+        """``rebalance`` returns the users that would move"""
+        fake_vmware.plan_rebalance.return_value = {'alice': ['vc1', 'vc2']}
+
+        output = tasks.rebalance(new_servers=['vc1', 'vc2'], pin=False, txn_id='myId')
+        expected = {'content': {'moves': {'alice': ['vc1', 'vc2']}}, 'error': None, 'params': {}}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(tasks, 'vmware')
+    def test_rebalance_value_error(self, fake_vmware):
+        """``rebalance`` sets the error in the dictionary to the ValueError message"""
+        fake_vmware.plan_rebalance.side_effect = [ValueError('testing')]
+
+        output = tasks.rebalance(new_servers=['vc1', 'vc2'], pin=True, txn_id='myId')
+
+        self.assertEqual(output['error'], 'testing')
+
+    @patch.object(tasks, 'vmware')
+    def test_reap(self, fake_vmware):
+        """``reap`` returns the report"""
+        report = {'alice': {'esrs1': {'reason': 'idle', 'action': 'off', 'error': None}}}
+        fake_vmware.reap_esrs.return_value = report
+
+        output = tasks.reap(dry_run=True, txn_id='myId')
+        expected = {'content': report, 'error': None, 'params': {'dry_run': True}}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(tasks, 'reaper')
+    def test_reaper_opt_out(self, fake_reaper):
+        """``reaper_opt_out`` updates the opt-out list"""
+        tasks.reaper_opt_out(username='alice', opt_out=True, txn_id='myId')
+
+        fake_reaper.set_opt_out.assert_called_with('alice', True)
+
+    @patch.object(tasks, 'vmware')
+    def test_export(self, fake_vmware):
+        """``export`` returns the number of records exported"""
+        fake_vmware.export_esrs.return_value = 42
+
+        output = tasks.export(txn_id='myId')
+
+        self.assertEqual(output['content'], {'records': 42})
+
+    @patch.object(tasks, 'vmware')
+    def test_reconcile_metadata(self, fake_vmware):
+        """``reconcile_metadata`` returns what changed on each vCenter"""
+        fake_vmware.reconcile_metadata.return_value = {'vc1': {'added': 1, 'updated': 0, 'removed': 0}}
+
+        output = tasks.reconcile_metadata(txn_id='myId')
+
+        self.assertEqual(output['content'], {'vc1': {'added': 1, 'updated': 0, 'removed': 0}})
+
+
+    @patch.object(tasks, 'start_refreshers')
+    def test_thread_pool_refreshers(self, fake_start_refreshers):
+        """``start_thread_pool_refreshers`` starts the refreshers when tasks run in the main process"""
+        fake_consumer = MagicMock()
+        fake_consumer.pool = tasks.thread.TaskPool.__new__(tasks.thread.TaskPool)
+
+        tasks.start_thread_pool_refreshers(sender=fake_consumer)
+
+        self.assertTrue(fake_start_refreshers.called)
+
+    @patch.object(tasks.os, 'makedirs')
+    @patch.object(tasks, 'network_index')
+    @patch.object(tasks, 'placement')
+    @patch.object(tasks.shards, 'servers')
+    def test_start_refreshers(self, fake_servers, fake_placement, fake_network_index, fake_makedirs):
+        """``start_refreshers`` doesn't let the network watcher hold a task's session slot"""
+        fake_servers.return_value = ['vc1']
+
+        tasks.start_refreshers()
+        connect = fake_network_index.get_index.return_value.start_watcher.call_args[0][0]
+
+        self.assertEqual(connect.args, ('vc1',))
+        self.assertEqual(connect.keywords, {'slot': False})
+
+    @patch.object(tasks.os, 'makedirs')
+    @patch.object(tasks, 'network_index')
+    @patch.object(tasks, 'placement')
+    @patch.object(tasks.shards, 'servers')
+    def test_start_refreshers_locks(self, fake_servers, fake_placement, fake_network_index, fake_makedirs):
+        """``start_refreshers`` has one process per node talk to vCenter, for each refresher and server"""
+        fake_servers.return_value = ['vc1', 'vc2']
+
+        tasks.start_refreshers()
+        lock_files = [x[1]['lock_file'] for x in fake_placement.get_engine.return_value.start_refresher.call_args_list]
+        lock_files += [x[1]['lock_file'] for x in fake_network_index.get_index.return_value.start_watcher.call_args_list]
+
+        self.assertEqual(len(set(lock_files)), 4)
+
+    @patch.object(tasks, 'preload')
+    def test_preload_worker(self, fake_preload):
+        """``preload_worker`` warms the worker before the pool forks"""
+        tasks.preload_worker(sender=MagicMock())
+
+        self.assertTrue(fake_preload.warm.called)
+
+    @patch.object(tasks, 'const')
+    @patch.object(tasks, 'preload')
+    def test_preload_worker_disabled(self, fake_preload, fake_const):
+        """``preload_worker`` does nothing when VLAB_ESRS_WORKER_PRELOAD is 0"""
+        fake_const.VLAB_ESRS_WORKER_PRELOAD = 0
+        tasks.preload_worker(sender=MagicMock())
+
+        self.assertFalse(fake_preload.warm.called)
+
+    def test_forget_task_logger(self):
+        """``forget_task_logger`` drops the logger made for a finished task"""
+        tasks.get_task_logger(txn_id='myId', task_id='some-task-id')
+
+        tasks.forget_task_logger(task_id='some-task-id')
+
+        self.assertFalse('some-task-id' in tasks.logging.Logger.manager.loggerDict)
+
+    @patch.object(tasks, 'vmware')
+    def test_power(self, fake_vmware):
+        """``power`` reports which ESRS instances it couldn't power on or off"""
+        fake_vmware.power_esrs.return_value = {'esrs1': None, 'esrs2': 'No ESRS named esrs2 found'}
+
+        output = tasks.power(username='bob', machine_name=['esrs1', 'esrs2'], action='off', txn_id='myId')
+
+        self.assertEqual(output['content'], {'esrs1': None, 'esrs2': 'No ESRS named esrs2 found'})
+        self.assertEqual(output['error'], 'Unable to power off esrs2')
+
+    @patch.object(tasks, 'vmware')
+    def test_power_one(self, fake_vmware):
+        """``power`` accepts a single name"""
+        fake_vmware.power_esrs.return_value = {'esrs1': None}
+
+        output = tasks.power(username='bob', machine_name='esrs1', action='on', txn_id='myId')
+        args, _ = fake_vmware.power_esrs.call_args
+
+        self.assertEqual(args[1], ['esrs1'])
+        self.assertEqual(output['error'], None)
+
+    @patch.object(tasks, 'vmware')
+    def test_power_value_error(self, fake_vmware):
+        """``power`` sets the error in the dictionary to the ValueError message"""
+        fake_vmware.power_esrs.side_effect = [ValueError("testing")]
+
+        output = tasks.power(username='bob', machine_name=None, action='on', txn_id='myId')
+
+        self.assertEqual(output['error'], 'testing')
+
+    @patch.object(tasks, 'profiling')
+    def test_start_profile_unmarked(self, fake_profiling):
+        """``start_profile`` leaves tasks alone unless they were sent with the X-PROFILE header"""
+        fake_profiling.HEADER = profiling.HEADER
+        fake_task = MagicMock()
+        fake_task.request = Context()
+
+        tasks.start_profile(task_id='some-task-id', task=fake_task, args=['myId'], kwargs={})
+
+        self.assertFalse(fake_profiling.start.called)
+
+    @patch.object(tasks, 'profiling')
+    def test_profile(self, fake_profiling):
+        """``start_profile`` and ``save_profile`` profile a task sent with the X-PROFILE header"""
+        fake_profiling.HEADER = profiling.HEADER
+        fake_task = MagicMock()
+        fake_task.request = Context({profiling.HEADER: True})
+
+        tasks.start_profile(task_id='some-task-id', task=fake_task, args=['bob', 'myId'], kwargs={})
+        tasks.save_profile(task=fake_task)
+
+        fake_profiling.start.assert_called_with('some-task-id')
+        self.assertTrue(fake_profiling.start.return_value.stop.called)
+
+    @patch.object(tasks, 'profiling')
+    def test_profile_busy(self, fake_profiling):
+        """``start_profile`` runs the task unprofiled when too many tasks are being profiled"""
+        fake_profiling.HEADER = profiling.HEADER
+        fake_profiling.start.return_value = None
+        fake_task = MagicMock()
+        fake_task.request = Context({profiling.HEADER: True})
+
+        tasks.start_profile(task_id='some-task-id', task=fake_task, args=['bob', 'myId'], kwargs={})
+        tasks.save_profile(task=fake_task)
+
+        self.assertEqual(getattr(fake_task.request, 'esrs_profiling', None), None)
+
+    @patch.object(tasks, 'start_refreshers')
+    def test_prefork_refreshers(self, fake_start_refreshers):
+        """``start_thread_pool_refreshers`` leaves the refreshers to the prefork child processes"""
+        tasks.start_thread_pool_refreshers(sender=MagicMock())
+
+        self.assertFalse(fake_start_refreshers.called)
+
+
 if __name__ == '__main__':
     unittest.main()
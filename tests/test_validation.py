@@ -0,0 +1,94 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in validation.py
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from vlab_esrs_api.lib import validation, metadata
+
+
+class TestCheckCreate(unittest.TestCase):
+    """A set of test cases for the check_create function"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.workdir = tempfile.mkdtemp()
+        self.index = metadata.MetadataIndex(os.path.join(self.workdir, 'metadata.db'))
+        self.index.reconcile('vc1', iter([{'owner': 'alice', 'name': 'esrs1', 'vcenter': 'vc1'}]))
+        self.index.replace_catalog(metadata.IMAGE, '', ['3.28', '3.30'])
+        self.index.replace_catalog(metadata.NETWORK, 'vc1', ['alice_frontend'])
+        self.now = metadata.time.time()
+        self.reader = metadata.MetadataIndex(self.index.path, read_only=True)
+        self.index_patcher = patch.object(validation.metadata, 'get_index', return_value=self.reader)
+        self.index_patcher.start()
+        self.const_patcher = patch.object(validation, 'const')
+        self.fake_const = self.const_patcher.start()
+        self.fake_const.VLAB_ESRS_VALIDATION_MAX_AGE = 1800
+        self.fake_const.VLAB_ESRS_VALIDATION_NETWORK_MAX_AGE = 180
+        self.fake_const.VLAB_ESRS_MAX_PER_USER = 0
+
+    def tearDown(self):
+        """Runs after every test case"""
+        self.index_patcher.stop()
+        self.const_patcher.stop()
+        shutil.rmtree(self.workdir)
+
+    def check(self, machine_name='esrs2', image='3.28', network='alice_frontend', later=0):
+        """Check a create by alice, ``later`` seconds after the index was updated"""
+        validation.check_create('alice', machine_name, image, network, clock=lambda: self.now + later)
+
+    def test_ok(self):
+        """``check_create`` accepts a create that can work"""
+        self.check()
+
+    def test_name_taken(self):
+        """``check_create`` raises Conflict if the user already has an ESRS with the name"""
+        with self.assertRaises(validation.Conflict):
+            self.check(machine_name='esrs1')
+
+    def test_quota(self):
+        """``check_create`` raises Conflict if the user has VLAB_ESRS_MAX_PER_USER ESRS"""
+        self.fake_const.VLAB_ESRS_MAX_PER_USER = 1
+
+        with self.assertRaises(validation.Conflict):
+            self.check()
+
+    def test_bad_image(self):
+        """``check_create`` raises ValueError for images that don't exist"""
+        with self.assertRaises(ValueError) as caught:
+            self.check(image='1.0')
+
+        self.assertFalse(isinstance(caught.exception, validation.Conflict))
+
+    def test_bad_network(self):
+        """``check_create`` raises ValueError for networks that don't exist"""
+        with self.assertRaises(ValueError):
+            self.check(network='alice_nope')
+
+    def test_stale_network(self):
+        """``check_create`` leaves networks to the worker once the network catalog is too old"""
+        self.check(network='alice_nope', later=600)
+
+    def test_stale(self):
+        """``check_create`` skips every check once the index is too old"""
+        self.check(machine_name='esrs1', image='1.0', network='alice_nope', later=3600)
+
+    def test_no_index(self):
+        """``check_create`` leaves every check to the worker if there's no index yet"""
+        validation.metadata.get_index.side_effect = ValueError('The ESRS metadata index is not available yet')
+
+        self.check(machine_name='esrs1')
+
+    def test_old_index(self):
+        """``check_create`` leaves every check to the worker if the index has no catalog"""
+        with self.index._connect() as conn:
+            conn.execute('DROP TABLE freshness')
+
+        self.check(machine_name='esrs1')
+
+
+if __name__ == '__main__':
+    unittest.main()
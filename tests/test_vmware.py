@@ -5,7 +5,7 @@ A suite of tests for the functions in vmware.py
 import unittest
 from unittest.mock import patch, MagicMock
 
-from vlab_esrs_api.lib.worker import vmware
+from vlab_esrs_api.lib.worker import vmware, breaker
 
 
 class TestVMware(unittest.TestCase):
@@ -14,6 +14,83 @@ class TestVMware(unittest.TestCase):
     def setUpClass(cls):
         vmware.logger = MagicMock()
 
+    def setUp(self):
+        """Runs before every test case"""
+        # Resolve networks from the fake vCenter, like the network index would
+        self.patcher = patch.object(vmware.network_index, 'lookup')
+        fake_lookup = self.patcher.start()
+        fake_lookup.side_effect = lambda vcenter, name, server=None: vcenter.networks[name]
+        # Keep the tests from writing a real metadata index
+        self.metadata_patcher = patch.object(vmware, 'metadata')
+        self.fake_metadata = self.metadata_patcher.start()
+        self.breaker_patcher = patch.object(vmware, 'breaker')
+        self.fake_breaker = self.breaker_patcher.start()
+        self.fake_breaker.allow.return_value = False
+        # The user's folder in the fake vCenter is empty
+        self.retrieve_patcher = patch.object(vmware.inventory, 'retrieve')
+        self.fake_retrieve = self.retrieve_patcher.start()
+        self.fake_retrieve.return_value = []
+
+    def tearDown(self):
+        """Runs after every test case"""
+        self.patcher.stop()
+        self.metadata_patcher.stop()
+        self.breaker_patcher.stop()
+        self.retrieve_patcher.stop()
+
+    @patch.object(vmware, 'vCenter')
+    def test_connect_records(self, fake_vCenter):
+        """``connect`` tells the circuit breaker how logging into vCenter went"""
+        with vmware.connect('vc1'):
+            pass
+
+        _, the_kwargs = self.fake_breaker.record.call_args
+
+        self.assertTrue(the_kwargs['ok'])
+
+    @patch.object(vmware, 'vCenter')
+    def test_connect_login_fails(self, fake_vCenter):
+        """``connect`` tells the circuit breaker when it cannot log into vCenter"""
+        fake_vCenter.side_effect = OSError('timed out')
+
+        with self.assertRaises(OSError):
+            with vmware.connect('vc1'):
+                pass
+
+        _, the_kwargs = self.fake_breaker.record.call_args
+
+        self.assertFalse(the_kwargs['ok'])
+
+    @patch.object(vmware.shards, 'session_slot')
+    @patch.object(vmware, 'vCenter')
+    def test_connect_slot(self, fake_vCenter, fake_session_slot):
+        """``connect`` holds a session slot while the session is open"""
+        with vmware.connect('vc1'):
+            pass
+
+        fake_session_slot.assert_called_with('vc1')
+
+    @patch.object(vmware.shards, 'session_slot')
+    @patch.object(vmware, 'vCenter')
+    def test_connect_no_slot(self, fake_vCenter, fake_session_slot):
+        """``connect`` can open a long-lived session without taking a task's session slot"""
+        with vmware.connect('vc1', slot=False):
+            pass
+
+        self.assertTrue(fake_vCenter.called)
+        self.assertFalse(fake_session_slot.called)
+
+    @patch.object(vmware, 'vCenter')
+    def test_connect_open(self, fake_vCenter):
+        """``connect`` doesn't try to log in while the circuit breaker is open"""
+        self.fake_breaker.allow.side_effect = breaker.BreakerOpen('vc1', 30)
+
+        with self.assertRaises(ValueError):
+            with vmware.connect('vc1'):
+                pass
+
+        self.assertFalse(fake_vCenter.called)
+
     @patch.object(vmware.virtual_machine, 'get_info')
     @patch.object(vmware, 'vCenter')
     def test_show_esrs(self, fake_vCenter, fake_get_info):
@@ -60,15 +137,15 @@ class TestVMware(unittest.TestCase):
 
     @patch.object(vmware.virtual_machine, 'set_meta')
     @patch.object(vmware, 'consume_task')
-    @patch.object(vmware, 'Ova')
+    @patch.object(vmware.import_spec, 'descriptor')
     @patch.object(vmware.virtual_machine, 'get_info')
-    @patch.object(vmware.virtual_machine, 'deploy_from_ova')
+    @patch.object(vmware.ovf, 'deploy_from_ova')
     @patch.object(vmware, 'vCenter')
-    def test_create_esrs(self, fake_vCenter, fake_deploy_from_ova, fake_get_info, fake_Ova, fake_consume_task, set_meta):
+    def test_create_esrs(self, fake_vCenter, fake_deploy_from_ova, fake_get_info, fake_descriptor, fake_consume_task, set_meta):
         """``create_esrs`` returns the new esrs's info when everything works"""
         fake_logger = MagicMock()
         fake_deploy_from_ova.return_value.name = 'myESRS'
-        fake_Ova.return_value.networks = ['vLabNetwork']
+        fake_descriptor.return_value.networks = ['vLabNetwork']
         fake_get_info.return_value = {'worked' : True}
         fake_vCenter.return_value.__enter__.return_value.networks = {'someNetwork': vmware.vim.Network(moId='asdf')}
 
@@ -82,14 +159,14 @@ class TestVMware(unittest.TestCase):
         self.assertEqual(output, expected)
 
     @patch.object(vmware, 'consume_task')
-    @patch.object(vmware, 'Ova')
+    @patch.object(vmware.import_spec, 'descriptor')
     @patch.object(vmware.virtual_machine, 'get_info')
-    @patch.object(vmware.virtual_machine, 'deploy_from_ova')
+    @patch.object(vmware.ovf, 'deploy_from_ova')
     @patch.object(vmware, 'vCenter')
-    def test_create_esrs_value_error(self, fake_vCenter, fake_deploy_from_ova, fake_get_info, fake_Ova, fake_consume_task):
+    def test_create_esrs_value_error(self, fake_vCenter, fake_deploy_from_ova, fake_get_info, fake_descriptor, fake_consume_task):
         """``create_esrs`` raises ValueError if supplied with a non-existing network"""
         fake_logger = MagicMock()
-        fake_Ova.return_value.networks = ['vLabNetwork']
+        fake_descriptor.return_value.networks = ['vLabNetwork']
         fake_get_info.return_value = {'worked' : True}
         fake_vCenter.return_value.__enter__.return_value.networks = {'someNetwork': vmware.vim.Network(moId='asdf')}
 
@@ -101,14 +178,14 @@ class TestVMware(unittest.TestCase):
                                     logger=fake_logger)
 
     @patch.object(vmware, 'consume_task')
-    @patch.object(vmware, 'Ova')
+    @patch.object(vmware.import_spec, 'descriptor')
     @patch.object(vmware.virtual_machine, 'get_info')
-    @patch.object(vmware.virtual_machine, 'deploy_from_ova')
+    @patch.object(vmware.ovf, 'deploy_from_ova')
     @patch.object(vmware, 'vCenter')
-    def test_create_esrs_bad_image(self, fake_vCenter, fake_deploy_from_ova, fake_get_info, fake_Ova, fake_consume_task):
+    def test_create_esrs_bad_image(self, fake_vCenter, fake_deploy_from_ova, fake_get_info, fake_descriptor, fake_consume_task):
         """``create_esrs`` raises ValueError if supplied with a non-existing image to deploy"""
         fake_logger = MagicMock()
-        fake_Ova.side_effect = FileNotFoundError('testing')
+        fake_descriptor.side_effect = FileNotFoundError('testing')
         fake_get_info.return_value = {'worked' : True}
         fake_vCenter.return_value.__enter__.return_value.networks = {'someNetwork': vmware.vim.Network(moId='asdf')}
 
@@ -119,6 +196,41 @@ class TestVMware(unittest.TestCase):
                                     network='someNetwork',
                                     logger=fake_logger)
 
+    @patch.object(vmware.ovf, 'deploy_from_ova')
+    @patch.object(vmware, 'vCenter')
+    def test_create_esrs_name_taken(self, fake_vCenter, fake_deploy_from_ova):
+        """``create_esrs`` raises ValueError, before deploying, if the user already has a VM with the name"""
+        self.fake_retrieve.return_value = [(MagicMock(), {'name': 'myESRS', 'config.annotation': ''})]
+
+        with self.assertRaises(ValueError):
+            vmware.create_esrs(username='alice', machine_name='myESRS', image='3.28',
+                               network='someNetwork', logger=MagicMock())
+        self.assertFalse(fake_deploy_from_ova.called)
+
+    @patch.object(vmware, 'const')
+    @patch.object(vmware.ovf, 'deploy_from_ova')
+    @patch.object(vmware, 'vCenter')
+    def test_create_esrs_quota(self, fake_vCenter, fake_deploy_from_ova, fake_const):
+        """``create_esrs`` raises ValueError, before deploying, if the user has VLAB_ESRS_MAX_PER_USER ESRS"""
+        fake_const.VLAB_ESRS_MAX_PER_USER = 2
+        self.fake_retrieve.return_value = [(MagicMock(), {'name': 'esrs1', 'config.annotation': '{"component": "ESRS"}'}),
+                                           (MagicMock(), {'name': 'other', 'config.annotation': '{"component": "OneFS"}'}),
+                                           (MagicMock(), {'name': 'esrs2', 'config.annotation': '{"component": "ESRS"}'})]
+
+        with self.assertRaises(ValueError):
+            vmware.create_esrs(username='alice', machine_name='myESRS', image='3.28',
+                               network='someNetwork', logger=MagicMock())
+        self.assertFalse(fake_deploy_from_ova.called)
+
+    @patch.object(vmware.os, 'listdir')
+    def test_list_images_catalog(self, fake_listdir):
+        """``list_images`` shares the images with the API, through the metadata index"""
+        fake_listdir.return_value = ['ESRS_3.28.ova']
+
+        vmware.list_images()
+
+        self.fake_metadata.get_index.return_value.replace_catalog.assert_called_with(self.fake_metadata.IMAGE, '', ['3.28'])
+
     @patch.object(vmware.virtual_machine, 'get_info')
     @patch.object(vmware, 'consume_task')
     @patch.object(vmware.virtual_machine, 'power')
@@ -246,6 +358,266 @@ class TestVMware(unittest.TestCase):
                                   new_network='dohNet')
 
 
+    @patch.object(vmware.virtual_machine, 'change_network')
+    @patch.object(vmware.virtual_machine, 'get_info')
+    @patch.object(vmware, 'vCenter')
+    def test_update_network_no_network_error(self, fake_vCenter, fake_get_info, fake_change_network):
+        """``update_network`` names the missing network in the error"""
+        fake_vm = MagicMock()
+        fake_vm.name = 'myESRS'
+        fake_folder = MagicMock()
+        fake_folder.childEntity = [fake_vm]
+        fake_vCenter.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
+        fake_vCenter.return_value.__enter__.return_value.networks = {'wootTown' : 'someNetworkObject'}
+        fake_get_info.return_value = {'meta': {'component' : 'ESRS'}}
+
+        with self.assertRaisesRegex(ValueError, 'No such network named dohNet'):
+            vmware.update_network(username='pat',
+                                  machine_name='myESRS',
+                                  new_network='dohNet')
+
+    @patch.object(vmware.virtual_machine, 'change_network')
+    @patch.object(vmware.virtual_machine, 'get_info')
+    @patch.object(vmware, 'vCenter')
+    def test_update_networks(self, fake_vCenter, fake_get_info, fake_change_network):
+        """``update_networks`` returns the outcome for every VM"""
+        fake_vms = []
+        for name in ('esrs1', 'esrs2', 'esrs3'):
+            fake_vm = MagicMock()
+            fake_vm.name = name
+            fake_vms.append(fake_vm)
+        fake_folder = MagicMock()
+        fake_folder.childEntity = fake_vms
+        fake_vCenter.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
+        fake_vCenter.return_value.__enter__.return_value.networks = {'wootTown' : 'someNetworkObject'}
+        fake_get_info.return_value = {'meta': {'component' : 'ESRS'}}
+        fake_change_network.side_effect = lambda vm, network: vm.name == 'esrs2' and 1/0
+
+        output = vmware.update_networks(username='pat',
+                                        machine_names=['esrs1', 'esrs2', 'notAThing'],
+                                        new_network='wootTown')
+        expected = {'esrs1': None, 'esrs2': 'division by zero', 'notAThing': 'No VM named notAThing found'}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(vmware.power, 'power')
+    @patch.object(vmware.power, 'find_esrs')
+    @patch.object(vmware, 'vCenter')
+    def test_power_esrs(self, fake_vCenter, fake_find_esrs, fake_power):
+        """``power_esrs`` powers the named ESRS instances, and reports the ones it can't find"""
+        fake_find_esrs.return_value = {'esrs1': ('vm1', 'poweredOn'), 'esrs2': ('vm2', 'poweredOn')}
+        fake_power.return_value = {'esrs1': None}
+
+        output = vmware.power_esrs('pat', ['esrs1', 'notAThing'], 'off', MagicMock())
+        args, _ = fake_power.call_args
+        expected = {'esrs1': None, 'notAThing': 'No ESRS named notAThing found'}
+
+        self.assertEqual(output, expected)
+        self.assertEqual(args[1], {'esrs1': ('vm1', 'poweredOn')})
+
+    @patch.object(vmware.power, 'power')
+    @patch.object(vmware.power, 'find_esrs')
+    @patch.object(vmware, 'vCenter')
+    def test_power_esrs_all(self, fake_vCenter, fake_find_esrs, fake_power):
+        """``power_esrs`` powers all of the user's ESRS instances when no names are given"""
+        fake_find_esrs.return_value = {'esrs1': ('vm1', 'poweredOn'), 'esrs2': ('vm2', 'poweredOn')}
+        fake_power.return_value = {'esrs1': None, 'esrs2': None}
+
+        output = vmware.power_esrs('pat', None, 'shutdown', MagicMock())
+
+        self.assertEqual(output, {'esrs1': None, 'esrs2': None})
+
+    @patch.object(vmware, 'vCenter')
+    def test_power_esrs_unknown(self, fake_vCenter):
+        """``power_esrs`` raises ValueError for unknown actions, before connecting to vCenter"""
+        with self.assertRaises(ValueError):
+            vmware.power_esrs('pat', None, 'hibernate', MagicMock())
+
+        self.assertFalse(fake_vCenter.called)
+
+    @patch.object(vmware.virtual_machine, 'change_network')
+    @patch.object(vmware.virtual_machine, 'get_info')
+    @patch.object(vmware, 'vCenter')
+    def test_update_networks_one_session(self, fake_vCenter, fake_get_info, fake_change_network):
+        """``update_networks`` changes every VM using one vCenter session"""
+        fake_vms = []
+        for name in ('esrs1', 'esrs2'):
+            fake_vm = MagicMock()
+            fake_vm.name = name
+            fake_vms.append(fake_vm)
+        fake_folder = MagicMock()
+        fake_folder.childEntity = fake_vms
+        fake_vCenter.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
+        fake_vCenter.return_value.__enter__.return_value.networks = {'wootTown' : 'someNetworkObject'}
+        fake_get_info.return_value = {'meta': {'component' : 'ESRS'}}
+
+        vmware.update_networks(username='pat', machine_names=['esrs1', 'esrs2'], new_network='wootTown')
+
+        self.assertEqual(fake_vCenter.call_count, 1)
+        self.assertEqual(fake_change_network.call_count, 2)
+
+    @patch.object(vmware.virtual_machine, 'get_info')
+    @patch.object(vmware, 'vCenter')
+    def test_update_networks_no_network(self, fake_vCenter, fake_get_info):
+        """``update_networks`` raises ValueError if the new network doesn't exist"""
+        fake_vCenter.return_value.__enter__.return_value.networks = {'wootTown' : 'someNetworkObject'}
+
+        with self.assertRaises(ValueError):
+            vmware.update_networks(username='pat', machine_names=['esrs1'], new_network='dohNet')
+
+    @patch.object(vmware.listing, 'list_esrs')
+    @patch.object(vmware, 'vCenter')
+    def test_page_esrs(self, fake_vCenter, fake_list_esrs):
+        """``page_esrs`` parses the fields before listing"""
+        fake_list_esrs.return_value = ({}, None)
+
+        vmware.page_esrs(username='alice', fields='name,meta.version', limit=5)
+        _, the_kwargs = fake_list_esrs.call_args
+
+        self.assertEqual(the_kwargs['fields'], {'name': None, 'meta': ['version']})
+        self.assertEqual(the_kwargs['limit'], 5)
+
+    @patch.object(vmware.virtual_machine, 'get_info')
+    @patch.object(vmware.shards, 'server_for')
+    @patch.object(vmware, 'vCenter')
+    def test_show_esrs_routed(self, fake_vCenter, fake_server_for, fake_get_info):
+        """``show_esrs`` connects to the vCenter that holds the user's VMs"""
+        fake_server_for.return_value = 'vcenter2.vlab.local'
+
+        vmware.show_esrs(username='alice')
+        the_args, the_kwargs = fake_vCenter.call_args
+
+        self.assertEqual(the_kwargs['host'], 'vcenter2.vlab.local')
+
+    @patch.object(vmware, 'vCenter')
+    def test_list_users(self, fake_vCenter):
+        """``list_users`` returns the names of the user folders"""
+        fake_user = MagicMock(spec=vmware.vim.Folder)
+        fake_user.name = 'alice'
+        fake_vm = MagicMock()
+        fake_vm.name = 'notAUser'
+        fake_top = MagicMock()
+        fake_top.childEntity = [fake_user, fake_vm]
+        fake_vCenter.return_value.__enter__.return_value.get_by_name.return_value = fake_top
+
+        output = vmware.list_users('vcenter1.vlab.local')
+
+        self.assertEqual(output, ['alice'])
+
+    @patch.object(vmware.shards, 'pin')
+    @patch.object(vmware.shards, 'overrides')
+    @patch.object(vmware.shards, 'servers')
+    @patch.object(vmware, 'list_users')
+    def test_plan_rebalance(self, fake_list_users, fake_servers, fake_overrides, fake_pin):
+        """``plan_rebalance`` only pins the moved users when asked to"""
+        fake_servers.return_value = ['vc1']
+        fake_overrides.return_value = {}
+        fake_list_users.return_value = ['user{}'.format(x) for x in range(50)]
+
+        output = vmware.plan_rebalance(['vc1', 'vc2'])
+
+        self.assertTrue(output)
+        self.assertFalse(fake_pin.called)
+        self.assertTrue(all(x == ['vc1', 'vc2'] for x in output.values()))
+
+    @patch.object(vmware.shards, 'pin')
+    @patch.object(vmware.shards, 'overrides')
+    @patch.object(vmware.shards, 'servers')
+    @patch.object(vmware, 'list_users')
+    def test_plan_rebalance_pin(self, fake_list_users, fake_servers, fake_overrides, fake_pin):
+        """``plan_rebalance`` pins moved users to their current vCenter"""
+        fake_servers.return_value = ['vc1']
+        fake_overrides.return_value = {}
+        fake_list_users.return_value = ['user{}'.format(x) for x in range(50)]
+
+        output = vmware.plan_rebalance(['vc1', 'vc2'], pin=True)
+        pinned = fake_pin.call_args[0][0]
+
+        self.assertEqual(set(pinned), set(output))
+        self.assertEqual(set(pinned.values()), {'vc1'})
+
+    @patch.object(vmware.reaper, 'reclaim')
+    @patch.object(vmware.reaper, 'sweep')
+    @patch.object(vmware.shards, 'servers')
+    @patch.object(vmware, 'vCenter')
+    def test_reap_esrs(self, fake_vCenter, fake_servers, fake_sweep, fake_reclaim):
+        """``reap_esrs`` sweeps every vCenter"""
+        fake_servers.return_value = ['vc1', 'vc2']
+        fake_reclaim.side_effect = [{'alice': {}}, {'bob': {}}]
+
+        output = vmware.reap_esrs(dry_run=True)
+
+        self.assertEqual(fake_sweep.call_count, 2)
+        self.assertEqual(output, {'alice': {}, 'bob': {}})
+        self.assertFalse(self.fake_metadata.get_index.return_value.remove.called)
+
+    @patch.object(vmware.reaper, 'reclaim')
+    @patch.object(vmware.reaper, 'sweep')
+    @patch.object(vmware.shards, 'servers')
+    @patch.object(vmware, 'vCenter')
+    def test_reap_esrs_index(self, fake_vCenter, fake_servers, fake_sweep, fake_reclaim):
+        """``reap_esrs`` removes the ESRS instances it deleted from the metadata index"""
+        fake_servers.return_value = ['vc1']
+        fake_reclaim.return_value = {'alice': {'esrs1': {'reason': 'age', 'action': 'delete', 'error': None},
+                                               'esrs2': {'reason': 'age', 'action': 'delete', 'error': 'doh'}}}
+
+        vmware.reap_esrs(dry_run=False)
+
+        self.fake_metadata.get_index.return_value.remove.assert_called_once_with('alice', 'esrs1')
+
+    @patch.object(vmware.exports, 'clean')
+    @patch.object(vmware.exports, 'ExportWriter')
+    @patch.object(vmware.export, 'records')
+    @patch.object(vmware.shards, 'servers')
+    @patch.object(vmware, 'vCenter')
+    def test_export_esrs(self, fake_vCenter, fake_servers, fake_records, fake_ExportWriter, fake_clean):
+        """``export_esrs`` writes the records of every vCenter"""
+        fake_servers.return_value = ['vc1', 'vc2']
+        fake_records.side_effect = lambda vcenter, server: iter([{'vcenter': server}])
+        writer = fake_ExportWriter.return_value.__enter__.return_value
+
+        vmware.export_esrs('abc-123')
+        written = [x[0][0] for x in writer.write.call_args_list]
+
+        self.assertEqual(written, [{'vcenter': 'vc1'}, {'vcenter': 'vc2'}])
+
+    @patch.object(vmware.export, 'records')
+    @patch.object(vmware.shards, 'servers')
+    @patch.object(vmware, 'vCenter')
+    def test_reconcile_metadata(self, fake_vCenter, fake_servers, fake_records):
+        """``reconcile_metadata`` reconciles the index with every vCenter, skipping VMs without an owner"""
+        fake_servers.return_value = ['vc1']
+        fake_records.return_value = iter([{'owner': 'alice', 'name': 'esrs1'}, {'owner': None, 'name': 'esrs2'}])
+        index = self.fake_metadata.get_index.return_value
+        index.reconcile.side_effect = lambda server, records: {'added': len(list(records))}
+
+        output = vmware.reconcile_metadata()
+
+        self.assertEqual(output, {'vc1': {'added': 1}})
+
+    def test_update_index_error(self):
+        """``_update_index`` doesn't fail the task when the index can't be updated"""
+        self.fake_metadata.get_index.return_value.remove.side_effect = vmware.sqlite3.OperationalError('locked')
+
+        vmware._update_index('remove', 'alice', 'esrs1')
+
+    @patch.object(vmware.virtual_machine, 'get_info')
+    @patch.object(vmware.virtual_machine, 'power')
+    @patch.object(vmware, 'consume_task')
+    @patch.object(vmware, 'vCenter')
+    def test_delete_esrs_index(self, fake_vCenter, fake_consume_task, fake_power, fake_get_info):
+        """``delete_esrs`` removes the ESRS instance from the metadata index"""
+        fake_vm = MagicMock()
+        fake_vm.name = 'myESRS'
+        fake_folder = MagicMock()
+        fake_folder.childEntity = [fake_vm]
+        fake_vCenter.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
+        fake_get_info.return_value = {'meta': {'component': 'ESRS'}}
+
+        vmware.delete_esrs(username='bob', machine_name='myESRS', logger=MagicMock())
+
+        self.fake_metadata.get_index.return_value.remove.assert_called_with('bob', 'myESRS')
+
 
 if __name__ == '__main__':
     unittest.main()
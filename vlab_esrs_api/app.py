@@ -2,12 +2,14 @@
 from flask import Flask
 from celery import Celery
 
-from vlab_esrs_api.lib import const
+from vlab_esrs_api.lib import const, encoding, results
 from vlab_esrs_api.lib.views import HealthView, ESRSView
 
 app = Flask(__name__)
 app.celery_app = Celery('esrs', backend='rpc://', broker=const.VLAB_MESSAGE_BROKER)
 app.celery_app.conf.broker_heartbeat = 0 #https://github.com/celery/celery/issues/4895
+encoding.configure(app.celery_app)
+results.configure(app.celery_app)
 
 HealthView.register(app)
 ESRSView.register(app)
@@ -0,0 +1,141 @@
+# -*- coding: UTF-8 -*-
+"""
+Cooperative cancellation of running tasks.
+
+The API asks for a task to be cancelled by adding a line to a marker, named
+after the task id, in ``VLAB_ESRS_CANCEL_DIR``. The API doesn't know who owns
+a task, so every request is kept, and a request by someone else can never
+replace the owner's. The task checks for the marker between
+chunks of work and stops at the next one. Celery's own ``revoke`` can only
+drop a task that hasn't started, or kill the whole worker process, which would
+leave a half uploaded VM (and its admission slot) behind.
+
+``VLAB_ESRS_CANCEL_DIR`` must be shared by the API and the workers.
+"""
+import os
+import re
+import time
+
+import ujson
+
+from vlab_esrs_api.lib import const
+
+VALID_ID = re.compile(r'^[A-Za-z0-9-]+$')
+
+
+class Cancelled(ValueError):
+    """The task was cancelled by the user"""
+    pass
+
+
+def path_for(task_id):
+    """Find the cancel marker of a task
+
+    :Returns: String
+
+    :Raises: ValueError for malformed task ids
+
+    :param task_id: The id of the task
+    :type task_id: String
+    """
+    if not task_id or not VALID_ID.match(task_id):
+        raise ValueError('Invalid task id: {}'.format(task_id))
+    return os.path.join(const.VLAB_ESRS_CANCEL_DIR, task_id)
+
+
+def request(task_id, username, admin=False):
+    """Ask a task to stop
+
+    :Returns: None
+
+    :Raises: ValueError for malformed task ids
+
+    :param task_id: The id of the task
+    :type task_id: String
+
+    :param username: The user who wants the task cancelled
+    :type username: String
+
+    :param admin: Set to True if the user may cancel anyone's tasks
+    :type admin: Boolean
+    """
+    path = path_for(task_id)
+    os.makedirs(const.VLAB_ESRS_CANCEL_DIR, exist_ok=True)
+    clean(const.VLAB_ESRS_CANCEL_TTL)
+    marker = {'username': username, 'admin': admin}
+    if marker in _read(path):
+        return
+    # appending one short line is atomic, so concurrent requests can't clobber each other
+    with open(path, 'a') as the_file:
+        the_file.write(ujson.dumps(marker) + '\n')
+
+
+def requested(task_id, owner):
+    """Check if a task should stop
+
+    :Returns: Boolean
+
+    :param task_id: The id of the running task
+    :type task_id: String
+
+    :param owner: The user the task is working for; only they (or an admin) may cancel it
+    :type owner: String
+    """
+    try:
+        markers = _read(path_for(task_id))
+    except ValueError:
+        return False
+    return any(x.get('admin') or x.get('username') == owner for x in markers)
+
+
+def _read(path):
+    """Load every cancel request in a marker
+
+    :Returns: List
+    """
+    try:
+        with open(path) as the_file:
+            lines = the_file.read().splitlines()
+    except OSError:
+        return []
+    markers = []
+    for line in lines:
+        try:
+            markers.append(ujson.loads(line))
+        except ValueError:
+            # a request still being written
+            continue
+    return markers
+
+
+def clear(task_id):
+    """Forget the cancel marker of a finished task
+
+    :Returns: None
+    """
+    try:
+        os.unlink(path_for(task_id))
+    except (OSError, ValueError):
+        pass
+
+
+def clean(max_age, clock=time.time):
+    """Delete markers for tasks that never checked them, like finished tasks
+
+    :Returns: None
+
+    :param max_age: Delete markers older than this many seconds
+    :type max_age: Integer
+    """
+    try:
+        names = os.listdir(const.VLAB_ESRS_CANCEL_DIR)
+    except FileNotFoundError:
+        return
+    now = clock()
+    for name in names:
+        path = os.path.join(const.VLAB_ESRS_CANCEL_DIR, name)
+        try:
+            if now - os.path.getmtime(path) > max_age:
+                os.unlink(path)
+        except FileNotFoundError:
+            pass
@@ -13,10 +13,12 @@ from collections import namedtuple, OrderedDict
 DEFINED = OrderedDict([
             ('VLAB_ESRS_LOG_LEVEL', environ.get('VLAB_ESRS_LOG_LEVEL', 'INFO')),
             ('INF_VCENTER_SERVER', environ.get('INF_VCENTER_SERVER', 'localhost')),
+            ('INF_VCENTER_SERVERS', environ.get('INF_VCENTER_SERVERS', environ.get('INF_VCENTER_SERVER', 'localhost'))),
             ('INF_VCENTER_PORT', int(environ.get('INFO_VCENTER_PORT', 443))),
             ('INF_VCENTER_USER', environ.get('INF_VCENTER_USER', 'tester')),
             ('INF_VCENTER_PASSWORD', environ.get('INF_VCENTER_PASSWORD', 'a')),
             ('INF_VCENTER_DATASTORE', environ.get('INF_VCENTER_DATASTORE', 'VM-Storage')),
+            ('INF_VCENTER_DATASTORES', environ.get('INF_VCENTER_DATASTORES', environ.get('INF_VCENTER_DATASTORE', 'VM-Storage'))),
             ('INF_VCENTER_RESORUCE_POOL', environ.get('INF_VCENTER_RESORUCE_POOL', 'Resources')),
             ('INF_VCENTER_TOP_LVL_DIR', environ.get('INF_VCENTER_TOP_LVL_DIR', 'vlab')),
             ('INF_VCENTER_VERIFY_CERT', environ.get('INF_VCENTER_VERIFY_CERT', False)),
@@ -24,6 +26,63 @@ DEFINED = OrderedDict([
             ('VLAB_URL', environ.get('VLAB_URL', 'https://localhost')),
             ('VLAB_ESRS_IMAGES_DIR', environ.get('VLAB_ESRS_IMAGES_DIR', '/images')),
             ('VLAB_VERIFY_TOKEN', environ.get('VLAB_VERIFY_TOKEN', False)),
+            ('VLAB_ESRS_IMAGE_CACHE_DIR', environ.get('VLAB_ESRS_IMAGE_CACHE_DIR', '')),
+            ('VLAB_ESRS_IMAGE_CACHE_MAX_GB', int(environ.get('VLAB_ESRS_IMAGE_CACHE_MAX_GB', 100))),
+            ('VLAB_ESRS_IMAGE_CACHE_PREFETCH', int(environ.get('VLAB_ESRS_IMAGE_CACHE_PREFETCH', 0))),
+            ('VLAB_ESRS_IMPORT_SPEC_CACHE_SIZE', int(environ.get('VLAB_ESRS_IMPORT_SPEC_CACHE_SIZE', 64))),
+            ('VLAB_ESRS_VERIFY_IMAGES', int(environ.get('VLAB_ESRS_VERIFY_IMAGES', 1))),
+            ('VLAB_ESRS_FORCE_VERIFY', int(environ.get('VLAB_ESRS_FORCE_VERIFY', 0))),
+            ('VLAB_ESRS_VERIFY_DB', environ.get('VLAB_ESRS_VERIFY_DB', '/tmp/esrs-verified.json')),
+            ('VLAB_ESRS_ADMISSION_DIR', environ.get('VLAB_ESRS_ADMISSION_DIR', '/tmp/esrs-admission')),
+            ('VLAB_ESRS_ADMISSION_MAX_WAIT', int(environ.get('VLAB_ESRS_ADMISSION_MAX_WAIT', 3600))),
+            ('VLAB_ESRS_IMPORTS_PER_DATASTORE', int(environ.get('VLAB_ESRS_IMPORTS_PER_DATASTORE', 4))),
+            ('VLAB_ESRS_IMPORTS_PER_HOST', int(environ.get('VLAB_ESRS_IMPORTS_PER_HOST', 2))),
+            ('VLAB_ESRS_PLACEMENT_TTL', int(environ.get('VLAB_ESRS_PLACEMENT_TTL', 60))),
+            ('VLAB_ESRS_PLACEMENT_POLICY', environ.get('VLAB_ESRS_PLACEMENT_POLICY', 'weighted')),
+            ('VLAB_ESRS_NETWORK_INDEX_TTL', int(environ.get('VLAB_ESRS_NETWORK_INDEX_TTL', 300))),
+            ('VLAB_ESRS_REFRESHER_LOCK_DIR', environ.get('VLAB_ESRS_REFRESHER_LOCK_DIR', '/tmp/esrs-refreshers')),
+            ('VLAB_ESRS_PARALLEL_OPS', int(environ.get('VLAB_ESRS_PARALLEL_OPS', 8))),
+            ('VLAB_ESRS_POWER_TIMEOUT', int(environ.get('VLAB_ESRS_POWER_TIMEOUT', 300))),
+            ('VLAB_ESRS_SHUTDOWN_TIMEOUT', int(environ.get('VLAB_ESRS_SHUTDOWN_TIMEOUT', 120))),
+            ('VLAB_ESRS_VCENTER_OVERRIDES', environ.get('VLAB_ESRS_VCENTER_OVERRIDES', '')),
+            ('VLAB_ESRS_VCENTER_CONCURRENCY', int(environ.get('VLAB_ESRS_VCENTER_CONCURRENCY', 10))),
+            ('VLAB_ESRS_RESULT_ENCODING', environ.get('VLAB_ESRS_RESULT_ENCODING', 'json')),
+            ('VLAB_ESRS_RESULT_COMPRESSION', environ.get('VLAB_ESRS_RESULT_COMPRESSION', 'zlib')),
+            ('VLAB_ESRS_RESULT_COMPRESS_OVER', int(environ.get('VLAB_ESRS_RESULT_COMPRESS_OVER', 4096))),
+            ('VLAB_ESRS_RESULT_BACKEND', environ.get('VLAB_ESRS_RESULT_BACKEND', 'rpc://')),
+            ('VLAB_ESRS_RESULT_TTL', int(environ.get('VLAB_ESRS_RESULT_TTL', 86400))),
+            ('VLAB_ESRS_RESULT_CLEANUP_INTERVAL', int(environ.get('VLAB_ESRS_RESULT_CLEANUP_INTERVAL', 3600))),
+            ('VLAB_ESRS_MAX_WAIT', int(environ.get('VLAB_ESRS_MAX_WAIT', 2))),
+            ('VLAB_ESRS_REAPER_INTERVAL', int(environ.get('VLAB_ESRS_REAPER_INTERVAL', 3600))),
+            ('VLAB_ESRS_REAPER_MAX_AGE_DAYS', int(environ.get('VLAB_ESRS_REAPER_MAX_AGE_DAYS', 90))),
+            ('VLAB_ESRS_REAPER_MAX_IDLE_DAYS', int(environ.get('VLAB_ESRS_REAPER_MAX_IDLE_DAYS', 14))),
+            ('VLAB_ESRS_REAPER_IDLE_MHZ', int(environ.get('VLAB_ESRS_REAPER_IDLE_MHZ', 50))),
+            ('VLAB_ESRS_REAPER_ACTION', environ.get('VLAB_ESRS_REAPER_ACTION', 'off')),
+            ('VLAB_ESRS_REAPER_DRY_RUN', int(environ.get('VLAB_ESRS_REAPER_DRY_RUN', 1))),
+            ('VLAB_ESRS_REAPER_OPT_OUT', environ.get('VLAB_ESRS_REAPER_OPT_OUT', '/tmp/esrs-reaper-opt-out.json')),
+            ('VLAB_ESRS_REAPER_STATE', environ.get('VLAB_ESRS_REAPER_STATE', '/tmp/esrs-reaper-activity.json')),
+            ('VLAB_ESRS_ADMINS', environ.get('VLAB_ESRS_ADMINS', '')),
+            ('VLAB_ESRS_EXPORT_DIR', environ.get('VLAB_ESRS_EXPORT_DIR', '/tmp/esrs-exports')),
+            ('VLAB_ESRS_EXPORT_TTL', int(environ.get('VLAB_ESRS_EXPORT_TTL', 86400))),
+            ('VLAB_ESRS_METADATA_DB', environ.get('VLAB_ESRS_METADATA_DB', '/tmp/esrs-metadata.db')),
+            ('VLAB_ESRS_METADATA_RECONCILE_INTERVAL', int(environ.get('VLAB_ESRS_METADATA_RECONCILE_INTERVAL', 900))),
+            ('VLAB_ESRS_VALIDATION_MAX_AGE', int(environ.get('VLAB_ESRS_VALIDATION_MAX_AGE', 1800))),
+            ('VLAB_ESRS_VALIDATION_NETWORK_MAX_AGE', int(environ.get('VLAB_ESRS_VALIDATION_NETWORK_MAX_AGE', 180))),
+            ('VLAB_ESRS_MAX_PER_USER', int(environ.get('VLAB_ESRS_MAX_PER_USER', 0))),
+            ('VLAB_ESRS_BREAKER_STATE', environ.get('VLAB_ESRS_BREAKER_STATE', '/tmp/esrs-breaker.json')),
+            ('VLAB_ESRS_BREAKER_WINDOW', int(environ.get('VLAB_ESRS_BREAKER_WINDOW', 60))),
+            ('VLAB_ESRS_BREAKER_MIN_CALLS', int(environ.get('VLAB_ESRS_BREAKER_MIN_CALLS', 5))),
+            ('VLAB_ESRS_BREAKER_ERROR_PCT', int(environ.get('VLAB_ESRS_BREAKER_ERROR_PCT', 50))),
+            ('VLAB_ESRS_BREAKER_SLOW_SECONDS', int(environ.get('VLAB_ESRS_BREAKER_SLOW_SECONDS', 10))),
+            ('VLAB_ESRS_BREAKER_COOLDOWN', int(environ.get('VLAB_ESRS_BREAKER_COOLDOWN', 30))),
+            ('VLAB_ESRS_CANCEL_DIR', environ.get('VLAB_ESRS_CANCEL_DIR', '/tmp/esrs-cancel')),
+            ('VLAB_ESRS_CANCEL_TTL', int(environ.get('VLAB_ESRS_CANCEL_TTL', 86400))),
+            ('VLAB_ESRS_PROFILE_DIR', environ.get('VLAB_ESRS_PROFILE_DIR', '/tmp/esrs-profiles')),
+            ('VLAB_ESRS_PROFILE_MAX', int(environ.get('VLAB_ESRS_PROFILE_MAX', 2))),
+            ('VLAB_ESRS_PROFILE_TTL', int(environ.get('VLAB_ESRS_PROFILE_TTL', 86400))),
+            ('VLAB_ESRS_WORKER_POOL', environ.get('VLAB_ESRS_WORKER_POOL', 'prefork')),
+            ('VLAB_ESRS_WORKER_CONCURRENCY', int(environ.get('VLAB_ESRS_WORKER_CONCURRENCY', 0))),
+            ('VLAB_ESRS_WORKER_PRELOAD', int(environ.get('VLAB_ESRS_WORKER_PRELOAD', 1))),
           ])
 
 Constants = namedtuple('Constants', list(DEFINED.keys()))
@@ -0,0 +1,93 @@
+# -*- coding: UTF-8 -*-
+"""
+A compact encoding for task results.
+
+Task results go through the result backend as JSON by default. Setting
+``VLAB_ESRS_RESULT_ENCODING=msgpack`` on the worker switches them to msgpack,
+compressed (with zlib, or zstd if ``VLAB_ESRS_RESULT_COMPRESSION=zstd``) when
+larger than ``VLAB_ESRS_RESULT_COMPRESS_OVER`` bytes. The message's content
+type tells the API which decoder to use, so the API always accepts both and
+the worker setting can change without redeploying the API.
+"""
+import zlib
+
+import msgpack
+from kombu.serialization import register
+
+from vlab_esrs_api.lib import const
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+SERIALIZER = 'esrs-msgpack'
+CONTENT_TYPE = 'application/x-esrs-msgpack'
+# The first byte of every payload says how the rest is compressed
+RAW = b'r'
+ZLIB = b'z'
+ZSTD = b's'
+
+
+def encode(data, compression=None, threshold=None):
+    """Serialize a task result
+
+    :Returns: Bytes
+
+    :param data: The task result
+    :type data: Dictionary
+
+    :param compression: Either 'zlib' or 'zstd'; defaults to VLAB_ESRS_RESULT_COMPRESSION
+    :type compression: String
+
+    :param threshold: Only compress payloads larger than this many bytes; defaults to VLAB_ESRS_RESULT_COMPRESS_OVER
+    :type threshold: Integer
+    """
+    compression = compression or const.VLAB_ESRS_RESULT_COMPRESSION
+    if threshold is None:
+        threshold = const.VLAB_ESRS_RESULT_COMPRESS_OVER
+    packed = msgpack.packb(data, use_bin_type=True)
+    if len(packed) <= threshold:
+        return RAW + packed
+    if compression == 'zstd' and zstandard is not None:
+        return ZSTD + zstandard.ZstdCompressor().compress(packed)
+    return ZLIB + zlib.compress(packed)
+
+
+def decode(payload):
+    """Deserialize a task result made by ``encode``
+
+    :Returns: Dictionary
+
+    :Raises: ValueError if the payload can't be decoded
+
+    :param payload: The encoded task result
+    :type payload: Bytes
+    """
+    if isinstance(payload, str):
+        # kombu hands over str when the transport didn't keep the bytes
+        payload = payload.encode('latin-1')
+    kind, body = payload[:1], payload[1:]
+    if kind == ZLIB:
+        body = zlib.decompress(body)
+    elif kind == ZSTD:
+        if zstandard is None:
+            raise ValueError('Result is zstd compressed, but zstandard is not installed')
+        body = zstandard.ZstdDecompressor().decompress(body)
+    elif kind != RAW:
+        raise ValueError('Unknown result encoding: {}'.format(kind))
+    return msgpack.unpackb(body, raw=False)
+
+
+def configure(celery_app):
+    """Register the encoding with a Celery app
+
+    :Returns: None
+
+    :param celery_app: The API's or the worker's Celery app
+    :type celery_app: celery.Celery
+    """
+    register(SERIALIZER, encode, decode, content_type=CONTENT_TYPE, content_encoding='binary')
+    celery_app.conf.result_accept_content = ['json', SERIALIZER]
+    if const.VLAB_ESRS_RESULT_ENCODING == 'msgpack':
+        celery_app.conf.result_serializer = SERIALIZER
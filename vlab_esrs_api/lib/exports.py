@@ -0,0 +1,167 @@
+# -*- coding: UTF-8 -*-
+"""
+Inventory exports, written as NDJSON (one JSON record per line).
+
+The worker appends records to ``<export id>.ndjson.part`` as it reads them
+from vCenter, and renames the file to ``<export id>.ndjson`` once it's done.
+The API streams the file to the client while it's still being written, so
+neither side ever holds the whole export in memory. ``VLAB_ESRS_EXPORT_DIR``
+must be shared by the API and the workers.
+"""
+import os
+import re
+import time
+
+import ujson
+
+from vlab_esrs_api.lib import const
+
+VALID_ID = re.compile(r'^[A-Za-z0-9-]+$')
+READ_SIZE = 65536
+
+
+def path_for(export_id, partial=False):
+    """Find the file of an export
+
+    :Returns: String
+
+    :Raises: ValueError for malformed export ids
+
+    :param export_id: The id of the task that made the export
+    :type export_id: String
+
+    :param partial: Set to True for the file being written
+    :type partial: Boolean
+    """
+    if not VALID_ID.match(export_id):
+        raise ValueError('Invalid export id: {}'.format(export_id))
+    path = os.path.join(const.VLAB_ESRS_EXPORT_DIR, '{}.ndjson'.format(export_id))
+    if partial:
+        path += '.part'
+    return path
+
+
+class ExportWriter(object):
+    """Writes the records of one export
+
+    :param export_id: The id of the task making the export
+    :type export_id: String
+    """
+    def __init__(self, export_id):
+        self.path = path_for(export_id)
+        self.partial = path_for(export_id, partial=True)
+        self.count = 0
+        self._file = None
+
+    def __enter__(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._file = open(self.partial, 'w')
+        return self
+
+    def __exit__(self, exc_type, exc_value, the_traceback):
+        self._file.close()
+        if exc_type is None:
+            os.rename(self.partial, self.path)
+        else:
+            # readers stop following once the partial file is gone
+            os.unlink(self.partial)
+
+    def write(self, record):
+        """Add a record to the export
+
+        :Returns: None
+
+        :param record: The record
+        :type record: Dictionary
+        """
+        self._file.write(ujson.dumps(record))
+        self._file.write('\n')
+        self.count += 1
+
+    def flush(self):
+        """Make the records written so far visible to readers
+
+        :Returns: None
+        """
+        self._file.flush()
+
+
+def follow(export_id, wait=30, poll_interval=0.5, sleep=time.sleep):
+    """Read an export, waiting for more records until the worker is done writing it
+
+    :Returns: Generator - chunks of NDJSON, always ending on a full line
+
+    :Raises: ValueError for malformed export ids
+
+    :param export_id: The id of the task that made the export
+    :type export_id: String
+
+    :param wait: Give up if the export doesn't grow for this many seconds
+    :type wait: Integer
+
+    :param poll_interval: How often to check for more records
+    :type poll_interval: Float
+
+    :param sleep: Blocks for some number of seconds
+    :type sleep: Callable
+    """
+    done = path_for(export_id)
+    partial = path_for(export_id, partial=True)
+    idle = 0
+    the_file = None
+    while the_file is None:
+        # the task might not have started yet
+        for path in (done, partial):
+            try:
+                the_file = open(path)
+                break
+            except FileNotFoundError:
+                continue
+        else:
+            if idle >= wait:
+                return
+            sleep(poll_interval)
+            idle += poll_interval
+    with the_file:
+        leftover = ''
+        idle = 0
+        while True:
+            chunk = the_file.read(READ_SIZE)
+            if chunk:
+                idle = 0
+                lines, _, leftover = (leftover + chunk).rpartition('\n')
+                if lines:
+                    yield lines + '\n'
+                continue
+            # renamed (or removed) files stay readable, so check if the writer is finished
+            if not os.path.exists(partial):
+                remaining = leftover + the_file.read()
+                if remaining:
+                    yield remaining
+                return
+            if idle >= wait:
+                return
+            sleep(poll_interval)
+            idle += poll_interval
+
+
+def clean(max_age, clock=time.time):
+    """Delete old exports
+
+    :Returns: None
+
+    :param max_age: Delete exports older than this many seconds
+    :type max_age: Integer
+    """
+    try:
+        names = os.listdir(const.VLAB_ESRS_EXPORT_DIR)
+    except FileNotFoundError:
+        return
+    now = clock()
+    for name in names:
+        path = os.path.join(const.VLAB_ESRS_EXPORT_DIR, name)
+        try:
+            if now - os.path.getmtime(path) > max_age:
+                os.unlink(path)
+        except FileNotFoundError:
+            pass
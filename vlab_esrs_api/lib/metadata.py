@@ -0,0 +1,312 @@
+# -*- coding: UTF-8 -*-
+"""
+A local, queryable index of ESRS metadata.
+
+The metadata ``create_esrs`` stores in a VM's notes can only be read back from
+vCenter one VM at a time. This SQLite index keeps a copy, indexed by owner,
+version and created time, so filtered lookups don't need a scan of vCenter.
+The worker tasks update it as they change VMs, and a periodic reconcile
+replaces it with what's really in vCenter to fix any drift.
+
+The workers also keep a catalog of the names that exist (the images, and the
+networks in each vCenter), and when each was last known to be current, so the
+API can reject a create that's sure to fail without asking vCenter.
+
+``VLAB_ESRS_METADATA_DB`` must be shared by the API (which only reads it) and
+the workers.
+"""
+import os
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+import ujson
+
+from vlab_esrs_api.lib import const
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS esrs (
+    owner TEXT NOT NULL,
+    name TEXT NOT NULL,
+    vcenter TEXT,
+    version TEXT,
+    created REAL,
+    state TEXT,
+    networks TEXT NOT NULL DEFAULT '[]',
+    updated REAL NOT NULL,
+    PRIMARY KEY (owner, name)
+);
+CREATE INDEX IF NOT EXISTS esrs_version ON esrs (version, owner, name);
+CREATE INDEX IF NOT EXISTS esrs_created ON esrs (created);
+CREATE TABLE IF NOT EXISTS catalog (
+    kind TEXT NOT NULL,
+    scope TEXT NOT NULL,
+    name TEXT NOT NULL,
+    PRIMARY KEY (kind, name, scope)
+);
+CREATE TABLE IF NOT EXISTS freshness (
+    kind TEXT NOT NULL,
+    scope TEXT NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (kind, scope)
+);
+"""
+# The primary key already indexes owner; esrs_version also covers the ORDER BY of query()
+COLUMNS = ('owner', 'name', 'vcenter', 'version', 'created', 'state', 'networks')
+RECONCILE_BATCH = 500
+# What the catalog and freshness tables track; ESRS instances are only tracked for freshness
+IMAGE = 'image'
+NETWORK = 'network'
+ESRS = 'esrs'
+
+
+class MetadataIndex(object):
+    """The ESRS metadata, in SQLite
+
+    :param path: The SQLite database file
+    :type path: String
+
+    :param read_only: Never create or change the database
+    :type read_only: Boolean
+    """
+    def __init__(self, path, read_only=False):
+        self.path = path
+        self.read_only = read_only
+        if not read_only:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            with self._connect() as conn:
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.executescript(SCHEMA)
+
+    def upsert(self, record):
+        """Add or replace an ESRS instance
+
+        :Returns: None
+
+        :param record: Has owner and name, and optionally the other COLUMNS
+        :type record: Dictionary
+        """
+        with self._connect() as conn:
+            _upsert(conn, record)
+
+    def remove(self, owner, name):
+        """Forget an ESRS instance
+
+        :Returns: None
+        """
+        with self._connect() as conn:
+            conn.execute('DELETE FROM esrs WHERE owner = ? AND name = ?', (owner, name))
+
+    def set_networks(self, owner, names, networks):
+        """Record a network change
+
+        :Returns: None
+
+        :param owner: The user who owns the ESRS instances
+        :type owner: String
+
+        :param names: The ESRS instances that changed
+        :type names: List
+
+        :param networks: The networks the instances are now connected to
+        :type networks: List
+        """
+        with self._connect() as conn:
+            conn.executemany('UPDATE esrs SET networks = ?, updated = ? WHERE owner = ? AND name = ?',
+                             [(ujson.dumps(networks), time.time(), owner, x) for x in names])
+
+    def reconcile(self, vcenter, records):
+        """Replace everything indexed for a vCenter with what's really there
+
+        :Returns: Dictionary - how many instances were added, updated and removed
+
+        :param vcenter: The vCenter server the records came from
+        :type vcenter: String
+
+        :param records: Every ESRS instance on the vCenter
+        :type records: Iterable
+        """
+        started = time.time()
+        counts = {'added': 0, 'updated': 0, 'removed': 0}
+        batch = []
+        for record in records:
+            batch.append(record)
+            if len(batch) >= RECONCILE_BATCH:
+                self._reconcile_batch(batch, counts)
+                batch = []
+        self._reconcile_batch(batch, counts)
+        with self._connect() as conn:
+            # anything not seen (or changed by a task) during the sweep is gone
+            cursor = conn.execute('DELETE FROM esrs WHERE vcenter = ? AND updated < ?', (vcenter, started))
+            counts['removed'] = cursor.rowcount
+            _mark_fresh(conn, ESRS, vcenter)
+        return counts
+
+    def _reconcile_batch(self, records, counts):
+        """Upsert some records in one short transaction, so tasks aren't locked out for the whole sweep"""
+        with self._connect() as conn:
+            for record in records:
+                existing = conn.execute('SELECT 1 FROM esrs WHERE owner = ? AND name = ?',
+                                        (record['owner'], record['name'])).fetchone()
+                counts['updated' if existing else 'added'] += 1
+                _upsert(conn, record)
+
+    def query(self, owner=None, version=None, created_before=None, created_after=None, limit=None):
+        """Find ESRS instances
+
+        :Returns: List of Dictionaries
+
+        :param owner: Only instances owned by this user
+        :type owner: String
+
+        :param version: Only instances of this version
+        :type version: String
+
+        :param created_before: Only instances created before this time, in seconds since the epoch
+        :type created_before: Float
+
+        :param created_after: Only instances created after this time, in seconds since the epoch
+        :type created_after: Float
+
+        :param limit: The most instances to return
+        :type limit: Integer
+        """
+        where = []
+        params = []
+        for clause, value in (('owner = ?', owner), ('version = ?', version),
+                              ('created < ?', created_before), ('created > ?', created_after)):
+            if value is not None:
+                where.append(clause)
+                params.append(value)
+        sql = 'SELECT {} FROM esrs'.format(', '.join(COLUMNS))
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY owner, name'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        with self._connect() as conn:
+            rows = conn.execute(sql, params).fetchall()
+        found = []
+        for row in rows:
+            record = dict(zip(COLUMNS, row))
+            record['networks'] = ujson.loads(record['networks'])
+            found.append(record)
+        return found
+
+    def exists(self, owner, name):
+        """Check if a user has an ESRS instance
+
+        :Returns: Boolean
+        """
+        with self._connect() as conn:
+            return conn.execute('SELECT 1 FROM esrs WHERE owner = ? AND name = ?', (owner, name)).fetchone() is not None
+
+    def count(self, owner):
+        """Count the ESRS instances a user has
+
+        :Returns: Integer
+        """
+        with self._connect() as conn:
+            return conn.execute('SELECT COUNT(*) FROM esrs WHERE owner = ?', (owner,)).fetchone()[0]
+
+    def replace_catalog(self, kind, scope, names):
+        """Record every name of a kind that exists in a scope, like every network in a vCenter
+
+        :Returns: None
+
+        :param kind: Either IMAGE or NETWORK
+        :type kind: String
+
+        :param scope: Where the names came from, like the vCenter server
+        :type scope: String
+
+        :param names: Every name that exists
+        :type names: Iterable
+        """
+        with self._connect() as conn:
+            conn.execute('DELETE FROM catalog WHERE kind = ? AND scope = ?', (kind, scope))
+            conn.executemany('INSERT OR IGNORE INTO catalog (kind, scope, name) VALUES (?, ?, ?)',
+                             [(kind, scope, x) for x in names])
+            _mark_fresh(conn, kind, scope)
+
+    def update_catalog(self, kind, scope, added=(), removed=()):
+        """Record names that came, or went, since the catalog of a scope was replaced
+
+        :Returns: None
+        """
+        with self._connect() as conn:
+            conn.executemany('DELETE FROM catalog WHERE kind = ? AND scope = ? AND name = ?',
+                             [(kind, scope, x) for x in removed])
+            conn.executemany('INSERT OR IGNORE INTO catalog (kind, scope, name) VALUES (?, ?, ?)',
+                             [(kind, scope, x) for x in added])
+            _mark_fresh(conn, kind, scope)
+
+    def in_catalog(self, kind, name):
+        """Check if a name exists, in any scope
+
+        :Returns: Boolean
+        """
+        with self._connect() as conn:
+            return conn.execute('SELECT 1 FROM catalog WHERE kind = ? AND name = ?', (kind, name)).fetchone() is not None
+
+    def freshness(self, kind):
+        """Find when what's known of a kind was last current, in every scope
+
+        :Returns: Float - the oldest time, in seconds since the epoch, or None if nothing was ever recorded
+        """
+        with self._connect() as conn:
+            return conn.execute('SELECT MIN(updated) FROM freshness WHERE kind = ?', (kind,)).fetchone()[0]
+
+    @contextmanager
+    def _connect(self):
+        """Open the database for one transaction"""
+        if self.read_only:
+            conn = sqlite3.connect('file:{}?mode=ro'.format(self.path), uri=True, timeout=30)
+        else:
+            conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+
+def _upsert(conn, record):
+    """Add or replace a row, within the caller's transaction"""
+    row = [record.get(x) for x in COLUMNS]
+    row[COLUMNS.index('networks')] = ujson.dumps(record.get('networks') or [])
+    conn.execute('INSERT OR REPLACE INTO esrs ({}, updated) VALUES ({}, ?)'.format(
+                 ', '.join(COLUMNS), ', '.join('?' * len(COLUMNS))), row + [time.time()])
+
+
+def _mark_fresh(conn, kind, scope):
+    """Record that what's known of a kind in a scope is current, within the caller's transaction"""
+    conn.execute('INSERT OR REPLACE INTO freshness (kind, scope, updated) VALUES (?, ?, ?)', (kind, scope, time.time()))
+
+
+_INDEXES = {}
+_INDEXES_LOCK = threading.Lock()
+
+
+def get_index(read_only=False):
+    """Obtain the metadata index
+
+    A process that asks for both gets two indexes, so a writer is never handed
+    the read only one (or the other way around).
+
+    :Returns: MetadataIndex
+
+    :Raises: ValueError if a read only index doesn't exist yet
+
+    :param read_only: Set to True in the API, which never changes the index
+    :type read_only: Boolean
+    """
+    read_only = bool(read_only)
+    with _INDEXES_LOCK:
+        if read_only not in _INDEXES:
+            if read_only and not os.path.exists(const.VLAB_ESRS_METADATA_DB):
+                raise ValueError('The ESRS metadata index is not available yet')
+            _INDEXES[read_only] = MetadataIndex(const.VLAB_ESRS_METADATA_DB, read_only=read_only)
+        return _INDEXES[read_only]
@@ -0,0 +1,142 @@
+# -*- coding: UTF-8 -*-
+"""
+On-demand profiling of single tasks.
+
+An admin adds the ``X-PROFILE: 1`` header to a request, and the API marks the
+Celery message of every task the request sends. The worker runs a marked task
+under cProfile and saves the stats to ``VLAB_ESRS_PROFILE_DIR``, named after
+the task id, where the API can read them back.
+
+Unmarked tasks never touch a profiler. At most ``VLAB_ESRS_PROFILE_MAX`` tasks
+are profiled at once by the workers sharing the directory; past that, marked
+tasks just run normally.
+``VLAB_ESRS_PROFILE_DIR`` must be shared by the API and the workers.
+"""
+import io
+import os
+import re
+import time
+import pstats
+import cProfile
+
+from vlab_esrs_api.lib import const
+from vlab_esrs_api.lib.worker.state import locked
+
+VALID_ID = re.compile(r'^[A-Za-z0-9-]+$')
+# The name of the Celery message header that asks for a task to be profiled
+HEADER = 'esrs_profile'
+
+
+class Profile(object):
+    """A running profile of one task
+
+    :param task_id: The id of the task being profiled
+    :type task_id: String
+
+    :param slot: Holds one of the ``VLAB_ESRS_PROFILE_MAX`` slots until the profile stops
+    :type slot: Context Manager
+    """
+    def __init__(self, task_id, slot):
+        self.task_id = task_id
+        self._slot = slot
+        self._profiler = cProfile.Profile()
+        self._profiler.enable()
+
+    def stop(self):
+        """Stop profiling, save the stats and give up the slot
+
+        :Returns: String - where the stats were saved
+        """
+        self._profiler.disable()
+        try:
+            clean(const.VLAB_ESRS_PROFILE_TTL)
+            path = path_for(self.task_id)
+            self._profiler.dump_stats(path)
+        finally:
+            self._slot.__exit__(None, None, None)
+        return path
+
+
+def path_for(task_id):
+    """Find the saved stats of a task
+
+    :Returns: String
+
+    :Raises: ValueError for malformed task ids
+
+    :param task_id: The id of the profiled task
+    :type task_id: String
+    """
+    if not task_id or not VALID_ID.match(task_id):
+        raise ValueError('Invalid task id: {}'.format(task_id))
+    return os.path.join(const.VLAB_ESRS_PROFILE_DIR, '{}.pstats'.format(task_id))
+
+
+def start(task_id):
+    """Start profiling a task, if there's a free slot
+
+    :Returns: Profile, or None if too many tasks are already being profiled
+
+    :Raises: OSError if the profile directory is unusable, ValueError if the thread is already being profiled
+
+    :param task_id: The id of the task to profile
+    :type task_id: String
+    """
+    lock_dir = os.path.join(const.VLAB_ESRS_PROFILE_DIR, 'slots')
+    os.makedirs(lock_dir, exist_ok=True)
+    for number in range(const.VLAB_ESRS_PROFILE_MAX):
+        slot = locked(os.path.join(lock_dir, '{}.lock'.format(number)), blocking=False)
+        try:
+            slot.__enter__()
+        except BlockingIOError:
+            continue
+        try:
+            return Profile(task_id, slot)
+        except BaseException:
+            # like when another profiler is already running in this thread
+            slot.__exit__(None, None, None)
+            raise
+    return None
+
+
+def report(task_id, limit=50):
+    """Summarize the saved stats of a task as text
+
+    :Returns: String
+
+    :Raises: ValueError for malformed task ids, FileNotFoundError if the task wasn't profiled
+
+    :param task_id: The id of the profiled task
+    :type task_id: String
+
+    :param limit: How many functions to list
+    :type limit: Integer
+    """
+    stream = io.StringIO()
+    stats = pstats.Stats(path_for(task_id), stream=stream)
+    stats.sort_stats('cumulative').print_stats(limit)
+    return stream.getvalue()
+
+
+def clean(max_age, clock=time.time):
+    """Delete old stats
+
+    :Returns: None
+
+    :param max_age: Delete stats older than this many seconds
+    :type max_age: Integer
+    """
+    try:
+        names = os.listdir(const.VLAB_ESRS_PROFILE_DIR)
+    except FileNotFoundError:
+        return
+    now = clock()
+    for name in names:
+        if not name.endswith('.pstats'):
+            continue
+        path = os.path.join(const.VLAB_ESRS_PROFILE_DIR, name)
+        try:
+            if now - os.path.getmtime(path) > max_age:
+                os.unlink(path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,124 @@
+# -*- coding: UTF-8 -*-
+"""
+A task result store that every API replica can read.
+
+With the ``rpc://`` backend, a task's result is sent back to the one API
+process that sent the task, so polling ``/task/<id>`` on any other replica
+just says PENDING. Setting ``VLAB_ESRS_RESULT_BACKEND`` to any Celery result
+backend URL (like ``redis://``) stores results where every replica can look
+them up by task id. This module adds a bundled ``sqlite://`` backend, for a
+SQLite file on a volume shared by the API replicas and the workers::
+
+    VLAB_ESRS_RESULT_BACKEND=sqlite:///var/lib/esrs-metadata/results.db
+
+Results older than ``VLAB_ESRS_RESULT_TTL`` seconds are deleted by the
+``celery.backend_cleanup`` task, which ``celery beat`` sends every
+``VLAB_ESRS_RESULT_CLEANUP_INTERVAL`` seconds.
+"""
+import os
+import time
+import sqlite3
+import threading
+
+from kombu.utils.encoding import ensure_bytes
+from celery.exceptions import ImproperlyConfigured
+from celery.backends.base import KeyValueStoreBackend
+
+from vlab_esrs_api.lib import const
+
+SCHEME = 'sqlite://'
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_updated ON results (updated);
+"""
+
+
+class SQLiteBackend(KeyValueStoreBackend):
+    """Stores task results in a SQLite database
+
+    :param url: Where the database is, like ``sqlite:///var/lib/esrs-metadata/results.db``
+    :type url: String
+
+    :param clock: For testing; returns the current time in seconds since the epoch
+    :type clock: Function
+    """
+    def __init__(self, url=None, clock=time.time, *args, **kwargs):
+        super(SQLiteBackend, self).__init__(*args, **kwargs)
+        if not url or not url.startswith(SCHEME) or len(url) == len(SCHEME):
+            raise ImproperlyConfigured('Result backend URL must look like sqlite:///path/to/results.db, not {}'.format(url))
+        self.url = url
+        self.path = url[len(SCHEME):]
+        self.clock = clock
+        # sqlite3 connections can't be shared by threads, or survive a fork
+        self._local = threading.local()
+
+    def __reduce__(self, args=(), kwargs=None):
+        kwargs = {} if not kwargs else kwargs
+        return super(SQLiteBackend, self).__reduce__(args, {**kwargs, 'url': self.url})
+
+    def _connection(self):
+        """Open the database, once per thread and process
+
+        :Returns: sqlite3.Connection
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key):
+        row = self._connection().execute('SELECT value FROM results WHERE key = ?', (_text(key),)).fetchone()
+        if row is not None:
+            return bytes(row[0])
+
+    def mget(self, keys):
+        for key in keys:
+            yield self.get(key)
+
+    def set(self, key, value):
+        self._connection().execute('INSERT OR REPLACE INTO results (key, value, updated) VALUES (?, ?, ?)',
+                                   (_text(key), ensure_bytes(value), self.clock()))
+
+    def delete(self, key):
+        self._connection().execute('DELETE FROM results WHERE key = ?', (_text(key),))
+
+    def cleanup(self):
+        """Delete the results older than ``result_expires``
+
+        :Returns: Integer - how many were deleted
+        """
+        if not self.expires:
+            return 0
+        cursor = self._connection().execute('DELETE FROM results WHERE updated < ?',
+                                            (self.clock() - self.expires,))
+        return cursor.rowcount
+
+
+def _text(key):
+    """Celery makes the keys as bytes"""
+    if isinstance(key, bytes):
+        return key.decode()
+    return key
+
+
+def configure(celery_app):
+    """Point a Celery app at the result store
+
+    :Returns: None
+
+    :param celery_app: The API's or the worker's Celery app
+    :type celery_app: celery.Celery
+    """
+    celery_app.loader.override_backends = dict(celery_app.loader.override_backends,
+                                               sqlite='vlab_esrs_api.lib.results:SQLiteBackend')
+    celery_app.conf.result_backend = const.VLAB_ESRS_RESULT_BACKEND
+    celery_app.conf.result_expires = const.VLAB_ESRS_RESULT_TTL
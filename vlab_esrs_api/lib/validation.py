@@ -0,0 +1,80 @@
+# -*- coding: UTF-8 -*-
+"""
+Rejects a create that's sure to fail, before it's sent to a worker.
+
+Without these checks, a bad image version, a network that doesn't exist, or a
+name that's already taken was only found by a worker, after it logged into
+vCenter. The API now checks the metadata index the workers keep (see
+``vlab_esrs_api.lib.metadata``) instead:
+
+- images the worker last listed (at most ``VLAB_ESRS_VALIDATION_MAX_AGE`` old)
+- networks the workers are watching (at most ``VLAB_ESRS_VALIDATION_NETWORK_MAX_AGE`` old)
+- the user's ESRS instances (reconciled at most ``VLAB_ESRS_VALIDATION_MAX_AGE`` ago)
+
+A check whose data is missing or older than that is skipped, so a stale
+index never blocks a create. The worker still checks vCenter before it
+deploys anything.
+"""
+import time
+import sqlite3
+
+from vlab_esrs_api.lib import const, metadata
+
+
+class Conflict(ValueError):
+    """The request clashes with what the user already has"""
+    pass
+
+
+def check_create(username, machine_name, image, network, clock=time.time):
+    """Make sure a create can work, as far as the metadata index knows
+
+    :Returns: None
+
+    :Raises: ValueError for unknown images and networks, Conflict if the name is taken or the user is at their quota
+
+    :param username: The user creating the ESRS instance
+    :type username: String
+
+    :param machine_name: The name of the new ESRS instance
+    :type machine_name: String
+
+    :param image: The version of ESRS to create
+    :type image: String
+
+    :param network: The full name of the network, like alice_frontend
+    :type network: String
+
+    :param clock: For testing; returns the current time in seconds since the epoch
+    :type clock: Function
+    """
+    try:
+        index = metadata.get_index(read_only=True)
+    except ValueError:
+        # the workers haven't made the index yet
+        return
+    now = clock()
+    try:
+        if _fresh(index, metadata.ESRS, now, const.VLAB_ESRS_VALIDATION_MAX_AGE):
+            if index.exists(username, machine_name):
+                raise Conflict('You already have an ESRS named {}'.format(machine_name))
+            if const.VLAB_ESRS_MAX_PER_USER and index.count(username) >= const.VLAB_ESRS_MAX_PER_USER:
+                raise Conflict('You may only have {} ESRS instances'.format(const.VLAB_ESRS_MAX_PER_USER))
+        if _fresh(index, metadata.IMAGE, now, const.VLAB_ESRS_VALIDATION_MAX_AGE):
+            if not index.in_catalog(metadata.IMAGE, image):
+                raise ValueError('Invalid version of ESRS supplied: {}'.format(image))
+        if _fresh(index, metadata.NETWORK, now, const.VLAB_ESRS_VALIDATION_NETWORK_MAX_AGE):
+            if not index.in_catalog(metadata.NETWORK, network):
+                raise ValueError('No such network named {}'.format(network))
+    except sqlite3.Error:
+        # like an index made before the catalog existed; the worker will check
+        return
+
+
+def _fresh(index, kind, now, max_age):
+    """Decide if what the index knows of a kind is current enough to reject a request
+
+    :Returns: Boolean
+    """
+    updated = index.freshness(kind)
+    return updated is not None and now - updated <= max_age
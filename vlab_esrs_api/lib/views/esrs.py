@@ -2,18 +2,32 @@
 """
 Defines the RESTful API for the ESRS deployment service
 """
+import sqlite3
+
 import ujson
-from flask import current_app
+from flask import current_app, g, has_request_context
 from flask_classy import request, route, Response
+from celery.signals import before_task_publish
+from celery.exceptions import TimeoutError as CeleryTimeoutError
 from vlab_inf_common.views import MachineView
 from vlab_inf_common.vmware import vCenter, vim
 from vlab_api_common import describe, get_logger, requires, validate_input
+from vlab_api_common.http_auth import get_token_from_header
 
 
-from vlab_esrs_api.lib import const
+from vlab_esrs_api.lib import const, exports, metadata, cancel, profiling, validation
+from vlab_esrs_api.lib.worker import listing
 
 
 logger = get_logger(__name__, loglevel=const.VLAB_ESRS_LOG_LEVEL)
+# How often to check for the result of a task, with ?wait, when the result backend has to be polled
+WAIT_INTERVAL = 0.05
+# A waiting request holds one of the few uwsgi workers, so ?wait only covers
+# tasks that finish in moments; VLAB_ESRS_MAX_WAIT can lower this, not raise it
+WAIT_CEILING = 5
+WAIT_ARG = {"description": "Seconds to wait for the result, instead of replying with a task-id; at most VLAB_ESRS_MAX_WAIT (2 by default, never more than 5)",
+            "type": "number",
+            "minimum": 0}
 
 
 class ESRSView(MachineView):
@@ -52,19 +66,162 @@ class ESRSView(MachineView):
     GET_SCHEMA = {"$schema": "http://json-schema.org/draft-04/schema#",
                   "description": "Display the ESRS instances you own"
                  }
+    GET_ARGS_SCHEMA = {"$schema": "http://json-schema.org/draft-04/schema#",
+                       "description": "Optionally limit what's returned",
+                       "type": "object",
+                       "properties": {
+                           "fields": {
+                               "description": "Comma separated fields to return, like name,state,ips,meta.version",
+                               "type": "string"
+                           },
+                           "limit": {
+                               "description": "The most ESRS instances to return",
+                               "type": "integer",
+                               "minimum": 1
+                           },
+                           "cursor": {
+                               "description": "Continue a listing; use the next_cursor param from the previous page",
+                               "type": "string"
+                           },
+                           "wait": WAIT_ARG
+                       }
+                      }
+    NETWORK_SCHEMA = {"$schema": "http://json-schema.org/draft-04/schema#",
+                      "description": "Change the network of one or more ESRS instances",
+                      "type": "object",
+                      "properties": {
+                          "name": {
+                              "description": "The name of the ESRS instance, or a list of names",
+                              "type": ["string", "array"],
+                              "items": {"type": "string"},
+                              "minItems": 1
+                          },
+                          "new_network": {
+                              "description": "The name of the network to connect to",
+                              "type": "string"
+                          }
+                      },
+                      "required": ["name", "new_network"]
+                     }
+    POWER_SCHEMA = {"$schema": "http://json-schema.org/draft-04/schema#",
+                    "description": "Power on, off, reboot or shut down ESRS instances",
+                    "type": "object",
+                    "properties": {
+                        "name": {
+                            "description": "The name of the ESRS instance, or a list of names; omit for all of your ESRS",
+                            "type": ["string", "array"],
+                            "items": {"type": "string"},
+                            "minItems": 1
+                        },
+                        "power": {
+                            "description": "What to do; shutdown powers off any VM whose guest OS does not shut down",
+                            "type": "string",
+                            "enum": ["on", "off", "reboot", "shutdown"]
+                        }
+                    },
+                    "required": ["power"]
+                   }
     IMAGES_SCHEMA = {"$schema": "http://json-schema.org/draft-04/schema#",
                      "description": "View available versions of ESRS that can be created"
                     }
+    IMAGES_ARGS_SCHEMA = {"$schema": "http://json-schema.org/draft-04/schema#",
+                          "description": "Optionally wait for the versions, instead of polling the task",
+                          "type": "object",
+                          "properties": {
+                              "wait": WAIT_ARG
+                          }
+                         }
+    EXPORT_SCHEMA = {"$schema": "http://json-schema.org/draft-04/schema#",
+                     "description": "Export every ESRS instance as NDJSON (admins only)"
+                    }
+    QUERY_ARGS_SCHEMA = {"$schema": "http://json-schema.org/draft-04/schema#",
+                         "description": "Find ESRS instances by their metadata; only admins may see other users'",
+                         "type": "object",
+                         "properties": {
+                             "owner": {
+                                 "description": "The user who owns the ESRS instances",
+                                 "type": "string"
+                             },
+                             "version": {
+                                 "description": "The version of ESRS, like 3.28",
+                                 "type": "string"
+                             },
+                             "created_before": {
+                                 "description": "Created before this time, in seconds since the epoch",
+                                 "type": "number"
+                             },
+                             "created_after": {
+                                 "description": "Created after this time, in seconds since the epoch",
+                                 "type": "number"
+                             },
+                             "limit": {
+                                 "description": "The most ESRS instances to return",
+                                 "type": "integer",
+                                 "minimum": 1
+                             }
+                         }
+                        }
+    REAPER_SCHEMA = {"$schema": "http://json-schema.org/draft-04/schema#",
+                     "description": "Stop (or resume) powering off your old and idle ESRS instances",
+                     "type": "object",
+                     "properties": {
+                         "opt_out": {
+                             "description": "Set to true to keep your ESRS instances running",
+                             "type": "boolean"
+                         }
+                     },
+                     "required": ["opt_out"]
+                    }
+
+
+    def before_request(self, name, *args, **kwargs):
+        """Admins can profile the tasks a request sends by adding the ``X-PROFILE: 1`` header"""
+        if request.headers.get('X-PROFILE') != '1':
+            return
+        try:
+            # the endpoint still checks the token with @requires before any task is sent
+            username = get_token_from_header()['username']
+        except Exception:
+            return
+        if _is_admin(username):
+            g.esrs_profile = True
+            g.esrs_profiled = []
 
+    def after_request(self, name, response):
+        """Say where to find the profile of each task the request sent"""
+        for task_id in g.get('esrs_profiled', []):
+            response.headers.add('Link', '<{0}{1}/profile/{2}>; rel=profile'.format(const.VLAB_URL, self.route_base, task_id))
+        return super(ESRSView, self).after_request(name, response)
 
     @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
-    @describe(post=POST_SCHEMA, delete=DELETE_SCHEMA, get=GET_SCHEMA)
+    @describe(post=POST_SCHEMA, delete=DELETE_SCHEMA, get=GET_SCHEMA, get_args=GET_ARGS_SCHEMA,
+              put=NETWORK_SCHEMA, patch=NETWORK_SCHEMA)
     def get(self, *args, **kwargs):
         """Display the ESRS instances you own"""
         username = kwargs['token']['username']
         txn_id = request.headers.get('X-REQUEST-ID', 'noId')
         resp_data = {'user' : username}
-        task = current_app.celery_app.send_task('esrs.show', [username, txn_id])
+        fields = request.args.get('fields', None)
+        limit = request.args.get('limit', None)
+        cursor = request.args.get('cursor', None)
+        try:
+            if fields:
+                listing.parse_fields(fields)
+            if limit is not None:
+                limit = int(limit)
+                if limit < 1:
+                    raise ValueError('limit must be at least 1')
+            if cursor:
+                listing.decode_cursor(cursor)
+            wait = _wait_seconds(request.args.get('wait', None))
+        except ValueError as doh:
+            resp_data['error'] = '{}'.format(doh)
+            return ujson.dumps(resp_data), 400
+        task = current_app.celery_app.send_task('esrs.show', [username, txn_id],
+                                                {'fields': fields, 'limit': limit, 'cursor': cursor})
+        finished = _wait_for(task, wait, resp_data)
+        if finished:
+            return finished
         resp_data['content'] = {'task-id': task.id}
         resp = Response(ujson.dumps(resp_data))
         resp.status_code = 202
@@ -82,6 +239,14 @@ class ESRSView(MachineView):
         machine_name = body['name']
         image = body['image']
         network = '{}_{}'.format(username, body['network'])
+        try:
+            validation.check_create(username, machine_name, image, network)
+        except validation.Conflict as doh:
+            resp_data['error'] = '{}'.format(doh)
+            return ujson.dumps(resp_data), 409
+        except ValueError as doh:
+            resp_data['error'] = '{}'.format(doh)
+            return ujson.dumps(resp_data), 400
         task = current_app.celery_app.send_task('esrs.create', [username, machine_name, image, network, txn_id])
         resp_data['content'] = {'task-id': task.id}
         resp = Response(ujson.dumps(resp_data))
@@ -104,17 +269,308 @@ class ESRSView(MachineView):
         resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task.id))
         return resp
 
+    @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
+    @validate_input(schema=NETWORK_SCHEMA)
+    def put(self, *args, **kwargs):
+        """Change the network of one or more ESRS instances"""
+        return self._modify_network(kwargs)
+
+    @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
+    @validate_input(schema=NETWORK_SCHEMA)
+    def patch(self, *args, **kwargs):
+        """Change the network of one or more ESRS instances"""
+        return self._modify_network(kwargs)
+
+    def _modify_network(self, kwargs):
+        """Shared logic for PUT and PATCH"""
+        username = kwargs['token']['username']
+        txn_id = request.headers.get('X-REQUEST-ID', 'noId')
+        resp_data = {'user' : username}
+        body = kwargs['body']
+        machine_name = body['name']
+        new_network = '{}_{}'.format(username, body['new_network'])
+        task = current_app.celery_app.send_task('esrs.modify_network', [username, machine_name, new_network, txn_id])
+        resp_data['content'] = {'task-id': task.id}
+        resp = Response(ujson.dumps(resp_data))
+        resp.status_code = 202
+        resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task.id))
+        return resp
+
+    @route('/power', methods=["POST"])
+    @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
+    @validate_input(schema=POWER_SCHEMA)
+    @describe(post=POWER_SCHEMA)
+    def power(self, *args, **kwargs):
+        """Power on, off, reboot or shut down one, several, or all of your ESRS instances"""
+        username = kwargs['token']['username']
+        txn_id = request.headers.get('X-REQUEST-ID', 'noId')
+        resp_data = {'user' : username}
+        body = kwargs['body']
+        task = current_app.celery_app.send_task('esrs.power', [username, body.get('name', None), body['power'], txn_id])
+        resp_data['content'] = {'task-id': task.id}
+        resp = Response(ujson.dumps(resp_data))
+        resp.status_code = 202
+        resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task.id))
+        return resp
+
     @route('/image', methods=["GET"])
     @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
-    @describe(get=IMAGES_SCHEMA)
+    @describe(get=IMAGES_SCHEMA, get_args=IMAGES_ARGS_SCHEMA)
     def image(self, *args, **kwargs):
         """Show available versions of ESRS that can be deployed"""
         username = kwargs['token']['username']
         txn_id = request.headers.get('X-REQUEST-ID', 'noId')
         resp_data = {'user' : username}
+        try:
+            wait = _wait_seconds(request.args.get('wait', None))
+        except ValueError as doh:
+            resp_data['error'] = '{}'.format(doh)
+            return ujson.dumps(resp_data), 400
         task = current_app.celery_app.send_task('esrs.image', [txn_id])
+        finished = _wait_for(task, wait, resp_data)
+        if finished:
+            return finished
+        resp_data['content'] = {'task-id': task.id}
+        resp = Response(ujson.dumps(resp_data))
+        resp.status_code = 202
+        resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task.id))
+        return resp
+
+    @route('/reaper', methods=["PUT"])
+    @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
+    @validate_input(schema=REAPER_SCHEMA)
+    @describe(put=REAPER_SCHEMA)
+    def reaper(self, *args, **kwargs):
+        """Stop (or resume) reclaiming your old and idle ESRS instances"""
+        username = kwargs['token']['username']
+        txn_id = request.headers.get('X-REQUEST-ID', 'noId')
+        resp_data = {'user' : username}
+        opt_out = kwargs['body']['opt_out']
+        task = current_app.celery_app.send_task('esrs.reaper_opt_out', [username, opt_out, txn_id])
         resp_data['content'] = {'task-id': task.id}
         resp = Response(ujson.dumps(resp_data))
         resp.status_code = 202
         resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task.id))
         return resp
+
+    @route('/export', methods=["POST"])
+    @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
+    @describe(post=EXPORT_SCHEMA, get=EXPORT_SCHEMA)
+    def export(self, *args, **kwargs):
+        """Start exporting every ESRS instance"""
+        username = kwargs['token']['username']
+        txn_id = request.headers.get('X-REQUEST-ID', 'noId')
+        resp_data = {'user' : username}
+        if not _is_admin(username):
+            resp_data['error'] = 'user {} does not have access'.format(username)
+            return ujson.dumps(resp_data), 403
+        task = current_app.celery_app.send_task('esrs.export', [txn_id])
+        resp_data['content'] = {'task-id': task.id}
+        resp = Response(ujson.dumps(resp_data))
+        resp.status_code = 202
+        resp.headers.add('Link', '<{0}{1}/export/{2}>; rel=export'.format(const.VLAB_URL, self.route_base, task.id))
+        return resp
+
+    @route('/export/<export_id>', methods=["GET"])
+    @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
+    def export_records(self, *args, **kwargs):
+        """Stream an export as NDJSON, while it's being written"""
+        username = kwargs['token']['username']
+        resp_data = {'user' : username}
+        if not _is_admin(username):
+            resp_data['error'] = 'user {} does not have access'.format(username)
+            return ujson.dumps(resp_data), 403
+        try:
+            exports.path_for(kwargs['export_id'])
+        except ValueError as doh:
+            resp_data['error'] = '{}'.format(doh)
+            return ujson.dumps(resp_data), 400
+        return Response(exports.follow(kwargs['export_id']), mimetype='application/x-ndjson')
+
+    @route('/task', methods=["GET"])
+    @route('/task/<tid>', methods=["GET"])
+    @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
+    @describe(get_args=MachineView.TASK_ARGS)
+    def handle_task(self, *args, **kwargs):
+        """Check the status of a task; a create waiting for its turn to upload includes its place in line"""
+        resp = {'user': kwargs['token']['username'], 'content' : {}}
+        if request.args.get('task-id', None) and kwargs.get('tid', None):
+            resp['error'] = 'task-id supplied in URL and as param'
+            return ujson.dumps(resp), 400
+        task_id = request.args.get('task-id', kwargs.get('tid', None))
+        if task_id is None:
+            resp['error'] = "no task id provided"
+            return ujson.dumps(resp), 400
+        result = current_app.celery_app.AsyncResult(task_id)
+        resp['content']['status'] = result.status
+        if result.status == 'SUCCESS':
+            if result.result['error']:
+                resp.update(result.result)
+                resp['error'] = result.result['error']
+                return ujson.dumps(resp), 400
+            return ujson.dumps(result.result), 200
+        elif result.status == 'FAILURE':
+            return ujson.dumps(resp), 500
+        elif result.status == 'QUEUED' and isinstance(result.info, dict):
+            resp['content']['position'] = result.info.get('position')
+        return ujson.dumps(resp), 202
+
+    @route('/task/<task_id>', methods=["DELETE"])
+    @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
+    def cancel_task(self, *args, **kwargs):
+        """Cancel a task; a create stops at the next chunk of its upload, and deletes the partial VM"""
+        username = kwargs['token']['username']
+        task_id = kwargs['task_id']
+        resp_data = {'user' : username}
+        try:
+            # the worker checks that the task belongs to the user
+            cancel.request(task_id, username, admin=_is_admin(username))
+        except ValueError as doh:
+            resp_data['error'] = '{}'.format(doh)
+            return ujson.dumps(resp_data), 400
+        resp_data['content'] = {'task-id': task_id}
+        resp = Response(ujson.dumps(resp_data))
+        resp.status_code = 202
+        resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task_id))
+        return resp
+
+    @route('/profile/<task_id>', methods=["GET"])
+    @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
+    def profile(self, *args, **kwargs):
+        """Download the profile of a task; a pstats file, or text with ``?format=text``"""
+        username = kwargs['token']['username']
+        task_id = kwargs['task_id']
+        resp_data = {'user' : username}
+        if not _is_admin(username):
+            resp_data['error'] = 'user {} does not have access'.format(username)
+            return ujson.dumps(resp_data), 403
+        try:
+            path = profiling.path_for(task_id)
+            if request.args.get('format', None) == 'text':
+                return Response(profiling.report(task_id), mimetype='text/plain')
+            with open(path, 'rb') as the_file:
+                stats = the_file.read()
+        except ValueError as doh:
+            resp_data['error'] = '{}'.format(doh)
+            return ujson.dumps(resp_data), 400
+        except FileNotFoundError:
+            resp_data['error'] = 'No profile for task {}; it may still be running'.format(task_id)
+            return ujson.dumps(resp_data), 404
+        resp = Response(stats, mimetype='application/octet-stream')
+        resp.headers.add('Content-Disposition', 'attachment; filename={}.pstats'.format(task_id))
+        return resp
+
+    @route('/query', methods=["GET"])
+    @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
+    @describe(get_args=QUERY_ARGS_SCHEMA)
+    def query(self, *args, **kwargs):
+        """Find ESRS instances from the local metadata index, without asking vCenter"""
+        username = kwargs['token']['username']
+        resp_data = {'user' : username}
+        owner = request.args.get('owner', None)
+        if not _is_admin(username):
+            if owner not in (None, username):
+                resp_data['error'] = 'user {} does not have access'.format(username)
+                return ujson.dumps(resp_data), 403
+            owner = username
+        try:
+            filters = {'owner': owner,
+                       'version': request.args.get('version', None),
+                       'created_before': _number(request.args.get('created_before', None), float),
+                       'created_after': _number(request.args.get('created_after', None), float),
+                       'limit': _number(request.args.get('limit', None), int)}
+            if filters['limit'] is not None and filters['limit'] < 1:
+                raise ValueError('limit must be at least 1')
+        except ValueError as doh:
+            resp_data['error'] = '{}'.format(doh)
+            return ujson.dumps(resp_data), 400
+        try:
+            resp_data['content'] = metadata.get_index(read_only=True).query(**filters)
+        except (ValueError, sqlite3.Error) as doh:
+            logger.error('Unable to query the metadata index: {}'.format(doh))
+            resp_data['error'] = 'The ESRS metadata index is unavailable'
+            return ujson.dumps(resp_data), 503
+        return ujson.dumps(resp_data), 200
+
+
+@before_task_publish.connect
+def _mark_profiled(headers=None, **kwargs):
+    """Ask the worker to profile tasks sent by a request with the ``X-PROFILE`` header"""
+    if has_request_context() and g.get('esrs_profile'):
+        headers[profiling.HEADER] = True
+        g.esrs_profiled.append(headers['id'])
+
+
+def _wait_seconds(value):
+    """Read the ``?wait`` query parameter
+
+    :Returns: Float - how long to wait, no longer than VLAB_ESRS_MAX_WAIT or WAIT_CEILING
+
+    :Raises: ValueError if the parameter isn't a number, or is negative
+    """
+    wait = _number(value, float)
+    if wait is None:
+        return 0
+    if not wait >= 0:
+        raise ValueError('wait must be at least 0')
+    return min(wait, const.VLAB_ESRS_MAX_WAIT, WAIT_CEILING)
+
+
+def _wait_for(task, wait, resp_data):
+    """Give a task a moment to finish, so the client doesn't have to poll for its result
+
+    With the ``rpc://`` backend this waits on the reply queue, instead of
+    polling. The API runs under uwsgi with one thread per worker, so the
+    worker serves nothing else while it waits; that's why ``wait`` is capped
+    at a few seconds (see ``_wait_seconds``). Longer tasks get a task-id to poll.
+
+    :Returns: Tuple - (body, status code) like ``/task/<id>``, or None if the task didn't finish in time
+
+    :param task: The task that was just sent
+    :type task: celery.result.AsyncResult
+
+    :param wait: The most seconds to wait
+    :type wait: Float
+
+    :param resp_data: The response so far
+    :type resp_data: Dictionary
+    """
+    if not wait:
+        return None
+    try:
+        task.get(timeout=wait, interval=WAIT_INTERVAL, propagate=False)
+    except CeleryTimeoutError:
+        return None
+    if task.status == 'SUCCESS':
+        result = task.result
+        if result['error']:
+            resp_data.update(result)
+            return ujson.dumps(resp_data), 400
+        return ujson.dumps(result), 200
+    elif task.status == 'FAILURE':
+        resp_data['content'] = {'status': task.status, 'task-id': task.id}
+        return ujson.dumps(resp_data), 500
+    return None
+
+
+def _number(value, kind):
+    """Convert a query parameter to a number
+
+    :Returns: Integer, Float, or None if the parameter wasn't supplied
+
+    :Raises: ValueError if the parameter isn't a number
+    """
+    if value is None:
+        return None
+    try:
+        return kind(value)
+    except ValueError:
+        raise ValueError('Not a number: {}'.format(value))
+
+
+def _is_admin(username):
+    """Only admins may see every user's ESRS instances
+
+    :Returns: Boolean
+    """
+    return username in [x.strip() for x in const.VLAB_ESRS_ADMINS.split(',') if x.strip()]
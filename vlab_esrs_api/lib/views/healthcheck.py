@@ -9,6 +9,7 @@ import ujson
 from flask_classy import FlaskView, Response
 
 from vlab_esrs_api.lib import const
+from vlab_esrs_api.lib.worker import breaker
 
 
 class HealthView(FlaskView):
@@ -23,6 +24,8 @@ class HealthView(FlaskView):
         resp = {}
         status = 200
         resp['version'] = pkg_resources.get_distribution('vlab-esrs-api').version
+        # The API stays up while vCenter is down; tasks just fail fast
+        resp['vcenter'] = breaker.status()
         response = Response(ujson.dumps(resp))
         response.status_code = status
         response.headers['Content-Type'] = 'application/json'
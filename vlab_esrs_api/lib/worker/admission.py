@@ -0,0 +1,372 @@
+# -*- coding: UTF-8 -*-
+"""
+Admission control for OVA imports.
+
+Too many simultaneous uploads to one datastore (or one ESXi host) collapses
+the aggregate throughput, so imports take a ticket per resource and wait in
+line until they're within that resource's cap. Tickets are files in a shared
+directory, so every worker process (and every worker node mounting the same
+directory) honors the same queue::
+
+    <admission dir>/<resource>/<enqueued at>-<ticket id>  - a ticket
+    <admission dir>/caps.json                            - tuned caps
+    <admission dir>/throughput.json                      - upload samples
+
+The default ``VLAB_ESRS_ADMISSION_DIR`` is under /tmp, so it only covers the
+worker processes of one container; point it at a volume every worker mounts
+(docker-compose.yml uses the metadata volume) to cap imports across all of them.
+
+Tickets are ordered by the time they were enqueued. Because every ticket of an
+import shares the same timestamp, the oldest import is first in line for every
+resource it needs, so imports waiting on several resources cannot deadlock.
+"""
+import os
+import time
+import uuid
+import threading
+from contextlib import contextmanager
+
+from vlab_esrs_api.lib import const, cancel
+from vlab_esrs_api.lib.worker.state import locked, load_json, save_json
+
+MAX_SAMPLES = 200
+GOOD_ENOUGH = 0.9
+
+
+class Ticket(object):
+    """A place in line for one or more resources
+
+    :param ticket_id: Uniquely identifies the import holding the ticket
+    :type ticket_id: String
+
+    :param resources: The resources the import needs, like datastore:VM-Storage
+    :type resources: List
+
+    :param enqueued: When the import got in line
+    :type enqueued: Float
+    """
+    def __init__(self, ticket_id, resources, enqueued):
+        self.ticket_id = ticket_id
+        self.resources = resources
+        self.enqueued = enqueued
+        self.file_name = '{:020d}-{}'.format(int(enqueued * 1000000), ticket_id)
+
+
+class AdmissionController(object):
+    """Caps the number of concurrent imports per datastore and ESXi host
+
+    :param directory: Where to keep the tickets; share it between workers
+    :type directory: String
+
+    :param caps: The default cap per kind of resource, like {'datastore': 4, 'host': 2}
+    :type caps: Dictionary
+
+    :param clock: Returns the current time in seconds
+    :type clock: Callable
+
+    :param sleep: Blocks for the supplied number of seconds
+    :type sleep: Callable
+
+    :param poll_interval: How often (in seconds) a waiting import checks its place in line
+    :type poll_interval: Integer
+
+    :param stale_after: Tickets not refreshed for this many seconds belong to a dead worker
+    :type stale_after: Integer
+
+    :param max_wait: Give up on an import still waiting after this many seconds
+    :type max_wait: Integer
+    """
+    def __init__(self, directory, caps, clock=time.time, sleep=time.sleep, poll_interval=2, stale_after=120,
+                 max_wait=3600):
+        self.directory = directory
+        self.caps = caps
+        self.clock = clock
+        self.sleep = sleep
+        self.poll_interval = poll_interval
+        self.stale_after = stale_after
+        self.max_wait = max_wait
+        self._caps_file = os.path.join(directory, 'caps.json')
+        self._samples_file = os.path.join(directory, 'throughput.json')
+        os.makedirs(directory, exist_ok=True)
+
+    def cap(self, resource):
+        """Look up how many concurrent imports a resource allows
+
+        :Returns: Integer
+
+        :param resource: The resource, like datastore:VM-Storage
+        :type resource: String
+        """
+        tuned = load_json(self._caps_file, default={})
+        if resource in tuned:
+            return tuned[resource]
+        return self.caps[resource.split(':')[0]]
+
+    def enqueue(self, resources, ticket_id=None):
+        """Get in line for the supplied resources
+
+        :Returns: Ticket
+
+        :param resources: The resources the import needs
+        :type resources: List
+
+        :param ticket_id: Uniquely identifies the import
+        :type ticket_id: String
+        """
+        ticket = Ticket(ticket_id or uuid.uuid4().hex, resources, self.clock())
+        for resource in resources:
+            queue = os.path.join(self.directory, resource)
+            os.makedirs(queue, exist_ok=True)
+            with open(os.path.join(queue, ticket.file_name), 'w'):
+                pass
+        self.heartbeat(ticket)
+        return ticket
+
+    def position(self, ticket):
+        """Find how many imports must finish before this one is admitted
+
+        :Returns: Integer - zero means the import may proceed
+
+        :param ticket: The place in line
+        :type ticket: Ticket
+        """
+        position = 0
+        for resource in ticket.resources:
+            waiting = self._live_tickets(resource)
+            try:
+                index = waiting.index(ticket.file_name)
+            except ValueError:
+                # our ticket was reaped as stale; get back in line where we were
+                self.heartbeat(ticket)
+                waiting = self._live_tickets(resource)
+                index = waiting.index(ticket.file_name)
+            position = max(position, index - self.cap(resource) + 1)
+        return position
+
+    def holders(self, resource):
+        """Count the imports currently admitted to a resource
+
+        :Returns: Integer
+        """
+        return min(len(self._live_tickets(resource)), self.cap(resource))
+
+    def heartbeat(self, ticket):
+        """Mark the ticket as still in use, so it isn't reaped as stale
+
+        :Returns: None
+        """
+        now = self.clock()
+        for resource in ticket.resources:
+            path = os.path.join(self.directory, resource, ticket.file_name)
+            with open(path, 'a'):
+                os.utime(path, (now, now))
+
+    def release(self, ticket):
+        """Give up the ticket, letting the next import in line proceed
+
+        :Returns: None
+        """
+        for resource in ticket.resources:
+            try:
+                os.unlink(os.path.join(self.directory, resource, ticket.file_name))
+            except FileNotFoundError:
+                pass
+
+    @contextmanager
+    def admit(self, resources, ticket_id=None, on_queued=None, cancelled=None):
+        """Block until the import may proceed, and hold the slots for the context
+
+        :Returns: Ticket
+
+        :Raises: cancel.Cancelled if the import is cancelled while it waits,
+                 or ValueError if it waits longer than ``max_wait``
+
+        :param resources: The resources the import needs
+        :type resources: List
+
+        :param ticket_id: Uniquely identifies the import
+        :type ticket_id: String
+
+        :param on_queued: Called with the place in line while the import waits,
+                          and with zero once a waiting import is admitted
+        :type on_queued: Callable
+
+        :param cancelled: Returns True if the import should give up its place in line
+        :type cancelled: Callable
+        """
+        ticket = self.enqueue(resources, ticket_id)
+        done = threading.Event()
+        keep_alive = None
+        try:
+            last_position = None
+            deadline = self.clock() + self.max_wait
+            while True:
+                position = self.position(ticket)
+                if position == 0:
+                    break
+                if cancelled is not None and cancelled():
+                    raise cancel.Cancelled('Cancelled while waiting to upload')
+                if self.clock() > deadline:
+                    raise ValueError('Gave up waiting to upload after {} seconds; {} imports were still ahead, '
+                                     'try again later'.format(self.max_wait, position))
+                if on_queued is not None and position != last_position:
+                    on_queued(position)
+                last_position = position
+                self.sleep(self.poll_interval)
+                self.heartbeat(ticket)
+            if on_queued is not None and last_position is not None:
+                on_queued(0)
+            keep_alive = threading.Thread(target=self._keep_alive, args=(ticket, done), daemon=True)
+            keep_alive.start()
+            yield ticket
+        finally:
+            done.set()
+            if keep_alive is not None:
+                keep_alive.join()
+            self.release(ticket)
+
+    def record_throughput(self, resource, nbytes, seconds):
+        """Save how fast an upload went, for tuning the caps later
+
+        :Returns: None
+
+        :param resource: The resource the upload went to
+        :type resource: String
+
+        :param nbytes: How much data was uploaded
+        :type nbytes: Integer
+
+        :param seconds: How long the upload took
+        :type seconds: Float
+        """
+        if seconds <= 0:
+            return
+        sample = {'concurrency': self.holders(resource), 'rate': nbytes / seconds}
+        with locked('{}.lock'.format(self._samples_file)):
+            samples = load_json(self._samples_file, default={})
+            samples[resource] = (samples.get(resource, []) + [sample])[-MAX_SAMPLES:]
+            save_json(self._samples_file, samples)
+
+    def tune(self):
+        """Set the cap of every resource from its measured upload throughput
+
+        :Returns: Dictionary - the new caps
+        """
+        samples = load_json(self._samples_file, default={})
+        with locked('{}.lock'.format(self._caps_file)):
+            caps = load_json(self._caps_file, default={})
+            for resource, resource_samples in samples.items():
+                cap = recommend_cap(resource_samples)
+                if cap:
+                    caps[resource] = cap
+            save_json(self._caps_file, caps)
+        return caps
+
+    def _live_tickets(self, resource):
+        """List the tickets for a resource in line order, reaping stale ones"""
+        queue = os.path.join(self.directory, resource)
+        try:
+            names = sorted(os.listdir(queue))
+        except FileNotFoundError:
+            return []
+        live = []
+        oldest_allowed = self.clock() - self.stale_after
+        for name in names:
+            path = os.path.join(queue, name)
+            try:
+                if os.stat(path).st_mtime < oldest_allowed:
+                    os.unlink(path)
+                    continue
+            except FileNotFoundError:
+                continue
+            live.append(name)
+        return live
+
+    def _keep_alive(self, ticket, done):
+        """Refresh an admitted ticket until the import finishes"""
+        while not done.wait(self.stale_after / 3):
+            self.heartbeat(ticket)
+
+
+def recommend_cap(samples):
+    """Find the lowest concurrency that achieves (nearly) the best aggregate throughput
+
+    :Returns: Integer, or None if there are no samples
+
+    :param samples: Measured uploads, like [{'concurrency': 2, 'rate': 104857600}]
+    :type samples: List
+    """
+    by_concurrency = {}
+    for sample in samples:
+        by_concurrency.setdefault(max(sample['concurrency'], 1), []).append(sample['rate'])
+    if not by_concurrency:
+        return None
+    aggregate = {c: c * sum(rates) / len(rates) for c, rates in by_concurrency.items()}
+    best = max(aggregate.values())
+    return min(c for c, rate in aggregate.items() if rate >= best * GOOD_ENOUGH)
+
+
+_CONTROLLER = None
+_CONTROLLER_LOCK = threading.Lock()
+
+
+def get_controller():
+    """Obtain the worker's admission controller, or None if admission control is disabled
+
+    :Returns: AdmissionController
+    """
+    global _CONTROLLER
+    if not const.VLAB_ESRS_ADMISSION_DIR:
+        return None
+    with _CONTROLLER_LOCK:
+        if _CONTROLLER is None:
+            _CONTROLLER = AdmissionController(const.VLAB_ESRS_ADMISSION_DIR,
+                                              caps={'datastore': const.VLAB_ESRS_IMPORTS_PER_DATASTORE,
+                                                    'host': const.VLAB_ESRS_IMPORTS_PER_HOST},
+                                              max_wait=const.VLAB_ESRS_ADMISSION_MAX_WAIT)
+        return _CONTROLLER
+
+
+@contextmanager
+def admit(resources, on_queued=None, cancelled=None):
+    """Wait for a turn to import to the resources, if admission control is enabled
+
+    :Returns: Ticket, or None when admission control is disabled
+
+    :param resources: The resources the import needs, like datastore:VM-Storage
+    :type resources: List
+
+    :param on_queued: Called with the place in line while the import waits,
+                      and with zero once a waiting import is admitted
+    :type on_queued: Callable
+
+    :param cancelled: Returns True if the import should give up its place in line
+    :type cancelled: Callable
+    """
+    controller = get_controller()
+    if controller is None:
+        yield None
+    else:
+        with controller.admit(resources, on_queued=on_queued, cancelled=cancelled) as ticket:
+            yield ticket
+
+
+def record_throughput(resource, nbytes, seconds):
+    """Save how fast an upload went, if admission control is enabled
+
+    :Returns: None
+    """
+    controller = get_controller()
+    if controller is not None:
+        controller.record_throughput(resource, nbytes, seconds)
+
+
+def tune():
+    """Retune the caps from the measured throughput
+
+    :Returns: Dictionary
+    """
+    controller = get_controller()
+    if controller is None:
+        return {}
+    return controller.tune()
@@ -0,0 +1,202 @@
+# -*- coding: UTF-8 -*-
+"""
+A circuit breaker for vCenter sessions.
+
+When a vCenter is down, every login blocks until it times out, and the worker
+pool fills up with hung tasks. The breaker keeps a short history of the
+sessions with each vCenter server; once too many of them fail (or log in
+slower than ``VLAB_ESRS_BREAKER_SLOW_SECONDS``), the breaker opens and tasks
+fail right away with ``BreakerOpen`` instead of trying to log in. A session
+fails if the login fails, or if the inventory, deploy or power calls made with
+it fail against vCenter (see ``vmware.connect``).
+
+After ``VLAB_ESRS_BREAKER_COOLDOWN`` seconds, the breaker is half open: a
+single task is let through to probe vCenter, while the rest keep failing fast.
+A good session closes the breaker, and a bad one opens it again.
+
+The history is kept in ``VLAB_ESRS_BREAKER_STATE``, so every worker process
+(and the health check in the API) sees the same breaker. The file is only
+rewritten when something changes: a good session with a healthy vCenter is
+remembered by the process, and written along with the next failure.
+"""
+import math
+import time
+import threading
+
+from vlab_esrs_api.lib import const
+from vlab_esrs_api.lib.worker.state import locked, load_json, save_json
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+# Bounds the size of the state file on a busy worker
+MAX_HISTORY = 200
+
+# Good calls to a healthy vCenter that this process hasn't written yet
+_PENDING = {}
+_PENDING_LOCK = threading.Lock()
+
+
+class BreakerOpen(ValueError):
+    """vCenter is failing, so the call wasn't attempted; it's safe to retry later
+
+    :param server: The vCenter server
+    :type server: String
+
+    :param retry_in: How many seconds until the breaker lets a call through
+    :type retry_in: Float
+    """
+    def __init__(self, server, retry_in):
+        self.server = server
+        self.retry_in = retry_in
+        msg = 'vCenter {} is unavailable; try again in {} seconds'.format(server, int(math.ceil(retry_in)))
+        super(BreakerOpen, self).__init__(msg)
+
+
+def allow(server, now=None):
+    """Decide if a call to vCenter may go ahead
+
+    :Returns: Boolean - True if the call is the probe of a half open breaker
+
+    :Raises: BreakerOpen
+
+    :param server: The vCenter server
+    :type server: String
+
+    :param now: The current time, in seconds since the epoch
+    :type now: Float
+    """
+    now = now or time.time()
+    path = const.VLAB_ESRS_BREAKER_STATE
+    # only take the lock when the breaker might change
+    if _breaker(load_json(path, default={}), server)['state'] == CLOSED:
+        return False
+    with locked('{}.lock'.format(path)):
+        state = load_json(path, default={})
+        breaker = _breaker(state, server)
+        if breaker['state'] == CLOSED:
+            return False
+        retry_at = breaker['opened'] + const.VLAB_ESRS_BREAKER_COOLDOWN
+        if breaker['state'] == HALF_OPEN:
+            # give up on a probe that's taking too long, and send another
+            retry_at = breaker['probing'] + const.VLAB_ESRS_BREAKER_COOLDOWN
+        if now < retry_at:
+            raise BreakerOpen(server, retry_at - now)
+        breaker['state'] = HALF_OPEN
+        breaker['probing'] = now
+        state[server] = breaker
+        save_json(path, state)
+    return True
+
+
+def record(server, ok, seconds, probe=False, now=None):
+    """Note how a call to vCenter went
+
+    :Returns: String - the state of the breaker
+
+    :param server: The vCenter server
+    :type server: String
+
+    :param ok: Set to False if the call failed
+    :type ok: Boolean
+
+    :param seconds: How long the call took
+    :type seconds: Float
+
+    :param probe: Set to True if the call was the probe of a half open breaker
+    :type probe: Boolean
+
+    :param now: The current time, in seconds since the epoch
+    :type now: Float
+    """
+    now = now or time.time()
+    call = [now, ok, round(seconds, 3)]
+    good = not _bad(call)
+    since = now - const.VLAB_ESRS_BREAKER_WINDOW
+    path = const.VLAB_ESRS_BREAKER_STATE
+    if good and not probe and _healthy(_breaker(load_json(path, default={}), server), since):
+        # nothing changes, so don't make every session wait on the lock
+        with _PENDING_LOCK:
+            pending = [x for x in _PENDING.get(server, []) if x[0] >= since][-MAX_HISTORY + 1:]
+            _PENDING[server] = pending + [call]
+        return CLOSED
+    with _PENDING_LOCK:
+        pending = _PENDING.pop(server, [])
+    with locked('{}.lock'.format(path)):
+        state = load_json(path, default={})
+        breaker = _breaker(state, server)
+        calls = sorted(breaker['calls'] + pending, key=lambda x: x[0])
+        breaker['calls'] = [x for x in calls if x[0] >= since][-MAX_HISTORY + 1:]
+        breaker['calls'].append(call)
+        if probe or breaker['state'] == HALF_OPEN:
+            if good:
+                breaker = _breaker({}, server)
+            elif probe:
+                breaker.update(state=OPEN, opened=now, probing=None)
+        elif breaker['state'] == CLOSED and _tripped(breaker['calls']):
+            breaker.update(state=OPEN, opened=now)
+        state[server] = breaker
+        save_json(path, state)
+    return breaker['state']
+
+
+def status(now=None):
+    """Describe the breaker of every vCenter server that's been called
+
+    :Returns: Dictionary - server -> {'state', 'calls', 'failures', 'slow', 'retry_in'}
+
+    :param now: The current time, in seconds since the epoch
+    :type now: Float
+    """
+    now = now or time.time()
+    since = now - const.VLAB_ESRS_BREAKER_WINDOW
+    info = {}
+    for server, breaker in load_json(const.VLAB_ESRS_BREAKER_STATE, default={}).items():
+        calls = [x for x in breaker.get('calls', []) if x[0] >= since]
+        retry_in = 0
+        if breaker.get('state') == OPEN:
+            retry_in = max(0, breaker['opened'] + const.VLAB_ESRS_BREAKER_COOLDOWN - now)
+        info[server] = {'state': breaker.get('state', CLOSED),
+                        'calls': len(calls),
+                        'failures': len([x for x in calls if not x[1]]),
+                        'slow': len([x for x in calls if x[2] > const.VLAB_ESRS_BREAKER_SLOW_SECONDS]),
+                        'retry_in': round(retry_in, 1)}
+    return info
+
+
+def _breaker(state, server):
+    """Obtain the breaker of a vCenter server from the shared state"""
+    return state.get(server, {'state': CLOSED, 'opened': None, 'probing': None, 'calls': []})
+
+
+def _bad(call):
+    """Decide if a call failed, or was too slow
+
+    :Returns: Boolean
+
+    :param call: The [when, ok, seconds] of the call
+    :type call: List
+    """
+    return not call[1] or call[2] > const.VLAB_ESRS_BREAKER_SLOW_SECONDS
+
+
+def _healthy(breaker, since):
+    """Decide if a breaker is closed, with no bad calls since a point in time
+
+    :Returns: Boolean
+    """
+    return breaker['state'] == CLOSED and not any(_bad(x) for x in breaker['calls'] if x[0] >= since)
+
+
+def _tripped(calls):
+    """Decide if the recent calls have failed (or been slow) enough to open the breaker
+
+    :Returns: Boolean
+
+    :param calls: The [when, ok, seconds] of every call in the window
+    :type calls: List
+    """
+    if len(calls) < const.VLAB_ESRS_BREAKER_MIN_CALLS:
+        return False
+    bad = len([x for x in calls if _bad(x)])
+    return bad * 100 >= len(calls) * const.VLAB_ESRS_BREAKER_ERROR_PCT
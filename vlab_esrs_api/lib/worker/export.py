@@ -0,0 +1,83 @@
+# -*- coding: UTF-8 -*-
+"""
+Reads every ESRS instance in vCenter, for fleet-wide inventory exports.
+
+The VMs are read in one paged PropertyCollector traversal of
+``INF_VCENTER_TOP_LVL_DIR`` and turned into records as each page arrives.
+Only the names of the user folders, hosts, datastores and networks (fetched up
+front) are held in memory, so memory use doesn't grow with the
+number of VMs.
+"""
+from vlab_inf_common.vmware import vim
+
+from vlab_esrs_api.lib import const
+from vlab_esrs_api.lib.worker import inventory, listing
+
+VM_PROPERTIES = ['name', 'parent', 'config.annotation', 'runtime.powerState', 'runtime.host', 'datastore',
+                 'network']
+# Make records visible to readers about once per page from vCenter
+FLUSH_EVERY = inventory.PAGE_SIZE
+
+
+def records(vcenter, server):
+    """Describe every ESRS instance on a vCenter server
+
+    :Returns: Generator - one Dictionary per ESRS instance
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param server: The vCenter server ``vcenter`` is connected to
+    :type server: String
+    """
+    top = vcenter.get_by_name(name=const.INF_VCENTER_TOP_LVL_DIR, vimtype=vim.Folder)
+    owners = _owners(vcenter, top)
+    hosts = _names(vcenter, vim.HostSystem)
+    datastores = _names(vcenter, vim.Datastore)
+    networks = _names(vcenter, vim.Network)
+    for vm, props in inventory.retrieve(vcenter, vim.VirtualMachine, VM_PROPERTIES, container=top):
+        meta = listing.parse_meta(props.get('config.annotation'))
+        if meta['component'] != 'ESRS':
+            continue
+        parent = props.get('parent')
+        host = props.get('runtime.host')
+        owner = owners.get(parent._moId) if parent is not None else None
+        prefix = '{}_'.format(owner)
+        vm_networks = [networks.get(x._moId) or '' for x in props.get('network') or []]
+        yield {'owner': owner,
+               'name': props['name'],
+               'version': meta.get('version'),
+               'created': meta.get('created'),
+               'state': props.get('runtime.powerState'),
+               'host': hosts.get(host._moId) if host is not None else None,
+               'datastore': [datastores.get(x._moId) for x in props.get('datastore') or []],
+               'networks': [x[len(prefix):] for x in vm_networks if x.startswith(prefix)],
+               'vcenter': server}
+
+
+def _owners(vcenter, top):
+    """Map every folder under the top level directory to the user who owns it
+
+    :Returns: Dictionary - folder moid -> username
+    """
+    folders = {}
+    for folder, props in inventory.retrieve(vcenter, vim.Folder, ['name', 'parent'], container=top):
+        parent = props.get('parent')
+        folders[folder._moId] = (props['name'], parent._moId if parent is not None else None)
+    owners = {}
+    for moid in folders:
+        # a user's folder is the one directly under the top level directory
+        current = moid
+        while current in folders and folders[current][1] != top._moId:
+            current = folders[current][1]
+        if current in folders:
+            owners[moid] = folders[current][0]
+    return owners
+
+
+def _names(vcenter, vimtype):
+    """Map every object of a type to its name
+
+    :Returns: Dictionary - moid -> name
+    """
+    return {obj._moId: props['name'] for obj, props in inventory.retrieve(vcenter, vimtype, ['name'])}
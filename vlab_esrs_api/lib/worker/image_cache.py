@@ -0,0 +1,294 @@
+# -*- coding: UTF-8 -*-
+"""
+A worker-local, content-addressed cache of the ESRS OVA images.
+
+The images live on a (slow, shared) network mount. When the cache is enabled,
+the first deploy of a version copies the OVA to local disk, and every other
+deploy on the node reads that copy. Layout of the cache directory::
+
+    <cache dir>/objects/<sha256>.ova   - the cached images
+    <cache dir>/locks/                 - per image/object lock files
+    <cache dir>/tmp/                   - partially filled copies
+    <cache dir>/index.json             - source image -> digest, hit counts, and when each object was last used
+
+Recency is kept in the index, not in the mtime of the cached copies, so a
+checkout never changes the file a deploy reads (see ``integrity.image_key``).
+
+Copies are checked twice. When an evicted image is copied again, the new copy
+must have the digest recorded for that (unchanged) source the first time. And
+``integrity`` verifies the cached copy against the OVA's own manifest the
+first time it's deployed, like any other image.
+"""
+import os
+import time
+import shutil
+import hashlib
+import threading
+from contextlib import contextmanager
+
+from vlab_esrs_api.lib import const
+from vlab_esrs_api.lib.worker.integrity import IntegrityError
+from vlab_esrs_api.lib.worker.state import locked, load_json, save_json
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class ImageCache(object):
+    """Copies OVAs from ``source_dir`` to ``cache_dir`` on first use
+
+    :param source_dir: Where the canonical OVA images are stored
+    :type source_dir: String
+
+    :param cache_dir: The local directory to cache images in
+    :type cache_dir: String
+
+    :param max_bytes: The most disk space the cache may consume
+    :type max_bytes: Integer
+    """
+    def __init__(self, source_dir, cache_dir, max_bytes):
+        self.source_dir = source_dir
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._objects = os.path.join(cache_dir, 'objects')
+        self._locks = os.path.join(cache_dir, 'locks')
+        self._tmp = os.path.join(cache_dir, 'tmp')
+        self._index = os.path.join(cache_dir, 'index.json')
+        self._index_lock = os.path.join(self._locks, 'index.lock')
+        for directory in (self._objects, self._locks, self._tmp):
+            os.makedirs(directory, exist_ok=True)
+
+    @contextmanager
+    def checkout(self, image_name):
+        """Obtain a local path to an image, filling the cache if needed.
+
+        The cached copy cannot be evicted while the context is held.
+
+        :Returns: String
+
+        :Raises: FileNotFoundError if the image doesn't exist
+
+        :param image_name: The file name of the OVA, like ESRS_3.28.ova
+        :type image_name: String
+        """
+        source = os.path.join(self.source_dir, image_name)
+        source_stat = os.stat(source)
+        if source_stat.st_size > self.max_bytes:
+            # Caching it would evict everything else, and still not fit
+            yield source
+            return
+        digest = self._fill(image_name, source, source_stat)
+        with locked(self._object_lock(digest), shared=True):
+            cached = self._object_path(digest)
+            if not os.path.isfile(cached):
+                # evicted between the fill and us obtaining the lock
+                digest = self._fill(image_name, source, source_stat)
+                cached = self._object_path(digest)
+            self._record_hit(image_name, digest)
+            yield cached
+
+    def prefetch(self, count):
+        """Fill the cache with the most frequently deployed images
+
+        :Returns: List of the image names that were prefetched
+
+        :param count: How many of the popular images to prefetch
+        :type count: Integer
+        """
+        hits = load_json(self._index, default={}).get('hits', {})
+        popular = sorted(hits, key=lambda x: hits[x], reverse=True)[:count]
+        prefetched = []
+        for image_name in popular:
+            source = os.path.join(self.source_dir, image_name)
+            try:
+                source_stat = os.stat(source)
+            except FileNotFoundError:
+                continue
+            if source_stat.st_size > self.max_bytes:
+                continue
+            self._fill(image_name, source, source_stat)
+            prefetched.append(image_name)
+        return prefetched
+
+    def cached(self):
+        """List the images in the cache
+
+        :Returns: List of the paths to the cached copies
+        """
+        return [os.path.join(self._objects, x) for x in sorted(os.listdir(self._objects)) if x.endswith('.ova')]
+
+    def _fill(self, image_name, source, source_stat):
+        """Copy an image into the cache, unless a current copy already exists.
+
+        Concurrent callers for the same image wait on the same lock, so only
+        one of them copies the image and the rest reuse that copy.
+
+        :Returns: String - the sha256 of the image
+        """
+        with locked(os.path.join(self._locks, '{}.lock'.format(image_name))):
+            known = load_json(self._index, default={}).get('sources', {}).get(image_name)
+            expected = None
+            if known and known['size'] == source_stat.st_size and known['mtime'] == source_stat.st_mtime:
+                if os.path.isfile(self._object_path(known['digest'])):
+                    return known['digest']
+                # evicted; copying it again must give the same bytes as last time
+                expected = known['digest']
+            self._evict(source_stat.st_size)
+            digest = self._copy(source, expected)
+            with locked(self._index_lock):
+                index = load_json(self._index, default={})
+                index.setdefault('sources', {})[image_name] = {'size': source_stat.st_size,
+                                                               'mtime': source_stat.st_mtime,
+                                                               'digest': digest}
+                save_json(self._index, index)
+            return digest
+
+    def _copy(self, source, expected=None):
+        """Copy the image to a temp file, verify it, then atomically publish it.
+
+        :Returns: String - the sha256 of the image
+
+        :Raises: IntegrityError if the image doesn't have the ``expected`` digest,
+                 RuntimeError if the copy on disk doesn't match what was read
+
+        :param source: The path to the canonical image
+        :type source: String
+
+        :param expected: The sha256 recorded for the source when it was last copied, if any
+        :type expected: String
+        """
+        hasher = hashlib.sha256()
+        tmp_path = os.path.join(self._tmp, '{}-{}'.format(os.getpid(), time.time()))
+        try:
+            with open(source, 'rb') as src, open(tmp_path, 'wb') as dest:
+                for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+                    hasher.update(chunk)
+                    dest.write(chunk)
+                dest.flush()
+                os.fsync(dest.fileno())
+            digest = hasher.hexdigest()
+            if expected is not None and digest != expected:
+                error = 'Image {} has sha256 {}, but had {} when it was first cached'
+                raise IntegrityError(error.format(os.path.basename(source), digest, expected))
+            if _sha256(tmp_path) != digest:
+                raise RuntimeError('Cached copy of {} does not match the source'.format(source))
+            os.rename(tmp_path, self._object_path(digest))
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+        return digest
+
+    def _evict(self, needed):
+        """Delete the least recently used images until ``needed`` bytes will fit
+
+        Images checked out by a running deploy are skipped.
+
+        :Returns: None
+        """
+        used = load_json(self._index, default={}).get('used', {})
+        objects = []
+        for name in os.listdir(self._objects):
+            path = os.path.join(self._objects, name)
+            try:
+                info = os.stat(path)
+            except FileNotFoundError:
+                # another worker evicted it after the listdir
+                continue
+            # never checked out since it was filled; as old as the copy
+            last_used = used.get(name.split('.')[0], info.st_mtime)
+            objects.append((last_used, info.st_size, name, path))
+        total = sum(x[1] for x in objects)
+        for _, size, name, path in sorted(objects):
+            if total + needed <= self.max_bytes:
+                break
+            digest = name.split('.')[0]
+            try:
+                with locked(self._object_lock(digest), blocking=False):
+                    os.unlink(path)
+                    total -= size
+            except BlockingIOError:
+                continue
+            except FileNotFoundError:
+                total -= size
+
+    def _record_hit(self, image_name, digest):
+        """Track how often an image is used, so prefetch knows what's popular,
+        and when its cached copy was last used, so eviction knows what's stale"""
+        with locked(self._index_lock):
+            index = load_json(self._index, default={})
+            hits = index.setdefault('hits', {})
+            hits[image_name] = hits.get(image_name, 0) + 1
+            used = index.setdefault('used', {})
+            used[digest] = time.time()
+            # forget the objects that have been evicted
+            for known in [x for x in used if not os.path.isfile(self._object_path(x))]:
+                del used[known]
+            save_json(self._index, index)
+
+    def _object_path(self, digest):
+        return os.path.join(self._objects, '{}.ova'.format(digest))
+
+    def _object_lock(self, digest):
+        return os.path.join(self._locks, '{}.lock'.format(digest))
+
+
+def _sha256(path):
+    """Compute the sha256 of a file
+
+    :Returns: String
+
+    :param path: The file to hash
+    :type path: String
+    """
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as the_file:
+        for chunk in iter(lambda: the_file.read(CHUNK_SIZE), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+_CACHE = None
+_CACHE_LOCK = threading.Lock()
+
+
+def get_cache():
+    """Obtain the worker's image cache, or None if caching is disabled
+
+    :Returns: ImageCache
+    """
+    global _CACHE
+    if not const.VLAB_ESRS_IMAGE_CACHE_DIR:
+        return None
+    with _CACHE_LOCK:
+        if _CACHE is None:
+            _CACHE = ImageCache(source_dir=const.VLAB_ESRS_IMAGES_DIR,
+                                cache_dir=const.VLAB_ESRS_IMAGE_CACHE_DIR,
+                                max_bytes=const.VLAB_ESRS_IMAGE_CACHE_MAX_GB * 1024 ** 3)
+        return _CACHE
+
+
+@contextmanager
+def checkout(image_name):
+    """Obtain the path to read an OVA from; the cached copy if caching is enabled
+
+    :Returns: String
+
+    :param image_name: The file name of the OVA, like ESRS_3.28.ova
+    :type image_name: String
+    """
+    cache = get_cache()
+    if cache is None:
+        yield os.path.join(const.VLAB_ESRS_IMAGES_DIR, image_name)
+    else:
+        with cache.checkout(image_name) as path:
+            yield path
+
+
+def prefetch():
+    """Warm the cache with the most popular images, per the configured count
+
+    :Returns: List
+    """
+    cache = get_cache()
+    if cache is None or not const.VLAB_ESRS_IMAGE_CACHE_PREFETCH:
+        return []
+    return cache.prefetch(const.VLAB_ESRS_IMAGE_CACHE_PREFETCH)
@@ -0,0 +1,262 @@
+# -*- coding: UTF-8 -*-
+"""
+Caches the OVF descriptors and import specs of the ESRS images.
+
+Every deploy of an image used to read its descriptor out of the OVA, and send
+it to vCenter (``OvfManager.CreateImportSpec``) to be parsed into an import
+spec. Only a few fields of that spec differ between instances of an image, so
+the first spec made for an image, resource pool, datastore and OVF networks is
+kept as a template. Later deploys copy the template, and patch in the name of
+the VM and the backing of its NICs.
+
+Images are identified by ``integrity.image_key``; when the image cache is
+enabled, that's the path of the content-addressed (sha256) copy, which stays
+the same for every checkout until the copy is evicted. Specs that
+can't be patched safely, like ones for vApps or opaque networks, are never
+cached, so those deploys always ask vCenter.
+"""
+import re
+import tarfile
+import threading
+from collections import namedtuple, OrderedDict
+
+from pyVmomi import vmodl
+from vlab_inf_common.vmware import vim
+
+from vlab_esrs_api.lib import const
+from vlab_esrs_api.lib.worker import integrity
+
+# Same as vlab_inf_common.vmware.Ova.networks
+NETWORK_NAME = re.compile(r'Network ovf:name=[\w\ \"]{1,50}')
+# Same as vlab_inf_common.vmware.virtual_machine.deploy_from_ova
+HOSTNAME = re.compile(r'^(([a-zA-Z0-9]|[a-zA-Z0-9][a-zA-Z0-9\-]*[a-zA-Z0-9])\.)*([A-Za-z0-9]|[A-Za-z0-9][A-Za-z0-9\-]*[A-Za-z0-9])$')
+
+Descriptor = namedtuple('Descriptor', 'name text networks')
+Template = namedtuple('Template', 'import_spec file_items nic_networks')
+
+
+class SpecCache(object):
+    """Keeps the most recently used descriptors and import spec templates
+
+    :param max_entries: How many descriptors, and how many templates, to keep
+    :type max_entries: Integer
+    """
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._descriptors = OrderedDict()
+        self._templates = OrderedDict()
+        self._switch_uuids = {}
+        self._lock = threading.Lock()
+
+    def descriptor(self, ova_path):
+        """Read the OVF descriptor of an image
+
+        :Returns: Descriptor
+
+        :Raises: ValueError if the OVA has no descriptor
+
+        :param ova_path: The location of the OVA
+        :type ova_path: String
+        """
+        key = integrity.image_key(ova_path)
+        with self._lock:
+            found = self._descriptors.get(key)
+            if found is not None:
+                self._descriptors.move_to_end(key)
+                return found
+        with tarfile.open(ova_path) as ova:
+            # the descriptor should be first, so this stops before the disks
+            for member in ova:
+                if member.name.endswith('.ovf'):
+                    break
+            else:
+                raise ValueError('OVA does not contain a .ovf file')
+            name = member.name
+            text = ova.extractfile(member).read().decode()
+        networks = [x.split('=')[1].replace('"', '') for x in NETWORK_NAME.findall(text)]
+        found = Descriptor(name, text, networks)
+        with self._lock:
+            _remember(self._descriptors, key, found, self.max_entries)
+        return found
+
+    def import_spec(self, vcenter, ova_path, resource_pool, datastore, machine_name, network_map):
+        """Make the import spec for a new instance of an image
+
+        :Returns: Tuple - (vim.ImportSpec, list of vim.OvfManager.FileItem, Boolean True if from the cache)
+
+        :Raises: ValueError if the machine name isn't a valid hostname, or vCenter rejects the OVA
+
+        :param vcenter: The instantiated connection to vCenter
+        :type vcenter: vlab_inf_common.vmware.vCenter
+
+        :param ova_path: The location of the OVA
+        :type ova_path: String
+
+        :param resource_pool: Where the new VM will run
+        :type resource_pool: vim.ResourcePool
+
+        :param datastore: Where the new VM will be stored
+        :type datastore: vim.Datastore
+
+        :param machine_name: The name of the new VM
+        :type machine_name: String
+
+        :param network_map: The mapping of networks defined in the OVA to vCenter networks
+        :type network_map: List of vim.OvfManager.NetworkMapping
+        """
+        if not HOSTNAME.match(machine_name):
+            error = 'Invalid machine name. Names can only contain characters a-z, A-Z, 0-9, periods (".") and dashes ("-"). Supplied: {}'.format(machine_name)
+            raise ValueError(error)
+        key = (integrity.image_key(ova_path), resource_pool._moId, datastore._moId,
+               tuple(x.name for x in network_map))
+        with self._lock:
+            template = self._templates.get(key)
+            if template is not None:
+                self._templates.move_to_end(key)
+        if template is not None:
+            networks = {x.name: x.network for x in network_map}
+            return self._patch(template, machine_name, networks), template.file_items, True
+
+        spec_params = vim.OvfManager.CreateImportSpecParams(entityName=machine_name,
+                                                            diskProvisioning='thin',
+                                                            networkMapping=network_map)
+        spec = vcenter.ovf_manager.CreateImportSpec(ovfDescriptor=self.descriptor(ova_path).text,
+                                                    resourcePool=resource_pool,
+                                                    datastore=datastore,
+                                                    cisp=spec_params)
+        if spec.error:
+            raise ValueError('Unable to import OVA: {}'.format(spec.error[0].msg))
+        template = _make_template(spec, network_map)
+        if template is not None:
+            with self._lock:
+                _remember(self._templates, key, template, self.max_entries)
+        return spec.importSpec, spec.fileItem, False
+
+    def _patch(self, template, machine_name, networks):
+        """Copy a template, with the fields of one instance
+
+        :Returns: vim.VirtualMachineImportSpec
+        """
+        import_spec = _copy(template.import_spec)
+        import_spec.configSpec.name = machine_name
+        for device, ovf_network in zip(_nics(import_spec), template.nic_networks):
+            device.backing = self._backing(networks[ovf_network])
+        return import_spec
+
+    def _backing(self, network):
+        """Connect a NIC to a network
+
+        :Returns: vim.vm.device.VirtualDevice.BackingInfo
+        """
+        if isinstance(network, vim.dvs.DistributedVirtualPortgroup):
+            config = network.config
+            switch = config.distributedVirtualSwitch
+            with self._lock:
+                switch_uuid = self._switch_uuids.get(switch._moId)
+            if switch_uuid is None:
+                switch_uuid = switch.uuid
+                with self._lock:
+                    self._switch_uuids[switch._moId] = switch_uuid
+            port = vim.dvs.PortConnection(portgroupKey=config.key, switchUuid=switch_uuid)
+            return vim.vm.device.VirtualEthernetCard.DistributedVirtualPortBackingInfo(port=port)
+        return vim.vm.device.VirtualEthernetCard.NetworkBackingInfo(deviceName=network.name, network=network)
+
+
+def _make_template(spec, network_map):
+    """Keep a spec from vCenter as a template, if it can be patched for other instances
+
+    :Returns: Template, or None if the spec shouldn't be cached
+    """
+    import_spec = spec.importSpec
+    if not isinstance(import_spec, vim.VirtualMachineImportSpec) or spec.warning:
+        return None
+    by_moid = {}
+    for mapping in network_map:
+        if mapping.network._moId in by_moid or isinstance(mapping.network, vim.OpaqueNetwork):
+            # can't tell which NIC belongs to which OVF network
+            return None
+        by_moid[mapping.network._moId] = mapping.name
+    nic_networks = []
+    for device in _nics(import_spec):
+        backing = device.backing
+        if isinstance(backing, vim.vm.device.VirtualEthernetCard.NetworkBackingInfo) and backing.network:
+            moid = backing.network._moId
+        elif isinstance(backing, vim.vm.device.VirtualEthernetCard.DistributedVirtualPortBackingInfo):
+            moid = backing.port.portgroupKey
+        else:
+            return None
+        if moid not in by_moid:
+            return None
+        nic_networks.append(by_moid[moid])
+    return Template(_copy(import_spec), list(spec.fileItem), nic_networks)
+
+
+def _nics(import_spec):
+    """Find the network cards in an import spec
+
+    :Returns: List of vim.vm.device.VirtualEthernetCard
+    """
+    return [x.device for x in import_spec.configSpec.deviceChange or []
+            if isinstance(x.device, vim.vm.device.VirtualEthernetCard)]
+
+
+def _copy(value):
+    """Deep copy a data object, sharing the (immutable) managed object references
+
+    ``copy.deepcopy`` would also copy the session each managed object is bound to.
+
+    :Returns: Object
+    """
+    if isinstance(value, vmodl.DynamicData):
+        clone = type(value)()
+        for prop in value._GetPropertyList():
+            setattr(clone, prop.name, _copy(getattr(value, prop.name)))
+        return clone
+    if isinstance(value, list):
+        return type(value)(_copy(x) for x in value)
+    return value
+
+
+def _remember(entries, key, value, max_entries):
+    """Add to an LRU dictionary, dropping the least recently used entries"""
+    entries[key] = value
+    entries.move_to_end(key)
+    while len(entries) > max_entries:
+        entries.popitem(last=False)
+
+
+_CACHE = None
+_CACHE_LOCK = threading.Lock()
+
+
+def get_cache():
+    """Obtain the worker's cache of import specs
+
+    :Returns: SpecCache
+    """
+    global _CACHE
+    with _CACHE_LOCK:
+        if _CACHE is None:
+            _CACHE = SpecCache(max_entries=const.VLAB_ESRS_IMPORT_SPEC_CACHE_SIZE)
+        return _CACHE
+
+
+def descriptor(ova_path):
+    """Read the OVF descriptor of an image
+
+    :Returns: Descriptor
+
+    :param ova_path: The location of the OVA
+    :type ova_path: String
+    """
+    return get_cache().descriptor(ova_path)
+
+
+def import_spec(vcenter, ova_path, resource_pool, datastore, machine_name, network_map):
+    """Make the import spec for a new instance of an image
+
+    :Returns: Tuple - (vim.ImportSpec, list of vim.OvfManager.FileItem, Boolean True if from the cache)
+
+    :Raises: ValueError if the machine name isn't a valid hostname, or vCenter rejects the OVA
+    """
+    return get_cache().import_spec(vcenter, ova_path, resource_pool, datastore, machine_name, network_map)
@@ -0,0 +1,153 @@
+# -*- coding: UTF-8 -*-
+"""
+Verifies OVA images against the manifest (``.mf``) bundled inside them.
+
+Hashing a multi-GB image is slow, so the hashes are computed while the disks
+are streamed to vCenter during the first deploy, and the outcome is recorded
+under the image's (path, size, inode). Later deploys of the unchanged file
+skip verification entirely.
+
+The key leaves out the mtime, which changes without the contents changing
+(like a ``touch``). Replace an image by writing a new file and renaming it
+over the old one, like the image cache publishes its copies; that gives it a
+new inode, so it's verified again.
+"""
+import os
+import re
+import time
+import hashlib
+
+from vlab_esrs_api.lib import const
+from vlab_esrs_api.lib.worker.state import locked, load_json, save_json
+
+MANIFEST_LINE = re.compile(r'^(?P<algo>SHA1|SHA256|SHA512)\((?P<name>.+)\)\s*=\s*(?P<digest>[0-9a-fA-F]+)\s*$')
+
+
+class IntegrityError(ValueError):
+    """Raised when an OVA doesn't match its manifest"""
+    pass
+
+
+def parse_manifest(text):
+    """Convert the contents of a ``.mf`` file into a dictionary
+
+    :Returns: Dictionary - file name -> (algorithm, hex digest)
+
+    :Raises: IntegrityError if the manifest is malformed
+
+    :param text: The contents of the manifest
+    :type text: String
+    """
+    manifest = {}
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        match = MANIFEST_LINE.match(line.strip())
+        if not match:
+            raise IntegrityError('Malformed OVA manifest line: {}'.format(line))
+        manifest[match.group('name')] = (match.group('algo').lower(), match.group('digest').lower())
+    return manifest
+
+
+def image_key(ova_path):
+    """Identify a specific revision of an OVA file without reading its contents
+
+    :Returns: String
+
+    :param ova_path: The path to the OVA
+    :type ova_path: String
+    """
+    info = os.stat(ova_path)
+    return '{}|{}|{}'.format(os.path.abspath(ova_path), info.st_size, info.st_ino)
+
+
+class Verifier(object):
+    """Tracks the hashes of the files in an OVA as they're read
+
+    :param ova_path: The path to the OVA being verified
+    :type ova_path: String
+
+    :param manifest_text: The contents of the OVA's manifest file
+    :type manifest_text: String
+    """
+    def __init__(self, ova_path, manifest_text):
+        self.ova_path = ova_path
+        self.key = image_key(ova_path)
+        self.manifest = parse_manifest(manifest_text)
+        self.manifest_sha256 = hashlib.sha256(manifest_text.encode()).hexdigest()
+        self._hashers = {name: hashlib.new(algo) for name, (algo, _) in self.manifest.items()}
+        self.seen = set()
+
+    def wants(self, name):
+        """Is the file covered by the manifest?
+
+        :Returns: Boolean
+        """
+        return name in self._hashers
+
+    def update(self, name, chunk):
+        """Feed the next chunk of a file to its hasher
+
+        :Returns: None
+
+        :Raises: IntegrityError if the file isn't in the manifest
+        """
+        try:
+            self._hashers[name].update(chunk)
+        except KeyError:
+            raise IntegrityError('File {} in OVA {} is not listed in its manifest'.format(name, self.ova_path))
+        self.seen.add(name)
+
+    def check(self):
+        """Compare what was read to the manifest, and record the outcome
+
+        :Returns: None
+
+        :Raises: IntegrityError if any file doesn't match the manifest
+        """
+        for name, (algo, expected) in self.manifest.items():
+            actual = self._hashers[name].hexdigest()
+            if actual != expected:
+                error = 'OVA {} failed verification: {} has {} {}, manifest says {}'
+                raise IntegrityError(error.format(os.path.basename(self.ova_path), name, algo, actual, expected))
+        _record(self.key, {'verified': time.time(), 'manifest_sha256': self.manifest_sha256})
+
+
+def needs_verification(ova_path, force=False):
+    """Decide if an OVA must be hashed during this deploy
+
+    :Returns: Boolean
+
+    :param ova_path: The path to the OVA
+    :type ova_path: String
+
+    :param force: Set to True to verify even if the image was verified before
+    :type force: Boolean
+    """
+    if not const.VLAB_ESRS_VERIFY_IMAGES:
+        return False
+    if force or const.VLAB_ESRS_FORCE_VERIFY:
+        return True
+    return verified(ova_path) is None
+
+
+def verified(ova_path):
+    """Look up the stored verification outcome for an OVA
+
+    :Returns: Dictionary, or None if this revision of the file was never verified
+
+    :param ova_path: The path to the OVA
+    :type ova_path: String
+    """
+    return load_json(const.VLAB_ESRS_VERIFY_DB, default={}).get(image_key(ova_path))
+
+
+def _record(key, outcome):
+    """Save the outcome of verifying an image"""
+    with locked('{}.lock'.format(const.VLAB_ESRS_VERIFY_DB)):
+        known = load_json(const.VLAB_ESRS_VERIFY_DB, default={})
+        # Older revisions of the same file will never match again
+        path = key.split('|')[0]
+        known = {k: v for k, v in known.items() if k.split('|')[0] != path}
+        known[key] = outcome
+        save_json(const.VLAB_ESRS_VERIFY_DB, known)
@@ -0,0 +1,195 @@
+# -*- coding: UTF-8 -*-
+"""
+Batched reads of the vCenter inventory.
+
+Reading ``vm.name`` (or any other property) off a managed object is a round
+trip to vCenter. These functions use the PropertyCollector to fetch just the
+properties needed for many objects in a handful of paged calls instead, or to
+wait on a property of many objects at once.
+"""
+import time
+
+from pyVmomi import vmodl
+from vlab_inf_common.vmware import vim
+
+PAGE_SIZE = 500
+
+
+def retrieve(vcenter, vimtype, properties, container=None, page_size=PAGE_SIZE):
+    """Fetch properties of every object of a type, one page at a time
+
+    Yields (managed object, {property: value}) so callers never hold more
+    than one page of results.
+
+    :Returns: Generator
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param vimtype: The kind of object to find, like vim.Network
+    :type vimtype: pyVmomi.VmomiSupport.ManagedObject
+
+    :param properties: The property paths to fetch, like ['name', 'runtime.powerState']
+    :type properties: List
+
+    :param container: Only search under this object; defaults to the whole inventory
+    :type container: vim.ManagedEntity
+
+    :param page_size: The most objects to fetch per call to vCenter
+    :type page_size: Integer
+    """
+    return retrieve_many(vcenter, {vimtype: properties}, container=container, page_size=page_size)
+
+
+def retrieve_many(vcenter, properties, container=None, page_size=PAGE_SIZE):
+    """Fetch properties of objects of several types in a single traversal
+
+    :Returns: Generator - like ``retrieve``
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param properties: The kind of object -> the property paths to fetch
+    :type properties: Dictionary
+
+    :param container: Only search under this object; defaults to the whole inventory
+    :type container: vim.ManagedEntity
+
+    :param page_size: The most objects to fetch per call to vCenter
+    :type page_size: Integer
+    """
+    content = vcenter.content
+    view = content.viewManager.CreateContainerView(container or content.rootFolder, list(properties), True)
+    try:
+        options = vmodl.query.PropertyCollector.RetrieveOptions(maxObjects=page_size)
+        collector = content.propertyCollector
+        result = collector.RetrievePropertiesEx([_filter_spec(view, properties)], options)
+        while result:
+            for item in result.objects:
+                yield item.obj, {x.name: x.val for x in item.propSet}
+            if not result.token:
+                break
+            result = collector.ContinueRetrievePropertiesEx(result.token)
+    finally:
+        view.Destroy()
+
+
+def wait_for(vcenter, objects, path, done, timeout, clock=time.time):
+    """Wait until a property of every object meets a condition, or the timeout passes
+
+    One PropertyCollector watches all the objects, so waiting on many objects
+    costs about as many calls to vCenter as waiting on one.
+
+    :Returns: Dictionary - the moId of each object -> the last value seen of the property
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param objects: The objects to watch
+    :type objects: List of pyVmomi.VmomiSupport.ManagedObject
+
+    :param path: The property path to watch, like 'info' or 'runtime.powerState'
+    :type path: String
+
+    :param done: Given a value of the property, returns True once the object is done
+    :type done: Callable
+
+    :param timeout: The most seconds to wait
+    :type timeout: Integer
+    """
+    values = {}
+    if not objects:
+        return values
+    collector = vcenter.content.propertyCollector.CreatePropertyCollector()
+    try:
+        obj_specs = [vmodl.query.PropertyCollector.ObjectSpec(obj=x) for x in objects]
+        prop_specs = [vmodl.query.PropertyCollector.PropertySpec(type=x, pathSet=[path])
+                      for x in set(type(x) for x in objects)]
+        # ask for the whole value of the property on every change, not just the nested part that changed
+        collector.CreateFilter(vmodl.query.PropertyCollector.FilterSpec(objectSet=obj_specs, propSet=prop_specs),
+                               partialUpdates=False)
+        pending = set(x._moId for x in objects)
+        deadline = clock() + timeout
+        version = ''
+        while pending:
+            remaining = deadline - clock()
+            if remaining <= 0:
+                break
+            options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=max(1, int(remaining)))
+            update = collector.WaitForUpdatesEx(version, options)
+            if update is None:
+                continue
+            version = update.version
+            for filter_update in update.filterSet:
+                for obj_update in filter_update.objectSet:
+                    moid = obj_update.obj._moId
+                    for change in obj_update.changeSet:
+                        if change.name == path:
+                            values[moid] = change.val
+                        elif change.name.startswith(path + '.') and values.get(moid) is not None:
+                            # a nested property, like info.state for the path info
+                            _assign(values[moid], change.name[len(path) + 1:], change.val)
+                        else:
+                            continue
+                        if done(values[moid]):
+                            pending.discard(moid)
+    finally:
+        collector.DestroyPropertyCollector()
+    return values
+
+
+def _assign(value, path, new):
+    """Apply the change of a nested property, like state, to a data object, like a TaskInfo
+
+    :Returns: None
+    """
+    if '[' in path:
+        # an element of an array; none of the properties waited on need those
+        return
+    names = path.split('.')
+    for name in names[:-1]:
+        value = getattr(value, name)
+    setattr(value, names[-1], new)
+
+
+def filter_spec(view, vimtype, properties):
+    """Build the PropertyCollector query for properties of every object in a container view
+
+    :Returns: vmodl.query.PropertyCollector.FilterSpec
+
+    :param view: The container view holding the objects
+    :type view: vim.view.ContainerView
+
+    :param vimtype: The kind of object in the view
+    :type vimtype: pyVmomi.VmomiSupport.ManagedObject
+
+    :param properties: The property paths to fetch
+    :type properties: List
+    """
+    return _filter_spec(view, {vimtype: properties})
+
+
+def _filter_spec(view, properties):
+    """Like ``filter_spec``, for a view holding several kinds of objects"""
+    traversal = vmodl.query.PropertyCollector.TraversalSpec(name='traverseView',
+                                                            path='view',
+                                                            skip=False,
+                                                            type=vim.view.ContainerView)
+    obj_spec = vmodl.query.PropertyCollector.ObjectSpec(obj=view, skip=True, selectSet=[traversal])
+    prop_specs = [vmodl.query.PropertyCollector.PropertySpec(type=vimtype, pathSet=paths)
+                  for vimtype, paths in properties.items()]
+    return vmodl.query.PropertyCollector.FilterSpec(objectSet=[obj_spec], propSet=prop_specs)
+
+
+def rebind(vcenter, managed_object):
+    """Attach a managed object obtained from an older session to the current one
+
+    :Returns: pyVmomi.VmomiSupport.ManagedObject
+
+    :param vcenter: The connection to use for the object's property reads and method calls
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param managed_object: The object to rebind
+    :type managed_object: pyVmomi.VmomiSupport.ManagedObject
+    """
+    return type(managed_object)(managed_object._moId, vcenter.content.rootFolder._stub)
@@ -0,0 +1,198 @@
+# -*- coding: UTF-8 -*-
+"""
+Paged, projected listings of a user's ESRS instances.
+
+``virtual_machine.get_info`` reads every property of a VM (and builds a
+console URL) one round trip at a time. When the caller only wants a few
+fields, the PropertyCollector fetches just the properties those fields need
+for every VM in one go, and ``get_info`` is skipped entirely.
+"""
+import base64
+import binascii
+
+import ujson
+from vlab_inf_common.vmware import vim, virtual_machine
+
+from vlab_esrs_api.lib.worker import inventory
+
+# field -> the VM properties needed to build it
+FIELDS = {'name': [],
+          'moid': [],
+          'state': ['runtime.powerState'],
+          'ips': ['guest.net'],
+          'networks': ['network'],
+          'console': [],
+          'meta': ['config.annotation'],
+         }
+# Needed to sort, and to tell ESRS from the user's other VMs
+REQUIRED_PROPERTIES = ['name', 'config.annotation']
+UNKNOWN_META = {'component': 'Unknown',
+                'created': 0,
+                'version': 'Unknown',
+                'generation': 0,
+                'configured': False}
+
+
+def parse_fields(fields):
+    """Convert the ``fields`` query parameter into the fields to return
+
+    :Returns: Dictionary - field -> None for the whole field, or a list of sub-fields (like meta.version)
+
+    :Raises: ValueError for unknown fields
+
+    :param fields: Comma separated field names, like "name,state,meta.version"
+    :type fields: String
+    """
+    wanted = {}
+    for field in [x.strip() for x in fields.split(',') if x.strip()]:
+        top, _, sub = field.partition('.')
+        if top not in FIELDS or (sub and top != 'meta'):
+            raise ValueError('Unknown field: {}'.format(field))
+        if not sub:
+            wanted[top] = None
+        elif wanted.get(top, []) is not None:
+            wanted.setdefault(top, []).append(sub)
+    if not wanted:
+        raise ValueError('No fields supplied')
+    return wanted
+
+
+def encode_cursor(name):
+    """Make an opaque cursor that resumes the listing after a VM
+
+    :Returns: String
+
+    :param name: The name of the last VM returned
+    :type name: String
+    """
+    return base64.urlsafe_b64encode(name.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Obtain the VM name a cursor resumes after
+
+    :Returns: String
+
+    :Raises: ValueError for a malformed cursor
+
+    :param cursor: The value from ``encode_cursor``
+    :type cursor: String
+    """
+    try:
+        return base64.urlsafe_b64decode(cursor.encode()).decode()
+    except (binascii.Error, UnicodeError):
+        raise ValueError('Invalid cursor: {}'.format(cursor))
+
+
+def list_esrs(vcenter, folder, username, fields=None, limit=None, cursor=None, network_name=None):
+    """List a user's ESRS instances, sorted by name
+
+    :Returns: Tuple - ({name: info}, the cursor for the next page or None)
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param folder: The user's folder
+    :type folder: vim.Folder
+
+    :param username: The user who owns the VMs
+    :type username: String
+
+    :param fields: The output of ``parse_fields``; None returns everything ``get_info`` does
+    :type fields: Dictionary
+
+    :param limit: The most VMs to return
+    :type limit: Integer
+
+    :param cursor: Resume the listing from a previous page
+    :type cursor: String
+
+    :param network_name: Returns the name of a vim.Network; required if fields has networks
+    :type network_name: Callable
+    """
+    properties = set(REQUIRED_PROPERTIES)
+    for field in (fields or {}):
+        properties.update(FIELDS[field])
+    after = decode_cursor(cursor) if cursor else None
+    found = []
+    for vm, props in inventory.retrieve(vcenter, vim.VirtualMachine, sorted(properties), container=folder):
+        if after is not None and props['name'] <= after:
+            continue
+        meta = parse_meta(props.get('config.annotation'))
+        if meta['component'] == 'ESRS':
+            found.append((props['name'], vm, props, meta))
+    found.sort(key=lambda x: x[0])
+    next_cursor = None
+    if limit is not None and len(found) > limit:
+        found = found[:limit]
+        next_cursor = encode_cursor(found[-1][0])
+    esrs_vms = {}
+    for name, vm, props, meta in found:
+        if fields is None:
+            esrs_vms[name] = virtual_machine.get_info(vcenter, vm, username)
+        else:
+            esrs_vms[name] = _project(vcenter, vm, props, meta, fields, username, network_name)
+    return esrs_vms, next_cursor
+
+
+def _project(vcenter, vm, props, meta, fields, username, network_name):
+    """Build the requested fields of one VM from the fetched properties"""
+    info = {}
+    for field, sub_fields in fields.items():
+        if field == 'name':
+            # already the key in the output
+            continue
+        elif field == 'moid':
+            info['moid'] = vm._moId
+        elif field == 'state':
+            info['state'] = props.get('runtime.powerState')
+        elif field == 'ips':
+            info['ips'] = _ips(props.get('guest.net') or [])
+        elif field == 'networks':
+            info['networks'] = _networks(props.get('network') or [], username, network_name)
+        elif field == 'console':
+            info['console'] = virtual_machine._get_vm_console_url(vcenter, vm)
+        elif field == 'meta':
+            if sub_fields is None:
+                info['meta'] = meta
+            else:
+                info['meta'] = {x: meta.get(x) for x in sub_fields}
+    return info
+
+
+def parse_meta(annotation):
+    """Decode the metadata stored in a VM's notes, like ``get_info`` does
+
+    :Returns: Dictionary
+
+    :param annotation: The VM's notes (``config.annotation``)
+    :type annotation: String
+    """
+    try:
+        meta = ujson.loads(annotation)
+    except (ValueError, TypeError):
+        # ValueError -> VM created, but notes not updated
+        # TypeError  -> VM failed to be created (or is still deploying); no notes
+        return dict(UNKNOWN_META)
+    if not isinstance(meta, dict):
+        return dict(UNKNOWN_META)
+    return meta
+
+
+def _ips(nics):
+    """The IPs of a VM, without the IPv6 link-local ones"""
+    ips = []
+    for nic in nics:
+        ips += nic.ipAddress
+    return [x for x in ips if not x.startswith('fe80::')]
+
+
+def _networks(networks, username, network_name):
+    """The names of the user's networks a VM is connected to"""
+    prefix = '{}_'.format(username)
+    names = []
+    for network in networks:
+        name = network_name(network)
+        if name and name.startswith(prefix):
+            names.append(name[len(prefix):])
+    return names
@@ -0,0 +1,347 @@
+# -*- coding: UTF-8 -*-
+"""
+An index of vCenter networks (port groups) by name, kept for the life of the worker.
+
+``vcenter.networks`` enumerates every port group in vCenter, which is slow
+with thousands of per-user networks. The index is loaded once, then kept
+current by a background thread that receives only the changes from vCenter
+(via ``WaitForUpdatesEx``). A lookup that misses re-checks vCenter for just
+that name before concluding the network doesn't exist, so a network created
+moments ago is still found.
+
+Every change is also shared with the API, through the catalog in the metadata
+index (see ``vlab_esrs_api.lib.validation``).
+"""
+import time
+import sqlite3
+import threading
+from functools import partial
+
+from pyVmomi import vmodl
+from vlab_api_common import get_logger
+from vlab_inf_common.vmware import vim
+
+from vlab_esrs_api.lib import const, metadata
+from vlab_esrs_api.lib.worker import inventory
+from vlab_esrs_api.lib.worker.state import elected
+
+logger = get_logger(__name__, loglevel=const.VLAB_ESRS_LOG_LEVEL)
+
+
+def fetch_all(vcenter):
+    """Obtain every network in vCenter
+
+    :Returns: Dictionary - name -> vim.Network
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+    """
+    return {props['name']: obj for obj, props in inventory.retrieve(vcenter, vim.Network, ['name'])}
+
+
+def fetch_one(vcenter, name):
+    """Look for a single network by name, without enumerating them all
+
+    :Returns: vim.Network, or None if it wasn't found
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param name: The name of the network
+    :type name: String
+    """
+    search = vcenter.content.searchIndex
+    for datacenter in vcenter.content.rootFolder.childEntity:
+        if not isinstance(datacenter, vim.Datacenter):
+            continue
+        found = search.FindChild(datacenter.networkFolder, name)
+        if isinstance(found, vim.Network):
+            return found
+    return None
+
+
+class NetworkIndex(object):
+    """Finds networks by name from a local copy of the inventory
+
+    :param ttl: Without a running watcher, reload everything after this many seconds
+    :type ttl: Integer
+
+    :param fetch_all: Returns every network, given a connection to vCenter
+    :type fetch_all: Callable
+
+    :param fetch_one: Returns a network by name (or None), given a connection to vCenter
+    :type fetch_one: Callable
+
+    :param miss_interval: The fewest seconds between full reloads caused by missed lookups
+    :type miss_interval: Integer
+
+    :param clock: Returns the current time in seconds
+    :type clock: Callable
+
+    :param listener: Called with (every name, after a full reload), or (None, added names, removed names)
+    :type listener: Callable
+    """
+    def __init__(self, ttl, fetch_all=fetch_all, fetch_one=fetch_one, miss_interval=5, clock=time.time,
+                 listener=None):
+        self.ttl = ttl
+        self.fetch_all = fetch_all
+        self.fetch_one = fetch_one
+        self.miss_interval = miss_interval
+        self.clock = clock
+        self.listener = listener
+        self._by_name = {}
+        self._by_moid = {}
+        self._fetched = None
+        self._watching = False
+        self._watcher = None
+        self._lock = threading.Lock()
+
+    def lookup(self, vcenter, name):
+        """Find a network by name
+
+        :Returns: vim.Network, usable with the supplied connection
+
+        :Raises: KeyError if no network has that name
+
+        :param vcenter: The caller's connection to vCenter
+        :type vcenter: vlab_inf_common.vmware.vCenter
+
+        :param name: The name of the network
+        :type name: String
+        """
+        if self._fetched is None or (not self._watching and self.clock() - self._fetched > self.ttl):
+            self.refresh(vcenter)
+        network = self._by_name.get(name)
+        if network is None:
+            network = self._refetch(vcenter, name)
+        if network is None:
+            raise KeyError(name)
+        return inventory.rebind(vcenter, network)
+
+    def name_of(self, vcenter, network):
+        """Find the name of a network
+
+        :Returns: String, or None if the network isn't in the index
+
+        :param vcenter: The caller's connection to vCenter
+        :type vcenter: vlab_inf_common.vmware.vCenter
+
+        :param network: The network
+        :type network: vim.Network
+        """
+        if self._fetched is None or (not self._watching and self.clock() - self._fetched > self.ttl):
+            self.refresh(vcenter)
+        return self._by_moid.get(network._moId)
+
+    def refresh(self, vcenter):
+        """Reload every network from vCenter
+
+        :Returns: None
+        """
+        networks = self.fetch_all(vcenter)
+        with self._lock:
+            self._by_name = dict(networks)
+            self._by_moid = {x._moId: name for name, x in networks.items()}
+            self._fetched = self.clock()
+        self._publish(list(networks))
+
+    def apply(self, changes):
+        """Update the index with changes to the inventory
+
+        :Returns: None
+
+        :param changes: Tuples of (kind, vim.Network, name), where kind is enter, modify or leave
+        :type changes: List
+        """
+        added, removed = [], []
+        with self._lock:
+            for kind, network, name in changes:
+                old_name = self._by_moid.pop(network._moId, None)
+                if old_name is not None:
+                    self._by_name.pop(old_name, None)
+                    removed.append(old_name)
+                if kind == 'leave':
+                    continue
+                name = name or old_name
+                if name is not None:
+                    self._by_name[name] = network
+                    self._by_moid[network._moId] = name
+                    added.append(name)
+            self._fetched = self.clock()
+        self._publish(None, added, removed)
+
+    def start_watcher(self, connect, wait_seconds=60, lock_file=None):
+        """Keep the index current from a background thread
+
+        :Returns: None
+
+        :param connect: Returns a new connection to vCenter, usable as a context manager
+        :type connect: Callable
+
+        :param wait_seconds: The longest a single call for changes may block
+        :type wait_seconds: Integer
+
+        :param lock_file: Only watch while holding this lock, so one process
+                          watches for the whole node. The rest reload the
+                          index every ``ttl`` seconds instead.
+        :type lock_file: String
+        """
+        if self._watcher is not None and self._watcher.is_alive():
+            return
+        self._watcher = threading.Thread(target=self._watch_forever, args=(connect, wait_seconds, lock_file),
+                                         daemon=True)
+        self._watcher.start()
+
+    def _publish(self, names, added=(), removed=()):
+        """Tell the listener what changed; no names at all just says the index is still current"""
+        if self.listener is not None:
+            self.listener(names, added, removed)
+
+    def _refetch(self, vcenter, name):
+        """Check vCenter for a network missing from the index
+
+        :Returns: vim.Network, or None
+        """
+        network = self.fetch_one(vcenter, name)
+        if network is not None:
+            self.apply([('enter', network, name)])
+            return network
+        if self.clock() - self._fetched > self.miss_interval:
+            # the network might live in a sub-folder that fetch_one doesn't search
+            self.refresh(vcenter)
+            return self._by_name.get(name)
+        return None
+
+    def _watch_forever(self, connect, wait_seconds, lock_file=None):
+        """Body of the background thread that receives inventory changes"""
+        if lock_file is not None:
+            with elected(lock_file, wait_seconds):
+                self._watch_loop(connect, wait_seconds)
+        else:
+            self._watch_loop(connect, wait_seconds)
+
+    def _watch_loop(self, connect, wait_seconds):
+        """Watch for changes, reconnecting whenever the connection fails"""
+        while True:
+            try:
+                with connect() as vcenter:
+                    self._watch(vcenter, wait_seconds)
+            except Exception as doh:
+                # lookups reload the whole index every ttl seconds until the watcher is back
+                logger.warning('Network watcher lost its connection to vCenter: {}'.format(doh))
+            finally:
+                self._watching = False
+            time.sleep(wait_seconds)
+
+    def _watch(self, vcenter, wait_seconds):
+        """Apply network changes until the connection fails"""
+        content = vcenter.content
+        view = content.viewManager.CreateContainerView(content.rootFolder, [vim.Network], True)
+        collector = content.propertyCollector.CreatePropertyCollector()
+        collector.CreateFilter(inventory.filter_spec(view, vim.Network, ['name']), partialUpdates=False)
+        options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=wait_seconds)
+        version = ''
+        initial = {}
+        try:
+            while True:
+                update = collector.WaitForUpdatesEx(version, options)
+                if update is None:
+                    if self._watching:
+                        # nothing changed for wait_seconds; the index is still current
+                        self._publish(None)
+                    continue
+                version = update.version
+                changes = []
+                for filter_update in update.filterSet:
+                    for obj_update in filter_update.objectSet:
+                        name = None
+                        for change in obj_update.changeSet:
+                            if change.name == 'name':
+                                name = change.val
+                        changes.append((obj_update.kind, obj_update.obj, name))
+                if not self._watching:
+                    # The first updates (maybe split over several calls) are
+                    # the whole inventory; swap it in all at once
+                    initial.update({name: obj for kind, obj, name in changes if kind != 'leave'})
+                    if not update.truncated:
+                        with self._lock:
+                            self._by_name = initial
+                            self._by_moid = {x._moId: name for name, x in initial.items()}
+                            self._fetched = self.clock()
+                        self._watching = True
+                        self._publish(list(initial))
+                else:
+                    self.apply(changes)
+        finally:
+            collector.DestroyPropertyCollector()
+            view.Destroy()
+
+
+_INDEXES = {}
+_INDEXES_LOCK = threading.Lock()
+
+
+def get_index(server):
+    """Obtain the worker's network index for a vCenter server
+
+    :Returns: NetworkIndex
+
+    :param server: The vCenter server
+    :type server: String
+    """
+    with _INDEXES_LOCK:
+        if server not in _INDEXES:
+            _INDEXES[server] = NetworkIndex(ttl=const.VLAB_ESRS_NETWORK_INDEX_TTL,
+                                            listener=partial(_share, server))
+        return _INDEXES[server]
+
+
+def _share(server, names, added=(), removed=()):
+    """Record the networks of a vCenter in the metadata index, for the API to validate creates with
+
+    The catalog is only a hint for the API; failing to update it must not fail a lookup.
+    """
+    try:
+        index = metadata.get_index()
+        if names is not None:
+            index.replace_catalog(metadata.NETWORK, server, names)
+        else:
+            index.update_catalog(metadata.NETWORK, server, added, removed)
+    except (sqlite3.Error, OSError):
+        pass
+
+
+def lookup(vcenter, name, server=None):
+    """Find a network by name
+
+    :Returns: vim.Network
+
+    :Raises: KeyError if no network has that name
+
+    :param vcenter: The caller's connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param name: The name of the network
+    :type name: String
+
+    :param server: The vCenter server ``vcenter`` is connected to
+    :type server: String
+    """
+    return get_index(server).lookup(vcenter, name)
+
+
+def name_of(vcenter, network, server=None):
+    """Find the name of a network
+
+    :Returns: String, or None
+
+    :param vcenter: The caller's connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param network: The network
+    :type network: vim.Network
+
+    :param server: The vCenter server ``vcenter`` is connected to
+    :type server: String
+    """
+    return get_index(server).name_of(vcenter, network)
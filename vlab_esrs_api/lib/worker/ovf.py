@@ -0,0 +1,247 @@
+# -*- coding: UTF-8 -*-
+"""
+Deploys an OVA to vCenter.
+
+This does the same job as ``virtual_machine.deploy_from_ova`` from
+vlab_inf_common (including powering the new VM on), but owns the upload of the disks so the bytes can be hashed
+(and the upload cancelled) as they stream to the ESXi host.
+"""
+import os
+import ssl
+import time
+import tarfile
+import http.client
+from urllib.parse import urlparse
+
+from pyVmomi import vmodl
+from vlab_inf_common.vmware import vim, consume_task, virtual_machine
+
+from vlab_esrs_api.lib import const, cancel
+from vlab_esrs_api.lib.worker import integrity, admission, placement, import_spec
+
+CHUNK_SIZE = 1024 * 1024
+LEASE_PROGRESS_INTERVAL = 30
+LEASE_TIMEOUT = 300
+
+
+def deploy_from_ova(vcenter, ova_path, network_map, username, machine_name, logger, force_verify=False,
+                    on_queued=None, server=None, cancelled=None, timings=None, power_on=True):
+    """Create a new VM from an OVA
+
+    :Returns: vim.VirtualMachine
+
+    :Raises: ValueError if vCenter rejects the OVA, integrity.IntegrityError
+             if the OVA doesn't match its manifest, or cancel.Cancelled
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param ova_path: The location of the OVA to deploy
+    :type ova_path: String
+
+    :param network_map: The mapping of networks defined in the OVA to vCenter networks
+    :type network_map: List of vim.OvfManager.NetworkMapping
+
+    :param username: The owner of the new VM
+    :type username: String
+
+    :param machine_name: The name of the new VM
+    :type machine_name: String
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+
+    :param force_verify: Set to True to check the OVA's manifest even if it was verified before
+    :type force_verify: Boolean
+
+    :param on_queued: Called with the place in line while waiting for a turn to upload
+    :type on_queued: Callable
+
+    :param server: The vCenter server ``vcenter`` is connected to
+    :type server: String
+
+    :param cancelled: Returns True if the import should stop; checked between chunks of the upload
+    :type cancelled: Callable
+
+    :param timings: Filled in with the seconds spent preparing the import spec, and uploading the disks
+    :type timings: Dictionary
+
+    :param power_on: Set to True to have the VM powered on after deployment. Default True
+    :type power_on: Boolean
+    """
+    cancelled = cancelled or (lambda: False)
+    timings = {} if timings is None else timings
+    with tarfile.open(ova_path) as ova:
+        started = time.time()
+        descriptor = import_spec.descriptor(ova_path)
+        timings['spec'] = time.time() - started
+        verifier = None
+        if integrity.needs_verification(ova_path, force=force_verify):
+            logger.info('Verifying {} while it uploads'.format(ova_path))
+            verifier = integrity.Verifier(ova_path, _read_member(ova, '.mf'))
+            if not verifier.wants(descriptor.name):
+                raise integrity.IntegrityError('OVA descriptor {} is not listed in its manifest'.format(descriptor.name))
+            verifier.update(descriptor.name, descriptor.text.encode())
+
+        folder = vcenter.get_by_name(name=username, vimtype=vim.Folder)
+        resource_pool = vcenter.resource_pools[const.INF_VCENTER_RESORUCE_POOL]
+        datastore_name, host_name = placement.get_engine(server).choose(vcenter, os.path.getsize(ova_path))
+        logger.info('Deploying to datastore {} on host {}'.format(datastore_name, host_name))
+        datastore = vcenter.datastores[datastore_name]
+        host = vcenter.host_systems[host_name]
+        started = time.time()
+        spec, file_items, cached = import_spec.import_spec(vcenter, ova_path, resource_pool, datastore,
+                                                           machine_name, network_map)
+        timings['spec'] += time.time() - started
+        logger.info('Prepared the import spec in {:.2f} seconds{}'.format(timings['spec'],
+                                                                         ' (cached)' if cached else ''))
+
+        datastore_slot = 'datastore:{}'.format(datastore.name)
+        with admission.admit([datastore_slot, 'host:{}'.format(host.name)], on_queued=on_queued,
+                             cancelled=cancelled):
+            lease = resource_pool.ImportVApp(spec, folder, host)
+            _wait_for_lease(lease)
+            try:
+                started = time.time()
+                sent = _upload_disks(lease, file_items, ova, verifier, logger, cancelled)
+                timings['upload'] = time.time() - started
+                logger.info('Uploaded {} bytes in {:.2f} seconds'.format(sent, timings['upload']))
+                admission.record_throughput(datastore_slot, sent, timings['upload'])
+                if verifier is not None:
+                    _hash_remaining(ova, verifier)
+                    verifier.check()
+            except BaseException as doh:
+                logger.error('Aborting import of {}: {}'.format(machine_name, doh))
+                entity = lease.info.entity
+                lease.HttpNfcLeaseAbort()
+                destroy_partial(entity, logger)
+                raise
+            # the lease's info isn't reliable once it's complete
+            the_vm = lease.info.entity
+            lease.HttpNfcLeaseComplete()
+    if power_on:
+        logger.debug("Powering on {}'s new VM {}".format(username, machine_name))
+        virtual_machine.power(the_vm, state='on')
+    return the_vm
+
+
+def _wait_for_lease(lease):
+    """Block until the import lease is ready for the disks to be uploaded
+
+    :Raises: ValueError if vCenter fails to create the lease, or takes longer than ``LEASE_TIMEOUT``
+    """
+    deadline = time.time() + LEASE_TIMEOUT
+    while lease.state == vim.HttpNfcLease.State.initializing:
+        if time.time() >= deadline:
+            try:
+                lease.HttpNfcLeaseAbort()
+            except Exception:
+                pass
+            raise ValueError('Unable to import OVA: vCenter took over {} seconds to start the import'.format(LEASE_TIMEOUT))
+        time.sleep(1)
+    if lease.state == vim.HttpNfcLease.State.error:
+        raise ValueError('Unable to import OVA: {}'.format(lease.error.msg))
+
+
+def destroy_partial(the_vm, logger):
+    """Delete a VM left behind by an import that didn't finish
+
+    vCenter normally removes it when the lease is aborted, so the VM being
+    gone already is fine.
+
+    :Returns: None
+    """
+    if the_vm is None:
+        return
+    try:
+        consume_task(the_vm.Destroy_Task())
+    except vmodl.fault.ManagedObjectNotFound:
+        pass
+    except Exception as doh:
+        logger.error('Unable to destroy partially created VM: {}'.format(doh))
+
+
+def _upload_disks(lease, file_items, ova, verifier, logger, cancelled):
+    """Stream each disk from the OVA to the ESXi host named in the lease
+
+    :Returns: Integer - the number of bytes uploaded
+
+    :Raises: cancel.Cancelled if ``cancelled`` returns True between chunks
+    """
+    items = {x.deviceId: x for x in file_items}
+    total = sum(ova.getmember(x.path).size for x in file_items) or 1
+    sent = 0
+    last_progress = time.time()
+    for device_url in lease.info.deviceUrl:
+        item = items[device_url.importKey]
+        member = ova.getmember(item.path)
+        logger.debug('Uploading {}'.format(item.path))
+        conn, response = _open_upload(device_url.url, member.size, item.create)
+        try:
+            disk = ova.extractfile(member)
+            for chunk in iter(lambda: disk.read(CHUNK_SIZE), b''):
+                if cancelled():
+                    raise cancel.Cancelled('Cancelled after uploading {} of {} bytes'.format(sent, total))
+                if verifier is not None:
+                    verifier.update(item.path, chunk)
+                conn.send(chunk)
+                sent += len(chunk)
+                if time.time() - last_progress > LEASE_PROGRESS_INTERVAL:
+                    lease.HttpNfcLeaseProgress(int(sent * 100 / total))
+                    last_progress = time.time()
+            resp = response()
+            if resp.status not in (200, 201):
+                raise ValueError('Upload of {} failed: HTTP {} {}'.format(item.path, resp.status, resp.reason))
+        finally:
+            conn.close()
+    return sent
+
+
+def _open_upload(url, size, create):
+    """Start the HTTP request that a disk is streamed over
+
+    :Returns: Tuple - (http.client.HTTPSConnection, callable that returns the response)
+    """
+    parsed = urlparse(url)
+    context = ssl._create_unverified_context()
+    conn = http.client.HTTPSConnection(parsed.hostname, parsed.port or 443, context=context)
+    conn.putrequest('PUT' if create else 'POST', parsed.path + ('?' + parsed.query if parsed.query else ''))
+    conn.putheader('Content-Type', 'application/x-vnd.vmware-streamVmdk')
+    conn.putheader('Content-Length', str(size))
+    conn.endheaders()
+    return conn, conn.getresponse
+
+
+def _hash_remaining(ova, verifier):
+    """Hash any files in the manifest that were not part of the upload"""
+    for name in verifier.manifest:
+        if name in verifier.seen:
+            continue
+        try:
+            member = ova.getmember(name)
+        except KeyError:
+            raise integrity.IntegrityError('File {} from the manifest is missing in the OVA'.format(name))
+        the_file = ova.extractfile(member)
+        for chunk in iter(lambda: the_file.read(CHUNK_SIZE), b''):
+            verifier.update(name, chunk)
+
+
+def _member_name(ova, extension):
+    """Find the file in the OVA with the given extension
+
+    :Returns: String
+
+    :Raises: ValueError if the OVA doesn't contain such a file
+    """
+    for name in ova.getnames():
+        if name.endswith(extension):
+            return name
+    raise ValueError('OVA does not contain a {} file'.format(extension))
+
+
+def _read_member(ova, extension):
+    """Read a (small) text file out of the OVA, like the descriptor or manifest
+
+    :Returns: String
+    """
+    return ova.extractfile(_member_name(ova, extension)).read().decode()
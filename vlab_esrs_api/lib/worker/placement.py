@@ -0,0 +1,216 @@
+# -*- coding: UTF-8 -*-
+"""
+Chooses the datastore and ESXi host a new ESRS instance is deployed to.
+
+Capacity stats are fetched from vCenter in the background and cached, so a
+deploy never waits on them. Between refreshes, every placement is charged
+against the cached stats; otherwise every deploy would pick the same "best"
+datastore until the next refresh.
+"""
+import time
+import random
+import threading
+
+from vlab_api_common import get_logger
+
+from vlab_esrs_api.lib import const
+from vlab_esrs_api.lib.worker import admission
+from vlab_esrs_api.lib.worker.state import elected
+
+logger = get_logger(__name__, loglevel=const.VLAB_ESRS_LOG_LEVEL)
+
+# How much a running import counts against a datastore/host, relative to a
+# completely full datastore or a host with that many VMs
+IMPORT_WEIGHT = 0.1
+HOST_IMPORT_VMS = 5
+
+
+def fetch_stats(vcenter):
+    """Obtain the current capacity of every datastore and host
+
+    :Returns: Dictionary
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+    """
+    datastores = {}
+    for name, datastore in vcenter.datastores.items():
+        summary = datastore.summary
+        datastores[name] = {'free': summary.freeSpace,
+                            'capacity': summary.capacity,
+                            'accessible': summary.accessible}
+    hosts = {}
+    for name, host in vcenter.host_systems.items():
+        runtime = host.runtime
+        hosts[name] = {'vms': len(host.vm),
+                       'usable': runtime.connectionState == 'connected' and not runtime.inMaintenanceMode,
+                       'datastores': [x.name for x in host.datastore]}
+    return {'datastores': datastores, 'hosts': hosts}
+
+
+class PlacementEngine(object):
+    """Picks where to deploy, using cached capacity stats
+
+    :param datastores: The names of the datastores ESRS may be deployed to
+    :type datastores: List
+
+    :param ttl: How many seconds the stats are good for
+    :type ttl: Integer
+
+    :param policy: Either 'weighted' (spread deploys randomly, favoring the
+                   best candidates) or 'deterministic' (always pick the best)
+    :type policy: String
+
+    :param fetch: Returns the stats, given a connection to vCenter
+    :type fetch: Callable
+
+    :param load: Returns the number of running imports to a resource, like datastore:VM-Storage
+    :type load: Callable
+
+    :param clock: Returns the current time in seconds
+    :type clock: Callable
+    """
+    def __init__(self, datastores, ttl, policy='weighted', fetch=fetch_stats, load=None, clock=time.time):
+        self.datastores = datastores
+        self.ttl = ttl
+        self.policy = policy
+        self.fetch = fetch
+        self.load = load or (lambda resource: 0)
+        self.clock = clock
+        self._stats = None
+        self._fetched = 0
+        self._lock = threading.Lock()
+        self._refresher = None
+
+    def refresh(self, vcenter):
+        """Replace the cached stats with fresh ones from vCenter
+
+        :Returns: None
+        """
+        stats = self.fetch(vcenter)
+        with self._lock:
+            self._stats = stats
+            self._fetched = self.clock()
+
+    def start_refresher(self, connect, lock_file=None):
+        """Keep the stats fresh from a background thread
+
+        :Returns: None
+
+        :param connect: Returns a new connection to vCenter, usable as a context manager
+        :type connect: Callable
+
+        :param lock_file: Only refresh while holding this lock, so one process
+                          refreshes for the whole node. The rest fall back to
+                          refreshing from ``choose``.
+        :type lock_file: String
+        """
+        if self._refresher is not None and self._refresher.is_alive():
+            return
+        self._refresher = threading.Thread(target=self._refresh_forever, args=(connect, lock_file), daemon=True)
+        self._refresher.start()
+
+    def choose(self, vcenter, needed_bytes):
+        """Pick the datastore and host for a new VM
+
+        :Returns: Tuple - (datastore name, host name)
+
+        :Raises: ValueError if no datastore has room, or no host can use it
+
+        :param vcenter: The caller's connection to vCenter; only used when the stats are too old
+        :type vcenter: vlab_inf_common.vmware.vCenter
+
+        :param needed_bytes: Roughly how much space the new VM needs
+        :type needed_bytes: Integer
+        """
+        if self._stats is None or self.clock() - self._fetched > self.ttl * 3:
+            # the background refresh is stuck (or hasn't run yet); don't place blind
+            self.refresh(vcenter)
+        with self._lock:
+            datastore = self._pick(self._datastore_scores(needed_bytes))
+            if datastore is None:
+                raise ValueError('No datastore has room for a new ESRS instance')
+            host = self._pick(self._host_scores(datastore))
+            if host is None:
+                raise ValueError('No usable ESXi host can reach datastore {}'.format(datastore))
+            # charge the placement until the next refresh sees it for real
+            self._stats['datastores'][datastore]['free'] -= needed_bytes
+            self._stats['hosts'][host]['vms'] += 1
+        return datastore, host
+
+    def _datastore_scores(self, needed_bytes):
+        """Score the datastores with room for the VM; higher is better"""
+        scores = {}
+        for name in self.datastores:
+            stats = self._stats['datastores'].get(name)
+            if not stats or not stats['accessible'] or stats['free'] <= needed_bytes:
+                continue
+            free_ratio = (stats['free'] - needed_bytes) / stats['capacity']
+            scores[name] = free_ratio - IMPORT_WEIGHT * self.load('datastore:{}'.format(name))
+        return scores
+
+    def _host_scores(self, datastore):
+        """Score the usable hosts that mount the datastore; higher is better"""
+        scores = {}
+        for name, stats in self._stats['hosts'].items():
+            if not stats['usable'] or datastore not in stats['datastores']:
+                continue
+            busy = stats['vms'] + HOST_IMPORT_VMS * self.load('host:{}'.format(name))
+            scores[name] = 1.0 / (1 + busy)
+        return scores
+
+    def _pick(self, scores):
+        """Select a candidate per the placement policy
+
+        :Returns: String, or None if there are no candidates
+        """
+        if not scores:
+            return None
+        if self.policy == 'deterministic':
+            return sorted(scores, key=lambda x: (-scores[x], x))[0]
+        names = sorted(scores)
+        floor = min(scores.values())
+        weights = [scores[x] - floor + 0.01 for x in names]
+        return random.choices(names, weights=weights)[0]
+
+    def _refresh_forever(self, connect, lock_file=None):
+        """Body of the background thread that refreshes the stats"""
+        if lock_file is not None:
+            with elected(lock_file, self.ttl):
+                self._refresh_loop(connect)
+        else:
+            self._refresh_loop(connect)
+
+    def _refresh_loop(self, connect):
+        """Refresh the stats every ``ttl`` seconds, forever"""
+        while True:
+            try:
+                with connect() as vcenter:
+                    self.refresh(vcenter)
+            except Exception as doh:
+                # choose() falls back to a synchronous refresh if this keeps failing
+                logger.warning('Unable to refresh placement stats: {}'.format(doh))
+            time.sleep(self.ttl)
+
+
+_ENGINES = {}
+_ENGINES_LOCK = threading.Lock()
+
+
+def get_engine(server):
+    """Obtain the worker's placement engine for a vCenter server
+
+    :Returns: PlacementEngine
+
+    :param server: The vCenter server
+    :type server: String
+    """
+    with _ENGINES_LOCK:
+        if server not in _ENGINES:
+            controller = admission.get_controller()
+            load = controller.holders if controller is not None else None
+            _ENGINES[server] = PlacementEngine(datastores=const.INF_VCENTER_DATASTORES.split(','),
+                                               ttl=const.VLAB_ESRS_PLACEMENT_TTL,
+                                               policy=const.VLAB_ESRS_PLACEMENT_POLICY,
+                                               load=load)
+        return _ENGINES[server]
@@ -0,0 +1,146 @@
+# -*- coding: UTF-8 -*-
+"""
+Power on, off, reboot or shut down many ESRS instances at once.
+
+Every VM's call to vCenter is issued in parallel on the caller's session, and
+then the resulting tasks are waited on together with a single
+PropertyCollector (see ``inventory.wait_for``), instead of one VM at a time.
+
+A guest shutdown asks VMware Tools to shut the OS down cleanly. VMs that
+can't (no Tools, or not running), or that are still running after
+``VLAB_ESRS_SHUTDOWN_TIMEOUT`` seconds, are powered off.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+from vlab_inf_common.vmware import vim
+
+from vlab_esrs_api.lib import const
+from vlab_esrs_api.lib.worker import inventory, listing
+
+ACTIONS = ('on', 'off', 'reboot', 'shutdown')
+VM_PROPERTIES = ['name', 'config.annotation', 'runtime.powerState']
+POWERED_ON = vim.VirtualMachinePowerState.poweredOn
+POWERED_OFF = vim.VirtualMachinePowerState.poweredOff
+FINISHED = (vim.TaskInfo.State.success, vim.TaskInfo.State.error)
+
+
+def find_esrs(vcenter, folder):
+    """Find the ESRS instances in a user's folder, and their power state
+
+    :Returns: Dictionary - machine name -> (vim.VirtualMachine, power state)
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param folder: The user's folder
+    :type folder: vim.Folder
+    """
+    found = {}
+    for vm, props in inventory.retrieve(vcenter, vim.VirtualMachine, VM_PROPERTIES, container=folder):
+        if listing.parse_meta(props.get('config.annotation'))['component'] == 'ESRS':
+            found[props['name']] = (vm, props.get('runtime.powerState'))
+    return found
+
+
+def power(vcenter, vms, action, logger):
+    """Change the power state of several VMs
+
+    :Returns: Dictionary - machine name -> None on success, or an error message
+
+    :Raises: ValueError for unknown actions
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param vms: The output of ``find_esrs``; machine name -> (vim.VirtualMachine, power state)
+    :type vms: Dictionary
+
+    :param action: One of 'on', 'off', 'reboot' or 'shutdown'
+    :type action: String
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    if action not in ACTIONS:
+        raise ValueError('Unknown power action: {}'.format(action))
+    results = {name: None for name in vms}
+    if action == 'on':
+        todo = {name: vm for name, (vm, state) in vms.items() if state != POWERED_ON}
+        results.update(_run_tasks(vcenter, todo, lambda vm: vm.PowerOnVM_Task()))
+    elif action == 'off':
+        todo = {name: vm for name, (vm, state) in vms.items() if state != POWERED_OFF}
+        results.update(_run_tasks(vcenter, todo, lambda vm: vm.PowerOffVM_Task()))
+    elif action == 'reboot':
+        todo = {}
+        for name, (vm, state) in vms.items():
+            if state == POWERED_ON:
+                todo[name] = vm
+            else:
+                results[name] = 'Unable to reboot {}; it is not powered on'.format(name)
+        results.update(_run_tasks(vcenter, todo, lambda vm: vm.ResetVM_Task()))
+    else:
+        todo = {name: vm for name, (vm, state) in vms.items() if state != POWERED_OFF}
+        results.update(_shutdown(vcenter, todo, logger))
+    return results
+
+
+def _shutdown(vcenter, vms, logger):
+    """Shut down the guest OS of each VM, and power off the ones that don't shut down
+
+    :Returns: Dictionary - machine name -> None on success, or an error message
+    """
+    asked = _issue(vms, lambda vm: vm.ShutdownGuest())
+    force = {name: vms[name] for name, outcome in asked.items() if isinstance(outcome, Exception)}
+    for name in force:
+        logger.info('Unable to shut down the guest OS of {}: {}'.format(name, asked[name]))
+    waiting = {name: vm for name, vm in vms.items() if name not in force}
+    states = inventory.wait_for(vcenter, list(waiting.values()), 'runtime.powerState',
+                                lambda state: state == POWERED_OFF, timeout=const.VLAB_ESRS_SHUTDOWN_TIMEOUT)
+    for name, vm in waiting.items():
+        if states.get(vm._moId) != POWERED_OFF:
+            logger.info('The guest OS of {} did not shut down in time'.format(name))
+            force[name] = vm
+    results = {name: None for name in vms}
+    if force:
+        logger.info('Powering off {}'.format(', '.join(sorted(force))))
+        results.update(_run_tasks(vcenter, force, lambda vm: vm.PowerOffVM_Task()))
+    return results
+
+
+def _run_tasks(vcenter, vms, call):
+    """Start a vCenter task for each VM in parallel, then wait for all of them
+
+    :Returns: Dictionary - machine name -> None on success, or an error message
+    """
+    started = _issue(vms, call)
+    results = {name: '{}'.format(outcome) for name, outcome in started.items() if isinstance(outcome, Exception)}
+    tasks = {name: task for name, task in started.items() if name not in results}
+    infos = inventory.wait_for(vcenter, list(tasks.values()), 'info',
+                               lambda info: info.state in FINISHED, timeout=const.VLAB_ESRS_POWER_TIMEOUT)
+    for name, task in tasks.items():
+        info = infos.get(task._moId)
+        if info is None or info.state not in FINISHED:
+            results[name] = 'Timed out waiting on vCenter'
+        elif info.state == vim.TaskInfo.State.error:
+            results[name] = '{}'.format(info.error.msg)
+        else:
+            results[name] = None
+    return results
+
+
+def _issue(vms, call):
+    """Make a call to vCenter for each VM, in parallel
+
+    :Returns: Dictionary - machine name -> what the call returned, or the Exception it raised
+    """
+    outcomes = {}
+    if not vms:
+        return outcomes
+    with ThreadPoolExecutor(max_workers=const.VLAB_ESRS_PARALLEL_OPS) as executor:
+        futures = {name: executor.submit(call, vm) for name, vm in vms.items()}
+        for name, future in futures.items():
+            try:
+                outcomes[name] = future.result()
+            except Exception as doh:
+                outcomes[name] = doh
+    return outcomes
@@ -0,0 +1,116 @@
+# -*- coding: UTF-8 -*-
+"""
+Warms the worker before its pool forks, so the children share the memory.
+
+A prefork child is a copy-on-write copy of the worker's parent process. Most
+of the per-child memory was things each child built for itself after the
+fork; pyVmomi loads its vSphere types lazily, the first time a task uses them,
+and the OVF descriptors and the hash ring of vCenter servers are cached on
+first use. ``warm`` builds all of those once, in the parent.
+
+Even objects the children only read get copied, once the children's garbage
+collector walks them. ``warm`` finishes with ``gc.freeze``, which moves every
+object the parent has made so far out of reach of the collector, so the pages
+holding them stay shared. The collector is disabled while warming, so freeing
+temporary objects doesn't leave holes in those pages.
+
+Set ``VLAB_ESRS_WORKER_PRELOAD=0`` to skip it. It's also skipped on Python
+3.6, which has no ``gc.freeze``; preloading without freezing leaves every
+child with more memory than not preloading at all.
+"""
+import gc
+import os
+import sys
+import time
+
+from pyVmomi import VmomiSupport
+from vlab_api_common import get_logger
+
+from vlab_esrs_api.lib import const
+from vlab_esrs_api.lib.worker import image_cache, import_spec, shards
+
+
+logger = get_logger(__name__, loglevel=const.VLAB_ESRS_LOG_LEVEL)
+
+
+def warm():
+    """Load everything the tasks share, then freeze it
+
+    :Returns: Dictionary - what was loaded, and how long it took; empty if it was skipped
+    """
+    if not hasattr(gc, 'freeze'):
+        logger.warning('Not preloading the worker; Python {}.{} has no gc.freeze'.format(*sys.version_info[:2]))
+        return {}
+    start = time.time()
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        loaded = {'types': vsphere_types(),
+                  'images': image_catalog(),
+                  'servers': configuration()}
+    finally:
+        gc.freeze()
+        if enabled:
+            gc.enable()
+    loaded['frozen'] = gc.get_freeze_count()
+    loaded['seconds'] = round(time.time() - start, 3)
+    logger.info('Preloaded {types} vSphere types, {images} images and {servers} vCenter servers '
+                'in {seconds}s; froze {frozen} objects'.format(**loaded))
+    return loaded
+
+
+def vsphere_types():
+    """Load every vSphere type pyVmomi knows about
+
+    :Returns: Integer - how many types were loaded
+    """
+    names = VmomiSupport.ListManagedTypes() + VmomiSupport.ListDataTypes() + VmomiSupport.ListEnumTypes()
+    for name in names:
+        VmomiSupport.GetVmodlType(name)
+    return len(names)
+
+
+def image_catalog():
+    """Read the OVF descriptor of every image, and of every image in the local cache
+
+    :Returns: Integer - how many descriptors were read
+    """
+    paths = _ovas(const.VLAB_ESRS_IMAGES_DIR)
+    cache = image_cache.get_cache()
+    if cache is not None:
+        paths += cache.cached()
+    count = 0
+    for path in paths:
+        try:
+            import_spec.descriptor(path)
+        except (OSError, ValueError) as doh:
+            # a missing or broken image is reported when someone deploys it
+            logger.warning('Unable to preload {}: {}'.format(path, doh))
+        else:
+            count += 1
+    return count
+
+
+def configuration():
+    """Build the hash ring of the configured vCenter servers
+
+    :Returns: Integer - how many vCenter servers are configured
+    """
+    try:
+        return len(shards.ring().servers)
+    except ValueError as doh:
+        logger.warning('Unable to preload the vCenter servers: {}'.format(doh))
+        return 0
+
+
+def _ovas(directory):
+    """Find the OVAs in a directory
+
+    :Returns: List
+    """
+    try:
+        names = sorted(os.listdir(directory))
+    except OSError as doh:
+        logger.warning('Unable to list images in {}: {}'.format(directory, doh))
+        return []
+    return [os.path.join(directory, x) for x in names if x.endswith('.ova')]
@@ -0,0 +1,209 @@
+# -*- coding: UTF-8 -*-
+"""
+Finds ESRS instances that are too old, or have sat idle too long.
+
+Every user folder under ``INF_VCENTER_TOP_LVL_DIR`` is read in one
+PropertyCollector traversal, instead of one folder (and one VM) at a time.
+
+vCenter doesn't record when a VM was last busy, so each sweep notes which VMs
+are using CPU in ``VLAB_ESRS_REAPER_STATE``; a VM is idle once it hasn't been
+seen busy (or at all) for ``VLAB_ESRS_REAPER_MAX_IDLE_DAYS``.
+
+The API writes the opt-outs (``VLAB_ESRS_REAPER_OPT_OUT``) and the workers
+read them, so both files belong on a volume the API and the workers share.
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from vlab_inf_common.vmware import vim, virtual_machine, consume_task
+
+from vlab_esrs_api.lib import const
+from vlab_esrs_api.lib.worker import inventory, listing
+from vlab_esrs_api.lib.worker.state import locked, load_json, save_json
+
+DAY = 86400
+VM_PROPERTIES = ['name', 'parent', 'config.annotation', 'runtime.powerState',
+                 'summary.quickStats.overallCpuUsage']
+FOLDER_PROPERTIES = ['name', 'parent']
+
+
+class Candidate(object):
+    """An ESRS instance the reaper wants to reclaim
+
+    :param username: The user who owns the VM
+    :type username: String
+
+    :param vm: The virtual machine
+    :type vm: vim.VirtualMachine
+
+    :param name: The name of the VM
+    :type name: String
+
+    :param reason: Why the VM is being reclaimed; either 'age' or 'idle'
+    :type reason: String
+
+    :param powered_on: If the VM is running
+    :type powered_on: Boolean
+    """
+    def __init__(self, username, vm, name, reason, powered_on):
+        self.username = username
+        self.vm = vm
+        self.name = name
+        self.reason = reason
+        self.powered_on = powered_on
+
+
+def sweep(vcenter, server, now=None):
+    """Find the ESRS instances to reclaim
+
+    :Returns: List of Candidate
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param server: The vCenter server ``vcenter`` is connected to
+    :type server: String
+
+    :param now: The current time, in seconds since the epoch
+    :type now: Float
+    """
+    now = now or time.time()
+    top = vcenter.get_by_name(name=const.INF_VCENTER_TOP_LVL_DIR, vimtype=vim.Folder)
+    opted_out = set(opt_outs())
+    folders = {}
+    vms = []
+    for obj, props in inventory.retrieve_many(vcenter,
+                                              {vim.Folder: FOLDER_PROPERTIES, vim.VirtualMachine: VM_PROPERTIES},
+                                              container=top):
+        if isinstance(obj, vim.Folder):
+            if props.get('parent') is not None and props['parent']._moId == top._moId:
+                folders[obj._moId] = props['name']
+        else:
+            vms.append((obj, props))
+    esrs = []
+    for vm, props in vms:
+        parent = props.get('parent')
+        username = folders.get(parent._moId) if parent is not None else None
+        if username is None or username in opted_out:
+            continue
+        meta = listing.parse_meta(props.get('config.annotation'))
+        if meta.get('component') == 'ESRS':
+            esrs.append((username, vm, props, meta))
+    last_busy = _record_activity(server, esrs, now)
+    candidates = []
+    for username, vm, props, meta in esrs:
+        reason = _reason(meta, last_busy[vm._moId], now)
+        if reason:
+            powered_on = props.get('runtime.powerState') == 'poweredOn'
+            candidates.append(Candidate(username, vm, props['name'], reason, powered_on))
+    return candidates
+
+
+def reclaim(candidates, action, dry_run=True):
+    """Power off or delete the ESRS instances, in parallel
+
+    :Returns: Dictionary - username -> {machine name: {'reason', 'action', 'error'}}
+
+    :param candidates: The output of ``sweep``
+    :type candidates: List
+
+    :param action: Either 'off' or 'delete'
+    :type action: String
+
+    :param dry_run: Set to False to actually power off/delete the VMs
+    :type dry_run: Boolean
+    """
+    if action not in ('off', 'delete'):
+        raise ValueError('Unknown reaper action: {}'.format(action))
+    report = {}
+    todo = {}
+    for candidate in candidates:
+        if action == 'off' and not candidate.powered_on:
+            # nothing left to reclaim
+            continue
+        report.setdefault(candidate.username, {})[candidate.name] = {'reason': candidate.reason,
+                                                                     'action': action,
+                                                                     'error': None}
+        todo[(candidate.username, candidate.name)] = candidate
+    if dry_run or not todo:
+        return report
+    with ThreadPoolExecutor(max_workers=const.VLAB_ESRS_PARALLEL_OPS) as executor:
+        futures = {key: executor.submit(_reclaim_one, candidate, action) for key, candidate in todo.items()}
+        for (username, name), future in futures.items():
+            try:
+                future.result()
+            except Exception as doh:
+                report[username][name]['error'] = '{}'.format(doh)
+    return report
+
+
+def opt_outs():
+    """The users whose ESRS instances are never reclaimed
+
+    :Returns: List
+    """
+    return load_json(const.VLAB_ESRS_REAPER_OPT_OUT, default=[])
+
+
+def set_opt_out(username, opt_out):
+    """Add or remove a user from the opt-out list
+
+    :Returns: None
+
+    :param username: The user
+    :type username: String
+
+    :param opt_out: Set to True to never reclaim the user's ESRS instances
+    :type opt_out: Boolean
+    """
+    path = const.VLAB_ESRS_REAPER_OPT_OUT
+    with locked('{}.lock'.format(path)):
+        users = set(load_json(path, default=[]))
+        if opt_out:
+            users.add(username)
+        else:
+            users.discard(username)
+        save_json(path, sorted(users))
+
+
+def _reclaim_one(candidate, action):
+    """Power off or delete one VM"""
+    if candidate.powered_on:
+        virtual_machine.power(candidate.vm, state='off')
+    if action == 'delete':
+        consume_task(candidate.vm.Destroy_Task())
+
+
+def _reason(meta, last_busy, now):
+    """Decide if a VM should be reclaimed
+
+    :Returns: String, or None to keep the VM
+    """
+    max_age = const.VLAB_ESRS_REAPER_MAX_AGE_DAYS * DAY
+    max_idle = const.VLAB_ESRS_REAPER_MAX_IDLE_DAYS * DAY
+    created = meta.get('created') or 0
+    if max_age and created and now - created > max_age:
+        return 'age'
+    if max_idle and now - last_busy > max_idle:
+        return 'idle'
+    return None
+
+
+def _record_activity(server, esrs, now):
+    """Note which VMs are busy now, and forget VMs that no longer exist
+
+    :Returns: Dictionary - moid -> the last time the VM was seen busy
+    """
+    path = const.VLAB_ESRS_REAPER_STATE
+    with locked('{}.lock'.format(path)):
+        state = load_json(path, default={})
+        previous = state.get(server, {})
+        last_busy = {}
+        for username, vm, props, meta in esrs:
+            busy = props.get('runtime.powerState') == 'poweredOn' and \
+                   (props.get('summary.quickStats.overallCpuUsage') or 0) >= const.VLAB_ESRS_REAPER_IDLE_MHZ
+            # the idle clock starts the first time the reaper sees a VM
+            last_busy[vm._moId] = now if busy else previous.get(vm._moId, now)
+        state[server] = last_busy
+        save_json(path, state)
+    return last_busy
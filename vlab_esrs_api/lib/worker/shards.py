@@ -0,0 +1,178 @@
+# -*- coding: UTF-8 -*-
+"""
+Spreads users over several vCenter servers.
+
+Each user lives on exactly one vCenter. Users are assigned with consistent
+hashing, so adding a vCenter only moves about 1/N of the users, and an
+override table can pin specific users to a specific vCenter (for example, to
+keep a user where their VMs are until they're migrated).
+"""
+import bisect
+import hashlib
+import threading
+from functools import lru_cache
+from contextlib import contextmanager
+
+from vlab_esrs_api.lib import const
+from vlab_esrs_api.lib.worker.state import locked, load_json, save_json
+
+REPLICAS = 100
+
+
+class HashRing(object):
+    """Consistent hashing of users to vCenter servers
+
+    :param servers: The vCenter servers
+    :type servers: List
+
+    :param replicas: How many points on the ring each server gets; more points spread users more evenly
+    :type replicas: Integer
+    """
+    def __init__(self, servers, replicas=REPLICAS):
+        if not servers:
+            raise ValueError('At least one vCenter server is required')
+        self.servers = list(servers)
+        points = []
+        for server in self.servers:
+            for replica in range(replicas):
+                points.append((_hash('{}#{}'.format(server, replica)), server))
+        points.sort()
+        self._keys = [x[0] for x in points]
+        self._servers = [x[1] for x in points]
+
+    def server_for(self, username):
+        """Find the vCenter a user is assigned to
+
+        :Returns: String
+
+        :param username: The user
+        :type username: String
+        """
+        index = bisect.bisect(self._keys, _hash(username)) % len(self._keys)
+        return self._servers[index]
+
+
+def _hash(key):
+    """Map a string to a point on the ring
+
+    :Returns: Integer
+    """
+    return int(hashlib.md5(key.encode()).hexdigest()[:16], 16)
+
+
+def servers():
+    """The configured vCenter servers
+
+    :Returns: List
+    """
+    return [x.strip() for x in const.INF_VCENTER_SERVERS.split(',') if x.strip()]
+
+
+def overrides():
+    """The users pinned to a specific vCenter
+
+    :Returns: Dictionary - username -> vCenter server
+    """
+    if not const.VLAB_ESRS_VCENTER_OVERRIDES:
+        return {}
+    return load_json(const.VLAB_ESRS_VCENTER_OVERRIDES, default={})
+
+
+def server_for(username):
+    """Find the vCenter that holds a user's VMs
+
+    :Returns: String
+
+    :param username: The user
+    :type username: String
+    """
+    pinned = overrides().get(username)
+    if pinned:
+        return pinned
+    return ring().server_for(username)
+
+
+def ring():
+    """The hash ring of the configured vCenter servers
+
+    :Returns: HashRing
+    """
+    return _ring(tuple(servers()))
+
+
+@lru_cache(maxsize=8)
+def _ring(servers):
+    """Build the ring once per set of servers"""
+    return HashRing(servers)
+
+
+_SLOTS = {}
+_SLOTS_LOCK = threading.Lock()
+
+
+@contextmanager
+def session_slot(server):
+    """Limit how many sessions this process opens to one vCenter at a time
+
+    :Returns: None
+
+    :param server: The vCenter server
+    :type server: String
+    """
+    with _SLOTS_LOCK:
+        if server not in _SLOTS:
+            _SLOTS[server] = threading.BoundedSemaphore(const.VLAB_ESRS_VCENTER_CONCURRENCY)
+        slot = _SLOTS[server]
+    with slot:
+        yield
+
+
+def plan_rebalance(usernames, old_servers, new_servers, pinned=None):
+    """Find the users whose vCenter changes when the set of servers changes
+
+    :Returns: Dictionary - username -> (old vCenter, new vCenter)
+
+    :param usernames: Every user with VMs
+    :type usernames: Iterable
+
+    :param old_servers: The vCenter servers in use now
+    :type old_servers: List
+
+    :param new_servers: The vCenter servers that will be used
+    :type new_servers: List
+
+    :param pinned: Users pinned to a vCenter; they never move
+    :type pinned: Dictionary
+    """
+    pinned = pinned or {}
+    old_ring = HashRing(old_servers)
+    new_ring = HashRing(new_servers)
+    moves = {}
+    for username in usernames:
+        if username in pinned:
+            continue
+        old = old_ring.server_for(username)
+        new = new_ring.server_for(username)
+        if old != new:
+            moves[username] = (old, new)
+    return moves
+
+
+def pin(assignments):
+    """Add users to the override table
+
+    :Returns: Dictionary - the whole override table
+
+    :Raises: ValueError if no override table is configured
+
+    :param assignments: username -> vCenter server
+    :type assignments: Dictionary
+    """
+    path = const.VLAB_ESRS_VCENTER_OVERRIDES
+    if not path:
+        raise ValueError('Set VLAB_ESRS_VCENTER_OVERRIDES to pin users to a vCenter')
+    with locked('{}.lock'.format(path)):
+        table = load_json(path, default={})
+        table.update(assignments)
+        save_json(path, table)
+    return table
@@ -0,0 +1,119 @@
+# -*- coding: UTF-8 -*-
+"""
+Helpers for sharing small bits of state between worker processes via files.
+
+The Celery worker forks several processes, and a node may run several worker
+containers that share a volume. These helpers give them a common, crash-safe
+way to coordinate: an ``flock`` based lock, and JSON documents that are
+replaced atomically.
+"""
+import os
+import json
+import time
+import fcntl
+import tempfile
+from contextlib import contextmanager
+
+
+@contextmanager
+def locked(lock_file, shared=False, blocking=True):
+    """Hold an advisory lock on a file for the life of the context
+
+    :Returns: Boolean - True if the lock was obtained
+
+    :Raises: BlockingIOError when ``blocking`` is False and the lock is held
+
+    :param lock_file: The path to the file to lock. It's created if needed.
+    :type lock_file: String
+
+    :param shared: Set to True to obtain a shared (reader) lock
+    :type shared: Boolean
+
+    :param blocking: Set to False to fail right away if the lock is held
+    :type blocking: Boolean
+    """
+    mode = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+    if not blocking:
+        mode |= fcntl.LOCK_NB
+    fd = os.open(lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, mode)
+        try:
+            yield True
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
+
+
+@contextmanager
+def elected(lock_file, retry_seconds, sleep=time.sleep):
+    """Wait to be the one process holding a lock, then hold it for the life of the context
+
+    For work only one process should do at a time, like a long-lived watcher.
+    The lock is released when the process exits, so another process takes over
+    within ``retry_seconds`` of the holder dying.
+
+    :Returns: Boolean - True once elected
+
+    :param lock_file: The path to the file to lock. It's created if needed.
+    :type lock_file: String
+
+    :param retry_seconds: How long to wait between tries for the lock
+    :type retry_seconds: Integer
+
+    :param sleep: Waits for a number of seconds
+    :type sleep: Callable
+    """
+    fd = os.open(lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                sleep(retry_seconds)
+        yield True
+    finally:
+        # closing the file releases the lock
+        os.close(fd)
+
+
+def load_json(path, default=None):
+    """Read a JSON document, returning ``default`` if it's missing or corrupt
+
+    :Returns: Object
+
+    :param path: The file to read
+    :type path: String
+
+    :param default: What to return when the file cannot be read
+    :type default: Object
+    """
+    try:
+        with open(path) as the_file:
+            return json.load(the_file)
+    except (OSError, ValueError):
+        return default
+
+
+def save_json(path, data):
+    """Atomically replace a JSON document; readers never see a partial write
+
+    :Returns: None
+
+    :param path: The file to write
+    :type path: String
+
+    :param data: The object to serialize
+    :type data: Object
+    """
+    directory = os.path.dirname(path) or '.'
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'w') as the_file:
+            json.dump(data, the_file)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
@@ -2,17 +2,124 @@
 """
 Entry point logic for available backend worker tasks
 """
+import os
+import logging
+from threading import Thread
+from functools import partial
+
 from celery import Celery
+from celery.concurrency import thread
+from celery.signals import worker_init, worker_ready, worker_process_init, task_prerun, task_postrun
 from vlab_api_common import get_task_logger
 
-from vlab_esrs_api.lib import const
-from vlab_esrs_api.lib.worker import vmware
+from vlab_esrs_api.lib import const, encoding, results, cancel, profiling
+from vlab_esrs_api.lib.worker import vmware, image_cache, admission, placement, network_index, shards, reaper, preload
 
 app = Celery('esrs', backend='rpc://', broker=const.VLAB_MESSAGE_BROKER)
+encoding.configure(app)
+results.configure(app)
+# The tasks mostly wait on vCenter, so one process can run many of them with ``threads``
+app.conf.worker_pool = const.VLAB_ESRS_WORKER_POOL
+if const.VLAB_ESRS_WORKER_CONCURRENCY:
+    app.conf.worker_concurrency = const.VLAB_ESRS_WORKER_CONCURRENCY
+# The periodic tasks run from ``celery beat``
+app.conf.beat_schedule = {}
+if const.VLAB_ESRS_REAPER_INTERVAL:
+    app.conf.beat_schedule['esrs-reap'] = {'task': 'esrs.reap',
+                                           'schedule': const.VLAB_ESRS_REAPER_INTERVAL,
+                                           'args': [bool(const.VLAB_ESRS_REAPER_DRY_RUN), 'reaper']}
+if const.VLAB_ESRS_METADATA_RECONCILE_INTERVAL:
+    app.conf.beat_schedule['esrs-reconcile-metadata'] = {'task': 'esrs.reconcile_metadata',
+                                                         'schedule': const.VLAB_ESRS_METADATA_RECONCILE_INTERVAL,
+                                                         'args': ['reconcile']}
+if const.VLAB_ESRS_RESULT_CLEANUP_INTERVAL and const.VLAB_ESRS_RESULT_BACKEND.startswith(results.SCHEME):
+    # replaces the default entry, which only runs once a day
+    app.conf.beat_schedule['celery.backend_cleanup'] = {'task': 'celery.backend_cleanup',
+                                                        'schedule': const.VLAB_ESRS_RESULT_CLEANUP_INTERVAL}
+
+
+@worker_init.connect
+def preload_worker(**kwargs):
+    """Load what the tasks share before the pool forks, so the children share the memory"""
+    if const.VLAB_ESRS_WORKER_PRELOAD:
+        preload.warm()
+
+
+@worker_ready.connect
+def prefetch_images(**kwargs):
+    """Warm the local image cache without delaying the worker from taking tasks"""
+    Thread(target=image_cache.prefetch, daemon=True).start()
+
+
+@worker_process_init.connect
+def start_refreshers(**kwargs):
+    """Keep the cached inventory (capacity stats, networks) fresh
+
+    Every worker process starts the threads, but only one process per node
+    (the holder of the lock file) actually talks to vCenter; the others take
+    over if it dies.
+    """
+    lock_dir = const.VLAB_ESRS_REFRESHER_LOCK_DIR
+    os.makedirs(lock_dir, exist_ok=True)
+    for server in shards.servers():
+        placement.get_engine(server).start_refresher(partial(vmware.connect, server),
+                                                     lock_file=os.path.join(lock_dir, '{}-placement.lock'.format(server)))
+        # the watcher's session lives forever, so it mustn't hold one of the task's session slots
+        network_index.get_index(server).start_watcher(partial(vmware.connect, server, slot=False),
+                                                      lock_file=os.path.join(lock_dir, '{}-networks.lock'.format(server)))
+
+
+@worker_ready.connect
+def start_thread_pool_refreshers(sender=None, **kwargs):
+    """The ``threads`` pool runs tasks in the main process, which never gets ``worker_process_init``"""
+    if isinstance(getattr(sender, 'pool', None), thread.TaskPool):
+        start_refreshers()
+
+
+@task_prerun.connect
+def start_profile(task_id=None, task=None, args=None, kwargs=None, **extra):
+    """Profile the task if an admin asked for it, with the ``X-PROFILE`` header"""
+    if not task.request.get(profiling.HEADER):
+        return
+    txn_id = (kwargs or {}).get('txn_id') or (args[-1] if args else 'noId')
+    logger = get_task_logger(txn_id=txn_id, task_id=task_id, loglevel=const.VLAB_ESRS_LOG_LEVEL.upper())
+    try:
+        profile = profiling.start(task_id)
+    except (OSError, ValueError) as doh:
+        logger.error('Unable to profile task: {}'.format(doh))
+        return
+    if profile is None:
+        logger.warning('Already profiling {} tasks; running unprofiled'.format(const.VLAB_ESRS_PROFILE_MAX))
+        return
+    logger.info('Profiling task {}'.format(task.name))
+    task.request.esrs_profiling = (profile, logger)
+
+
+@task_postrun.connect
+def save_profile(task=None, **kwargs):
+    """Save the profile of the task, if it was profiled"""
+    profiled = getattr(task.request, 'esrs_profiling', None)
+    if profiled is None:
+        return
+    profile, logger = profiled
+    task.request.esrs_profiling = None
+    try:
+        logger.info('Saved profile to {}'.format(profile.stop()))
+    except OSError as doh:
+        logger.error('Unable to save profile: {}'.format(doh))
+
+
+@task_postrun.connect
+def forget_task_logger(task_id=None, **kwargs):
+    """``get_task_logger`` makes a logger named after each task, which ``logging`` keeps forever"""
+    logger = logging.Logger.manager.loggerDict.pop(task_id, None)
+    if isinstance(logger, logging.Logger):
+        for handler in logger.handlers:
+            handler.close()
 
 
 @app.task(name='esrs.show', bind=True)
-def show(self, username, txn_id):
+def show(self, username, txn_id, fields=None, limit=None, cursor=None):
     """Obtain basic information about ESRS
 
     :Returns: Dictionary
@@ -22,12 +129,25 @@ def show(self, username, txn_id):
 
     :param txn_id: A unique string supplied by the client to track the call through logs
     :type txn_id: String
+
+    :param fields: Comma separated field names to return, like "name,state,meta.version"
+    :type fields: String
+
+    :param limit: The most ESRS instances to return
+    :type limit: Integer
+
+    :param cursor: Continue from a previous page; see ``params.next_cursor`` in the response
+    :type cursor: String
     """
     logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_ESRS_LOG_LEVEL.upper())
     resp = {'content' : {}, 'error': None, 'params': {}}
     logger.info('Task starting')
     try:
-        info = vmware.show_esrs(username)
+        if fields or limit or cursor:
+            info, next_cursor = vmware.page_esrs(username, fields=fields, limit=limit, cursor=cursor)
+            resp['params']['next_cursor'] = next_cursor
+        else:
+            info = vmware.show_esrs(username)
     except ValueError as doh:
         logger.error('Task failed: {}'.format(doh))
         resp['error'] = '{}'.format(doh)
@@ -61,11 +181,28 @@ def create(self, username, machine_name, image, network, txn_id):
     logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_ESRS_LOG_LEVEL.upper())
     resp = {'content' : {}, 'error': None, 'params': {}}
     logger.info('Task starting')
+
+    def on_queued(position):
+        if position == 0:
+            logger.info('Admitted; starting the upload')
+            self.update_state(state='STARTED')
+        else:
+            logger.info('Waiting to upload; position {} in line'.format(position))
+            self.update_state(state='QUEUED', meta={'position': position})
+
+    cancelled = partial(cancel.requested, self.request.id, username)
+    timings = {}
     try:
-        resp['content'] = vmware.create_esrs(username, machine_name, image, network, logger)
+        if cancelled():
+            raise cancel.Cancelled('Cancelled before starting')
+        resp['content'] = vmware.create_esrs(username, machine_name, image, network, logger,
+                                             on_queued=on_queued, cancelled=cancelled, timings=timings)
+        resp['params']['timings'] = timings
     except ValueError as doh:
         logger.error('Task failed: {}'.format(doh))
         resp['error'] = '{}'.format(doh)
+    finally:
+        cancel.clear(self.request.id)
     logger.info('Task complete')
     return resp
 
@@ -120,12 +257,208 @@ def image(self, txn_id):
 
 @app.task(name='esrs.modify_network', bind=True)
 def modify_network(self, username, machine_name, new_network, txn_id):
-    """Change the network an ESRS instance is connected to"""
+    """Change the network an ESRS instance (or several) is connected to
+
+    :Returns: Dictionary
+
+    :param username: The name of the user who owns the ESRS instances
+    :type username: String
+
+    :param machine_name: The name of the ESRS instance, or a list of names
+    :type machine_name: String or List
+
+    :param new_network: The name of the network to connect to
+    :type new_network: String
+
+    :param txn_id: A unique string supplied by the client to track the call through logs
+    :type txn_id: String
+    """
+    logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_ESRS_LOG_LEVEL.upper())
+    resp = {'content' : {}, 'error': None, 'params': {}}
+    logger.info('Task starting')
+    try:
+        if isinstance(machine_name, list):
+            results = vmware.update_networks(username, machine_name, new_network)
+            resp['content'] = results
+            failed = [x for x in results if results[x]]
+            if failed:
+                resp['error'] = 'Unable to change the network of {}'.format(', '.join(sorted(failed)))
+        else:
+            vmware.update_network(username, machine_name, new_network)
+    except ValueError as doh:
+        logger.error('Task failed: {}'.format(doh))
+        resp['error'] = '{}'.format(doh)
+    logger.info('Task complete')
+    return resp
+
+
+@app.task(name='esrs.power', bind=True)
+def power(self, username, machine_name, action, txn_id):
+    """Power on, off, reboot or shut down ESRS instances
+
+    :Returns: Dictionary
+
+    :param username: The name of the user who owns the ESRS instances
+    :type username: String
+
+    :param machine_name: The name of the ESRS instance, a list of names, or None for all of the user's ESRS
+    :type machine_name: String, List or None
+
+    :param action: One of 'on', 'off', 'reboot' or 'shutdown'
+    :type action: String
+
+    :param txn_id: A unique string supplied by the client to track the call through logs
+    :type txn_id: String
+    """
+    logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_ESRS_LOG_LEVEL.upper())
+    resp = {'content' : {}, 'error': None, 'params': {}}
+    logger.info('Task starting')
+    machine_names = [machine_name] if isinstance(machine_name, str) else machine_name
+    try:
+        results = vmware.power_esrs(username, machine_names, action, logger)
+        resp['content'] = results
+        failed = [x for x in results if results[x]]
+        if failed:
+            resp['error'] = 'Unable to power {} {}'.format(action, ', '.join(sorted(failed)))
+    except ValueError as doh:
+        logger.error('Task failed: {}'.format(doh))
+        resp['error'] = '{}'.format(doh)
+    logger.info('Task complete')
+    return resp
+
+
+@app.task(name='esrs.tune_admission', bind=True)
+def tune_admission(self, txn_id):
+    """Set the caps on concurrent OVA imports from the measured upload throughput
+
+    :Returns: Dictionary
+
+    :param txn_id: A unique string supplied by the client to track the call through logs
+    :type txn_id: String
+    """
+    logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_ESRS_LOG_LEVEL.upper())
+    resp = {'content' : {}, 'error': None, 'params': {}}
+    logger.info('Task starting')
+    resp['content'] = {'caps': admission.tune()}
+    logger.info('Task complete')
+    return resp
+
+
+@app.task(name='esrs.rebalance', bind=True)
+def rebalance(self, new_servers, pin, txn_id):
+    """Plan moving users between vCenter servers before the set of servers changes
+
+    :Returns: Dictionary
+
+    :param new_servers: The vCenter servers that will be used
+    :type new_servers: List
+
+    :param pin: Set to True to pin every moved user to their current vCenter
+    :type pin: Boolean
+
+    :param txn_id: A unique string supplied by the client to track the call through logs
+    :type txn_id: String
+    """
+    logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_ESRS_LOG_LEVEL.upper())
+    resp = {'content' : {}, 'error': None, 'params': {}}
+    logger.info('Task starting')
+    try:
+        resp['content'] = {'moves': vmware.plan_rebalance(new_servers, pin=pin)}
+    except ValueError as doh:
+        logger.error('Task failed: {}'.format(doh))
+        resp['error'] = '{}'.format(doh)
+    logger.info('Task complete')
+    return resp
+
+
+@app.task(name='esrs.reap', bind=True)
+def reap(self, dry_run, txn_id):
+    """Reclaim ESRS instances that are too old, or have been idle too long
+
+    :Returns: Dictionary
+
+    :param dry_run: Set to False to actually power off/delete the ESRS instances
+    :type dry_run: Boolean
+
+    :param txn_id: A unique string supplied by the client to track the call through logs
+    :type txn_id: String
+    """
+    logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_ESRS_LOG_LEVEL.upper())
+    resp = {'content' : {}, 'error': None, 'params': {'dry_run': dry_run}}
+    logger.info('Task starting')
+    try:
+        resp['content'] = vmware.reap_esrs(dry_run=dry_run)
+    except ValueError as doh:
+        logger.error('Task failed: {}'.format(doh))
+        resp['error'] = '{}'.format(doh)
+    else:
+        for username, machines in resp['content'].items():
+            for machine_name, result in machines.items():
+                logger.info('Reaper {} {} of {} ({}): {}'.format('would' if dry_run else 'did', result['action'],
+                                                               machine_name, username, result['reason']))
+    logger.info('Task complete')
+    return resp
+
+
+@app.task(name='esrs.reaper_opt_out', bind=True)
+def reaper_opt_out(self, username, opt_out, txn_id):
+    """Stop (or resume) reclaiming a user's idle ESRS instances
+
+    :Returns: Dictionary
+
+    :param username: The user
+    :type username: String
+
+    :param opt_out: Set to True to never reclaim the user's ESRS instances
+    :type opt_out: Boolean
+
+    :param txn_id: A unique string supplied by the client to track the call through logs
+    :type txn_id: String
+    """
+    logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_ESRS_LOG_LEVEL.upper())
+    resp = {'content' : {}, 'error': None, 'params': {}}
+    logger.info('Task starting')
+    reaper.set_opt_out(username, opt_out)
+    resp['content'] = {'opt_out': opt_out}
+    logger.info('Task complete')
+    return resp
+
+
+@app.task(name='esrs.export', bind=True)
+def export(self, txn_id):
+    """Write every ESRS instance to an NDJSON export named after the task id
+
+    :Returns: Dictionary
+
+    :param txn_id: A unique string supplied by the client to track the call through logs
+    :type txn_id: String
+    """
+    logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_ESRS_LOG_LEVEL.upper())
+    resp = {'content' : {}, 'error': None, 'params': {}}
+    logger.info('Task starting')
+    try:
+        resp['content'] = {'records': vmware.export_esrs(self.request.id)}
+    except ValueError as doh:
+        logger.error('Task failed: {}'.format(doh))
+        resp['error'] = '{}'.format(doh)
+    logger.info('Task complete')
+    return resp
+
+
+@app.task(name='esrs.reconcile_metadata', bind=True)
+def reconcile_metadata(self, txn_id):
+    """Fix any drift between the local metadata index and vCenter
+
+    :Returns: Dictionary
+
+    :param txn_id: A unique string supplied by the client to track the call through logs
+    :type txn_id: String
+    """
     logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_ESRS_LOG_LEVEL.upper())
     resp = {'content' : {}, 'error': None, 'params': {}}
     logger.info('Task starting')
     try:
-        vmware.update_network(username, machine_name, new_network)
+        resp['content'] = vmware.reconcile_metadata()
     except ValueError as doh:
         logger.error('Task failed: {}'.format(doh))
         resp['error'] = '{}'.format(doh)
@@ -1,11 +1,65 @@
 # -*- coding: UTF-8 -*-
 """Business logic for backend worker tasks"""
+import ssl
 import time
+import socket
 import random
 import os.path
-from vlab_inf_common.vmware import vCenter, Ova, vim, virtual_machine, consume_task
+import sqlite3
+import http.client
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from pyVmomi import vmodl
+from vlab_inf_common.vmware import vCenter, vim, virtual_machine, consume_task
 
-from vlab_esrs_api.lib import const
+from vlab_esrs_api.lib import const, exports, metadata, cancel
+from vlab_esrs_api.lib.worker import image_cache, ovf, network_index, shards, listing, reaper, export, breaker, import_spec, power
+from vlab_esrs_api.lib.worker import inventory
+
+# Errors from talking to a vCenter (or its ESXi hosts) that count against its
+# circuit breaker; errors a user causes, like a bad name, don't
+VCENTER_FAILURES = (ConnectionError, TimeoutError, socket.gaierror, ssl.SSLError, http.client.HTTPException,
+                    vmodl.RuntimeFault)
+
+
+@contextmanager
+def connect(server, slot=True):
+    """Open a new session with a vCenter server
+
+    :Returns: vlab_inf_common.vmware.vCenter
+
+    Each session counts as one call to the circuit breaker. The call failed if
+    the login failed, or if the work done with the session raised one of
+    ``VCENTER_FAILURES``; it was slow if the login was slow.
+
+    :Raises: breaker.BreakerOpen if the vCenter has been failing
+
+    :param server: The vCenter to connect to; see ``shards.server_for``
+    :type server: String
+
+    :param slot: Set to False for a long-lived session that shouldn't hold one of the process' task slots
+    :type slot: Boolean
+    """
+    # fail fast, before waiting on a session slot
+    probe = breaker.allow(server)
+    with shards.session_slot(server) if slot else _no_slot():
+        start = time.time()
+        try:
+            session = vCenter(host=server, user=const.INF_VCENTER_USER,
+                              password=const.INF_VCENTER_PASSWORD)
+        except Exception:
+            breaker.record(server, ok=False, seconds=time.time() - start, probe=probe)
+            raise
+        login_seconds = time.time() - start
+        ok = True
+        try:
+            with session as vcenter:
+                yield vcenter
+        except VCENTER_FAILURES:
+            ok = False
+            raise
+        finally:
+            breaker.record(server, ok=ok, seconds=login_seconds, probe=probe)
 
 
 def show_esrs(username):
@@ -17,8 +71,8 @@ def show_esrs(username):
     :type username: String
     """
     esrs_vms = {}
-    with vCenter(host=const.INF_VCENTER_SERVER, user=const.INF_VCENTER_USER, \
-                 password=const.INF_VCENTER_PASSWORD) as vcenter:
+    server = shards.server_for(username)
+    with connect(server) as vcenter:
         folder = vcenter.get_by_name(name=username, vimtype=vim.Folder)
         for vm in folder.childEntity:
             info = virtual_machine.get_info(vcenter, vm, username)
@@ -27,6 +81,34 @@ def show_esrs(username):
     return esrs_vms
 
 
+def page_esrs(username, fields=None, limit=None, cursor=None):
+    """Obtain some information about some of a user's ESRS instances
+
+    :Returns: Tuple - ({name: info}, the cursor for the next page or None)
+
+    :Raises: ValueError for unknown fields, or a malformed cursor
+
+    :param username: The user requesting info about their ESRS instances
+    :type username: String
+
+    :param fields: Comma separated field names, like "name,state,meta.version"; None for every field
+    :type fields: String
+
+    :param limit: The most ESRS instances to return
+    :type limit: Integer
+
+    :param cursor: The cursor returned with the previous page
+    :type cursor: String
+    """
+    wanted = listing.parse_fields(fields) if fields else None
+    server = shards.server_for(username)
+    with connect(server) as vcenter:
+        folder = vcenter.get_by_name(name=username, vimtype=vim.Folder)
+        network_name = lambda network: network_index.name_of(vcenter, network, server=server)
+        return listing.list_esrs(vcenter, folder, username, fields=wanted, limit=limit, cursor=cursor,
+                                 network_name=network_name)
+
+
 def delete_esrs(username, machine_name, logger):
     """Unregister and destroy a user's esrs
 
@@ -41,8 +123,8 @@ def delete_esrs(username, machine_name, logger):
     :param logger: An object for logging messages
     :type logger: logging.LoggerAdapter
     """
-    with vCenter(host=const.INF_VCENTER_SERVER, user=const.INF_VCENTER_USER, \
-                 password=const.INF_VCENTER_PASSWORD) as vcenter:
+    server = shards.server_for(username)
+    with connect(server) as vcenter:
         folder = vcenter.get_by_name(name=username, vimtype=vim.Folder)
         for entity in folder.childEntity:
             if entity.name == machine_name:
@@ -53,12 +135,13 @@ def delete_esrs(username, machine_name, logger):
                     delete_task = entity.Destroy_Task()
                     logger.debug('blocking while VM is being destroyed')
                     consume_task(delete_task)
+                    _update_index('remove', username, machine_name)
                     break
         else:
             raise ValueError('No {} named {} found'.format('ESRS', machine_name))
 
 
-def create_esrs(username, machine_name, image, network, logger):
+def create_esrs(username, machine_name, image, network, logger, on_queued=None, cancelled=None, timings=None):
     """Deploy a new instances of ESRS
 
     :Returns: Dictionary
@@ -77,27 +160,43 @@ def create_esrs(username, machine_name, image, network, logger):
 
     :param logger: An object for logging messages
     :type logger: logging.LoggerAdapter
+
+    :param on_queued: Called with the place in line while waiting for a turn to upload
+    :type on_queued: Callable
+
+    :param cancelled: Returns True if the user cancelled the create
+    :type cancelled: Callable
+
+    :param timings: Filled in with the seconds spent preparing the import spec, and uploading the disks
+    :type timings: Dictionary
     """
-    with vCenter(host=const.INF_VCENTER_SERVER, user=const.INF_VCENTER_USER,
-                 password=const.INF_VCENTER_PASSWORD) as vcenter:
+    cancelled = cancelled or (lambda: False)
+    server = shards.server_for(username)
+    with connect(server) as vcenter:
+        # the API checked a cached copy of the inventory; this is the real check
+        _check_create(vcenter, username, machine_name)
         image_name = convert_name(image)
         logger.info(image_name)
         try:
-            ova = Ova(os.path.join(const.VLAB_ESRS_IMAGES_DIR, image_name))
+            with image_cache.checkout(image_name) as ova_path:
+                network_map = vim.OvfManager.NetworkMapping()
+                network_map.name = import_spec.descriptor(ova_path).networks[0]
+                try:
+                    network_map.network = network_index.lookup(vcenter, network, server=server)
+                except KeyError:
+                    raise ValueError('No such network named {}'.format(network))
+                the_vm = ovf.deploy_from_ova(vcenter, ova_path, [network_map],
+                                             username, machine_name, logger,
+                                             on_queued=on_queued, server=server, cancelled=cancelled,
+                                             timings=timings)
         except FileNotFoundError:
             error = "Invalid version of ESRS supplied: {}".format(image)
             raise ValueError(error)
-        try:
-            network_map = vim.OvfManager.NetworkMapping()
-            network_map.name = ova.networks[0]
-            try:
-                network_map.network = vcenter.networks[network]
-            except KeyError:
-                raise ValueError('No such network named {}'.format(network))
-            the_vm = virtual_machine.deploy_from_ova(vcenter, ova, [network_map],
-                                                     username, machine_name, logger)
-        finally:
-            ova.close()
+        if cancelled():
+            # cancelled just as the upload finished
+            virtual_machine.power(the_vm, state='off')
+            ovf.destroy_partial(the_vm, logger)
+            raise cancel.Cancelled('Cancelled after the upload finished')
         meta_data = {'component' : "ESRS",
                      'created': time.time(),
                      'version': image,
@@ -106,6 +205,13 @@ def create_esrs(username, machine_name, image, network, logger):
                     }
         virtual_machine.set_meta(the_vm, meta_data)
         info = virtual_machine.get_info(vcenter, the_vm, username, ensure_ip=True)
+        _update_index('upsert', {'owner': username,
+                                 'name': the_vm.name,
+                                 'vcenter': server,
+                                 'version': image,
+                                 'created': meta_data['created'],
+                                 'state': info.get('state'),
+                                 'networks': info.get('networks')})
         return {the_vm.name: info}
 
 
@@ -116,6 +222,7 @@ def list_images():
     """
     images = os.listdir(const.VLAB_ESRS_IMAGES_DIR)
     images = [convert_name(x, to_version=True) for x in images]
+    _update_index('replace_catalog', metadata.IMAGE, '', images)
     return images
 
 
@@ -149,8 +256,8 @@ def update_network(username, machine_name, new_network):
     :param new_network: The name of the new network to connect the VM to
     :type new_network: String
     """
-    with vCenter(host=const.INF_VCENTER_SERVER, user=const.INF_VCENTER_USER, \
-                 password=const.INF_VCENTER_PASSWORD) as vcenter:
+    server = shards.server_for(username)
+    with connect(server) as vcenter:
         folder = vcenter.get_by_name(name=username, vimtype=vim.Folder)
         for entity in folder.childEntity:
             if entity.name == machine_name:
@@ -163,9 +270,227 @@ def update_network(username, machine_name, new_network):
             raise ValueError(error)
 
         try:
-            network = vcenter.networks[new_network]
+            network = network_index.lookup(vcenter, new_network, server=server)
         except KeyError:
-            error = 'No VM named {} found'.format(machine_name)
+            error = 'No such network named {}'.format(new_network)
             raise ValueError(error)
         else:
             virtual_machine.change_network(the_vm, network)
+            _update_index('set_networks', username, [machine_name], [_short_network(username, new_network)])
+
+
+def update_networks(username, machine_names, new_network):
+    """Change the network of several VMs at once, using a single vCenter session
+
+    :Returns: Dictionary - machine name -> None on success, or an error message
+
+    :Raises: ValueError if the new network doesn't exist
+
+    :param username: The name of the user who owns the virtual machines
+    :type username: String
+
+    :param machine_names: The names of the virtual machines
+    :type machine_names: List
+
+    :param new_network: The name of the new network to connect the VMs to
+    :type new_network: String
+    """
+    results = {x: 'No VM named {} found'.format(x) for x in machine_names}
+    server = shards.server_for(username)
+    with connect(server) as vcenter:
+        try:
+            network = network_index.lookup(vcenter, new_network, server=server)
+        except KeyError:
+            error = 'No such network named {}'.format(new_network)
+            raise ValueError(error)
+        folder = vcenter.get_by_name(name=username, vimtype=vim.Folder)
+        the_vms = {}
+        for entity in folder.childEntity:
+            if entity.name in results:
+                info = virtual_machine.get_info(vcenter, entity, username)
+                if info['meta']['component'] == 'ESRS':
+                    the_vms[entity.name] = entity
+        with ThreadPoolExecutor(max_workers=const.VLAB_ESRS_PARALLEL_OPS) as executor:
+            futures = {name: executor.submit(virtual_machine.change_network, vm, network) for name, vm in the_vms.items()}
+            for name, future in futures.items():
+                try:
+                    future.result()
+                except Exception as doh:
+                    results[name] = '{}'.format(doh)
+                else:
+                    results[name] = None
+    changed = [x for x in machine_names if results[x] is None]
+    _update_index('set_networks', username, changed, [_short_network(username, new_network)])
+    return results
+
+
+def power_esrs(username, machine_names, action, logger):
+    """Power on, off, reboot or shut down several ESRS instances, using a single vCenter session
+
+    :Returns: Dictionary - machine name -> None on success, or an error message
+
+    :Raises: ValueError for unknown actions
+
+    :param username: The name of the user who owns the ESRS instances
+    :type username: String
+
+    :param machine_names: The names of the ESRS instances, or None for all of the user's ESRS
+    :type machine_names: List
+
+    :param action: One of 'on', 'off', 'reboot' or 'shutdown'
+    :type action: String
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    if action not in power.ACTIONS:
+        raise ValueError('Unknown power action: {}'.format(action))
+    server = shards.server_for(username)
+    with connect(server) as vcenter:
+        folder = vcenter.get_by_name(name=username, vimtype=vim.Folder)
+        found = power.find_esrs(vcenter, folder)
+        if machine_names is None:
+            machine_names = sorted(found)
+        results = {x: 'No ESRS named {} found'.format(x) for x in machine_names}
+        the_vms = {x: found[x] for x in machine_names if x in found}
+        logger.info('Powering {} {} ESRS instances'.format(action, len(the_vms)))
+        results.update(power.power(vcenter, the_vms, action, logger))
+    return results
+
+
+def list_users(server):
+    """Find every user with a folder on a vCenter server
+
+    :Returns: List
+
+    :param server: The vCenter server
+    :type server: String
+    """
+    with connect(server) as vcenter:
+        top = vcenter.get_by_name(name=const.INF_VCENTER_TOP_LVL_DIR, vimtype=vim.Folder)
+        return [x.name for x in top.childEntity if isinstance(x, vim.Folder)]
+
+
+def plan_rebalance(new_servers, pin=False):
+    """Find the users whose vCenter changes when the set of vCenter servers changes
+
+    Moving the VMs themselves is left to the admin; pinning keeps the moved
+    users on their current vCenter until then.
+
+    :Returns: Dictionary - username -> [current vCenter, new vCenter]
+
+    :param new_servers: The vCenter servers that will be used
+    :type new_servers: List
+
+    :param pin: Set to True to pin every moved user to their current vCenter
+    :type pin: Boolean
+    """
+    old_servers = shards.servers()
+    usernames = set()
+    for server in old_servers:
+        usernames.update(list_users(server))
+    moves = shards.plan_rebalance(usernames, old_servers, new_servers, pinned=shards.overrides())
+    if pin and moves:
+        shards.pin({user: old for user, (old, new) in moves.items()})
+    return {user: list(servers) for user, servers in moves.items()}
+
+
+def reap_esrs(dry_run=True):
+    """Power off or delete the ESRS instances that are too old, or idle too long
+
+    :Returns: Dictionary - username -> {machine name: {'reason', 'action', 'error'}}
+
+    :param dry_run: Set to False to actually power off/delete the VMs
+    :type dry_run: Boolean
+    """
+    report = {}
+    for server in shards.servers():
+        with connect(server) as vcenter:
+            candidates = reaper.sweep(vcenter, server)
+            report.update(reaper.reclaim(candidates, const.VLAB_ESRS_REAPER_ACTION, dry_run=dry_run))
+    if not dry_run:
+        for username, machines in report.items():
+            for machine_name, outcome in machines.items():
+                if outcome['action'] == 'delete' and outcome['error'] is None:
+                    _update_index('remove', username, machine_name)
+    return report
+
+
+def export_esrs(export_id):
+    """Write every ESRS instance, on every vCenter, to an NDJSON export
+
+    :Returns: Integer - the number of ESRS instances exported
+
+    :param export_id: Names the export; see ``exports.path_for``
+    :type export_id: String
+    """
+    exports.clean(const.VLAB_ESRS_EXPORT_TTL)
+    with exports.ExportWriter(export_id) as writer:
+        for server in shards.servers():
+            with connect(server) as vcenter:
+                for count, record in enumerate(export.records(vcenter, server), 1):
+                    writer.write(record)
+                    if not count % export.FLUSH_EVERY:
+                        writer.flush()
+            writer.flush()
+    return writer.count
+
+
+def reconcile_metadata():
+    """Replace the local metadata index with what's really in vCenter
+
+    :Returns: Dictionary - vCenter server -> how many ESRS instances were added, updated and removed
+    """
+    index = metadata.get_index()
+    counts = {}
+    try:
+        list_images()
+    except OSError:
+        # the API just skips checking images until the catalog is current again
+        pass
+    for server in shards.servers():
+        with connect(server) as vcenter:
+            records = (x for x in export.records(vcenter, server) if x['owner'] is not None)
+            counts[server] = index.reconcile(server, records)
+    return counts
+
+
+def _check_create(vcenter, username, machine_name):
+    """Make sure a user can create a new ESRS instance
+
+    :Returns: None
+
+    :Raises: ValueError if the name is taken, or the user has too many ESRS instances
+    """
+    folder = vcenter.get_by_name(name=username, vimtype=vim.Folder)
+    esrs_count = 0
+    for _, props in inventory.retrieve(vcenter, vim.VirtualMachine, ['name', 'config.annotation'], container=folder):
+        if props.get('name') == machine_name:
+            raise ValueError('You already have a machine named {}'.format(machine_name))
+        if listing.parse_meta(props.get('config.annotation'))['component'] == 'ESRS':
+            esrs_count += 1
+    if const.VLAB_ESRS_MAX_PER_USER and esrs_count >= const.VLAB_ESRS_MAX_PER_USER:
+        raise ValueError('You may only have {} ESRS instances'.format(const.VLAB_ESRS_MAX_PER_USER))
+
+
+@contextmanager
+def _no_slot():
+    """Stands in for ``shards.session_slot`` when a session doesn't take a slot"""
+    yield
+
+
+def _update_index(method, *args):
+    """Apply a change to the local metadata index
+
+    The index is a cache of what's in vCenter; failing to update it must not
+    fail the task, and the periodic reconcile fixes anything missed.
+    """
+    try:
+        getattr(metadata.get_index(), method)(*args)
+    except (sqlite3.Error, OSError):
+        pass
+
+
+def _short_network(username, network):
+    """Convert a network name to the one the user knows it by, like get_info does"""
+    return network.replace('{}_'.format(username), '', 1)